@@ -9,6 +9,8 @@ from typing import List
 import paho.mqtt.client as mqtt
 
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.threadbudget import ThreadBudget
+from octoeverywhere.boundedexecutor import Executors
 
 from linux_host.config import Config
 from linux_host.networksearch import NetworkSearch
@@ -74,8 +76,7 @@ class BambuClient:
 
         # Start a thread to setup and maintain the connection.
         self.Client:mqtt.Client = None
-        t = threading.Thread(target=self._ClientWorker)
-        t.start()
+        ThreadBudget.StartThread("BambuClient", self._ClientWorker)
 
 
     # Returns the current local State object which is kept in sync with the printer.
@@ -213,8 +214,7 @@ class BambuClient:
                 # Report and disconnect since we are in an unknown state.
                 Sentry.Exception("BambuClient _ForceStateSyncAsync exception.", e)
                 self.Client.disconnect()
-        t = threading.Thread(target=_FullSyncWorker)
-        t.start()
+        Executors.IoMustRun(_FullSyncWorker)
 
 
     # Fired whenever the client is disconnected, we need to clean up the state since it's now unknown.
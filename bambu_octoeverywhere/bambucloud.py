@@ -2,7 +2,6 @@ import json
 import codecs
 import base64
 import logging
-import threading
 from enum import Enum
 
 import requests
@@ -10,6 +9,7 @@ import requests
 from linux_host.config import Config
 
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.boundedexecutor import Executors
 
 
 # The result of a login request.
@@ -197,7 +197,7 @@ class BambuCloud:
 
     # Get's the known device info from the Bambu API and ensures it's synced with our config settings.
     def SyncBambuCloudInfoAsync(self) -> bool:
-        threading.Thread(target=self.SyncBambuCloudInfo, daemon=True).start()
+        Executors.IoMustRun(self.SyncBambuCloudInfo)
 
 
     def SyncBambuCloudInfo(self) -> bool:
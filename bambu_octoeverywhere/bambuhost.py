@@ -9,6 +9,7 @@ from octoeverywhere.hostcommon import HostCommon
 from octoeverywhere.linkhelper import LinkHelper
 from octoeverywhere.compression import Compression
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.boundedexecutor import Executors
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.commandhandler import CommandHandler
@@ -18,6 +19,7 @@ from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.compat import Compat
+from octoeverywhere.startupprofiler import StartupProfiler
 
 from linux_host.config import Config
 from linux_host.secrets import Secrets
@@ -72,6 +74,10 @@ class BambuHost:
             # Find the version of the plugin, this is required and it will throw if it fails.
             pluginVersionStr = Version.GetPluginVersion(repoRoot)
             self.Logger.info("Plugin Version: %s", pluginVersionStr)
+            StartupProfiler.Phase("Host Imports And Logger")
+
+            # Setup the thread budget and the shared executors before anything starts threads.
+            Executors.Init(self.Logger)
 
             # Setup the HttpSession cache early, so it can be used whenever
             HttpSessions.Init(self.Logger)
@@ -85,6 +91,7 @@ class BambuHost:
 
             # Now, detect if this is a new instance and we need to init our global vars. If so, the setup script will be waiting on this.
             self.DoFirstTimeSetupIfNeeded()
+            StartupProfiler.Phase("Sentry And First Time Setup")
 
             # Get our required vars
             printerId = self.GetPrinterId()
@@ -108,6 +115,7 @@ class BambuHost:
 
             # Init the mdns client
             MDns.Init(self.Logger, localStorageDir)
+            StartupProfiler.Phase("Telemetry, Compression, And MDns")
 
             # Init device id
             DeviceId.Init(self.Logger)
@@ -148,6 +156,7 @@ class BambuHost:
 
             # Setup and start the Bambu Client
             BambuClient.Init(self.Logger, self.Config, stateTranslator)
+            StartupProfiler.Phase("Host Services Init")
 
             # Now start the main runner!
             OctoEverywhereWsUri = HostCommon.c_OctoEverywhereOctoClientWsUri
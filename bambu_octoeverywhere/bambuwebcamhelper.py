@@ -12,6 +12,10 @@ from .bambuclient import BambuClient
 # This class implements the webcam platform helper interface for bambu.
 class BambuWebcamHelper():
 
+    # How long we use the streaming url before we rebuild it, in case the access code or ip changed.
+    c_UrlCacheTimeSec = 30.0
+    # How long until we check again, if we built the url before we had the printer state.
+    c_NoStateRetrySec = 2.0
 
     def __init__(self, logger:logging.Logger, config:Config) -> None:
         self.Logger = logger
@@ -75,34 +79,26 @@ class BambuWebcamHelper():
 
 
     # This needs to be thread safe, but we don't use any locks. It's find if multiple threads get the info at the same time.
+    # This never waits for the printer state, since it's called when handling requests. If we don't have the state yet, we use the
+    # websocket stream for now and check again soon.
     def _UpdateUrlsIfNeeded(self) -> None:
         # Test if we need to update or use the cached values.
-        if self.CachedStreamingUrl is not None and len(self.CachedStreamingUrl) > 0 and time.time() - self.LastUrlUpdateTimeSec < 30.0:
+        if self.CachedStreamingUrl is not None and len(self.CachedStreamingUrl) > 0 and time.time() - self.LastUrlUpdateTimeSec < BambuWebcamHelper.c_UrlCacheTimeSec:
             return
 
         # Before we can return the webcam config, we need to know what kind of printer this is.
         # TODO - Right now it seems the X1 doesn't send back version info on start or with the version command,
         # so we use the existence of the RTSP URL to determine what we can do.
         # Ideally we would use the printer version in the future.
+        # When the state object is not None, we know we got the state sync.
+        # Now we can check if there's a RTSP url or not, which will indicate what kind of stream we need to use.
         rtspUrl = None
-        stateGetAttempt = 0
-        while True:
-            stateGetAttempt += 1
-            # Wait until the object exists
-            state = BambuClient.Get().GetState()
-            if state is not None:
-                # When the state object is not None, we know we got the state sync.
-                # Now we can check if there's a RTSP url or not, which will indicate what kind of stream we need to use.
-                rtspUrl = state.rtsp_url
-                break
-
-            # If we didn't get the state after a few attempts, we give up and default to the websocket stream.
-            if stateGetAttempt > 5:
-                self.Logger.warn(f"BambuWebcamHelper wasn't able to get the printer state after {stateGetAttempt} attempts")
-                break
-
-            # Sleep for a bit before trying again.
-            time.sleep(2.0)
+        state = BambuClient.Get().GetState()
+        if state is not None:
+            rtspUrl = state.rtsp_url
+        elif self.CachedStreamingUrl is not None and len(self.CachedStreamingUrl) > 0:
+            # If we lost the state, keep using the url we have until we get it back.
+            return
 
         # Get the access code and ip from the config file, so we always get the latest.
         # The BambuClient class will update the value in the config if the IP address of the printer changes, which can happen while we are running.
@@ -130,4 +126,8 @@ class BambuWebcamHelper():
             self.CachedStreamingUrl = f"ws://bblp:{accessCode}@{ipOrHostname}:6000"
 
         # Set the time we updated the cached values.
+        # If we didn't have the state, set the time so we check again soon, since the url might be wrong.
         self.LastUrlUpdateTimeSec = time.time()
+        if state is None:
+            self.Logger.info("BambuWebcamHelper doesn't have the printer state yet, using the websocket stream for now.")
+            self.LastUrlUpdateTimeSec -= BambuWebcamHelper.c_UrlCacheTimeSec - BambuWebcamHelper.c_NoStateRetrySec
@@ -158,6 +158,9 @@ if __name__ == '__main__':
         elif mode == CompanionMode.Klipper:
             pyPackage = "moonraker_octoeverywhere"
 
+        # Config writes are batched, so make sure everything the bootstrap set is on disk before the plugin process reads it.
+        config.Flush()
+
         # Instead of running the plugin in our process, we decided to launch a different process so it's clean and runs
         # just like the plugin normally runs.
         pythonPath = os.path.join(virtualEnvPath, os.path.join("bin", "python3"))
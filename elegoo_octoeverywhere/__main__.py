@@ -1,3 +1,9 @@
+# The startup profiler must be started before anything else is imported, so it can see how long the imports take.
+# It does nothing unless the OE_STARTUP_PROFILE env var is set.
+from octoeverywhere.startupprofiler import StartupProfiler
+StartupProfiler.Start()
+
+#pylint: disable=wrong-import-position,wrong-import-order
 import sys
 
 from linux_host.startup import Startup
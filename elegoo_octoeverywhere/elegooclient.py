@@ -10,6 +10,7 @@ from octoeverywhere.compat import Compat
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.websocketimpl import Client
 from octoeverywhere.octohttprequest import OctoHttpRequest
+from octoeverywhere.threadbudget import ThreadBudget
 
 from linux_host.config import Config
 from linux_host.networksearch import NetworkSearch
@@ -143,8 +144,7 @@ class ElegooClient:
         OctoHttpRequest.SetLocalHttpProxyPort(80)
 
         # Start the client worker thread.
-        t = threading.Thread(target=self._ClientWorker)
-        t.start()
+        ThreadBudget.StartThread("ElegooClient", self._ClientWorker)
 
 
     # Returns the local printer state object with the most up-to-date information.
@@ -1,9 +1,13 @@
+import os
+import json
+import time
 import logging
 import threading
 
-from typing import List
+from typing import Dict, List
 
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.threadbudget import ThreadBudget
 
 from .elegooclient import ElegooClient
 from .elegoomodels import PrinterState
@@ -27,10 +31,10 @@ class FileInfo:
 
         self.CreateTimeSec:int = fileDirInfo.get("CreateTime", None)
         self.TotalLayers:int = fileDirInfo.get("TotalLayers", None)
+        self.FileSizeBytes:int = fileDirInfo.get("FileSize", None)
         self.FileSizeKb:int = None
-        fileSizeBytes = fileDirInfo.get("FileSize", None)
-        if fileSizeBytes is not None:
-            self.FileSizeKb = int(fileSizeBytes / 1024)
+        if self.FileSizeBytes is not None:
+            self.FileSizeKb = int(self.FileSizeBytes / 1024)
 
         # These are usually 0
         self.LayerHeight:int = fileDirInfo.get("LayerHeight", None)
@@ -54,14 +58,58 @@ class FileInfo:
             self.EstFilamentWeightMg = int(weightG * 1000)
 
 
+    # Returns the key used to tell if a file has changed.
+    # The printer doesn't give us a modified time, but a re-uploaded file gets a new create time, and usually a new size.
+    def GetIndexKey(self) -> str:
+        return FileInfo.BuildIndexKey(self.FileNameWithPath, self.FileSizeBytes, self.CreateTimeSec)
+
+
+    @staticmethod
+    def BuildIndexKey(fileNameWithPath:str, fileSizeBytes:int, createTimeSec:int) -> str:
+        return f"{fileNameWithPath}|{fileSizeBytes}|{createTimeSec}"
+
+
+    # Returns a compact list that can be saved to the index file.
+    def ToIndexEntry(self) -> list:
+        return [self.FileNameWithPath, self.FileSizeBytes, self.CreateTimeSec, self.TotalLayers, self.LayerHeight, self.EstFilamentLength, self.EstPrintTimeSec, self.EstFilamentWeightMg]
+
+
+    # Builds a FileInfo from an index file entry.
+    @staticmethod
+    def FromIndexEntry(logger:logging.Logger, entry:list) -> "FileInfo":
+        f = FileInfo(logger, {
+            "name": entry[0],
+            "FileSize": entry[1],
+            "CreateTime": entry[2],
+            "TotalLayers": entry[3],
+            "LayerHeight": entry[4],
+            "EstFilamentLength": entry[5],
+        })
+        f.EstPrintTimeSec = entry[6]
+        f.EstFilamentWeightMg = entry[7]
+        return f
+
+
 # The file manager and cache class for the Elegoo printer.
+#
+# The file index is keyed by the file name, size, and create time, so a sync only needs to get the extra file info
+# for files that are new or changed. The index is saved to disk, so after a restart we don't need to get it all again.
+#
+# The index is copy-on-write. A sync builds new dicts and swaps them in, so GetFileInfo never waits on a sync.
 class ElegooFileManager:
 
+    # The min time between syncs, unless the sync is forced.
+    c_MinSyncIntervalSec = 60
+
+    # The index file name and version. If the format changes, bump the version and the old file will be ignored.
+    c_IndexFileName = "ElegooFileIndex.json"
+    c_IndexFileVersion = 1
+
     _Instance = None
 
     @staticmethod
-    def Init(logger:logging.Logger):
-        ElegooFileManager._Instance = ElegooFileManager(logger)
+    def Init(logger:logging.Logger, localStorageDir:str = None):
+        ElegooFileManager._Instance = ElegooFileManager(logger, localStorageDir)
 
 
     @staticmethod
@@ -69,21 +117,47 @@ class ElegooFileManager:
         return ElegooFileManager._Instance
 
 
-    def __init__(self, logger:logging.Logger) -> None:
+    def __init__(self, logger:logging.Logger, localStorageDir:str = None) -> None:
         self.Logger = logger
+        self.IndexFilePath = None
+        if localStorageDir is not None:
+            self.IndexFilePath = os.path.join(localStorageDir, ElegooFileManager.c_IndexFileName)
+
+        # These are never modified once they are set, they are only replaced.
+        # FilesByKey is the index key -> FileInfo and FilesByNameLower is the lower case file name -> FileInfo.
+        self.FilesByKey:Dict[str, FileInfo] = {}
+        self.FilesByNameLower:Dict[str, FileInfo] = {}
 
-        self.Files:List[FileInfo] = []
         self.Lock = threading.Lock()
         self.SyncThread:threading.Thread = None
+        self.SyncRequested = False
+        self.SyncForced = False
+        self.SyncEvent = threading.Event()
+        self.LastSyncTimeSec = 0.0
+
+        self._LoadIndexFile()
 
 
     # Kicks off an async sync of the file manager.
-    def Sync(self):
-        # If there's no sync thread, start one now.
+    # Syncs are rate limited, unless force is set, which should be used when we know there's a file we need.
+    # If a sync is already running, another one will run after it.
+    def Sync(self, force:bool = False):
         with self.Lock:
+            self.SyncRequested = True
+            if force:
+                self.SyncForced = True
+            # Wake the sync thread if it's waiting on the rate limit.
+            self.SyncEvent.set()
+            # If there's no sync thread, start one now.
             if self.SyncThread is None:
-                self.SyncThread = threading.Thread(target=self._SyncThread, name="ElegooFileManagerSyncThread")
-                self.SyncThread.start()
+                self.SyncThread = ThreadBudget.StartThread("ElegooFileManagerSync", self._SyncThread, name="ElegooFileManagerSyncThread", daemon=True)
+
+
+    # Called by the state translator when a print starts.
+    # If we don't have the info for the file being printed, we force a sync, otherwise the normal rate limit applies.
+    def OnPrintStarted(self, printerState:PrinterState):
+        fileInfo = self.GetFileInfoFromState(printerState)
+        self.Sync(force=fileInfo is None or fileInfo.HasExtraFileInfo() is False)
 
 
     # Returns the file info for the current print.
@@ -101,100 +175,124 @@ class ElegooFileManager:
             return None
 
         # Try to find it using the lower case search.
-        fileNameLower = fileName.lower()
-        with self.Lock:
-            for f in self.Files:
-                if f.FileNameLower == fileNameLower:
-                    return f
-        return None
+        # No lock is needed, since the dict is never modified once it's set.
+        return self.FilesByNameLower.get(fileName.lower(), None)
 
 
     def _SyncThread(self):
         try:
-            self.Logger.debug("Starting file manager sync.")
-            currentFileCount = 0
-            with self.Lock:
-                currentFileCount = len(self.Files)
-
-            # First, sync the current file list.
-            self._DoFileSystemSync()
-
-            # Now, sync the file details for any file that needs it.
-            self._SyncExtraFileInfo()
-
-            with self.Lock:
-                self.Logger.debug(f"File manager sync complete. {len(self.Files)-currentFileCount} files added.")
+            while True:
+                # Figure out if there's anything to do, and how long we need to wait to respect the rate limit.
+                with self.Lock:
+                    if self.SyncRequested is False:
+                        # When the sync thread is done, set it to None.
+                        self.SyncThread = None
+                        return
+                    waitSec = 0.0
+                    if self.SyncForced is False:
+                        waitSec = self.LastSyncTimeSec + ElegooFileManager.c_MinSyncIntervalSec - time.time()
+                    if waitSec <= 0:
+                        self.SyncRequested = False
+                        self.SyncForced = False
+                    self.SyncEvent.clear()
+                if waitSec > 0:
+                    # Wait for the rate limit, or until a forced sync wakes us up.
+                    self.SyncEvent.wait(waitSec)
+                    continue
+                self._DoSync()
+                self.LastSyncTimeSec = time.time()
         except Exception as e:
             Sentry.Exception("Exception in ElegooFileManager.", e)
-        finally:
-            # When the sync thread is done, set it to None.
             with self.Lock:
                 self.SyncThread = None
+        finally:
             self.Logger.debug("File manager sync thread complete.")
 
 
+    def _DoSync(self):
+        self.Logger.debug("Starting file manager sync.")
+        start = time.time()
+
+        # First, get the current file list and diff it with the index.
+        result = self._DoFileSystemSync()
+        if result is None:
+            return
+        added, removed = result
+
+        # Now, sync the file details for any file that needs it.
+        fetched = self._SyncExtraFileInfo()
+
+        # If anything changed, save the index.
+        if added > 0 or removed > 0 or fetched > 0:
+            self._SaveIndexFile()
+        self.Logger.debug(f"File manager sync complete in {time.time()-start:.2f}s. {added} files added or changed, {removed} removed, {fetched} file infos fetched.")
+
+
+    # Gets the file list and builds the new index from it, reusing any files we already know about.
+    # Returns (added or changed count, removed count), or None on failure.
     def _DoFileSystemSync(self):
         try:
             # This command gets the current file list.
             result = ElegooClient.Get().SendRequest(258, {"Url": "/local"})
             if result is None or result.HasError():
                 self.Logger.error("ElegooFileManager failed to get the file list.")
-                return
+                return None
 
             # Get the data object from the result.
             r = result.GetResult()
             data = r.get("Data", None)
             if data is None:
                 self.Logger.error("ElegooFileManager file list cmd is missing the first data object.")
-                return
+                return None
             data = data.get("Data", None)
             if data is None:
                 self.Logger.error("ElegooFileManager file list cmd is missing the second data object.")
-                return
+                return None
             fileList = data.get("FileList", None)
             if fileList is None:
                 self.Logger.error("ElegooFileManager file list cmd is missing the FileList.")
-                return
-
-            # Build a local file list.
-            files:List[FileInfo] = []
+                return None
+
+            # Build the new index. If the file is in the current index with the same key, it's unchanged and we keep the one we have,
+            # since it has the extra file info. Otherwise it's a new file or it was changed.
+            currentFilesByKey = self.FilesByKey
+            filesByKey:Dict[str, FileInfo] = {}
+            filesByNameLower:Dict[str, FileInfo] = {}
+            added = 0
             for f in fileList:
-                fileInfo = FileInfo(self.Logger, f)
-                files.append(fileInfo)
-
-            # Merge this list with anything we currently have.
-            with self.Lock:
-                # For each new file...
-                for f in files:
-                    found = False
-                    for s in self.Files:
-                        # Match the names
-                        if s.FileNameWithPath == f.FileNameWithPath:
-                            # The file seems to exist, but we want to make sure it wasn't re-uploaded or something.
-                            if s.FileNameWithPath != f.FileNameWithPath :
-                                # Delete the current file and replace it with the new one.
-                                self.Files.remove(s)
-                                self.Files.append(f)
-                            # Set the found flag since we are good.
-                            found = True
-                            break
-                    # If we didn't find the file, add it.
-                    if found is False:
-                        self.Files.append(f)
+                name = f.get("name", None)
+                if name is None:
+                    continue
+                key = FileInfo.BuildIndexKey(name, f.get("FileSize", None), f.get("CreateTime", None))
+                fileInfo = currentFilesByKey.get(key, None)
+                if fileInfo is None:
+                    fileInfo = FileInfo(self.Logger, f)
+                    added += 1
+                filesByKey[key] = fileInfo
+                filesByNameLower[fileInfo.FileNameLower] = fileInfo
+            removed = len(currentFilesByKey) - (len(filesByKey) - added)
+
+            # Swap in the new index.
+            self._SetIndex(filesByKey, filesByNameLower)
+            return (added, removed)
         except Exception as e:
             Sentry.Exception("_DoFileSystemSync", e)
+        return None
 
 
-    def _SyncExtraFileInfo(self):
-        # Under lock, get any files we need to get info for.
-        fileNamsAndPathsToSync = []
-        with self.Lock:
-            for f in self.Files:
-                if f.HasExtraFileInfo() is False:
-                    fileNamsAndPathsToSync.append(f.FileNameWithPath)
+    # Gets the extra file info for any file that doesn't have it.
+    # Returns the number of files updated.
+    def _SyncExtraFileInfo(self) -> int:
+        # Get any files we need to get info for, from the current index.
+        filesToSync:List[FileInfo] = []
+        for f in self.FilesByKey.values():
+            if f.HasExtraFileInfo() is False:
+                filesToSync.append(f)
 
+        updated = 0
         try:
-            for fileNameAndPath in fileNamsAndPathsToSync:
+            for f in filesToSync:
+                fileNameAndPath = f.FileNameWithPath
                 # This command gets the file info just for this file.
                 result = ElegooClient.Get().SendRequest(260, {"Url": fileNameAndPath})
                 if result is None or result.HasError():
@@ -216,11 +314,53 @@ class ElegooFileManager:
                     self.Logger.error(f"Failed to get file info for {fileNameAndPath}")
                     continue
 
-                # Update the file info.
-                with self.Lock:
-                    for f in self.Files:
-                        if f.FileNameWithPath == fileNameAndPath:
-                            f.UpdateExtraFileInfo(fileInfo)
-                            break
+                # Update the file info. The fields only go from None to set, so it's safe to update while readers have it.
+                f.UpdateExtraFileInfo(fileInfo)
+                updated += 1
         except Exception as e:
             Sentry.Exception("Error in _SyncFileInfo", e)
+        return updated
+
+
+    def _SetIndex(self, filesByKey:Dict[str, FileInfo], filesByNameLower:Dict[str, FileInfo]):
+        with self.Lock:
+            self.FilesByKey = filesByKey
+            self.FilesByNameLower = filesByNameLower
+
+
+    def _SaveIndexFile(self):
+        if self.IndexFilePath is None:
+            return
+        try:
+            data = {
+                "Version": ElegooFileManager.c_IndexFileVersion,
+                "Files": [f.ToIndexEntry() for f in self.FilesByKey.values()],
+            }
+            # Write to a temp file and then move it, so we never leave a partial file.
+            tempPath = self.IndexFilePath + ".tmp"
+            with open(tempPath, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tempPath, self.IndexFilePath)
+        except Exception as e:
+            Sentry.Exception("ElegooFileManager failed to save the file index.", e)
+
+
+    def _LoadIndexFile(self):
+        if self.IndexFilePath is None or os.path.exists(self.IndexFilePath) is False:
+            return
+        try:
+            with open(self.IndexFilePath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("Version", None) != ElegooFileManager.c_IndexFileVersion:
+                self.Logger.info("ElegooFileManager file index is an old version, ignoring it.")
+                return
+            filesByKey:Dict[str, FileInfo] = {}
+            filesByNameLower:Dict[str, FileInfo] = {}
+            for entry in data.get("Files", []):
+                fileInfo = FileInfo.FromIndexEntry(self.Logger, entry)
+                filesByKey[fileInfo.GetIndexKey()] = fileInfo
+                filesByNameLower[fileInfo.FileNameLower] = fileInfo
+            self._SetIndex(filesByKey, filesByNameLower)
+            self.Logger.info(f"ElegooFileManager file index loaded with {len(filesByKey)} files.")
+        except Exception as e:
+            self.Logger.error("ElegooFileManager failed to load the file index, it will be rebuilt. "+str(e))
@@ -9,6 +9,7 @@ from octoeverywhere.linkhelper import LinkHelper
 from octoeverywhere.hostcommon import HostCommon
 from octoeverywhere.compression import Compression
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.boundedexecutor import Executors
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.commandhandler import CommandHandler
@@ -17,6 +18,7 @@ from octoeverywhere.octoeverywhereimpl import OctoEverywhere
 from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.compat import Compat
+from octoeverywhere.startupprofiler import StartupProfiler
 
 from linux_host.config import Config
 from linux_host.secrets import Secrets
@@ -75,6 +77,10 @@ class ElegooHost:
             # Find the version of the plugin, this is required and it will throw if it fails.
             pluginVersionStr = Version.GetPluginVersion(repoRoot)
             self.Logger.info("Plugin Version: %s", pluginVersionStr)
+            StartupProfiler.Phase("Host Imports And Logger")
+
+            # Setup the thread budget and the shared executors before anything starts threads.
+            Executors.Init(self.Logger)
 
             # Setup the HttpSession cache early, so it can be used whenever
             HttpSessions.Init(self.Logger)
@@ -88,6 +94,7 @@ class ElegooHost:
 
             # Now, detect if this is a new instance and we need to init our global vars. If so, the setup script will be waiting on this.
             self.DoFirstTimeSetupIfNeeded()
+            StartupProfiler.Phase("Sentry And First Time Setup")
 
             # Get our required vars
             printerId = self.GetPrinterId()
@@ -111,6 +118,7 @@ class ElegooHost:
 
             # Init the mdns client
             MDns.Init(self.Logger, localStorageDir)
+            StartupProfiler.Phase("Telemetry, Compression, And MDns")
 
             # Init device id
             DeviceId.Init(self.Logger)
@@ -144,13 +152,14 @@ class ElegooHost:
             Compat.SetRelayWebsocketProvider(websocketMux)
 
             # Init the file manager
-            ElegooFileManager.Init(self.Logger)
+            ElegooFileManager.Init(self.Logger, localStorageDir)
 
             # Init the slipstream cache
             Slipstream.Init(self.Logger)
 
             # Setup and start the Elegoo Client
             ElegooClient.Init(self.Logger, self.Config, printerId, pluginVersionStr, stateTranslator, websocketMux, ElegooFileManager.Get())
+            StartupProfiler.Phase("Host Services Init")
 
             # Now start the main runner!
             OctoEverywhereWsUri = HostCommon.c_OctoEverywhereOctoClientWsUri
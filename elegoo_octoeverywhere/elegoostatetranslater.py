@@ -67,8 +67,8 @@ class ElegooStateTranslator:
                         # we can always set it here, and then have one check.
                         self.IsWaitingOnPrintInfoToFirePrintStart = True
                         # But this is a good time to fire a file sync, since we should have the file on the system now, and the start
-                        # event will try to pull info from it.
-                        ElegooFileManager.Get().Sync()
+                        # event will try to pull info from it. If we don't have the file yet, this will skip the sync rate limit.
+                        ElegooFileManager.Get().OnPrintStarted(pState)
             # Check for the paused state
             elif pState.IsPaused():
                 # If the error is temporary, like a filament run out, the printer goes into a paused state with the printer_error set.
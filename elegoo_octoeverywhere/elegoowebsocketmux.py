@@ -5,6 +5,8 @@ import octowebsocket
 
 from octoeverywhere.Proto import HttpInitialContext
 from octoeverywhere.Proto.PathTypes import PathTypes
+from octoeverywhere.threadbudget import ThreadBudget
+from octoeverywhere.boundedexecutor import Executors
 
 from .elegooclient import ElegooClient
 
@@ -163,7 +165,7 @@ class ElegooWebsocketClientProxy():
                 self.Mux.ProxyOpened(self)
             except Exception as e:
                 self._fireErrorAndCloseAsync("Exception in OnWsOpen callback.", e)
-        threading.Thread(target=openThread, name="ElegooWebsocketClientProxy-OpenThread").start()
+        Executors.Callback(openThread)
 
 
     # Closes the websocket.
@@ -193,7 +195,7 @@ class ElegooWebsocketClientProxy():
                     self.OnWsClose(self)
             except Exception as e:
                 self.Logger.error(f"ElegooWebsocketClientProxy failed to call OnWsClose. {e}")
-        threading.Thread(target=closeThread, name="ElegooWebsocketClientProxy-CloseThread").start()
+        Executors.Callback(closeThread)
 
 
     def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True):
@@ -282,7 +284,7 @@ class ElegooWebsocketClientProxy():
 
             except Exception as e:
                 self._fireErrorAndCloseAsync("Exception in ReceiveThread.", e)
-        threading.Thread(target=receiveThread, name="ElegooWebsocketClientProxy-ReceiveThread").start()
+        ThreadBudget.StartThread("ElegooWebsocketProxyReceive", receiveThread, name="ElegooWebsocketClientProxy-ReceiveThread")
 
 
     # A helper to handle all errors and make sure we are closed.
@@ -298,7 +300,7 @@ class ElegooWebsocketClientProxy():
 
             # First next close.
             self.Close()
-        threading.Thread(target=errorThread, name="ElegooWebsocketClientProxy-ErrorThread").start()
+        Executors.Callback(errorThread)
 
 
     # Logging helper.
@@ -1,12 +1,16 @@
+import io
 import os
+import atexit
 import threading
 
 import configparser
 
 # This is what we use as our important settings config.
 # This single config class is used for all of the plugin types, but not all of the values are used for each type.
-# It's a bit heavy handed with the lock and aggressive saving, but these
-# settings are important, and not accessed much.
+#
+# Reads come from an immutable snapshot of the config values, which is swapped out on every change, so they don't need the lock.
+# Changes are saved on a short debounce, so a flow that sets many values only writes the file once. The save is atomic, so
+# the installer or the user never see a partial file. Call Flush() to write any pending changes right away.
 class Config:
 
     # This can't change or all past plugins will fail.
@@ -110,6 +114,12 @@ class Config:
         { "Target": MoonrakerApiKey,  "Comment": "Leave blank unless your Moonraker requires an API key to connect. Moonraker API keys can be generated from the Mainsail or Fluidd."},
     ]
 
+    # The comment lines to insert, by the lower case target key, so we can render the comments in one pass.
+    c_ConfigCommentLines = {c["Target"].lower(): "# " + c["Comment"] + "\n" for c in c_ConfigComments}
+
+    # How long we wait after a change before saving, so many changes are written at once.
+    c_SaveDebounceSec = 0.2
+
 
     # The config lib we use doesn't support the % sign, even though it's valid .cfg syntax.
     # Since we save URLs into the config for the webcam, it's valid syntax to use a %20 and such, thus we should support it.
@@ -124,6 +134,13 @@ class Config:
         # A lock to keep file access super safe
         self.ConfigLock = threading.Lock()
         self.Config = None
+        # The current values by section and key, with the % replaces already reversed.
+        # This dict is never changed once it's set, a new one is built on every change.
+        self.Snapshot = {}
+        self.SaveTimer:threading.Timer = None
+        self.HasPendingSave = False
+        # Make sure any pending changes are written before we exit.
+        atexit.register(self.Flush)
         # Load the config on init, to ensure it exists.
         # This will throw if there's an error reading the config.
         self._LoadConfigIfNeeded_UnderLock()
@@ -147,24 +164,29 @@ class Config:
             self._LoadConfigIfNeeded_UnderLock(forceRead=True)
 
 
+    # Writes any pending changes to the file now.
+    def Flush(self) -> None:
+        with self.ConfigLock:
+            if self.SaveTimer is not None:
+                self.SaveTimer.cancel()
+                self.SaveTimer = None
+            if self.HasPendingSave:
+                self._SaveConfig_UnderLock()
+
+
     # Gets a value from the config given the header and key.
     # If the value isn't set, the default value is returned and the default value is saved into the config.
     # If the default value is None, the default will not be written into the config.
     def GetStr(self, section:str, key:str, defaultValue:str, keepInConfigIfNone=False) -> str:
-        with self.ConfigLock:
-            # Ensure we have the config.
-            self._LoadConfigIfNeeded_UnderLock()
-            # Check if the section and key exists
-            if self.Config.has_section(section):
-                if key in self.Config[section].keys():
-                    value = self.Config[section][key]
-                    # If None or empty string written consider it not a valid value so use the default value.
-                    # The default value logic will handle the keepInConfigIfNone case.
-                    # Use lower, to accept user generated errors.
-                    if value.lower() != "none" and len(value) > 0:
-                        # Reverse any possible string replaces we had to add.
-                        value = value.replace(Config.PercentageStringReplaceString, "%")
-                        return value
+        # Check if the section and key exists, the snapshot is never changed so we don't need the lock.
+        sectionValues = self.Snapshot.get(section, None)
+        if sectionValues is not None:
+            value = sectionValues.get(key, None)
+            # If None or empty string written consider it not a valid value so use the default value.
+            # The default value logic will handle the keepInConfigIfNone case.
+            # Use lower, to accept user generated errors.
+            if value is not None and len(value) > 0 and value.lower() != "none":
+                return value
         # The value wasn't set, create it using the default.
         self.SetStr(section, key, defaultValue, keepInConfigIfNone)
         return defaultValue
@@ -309,8 +331,12 @@ class Config:
                     return
             else:
                 # If not none, set the key
+                # If the value didn't change, there's nothing to save.
+                if self.Config[section].get(key, None) == value:
+                    return
                 self.Config[section][key] = value
-            self._SaveConfig_UnderLock()
+            self._UpdateSnapshot_UnderLock()
+            self._ScheduleSave_UnderLock()
 
 
     def _LoadConfigIfNeeded_UnderLock(self, forceRead = False) -> None:
@@ -329,32 +355,66 @@ class Config:
             # If no config exists, create a new file by writing the empty config now.
             #print("Config file doesn't exist. Creating a new file now!")
             self._SaveConfig_UnderLock()
+        self._UpdateSnapshot_UnderLock()
+
+
+    # Builds a new snapshot of the current values and swaps it in.
+    def _UpdateSnapshot_UnderLock(self) -> None:
+        snapshot = {}
+        for section in self.Config.sections():
+            # Use the raw values, since the parser's interpolation doesn't support the % sign anyways.
+            snapshot[section] = {k: v.replace(Config.PercentageStringReplaceString, "%") for k, v in self.Config.items(section, raw=True)}
+        self.Snapshot = snapshot
+
+
+    def _ScheduleSave_UnderLock(self) -> None:
+        self.HasPendingSave = True
+        if self.SaveTimer is not None:
+            return
+        self.SaveTimer = threading.Timer(Config.c_SaveDebounceSec, self._OnSaveTimer)
+        self.SaveTimer.daemon = True
+        self.SaveTimer.start()
+
+
+    def _OnSaveTimer(self) -> None:
+        try:
+            with self.ConfigLock:
+                self.SaveTimer = None
+                if self.HasPendingSave:
+                    self._SaveConfig_UnderLock()
+        except Exception as e:
+            if self.Logger is not None:
+                self.Logger.error("Failed to save the config file. "+str(e))
 
 
     def _SaveConfig_UnderLock(self) -> None:
         if self.Config is None:
             return
-
-        # Write the current settings to the file.
-        # This lets the config lib format everything how it wants.
-        with open(self.OeConfigFilePath, 'w', encoding="utf-8") as f:
-            self.Config.write(f)
-
-        # After writing, read the file and insert any comments we have.
-        finalOutput = ""
-        with open(self.OeConfigFilePath, 'r', encoding="utf-8") as f:
-            # Read all lines
-            lines = f.readlines()
-            for line in lines:
-                lineLower = line.lower()
-                # If anything in the line matches the target, add the comment just before this line.
-                for cObj in Config.c_ConfigComments:
-                    if cObj["Target"] in lineLower:
-                        # Add the comment.
-                        finalOutput += "# " + cObj["Comment"] + os.linesep
-                        break
-                finalOutput += line
-
-        # Finally, write the file back one more time.
-        with open(self.OeConfigFilePath, 'w', encoding="utf-8") as f:
-            f.write(finalOutput)
+        self.HasPendingSave = False
+
+        # Let the config lib format everything how it wants, and then insert any comments we have just before the keys they target.
+        buffer = io.StringIO()
+        self.Config.write(buffer)
+        output = []
+        for line in buffer.getvalue().splitlines(keepends=True):
+            equalsPos = line.find("=")
+            if equalsPos > 0:
+                comment = Config.c_ConfigCommentLines.get(line[:equalsPos].strip().lower(), None)
+                if comment is not None:
+                    output.append(comment)
+            output.append(line)
+
+        # Write to a temp file and then move it, so the file is never partially written.
+        # Keep the mode and owner of the current file, since the installer runs as root but the plugin doesn't.
+        tempPath = self.OeConfigFilePath + ".tmp"
+        with open(tempPath, 'w', encoding="utf-8") as f:
+            f.write("".join(output))
+        if os.path.exists(self.OeConfigFilePath):
+            try:
+                stat = os.stat(self.OeConfigFilePath)
+                os.chmod(tempPath, stat.st_mode & 0o7777)
+                if hasattr(os, "chown"):
+                    os.chown(tempPath, stat.st_uid, stat.st_gid)
+            except Exception:
+                pass
+        os.replace(tempPath, self.OeConfigFilePath)
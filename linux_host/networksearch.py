@@ -12,6 +12,7 @@ from typing import List
 import paho.mqtt.client as mqtt
 
 from octoeverywhere.websocketimpl import Client
+from octoeverywhere.threadbudget import ThreadBudget
 
 # A helper class that's the result of a network search.
 class ElegooNetworkSearchResult:
@@ -472,8 +473,12 @@ class NetworkSearch:
                             # If all of the threads are done, we are done.
                             if doneThreads[0] == totalThreads:
                                 doneEvent.set()
-                t = threading.Thread(target=threadFunc, args=(counter,))
-                t.start()
+                # If the thread budget is used, the scan just runs on fewer threads, since each thread checks IPs until there are none left.
+                if ThreadBudget.StartThread("NetworkSearch", threadFunc, args=(counter,), required=False) is None:
+                    with threadLock:
+                        doneThreads[0] += 1
+                        if doneThreads[0] == totalThreads:
+                            doneEvent.set()
                 counter += 1
             doneEvent.wait()
             return foundIps
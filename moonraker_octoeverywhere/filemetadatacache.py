@@ -1,13 +1,124 @@
+import os
+import json
+import time
 import logging
+import threading
+from collections import OrderedDict
+
+from octoeverywhere.sentry import Sentry
+from octoeverywhere.threadbudget import ThreadBudget
+
+# The metadata we care about for a single file.
+class FileMetadata:
+
+    def __init__(self, fileName:str) -> None:
+        self.FileName = fileName
+        # The moonraker modified time of the file, used to know if the metadata is still valid.
+        self.Modified:float = None
+        # False if the entry was loaded from disk or survived a moonraker reconnect, since we might have missed file changes.
+        self.Verified = True
+        # Set when refreshing an unverified entry failed, so we back off instead of asking again on every get.
+        self.RefreshFailedTimeSec = 0.0
+        self.EstimatedPrintTimeSec:float = -1.0
+        self.EstimatedFilamentUsageMm:int = -1
+        self.FileSizeKBytes:int = -1
+        self.LayerCount:float = -1.0
+        self.FirstLayerHeight:float = -1.0
+        self.LayerHeight:float = -1.0
+        self.ObjectHeight:float = -1.0
+
+
+    # Parses the result of the server.files.metadata call.
+    def ParseMetadataResult(self, res:dict) -> None:
+        # Get the value, if it exists and it's valid.
+        if "modified" in res and res["modified"] is not None:
+            self.Modified = float(res["modified"])
+        if "estimated_time" in res and res["estimated_time"] is not None:
+            value = float(res["estimated_time"])
+            if value > 0.001:
+                self.EstimatedPrintTimeSec = value
+        if "size" in res and res["size"] is not None:
+            value = int(res["size"])
+            if value > 0:
+                self.FileSizeKBytes = int(value / 1024)
+        if "filament_total" in res and res["filament_total"] is not None:
+            value = int(res["filament_total"])
+            if value > 0:
+                self.EstimatedFilamentUsageMm = value
+        if "layer_count" in res and res["layer_count"] is not None:
+            value = float(res["layer_count"])
+            if value > 0:
+                self.LayerCount = value
+        if "first_layer_height" in res and res["first_layer_height"] is not None:
+            value = float(res["first_layer_height"])
+            if value > 0:
+                self.FirstLayerHeight = value
+        if "layer_height" in res and res["layer_height"] is not None:
+            value = float(res["layer_height"])
+            if value > 0:
+                self.LayerHeight = value
+        if "object_height" in res and res["object_height"] is not None:
+            value = float(res["object_height"])
+            if value > 0:
+                self.ObjectHeight = value
+
+
+    def ToCacheEntry(self) -> dict:
+        return {
+            "FileName": self.FileName,
+            "Modified": self.Modified,
+            "EstimatedPrintTimeSec": self.EstimatedPrintTimeSec,
+            "EstimatedFilamentUsageMm": self.EstimatedFilamentUsageMm,
+            "FileSizeKBytes": self.FileSizeKBytes,
+            "LayerCount": self.LayerCount,
+            "FirstLayerHeight": self.FirstLayerHeight,
+            "LayerHeight": self.LayerHeight,
+            "ObjectHeight": self.ObjectHeight,
+        }
+
+
+    @staticmethod
+    def FromCacheEntry(entry:dict) -> "FileMetadata":
+        m = FileMetadata(entry["FileName"])
+        m.Modified = entry.get("Modified", None)
+        m.EstimatedPrintTimeSec = entry.get("EstimatedPrintTimeSec", -1.0)
+        m.EstimatedFilamentUsageMm = entry.get("EstimatedFilamentUsageMm", -1)
+        m.FileSizeKBytes = entry.get("FileSizeKBytes", -1)
+        m.LayerCount = entry.get("LayerCount", -1.0)
+        m.FirstLayerHeight = entry.get("FirstLayerHeight", -1.0)
+        m.LayerHeight = entry.get("LayerHeight", -1.0)
+        m.ObjectHeight = entry.get("ObjectHeight", -1.0)
+        # We can't know if the file changed while we weren't running, so it needs to be checked before a print.
+        m.Verified = False
+        return m
+
 
 # A helper class that caches known file metadata info, so we don't have to pull it often.
+#
+# The cache holds an LRU of files, each with the moonraker modified time of the file when the metadata was read.
+# Entries are invalidated by the notify_filelist_changed notifications, and the cache is persisted so we don't need to
+# ask moonraker again after a restart. Since we can miss file changes while we aren't connected, entries loaded from disk or
+# that survived a reconnect are still used, but they are refreshed in the background, and always re-read when a print starts.
+# If many callers ask for the same file at once, only one RPC is made and the others wait for it.
 class FileMetadataCache:
 
+    # The max number of files we keep in the cache.
+    c_MaxEntries = 50
+
+    # How long a caller will wait for another caller's in flight request for the same file.
+    c_InFlightWaitTimeoutSec = 20.0
+
+    # If refreshing an unverified entry fails, like when the file was deleted, we don't try again in the background for this long.
+    c_RefreshFailedBackoffSec = 300.0
+
+    c_CacheFileName = "FileMetadataCache.json"
+    c_CacheFileVersion = 1
+
     _Instance = None
 
     @staticmethod
-    def Init(logger:logging.Logger, moonrakerClient):
-        FileMetadataCache._Instance = FileMetadataCache(logger, moonrakerClient)
+    def Init(logger:logging.Logger, moonrakerClient, localStorageDir:str = None):
+        FileMetadataCache._Instance = FileMetadataCache(logger, moonrakerClient, localStorageDir)
 
 
     @staticmethod
@@ -15,106 +126,199 @@ class FileMetadataCache:
         return FileMetadataCache._Instance
 
 
-    def __init__(self, logger:logging.Logger, moonrakerClient) -> None:
+    def __init__(self, logger:logging.Logger, moonrakerClient, localStorageDir:str = None) -> None:
         self.Logger = logger
         self.MoonrakerClient = moonrakerClient
-        self.FileName:str = None
-        self.EstimatedPrintTimeSec:float = -1.0
-        self.EstimatedFilamentUsageMm:int = -1
-        self.FileSizeKBytes:int = -1
-        self.LayerCount:float = -1.0
-        self.FirstLayerHeight:float = -1.0
-        self.LayerHeight:float = -1.0
-        self.ObjectHeight:float = -1.0
-        self.ResetCache()
+        self.Lock = threading.Lock()
+        self.Entries:OrderedDict = OrderedDict()
+        # Maps the file names we are currently requesting to an event that's set when the request is done.
+        self.InFlight = {}
+        # Incremented on every invalidation, so an in flight request that started before the invalidation isn't cached.
+        self.Generation = 0
+        self.IsPrefetchRunning = False
+        self.SaveLock = threading.Lock()
+        self.CacheFilePath = None
+        if localStorageDir is not None:
+            self.CacheFilePath = os.path.join(localStorageDir, FileMetadataCache.c_CacheFileName)
+            self._LoadCacheFile()
 
 
     # Clears the cache from all current values.
     def ResetCache(self):
-        self.FileName = None
-        self.EstimatedPrintTimeSec = -1.0
-        self.EstimatedFilamentUsageMm = -1
-        self.FileSizeKBytes = -1
-        self.LayerCount = -1.0
-        self.FirstLayerHeight = -1.0
-        self.LayerHeight = -1.0
-        self.ObjectHeight = -1.0
+        with self.Lock:
+            self.Entries.clear()
+            self.Generation += 1
+        self._SaveCacheFile()
+
+
+    # Called when a new print starts.
+    # If we don't know the file, or the entry might be stale, this will get the metadata now.
+    def OnPrintStart(self, filename:str):
+        with self.Lock:
+            entry = self.Entries.get(filename, None)
+            if entry is not None and entry.Verified:
+                return
+        self._GetMetadata(filename, forceRefresh=True)
+
+
+    # Called when the moonraker websocket is connected, since we might have missed file changes while it wasn't.
+    def OnMoonrakerConnected(self):
+        with self.Lock:
+            for entry in self.Entries.values():
+                entry.Verified = False
+
+
+    # Called with the params of the notify_filelist_changed notification.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#file-list-changed
+    def OnFileListChanged(self, params:dict):
+        try:
+            action = params.get("action", None)
+            if action is None:
+                return
+            # Only gcode files have metadata.
+            item = params.get("item", {})
+            sourceItem = params.get("source_item", None)
+            if action == "root_update":
+                self.ResetCache()
+                return
+            if item.get("root", "gcodes") != "gcodes" and (sourceItem is None or sourceItem.get("root", "gcodes") != "gcodes"):
+                return
+            paths = []
+            if "path" in item:
+                paths.append(item["path"])
+            if sourceItem is not None and "path" in sourceItem:
+                paths.append(sourceItem["path"])
+            if len(paths) == 0:
+                return
+            isDir = action.endswith("_dir")
+            changed = False
+            with self.Lock:
+                self.Generation += 1
+                for path in paths:
+                    if isDir:
+                        # Remove everything under the dir.
+                        prefix = path.rstrip("/") + "/"
+                        for name in [n for n in self.Entries if n.startswith(prefix)]:
+                            del self.Entries[name]
+                            changed = True
+                    else:
+                        # If the modified time matches what we have, the file didn't change.
+                        entry = self.Entries.get(path, None)
+                        if entry is None:
+                            continue
+                        if action == "modify_file" or action == "create_file":
+                            if entry.Modified is not None and item.get("modified", None) == entry.Modified:
+                                entry.Verified = True
+                                continue
+                        del self.Entries[path]
+                        changed = True
+            if changed:
+                self._SaveCacheFile()
+        except Exception as e:
+            Sentry.Exception("FileMetadataCache failed to handle a file list change.", e)
+
+
+    # Gets the metadata of the next job in the job queue in the background, so it's ready when that print starts.
+    # This also refreshes any stale entries we have.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#retrieve-the-job-queue-status
+    def Prefetch(self):
+        with self.Lock:
+            if self.IsPrefetchRunning:
+                return
+            self.IsPrefetchRunning = True
+        if ThreadBudget.StartThread("FileMetadataPrefetch", self._PrefetchThread, daemon=True, required=False) is None:
+            with self.Lock:
+                self.IsPrefetchRunning = False
 
 
     # If the estimated time for the print can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1.0
     def GetEstimatedPrintTimeSec(self, filename:str) -> float:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedPrintTimeSec
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedPrintTimeSec
+        return self._GetMetadata(filename).EstimatedPrintTimeSec
 
 
     # If the filament usage can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetEstimatedFilamentUsageMm(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedFilamentUsageMm
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedFilamentUsageMm
+        return self._GetMetadata(filename).EstimatedFilamentUsageMm
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetFileSizeKBytes(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.FileSizeKBytes
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.FileSizeKBytes
+        return self._GetMetadata(filename).FileSizeKBytes
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # Any of the values will return -1 if they are unknown.
     def GetLayerInfo(self, filename:str):
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-
-    # Does a refresh of the file name metadata cache.
-    def _RefreshFileMetaDataCache(self, filename:str) -> None:
-
-        # Reset everything.
-        self.ResetCache()
-
+        m = self._GetMetadata(filename)
+        return (m.LayerCount, m.LayerHeight, m.FirstLayerHeight, m.ObjectHeight)
+
+
+    # Returns the metadata for the file. This never returns None, if the metadata can't be found all of the values will be -1.
+    def _GetMetadata(self, filename:str, forceRefresh:bool = False) -> FileMetadata:
+        isOwner = False
+        isStale = False
+        generation = 0
+        event:threading.Event = None
+        with self.Lock:
+            entry = self.Entries.get(filename, None)
+            if entry is not None and forceRefresh is False:
+                self.Entries.move_to_end(filename)
+                isStale = entry.Verified is False and self._CanRetryRefresh(entry)
+            else:
+                # If someone else is getting this file, we will wait for them.
+                event = self.InFlight.get(filename, None)
+                if event is None:
+                    event = threading.Event()
+                    self.InFlight[filename] = event
+                    isOwner = True
+                generation = self.Generation
+
+        if entry is not None and forceRefresh is False:
+            # If the entry might be stale, use it for now, but refresh it in the background.
+            if isStale:
+                self.Prefetch()
+            return entry
+
+        if isOwner is False:
+            event.wait(FileMetadataCache.c_InFlightWaitTimeoutSec)
+            with self.Lock:
+                entry = self.Entries.get(filename, None)
+            if entry is None:
+                return FileMetadata(filename)
+            return entry
+
+        try:
+            entry = self._RefreshFileMetaData(filename)
+            if entry is None:
+                # The call failed, don't cache anything so we try again next time.
+                # If we had an entry that might be stale, it's still better than nothing, but remember it failed so we back off.
+                with self.Lock:
+                    entry = self.Entries.get(filename, None)
+                    if entry is not None:
+                        entry.RefreshFailedTimeSec = time.time()
+                if entry is None:
+                    return FileMetadata(filename)
+                return entry
+            with self.Lock:
+                # If the file was changed while we were getting the metadata, don't cache it.
+                if generation == self.Generation:
+                    self.Entries[filename] = entry
+                    self.Entries.move_to_end(filename)
+                    while len(self.Entries) > FileMetadataCache.c_MaxEntries:
+                        self.Entries.popitem(last=False)
+            self._SaveCacheFile()
+            return entry
+        finally:
+            with self.Lock:
+                self.InFlight.pop(filename, None)
+            event.set()
+
+
+    # Does the metadata RPC for the file, returns None on failure.
+    def _RefreshFileMetaData(self, filename:str) -> FileMetadata:
         # Make the call.
         result = self.MoonrakerClient.SendJsonRpcRequest("server.files.metadata",
         {
@@ -123,42 +327,89 @@ class FileMetadataCache:
 
         # If we fail this call, just return, which will keep the cache invalid.
         if result.HasError():
-            self.Logger.error("_RefreshFileMetaDataCache failed to get file meta. "+result.GetLoggingErrorStr())
-            return
+            self.Logger.error("_RefreshFileMetaData failed to get file meta. "+result.GetLoggingErrorStr())
+            return None
 
         # If we got here, we know we got a good result.
-        # Set the cached vars so we don't call again, even though we might not be able to get them, meaning the file doesn't have them.
-        self.FileName = filename
-
-        # Get the value, if it exists and it's valid.
-        res = result.GetResult()
-        if "estimated_time" in res:
-            value = float(res["estimated_time"])
-            if value > 0.001:
-                self.EstimatedPrintTimeSec = value
-        if "size" in res:
-            value = int(res["size"])
-            if value > 0:
-                self.FileSizeKBytes = int(value / 1024)
-        if "filament_total" in res:
-            value = int(res["filament_total"])
-            if value > 0:
-                self.EstimatedFilamentUsageMm = value
-        if "layer_count" in res and res["layer_count"] is not None:
-            value = float(res["layer_count"])
-            if value > 0:
-                self.LayerCount = value
-        if "first_layer_height" in res and res["first_layer_height"] is not None:
-            value = float(res["first_layer_height"])
-            if value > 0:
-                self.FirstLayerHeight = value
-        if "layer_height" in res and res["layer_height"] is not None:
-            value = float(res["layer_height"])
-            if value > 0:
-                self.LayerHeight = value
-        if "object_height" in res and res["object_height"] is not None:
-            value = float(res["object_height"])
-            if value > 0:
-                self.ObjectHeight = value
-
-        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(self.EstimatedPrintTimeSec)}, size: {str(self.FileSizeKBytes)}, filament usage: {str(self.EstimatedFilamentUsageMm)}")
+        # We cache the result even if it doesn't have the values we want, meaning the file doesn't have them.
+        entry = FileMetadata(filename)
+        entry.ParseMetadataResult(result.GetResult())
+        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(entry.EstimatedPrintTimeSec)}, size: {str(entry.FileSizeKBytes)}, filament usage: {str(entry.EstimatedFilamentUsageMm)}")
+        return entry
+
+
+    def _PrefetchThread(self):
+        try:
+            # Refresh anything that might be stale.
+            with self.Lock:
+                staleFiles = [e.FileName for e in self.Entries.values() if e.Verified is False and self._CanRetryRefresh(e)]
+            for filename in staleFiles:
+                self._GetMetadata(filename, forceRefresh=True)
+
+            # Get the next job in the queue, if there is one.
+            result = self.MoonrakerClient.SendJsonRpcRequest("server.job_queue.status")
+            if result.HasError():
+                # The job queue is optional, so this will fail if it's not setup.
+                self.Logger.debug("FileMetadataCache failed to get the job queue. "+result.GetLoggingErrorStr())
+                return
+            queuedJobs = result.GetResult().get("queued_jobs", [])
+            if len(queuedJobs) == 0:
+                return
+            filename = queuedJobs[0].get("filename", None)
+            if filename is None:
+                return
+            with self.Lock:
+                if filename in self.Entries:
+                    return
+            start = time.time()
+            self._GetMetadata(filename)
+            self.Logger.debug(f"FileMetadataCache prefetched the next queued job [{filename}] in {time.time()-start:.3f}s")
+        except Exception as e:
+            Sentry.Exception("FileMetadataCache prefetch failed.", e)
+        finally:
+            with self.Lock:
+                self.IsPrefetchRunning = False
+
+
+    # Returns True if the entry's last refresh didn't fail recently.
+    def _CanRetryRefresh(self, entry:FileMetadata) -> bool:
+        return time.time() - entry.RefreshFailedTimeSec > FileMetadataCache.c_RefreshFailedBackoffSec
+
+
+    def _SaveCacheFile(self):
+        if self.CacheFilePath is None:
+            return
+        try:
+            with self.Lock:
+                data = {
+                    "Version": FileMetadataCache.c_CacheFileVersion,
+                    "Files": [e.ToCacheEntry() for e in self.Entries.values()],
+                }
+            # Write to a temp file and then move it, so we never leave a partial file.
+            with self.SaveLock:
+                tempPath = self.CacheFilePath + ".tmp"
+                with open(tempPath, "w", encoding="utf-8") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tempPath, self.CacheFilePath)
+        except Exception as e:
+            Sentry.Exception("FileMetadataCache failed to save the cache file.", e)
+
+
+    def _LoadCacheFile(self):
+        if self.CacheFilePath is None or os.path.exists(self.CacheFilePath) is False:
+            return
+        try:
+            with open(self.CacheFilePath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("Version", None) != FileMetadataCache.c_CacheFileVersion:
+                self.Logger.info("FileMetadataCache cache file is an old version, ignoring it.")
+                return
+            with self.Lock:
+                for entry in data.get("Files", []):
+                    m = FileMetadata.FromCacheEntry(entry)
+                    self.Entries[m.FileName] = m
+                while len(self.Entries) > FileMetadataCache.c_MaxEntries:
+                    self.Entries.popitem(last=False)
+            self.Logger.info(f"FileMetadataCache loaded {len(self.Entries)} files from the cache file.")
+        except Exception as e:
+            self.Logger.error("FileMetadataCache failed to load the cache file. "+str(e))
@@ -1,5 +1,6 @@
 from octoeverywhere.compat import Compat
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.pathrouter import PathRouter, PathRoute, RouteHandlerId
 
 from .moonrakerclient import MoonrakerClient
 
@@ -28,13 +29,30 @@ class MoonrakerApiRouter:
 
     def __init__(self, logger):
         self.Logger = logger
-        self.MoonrakerPortStr = None
+        self.MoonrakerHostAndPortStr = None
+        self.Router = None
 
         # Get the moonraker port from the config.
         (ipOrHostnameStr, portInt) = MoonrakerClient.Get().GetMoonrakerHostAndPortFromConfig()
         if ipOrHostnameStr is None or portInt is None:
             return
         self.MoonrakerHostAndPortStr = f"{ipOrHostnameStr}:{str(portInt)}"
+
+        # Basically we need to map all of moonraker's APIs,
+        # which can be found in the moonraker APIs docs or by looking at the nginx configs
+        #    cat /etc/nginx/sites-available/mainsail
+        #    cat /etc/nginx/sites-available/fluidd
+        #
+        # Remember that there can be whatever suffixes or ? arguments on the URLs, so these are prefix matches.
+        self.Router = PathRouter([
+            PathRoute("/websocket", RouteHandlerId.Websocket, self.MoonrakerHostAndPortStr),
+            PathRoute("/printer/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+            PathRoute("/api/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+            PathRoute("/access/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+            PathRoute("/machine/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+            PathRoute("/server/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+            PathRoute("/debug/", RouteHandlerId.MoonrakerApi, self.MoonrakerHostAndPortStr),
+        ])
         self.Logger.info("MoonrakerApiRouter using bound to moonraker at "+self.MoonrakerHostAndPortStr)
 
 
@@ -48,18 +66,12 @@ class MoonrakerApiRouter:
     # Note this will be used by both websockets and http calls.
     def MapRelativePathToAbsolutePathIfNeeded(self, relativeUrl, protocol):
         # If we have no port, do nothing.
-        if self.MoonrakerHostAndPortStr is None:
+        if self.Router is None:
             return None
         try:
-            # Basically we need to map all of moonraker's APIs,
-            # which can be found in the moonraker APIs docs or by looking at the nginx configs
-            #    cat /etc/nginx/sites-available/mainsail
-            #    cat /etc/nginx/sites-available/fluidd
-            #
-            # Remember that there can be whatever suffixes or ? arguments on the URLs
-            relativeUrlLower = relativeUrl.lower()
-            if relativeUrlLower.startswith("/websocket") or relativeUrlLower.startswith("/printer/") or relativeUrlLower.startswith("/api/") or relativeUrlLower.startswith("/access/") or relativeUrlLower.startswith("/machine/") or relativeUrlLower.startswith("/server/") or relativeUrlLower.startswith("/debug/"):
-                return protocol + self.MoonrakerHostAndPortStr + relativeUrl
+            route = self.Router.Match(relativeUrl)
+            if route is not None:
+                return route.BuildAbsoluteUrl(protocol, relativeUrl)
         except Exception as e:
             Sentry.Exception("MoonrakerApiRouter exception while handling MapRelativePathToAbsolutePathIfNeeded.", e)
         return None
@@ -15,6 +15,7 @@ from octoeverywhere.websocketimpl import Client
 from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.exceptions import NoSentryReportException
 from octoeverywhere.debugprofiler import DebugProfiler, DebugProfilerFeatures
+from octoeverywhere.threadbudget import ThreadBudget
 
 from linux_host.config import Config
 
@@ -106,8 +107,7 @@ class MoonrakerClient:
         # Setup the non response message thread
         # See _NonResponseMsgQueueWorker to why this is needed.
         self.NonResponseMsgQueue = queue.Queue(20000)
-        self.NonResponseMsgThread = threading.Thread(target=self._NonResponseMsgQueueWorker)
-        self.NonResponseMsgThread.start()
+        self.NonResponseMsgThread = ThreadBudget.StartThread("MoonrakerNonResponseMsg", self._NonResponseMsgQueueWorker)
 
         # Some instances use auth and we need an API key to access them. If this is not set to None, it's the API key.
         # This is found and set when we try to connect and we fail due to an unauthed socket.
@@ -121,9 +121,8 @@ class MoonrakerClient:
         self.WebSocketKlippyReady = False
         self.WebSocketLock = threading.Lock()
         self.WebSocketDebugProfiler:DebugProfiler = None # Must be created on the thread.
-        self.WsThread = threading.Thread(target=self._WebSocketWorkerThread)
+        self.WsThread = None
         self.WsThreadRunning = False
-        self.WsThread.daemon = True
 
 
     def GetNotificationHandler(self) -> NotificationsHandler:
@@ -149,7 +148,7 @@ class MoonrakerClient:
         if self.WsThreadRunning is False:
             self.WsThreadRunning = True
             self.Logger.info("Starting Moonraker connection client.")
-            self.WsThread.start()
+            self.WsThread = ThreadBudget.StartThread("MoonrakerWs", self._WebSocketWorkerThread, daemon=True)
 
 
     # Checks to moonraker config for the host and port. We use the moonraker config so we don't duplicate the
@@ -386,6 +385,9 @@ class MoonrakerClient:
             self._RestartWebsocket()
             return
 
+        # We might have missed file changes while we weren't connected, so let the file cache know.
+        FileMetadataCache.Get().OnMoonrakerConnected()
+
         # Call the event handler
         self.MoonrakerCompat.OnMoonrakerClientConnected()
 
@@ -405,8 +407,17 @@ class MoonrakerClient:
         # These objects can come in all shapes and sizes. So we only look for exactly what we need, if we don't find it
         # We ignore the object, someone else might match it.
 
+        # Used to keep the file metadata cache up to date.
+        if method == "notify_filelist_changed":
+            actionContainerObj = self._GetWsMsgParam(msg, "action")
+            if actionContainerObj is not None:
+                FileMetadataCache.Get().OnFileListChanged(actionContainerObj)
+            return
+
         # Used to watch for print starts, ends, and failures.
         if method == "notify_history_changed":
+            # Any history change means the job queue might move, so get the next job's metadata ready.
+            FileMetadataCache.Get().Prefetch()
             actionContainerObj = self._GetWsMsgParam(msg, "action")
             if actionContainerObj is not None:
                 action = actionContainerObj["action"]
@@ -665,8 +676,7 @@ class MoonrakerClient:
 
         # According to the docs, there's a startup sequence we need to before sending requests.
         # We use a new thread to do the startup sequence, since we can't block this or we won't get messages.
-        t = threading.Thread(target=self._AfterOpenReadyWaiter, args=(ws,))
-        t.start()
+        ThreadBudget.StartThread("MoonrakerAfterOpenReadyWaiter", self._AfterOpenReadyWaiter, args=(ws,))
 
 
     def _onWsMsg(self, ws, msgBytes: bytes):
@@ -878,9 +888,8 @@ class MoonrakerCompat:
                 self.NotificationHandler.OnError("Klipper Disconnected")
 
         # Push the work off to a thread so we don't hang OctoPrint's plugin callbacks.
-        thread = threading.Thread(target=disconnectWaiter)
-        thread.isDaemon = True
-        thread.start()
+        # This uses its own thread, since it would hold an io worker for the whole delay.
+        ThreadBudget.StartThread("KlipperDisconnectWaiter", disconnectWaiter, daemon=True)
 
 
     # Called when a new print is starting.
@@ -889,9 +898,9 @@ class MoonrakerCompat:
         if self.IsReadyToProcessNotifications is False:
             return
 
-        # Since this is a new print, reset the cache. The file name might be the same as the last, but have
-        # different props, so we will always reset. We know when we are printing the same file name will have the same props.
-        FileMetadataCache.Get().ResetCache()
+        # Let the cache know a print is starting. If the file might have changed since we cached it, this will get the metadata again.
+        # The cache is invalidated by the file list changed notifications, so if the file is known and unchanged, there's no RPC.
+        FileMetadataCache.Get().OnPrintStart(fileName)
 
         # Try to get the starting file info if we can.
         filamentUsageMm = FileMetadataCache.Get().GetEstimatedFilamentUsageMm(fileName)
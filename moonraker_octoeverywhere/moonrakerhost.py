@@ -10,6 +10,7 @@ from octoeverywhere.linkhelper import LinkHelper
 from octoeverywhere.compression import Compression
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.boundedexecutor import Executors
 from octoeverywhere.Webcam.webcamhelper import WebcamHelper
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.commandhandler import CommandHandler
@@ -18,6 +19,7 @@ from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.localip import LocalIpHelper
 from octoeverywhere.compat import Compat
+from octoeverywhere.startupprofiler import StartupProfiler
 
 from linux_host.config import Config
 from linux_host.secrets import Secrets
@@ -88,6 +90,10 @@ class MoonrakerHost:
             # Find the version of the plugin, this is required and it will throw if it fails.
             pluginVersionStr = Version.GetPluginVersion(repoRoot)
             self.Logger.info("Plugin Version: %s", pluginVersionStr)
+            StartupProfiler.Phase("Host Imports And Logger")
+
+            # Setup the thread budget and the shared executors before anything starts threads.
+            Executors.Init(self.Logger)
 
             # Setup the HttpSession cache early, so it can be used whenever
             HttpSessions.Init(self.Logger)
@@ -109,6 +115,7 @@ class MoonrakerHost:
 
             # Now, detect if this is a new instance and we need to init our global vars. If so, the setup script will be waiting on this.
             self.DoFirstTimeSetupIfNeeded(klipperConfigDir, serviceName)
+            StartupProfiler.Phase("Sentry And First Time Setup")
 
             # Get our required vars
             printerId = self.GetPrinterId()
@@ -132,6 +139,7 @@ class MoonrakerHost:
 
             # Init the mdns client
             MDns.Init(self.Logger, localStorageDir)
+            StartupProfiler.Phase("Telemetry, Compression, And MDns")
 
             # Init device id
             DeviceId.Init(self.Logger)
@@ -186,7 +194,7 @@ class MoonrakerHost:
             MoonrakerClient.Init(self.Logger, self.Config, moonrakerConfigFilePath, printerId, self, pluginVersionStr)
 
             # Init our file meta data cache helper
-            FileMetadataCache.Init(self.Logger, MoonrakerClient.Get())
+            FileMetadataCache.Init(self.Logger, MoonrakerClient.Get(), localStorageDir)
 
             # Setup the command handler
             CommandHandler.Init(self.Logger, MoonrakerClient.Get().GetNotificationHandler(), MoonrakerCommandHandler(self.Logger), self)
@@ -201,6 +209,7 @@ class MoonrakerHost:
 
             # Setup the moonraker API router
             MoonrakerApiRouter.Init(self.Logger)
+            StartupProfiler.Phase("Host Services Init")
 
             # Now start the main runner!
             OctoEverywhereWsUri = HostCommon.c_OctoEverywhereOctoClientWsUri
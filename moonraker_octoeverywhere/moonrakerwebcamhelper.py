@@ -8,6 +8,7 @@ import requests
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.debugprofiler import DebugProfiler, DebugProfilerFeatures
 from octoeverywhere.Webcam.webcamhelper import WebcamSettingItem, WebcamHelper
+from octoeverywhere.threadbudget import ThreadBudget
 
 from linux_host.config import Config
 
@@ -77,9 +78,7 @@ class MoonrakerWebcamHelper():
         self.Rotation:int = MoonrakerWebcamHelper.c_DefaultRotation
         self._ReadManuallySetValues()
 
-        t = threading.Thread(target=self._WebcamSettingsUpdateWorker)
-        t.daemon = True
-        t.start()
+        ThreadBudget.StartThread("MoonrakerWebcamSettings", self._WebcamSettingsUpdateWorker, daemon=True)
 
 
     # !! Interface Function !!
@@ -1,6 +1,6 @@
 import os
+import time
 import logging
-import threading
 import hashlib
 import random
 import string
@@ -10,15 +10,33 @@ from octoeverywhere.ostypeidentifier import OsTypeIdentifier
 from octoeverywhere.debugprofiler import DebugProfiler, DebugProfilerFeatures
 
 from octoeverywhere.Proto import OsType
+from octoeverywhere.threadbudget import ThreadBudget
+from octoeverywhere.filewatcher import FileWatcher
 
 # A class to handle getting our UI into common front ends.
 class UiInjector():
 
-    # This is how often we will check the state of things.
-    # Since our checks are light weight, there's no harm in doing this somewhat frequently.
-    # We don't have any other way of detecting file changes right now, so this is our only way.
+    # If inotify isn't available, this is how often we will check the state of things.
+    # Since the checks only stat the files unless something changed, there's no harm in doing this somewhat frequently.
     c_UpdateCheckIntervalSec = 60
 
+    # With inotify, we only check when the files we care about change. But we still check every so often,
+    # in case we missed something, like a change to a frontend dir that didn't exist when the watches were set.
+    c_EventDrivenCheckIntervalSec = 30 * 60
+
+    # When something changes, we wait until there have been no changes for this long before checking, so a frontend update
+    # that writes a lot of files only causes one check, after it's done. But we never wait longer than the max.
+    c_ChangeDebounceSec = 2.0
+    c_ChangeMaxDebounceSec = 30.0
+
+    # The list of possible front ends we expect to find.
+    # fluidd-pad if found on the sonic pad.
+    # On the k1, the default creality frontend is called "frontend" in the /usr/share/ dir (it's a fork of fluidd)
+    c_PossibleFrontEndDirs = ["mainsail", "fluidd", "fluidd-pad", "frontend"]
+
+    # The files in a frontend root we care about, and the dir our static files are copied into.
+    c_FrontEndWatchedNames = ["index.html", "sw.js", "oe"]
+
     _Instance = None
     _Debug = False
 
@@ -39,9 +57,16 @@ class UiInjector():
         self.StaticUiJsFilePath = None
         self.StaticUiCssFilePath = None
         self.StaticFileHash = None
-        self.WorkerEvent = threading.Event()
-        self.WorkerThread = threading.Thread(target=self._Worker)
-        self.WorkerThread.start()
+        # The (size, mtime) of the static files when they were hashed, so we only hash them again if they change.
+        self.StaticFileFingerprint = None
+        # html root -> the (index size, index mtime, static file hash) when we last found the injection was up to date.
+        # If nothing has changed since then, we don't need to read the index again.
+        self.FrontEndFingerprints = {}
+        # The dirs we found on the last check, which are the dirs we watch.
+        self.SearchRootDirs = []
+        self.FrontEndRootDirs = []
+        self.FileWatcher = FileWatcher(logger, "UiInjector")
+        self.WorkerThread = ThreadBudget.StartThread("UiInjector", self._Worker)
 
 
     def _Worker(self):
@@ -54,11 +79,32 @@ class UiInjector():
                     # This function has it's own try except, so it won't throw out.
                     self._ExecuteOnce()
 
-                # Now wait on our event handle.
-                self.WorkerEvent.wait(UiInjector.c_UpdateCheckIntervalSec)
+                # Watch the dirs we found, and wait for something to change.
+                # If we can't watch for changes, this waits the poll interval.
+                self.FileWatcher.SetWatches(self._GetWatches())
+                timeoutSec = UiInjector.c_EventDrivenCheckIntervalSec if self.FileWatcher.IsEventDriven() else UiInjector.c_UpdateCheckIntervalSec
+                if self.FileWatcher.WaitForChanges(timeoutSec, UiInjector.c_ChangeDebounceSec, UiInjector.c_ChangeMaxDebounceSec):
+                    self.Logger.debug("UiInjector detected a change to the frontend or static files.")
 
             except Exception as e:
                 Sentry.Exception("UiInjector worker exception.", e)
+                # Don't spin if the watcher is what's failing.
+                time.sleep(UiInjector.c_UpdateCheckIntervalSec)
+
+
+    # Returns the dirs to watch, as a dict of dir path -> the names in the dir we care about.
+    def _GetWatches(self) -> dict:
+        watches = {}
+        # The search roots, to find frontends that are installed, removed, or replaced.
+        for d in self.SearchRootDirs:
+            watches[d] = UiInjector.c_PossibleFrontEndDirs
+        # The frontend roots, for updates to the index and service worker, or our files being removed.
+        for d in self.FrontEndRootDirs:
+            watches[d] = UiInjector.c_FrontEndWatchedNames
+        # Our static files.
+        if self.StaticUiJsFilePath is not None:
+            watches[os.path.dirname(self.StaticUiJsFilePath)] = [os.path.basename(self.StaticUiJsFilePath), os.path.basename(self.StaticUiCssFilePath)]
+        return watches
 
 
     # Does the work.
@@ -80,28 +126,51 @@ class UiInjector():
                 # On the K1, the 3rd party script install fluidd and/or mainsail to /usr/data.
                 searchRootDirs.append("/usr/data/")
 
-            # The list of possible front ends we expect to find.
-            # fluidd-pad if found on the sonic pad.
-            # On the k1, the default creality frontend is called "frontend" in the /usr/share/ dir (it's a fork of fluidd)
-            possibleFrontEndDirs = ["mainsail", "fluidd", "fluidd-pad", "frontend"]
-
             # For each possible path
+            frontEndRootDirs = []
             for d in searchRootDirs:
                 # For each possible frontend, try to set it up.
-                for frontEnd in possibleFrontEndDirs:
+                for frontEnd in UiInjector.c_PossibleFrontEndDirs:
                     # Build the possible root.
                     htmlStaticRoot = os.path.join(d, frontEnd)
                     # See if it exists.
                     if os.path.exists(htmlStaticRoot):
+                        frontEndRootDirs.append(htmlStaticRoot)
+                        # If nothing has changed since we last found it was up to date, we don't need to do anything.
+                        if self._IsFrontEndUpToDate(htmlStaticRoot):
+                            continue
                         # If so, try to find the html file and inject it if needed.
                         if self._DoInject(htmlStaticRoot):
                             # If successful, make sure our latest js and css files are also there.
                             self._UpdateStaticFilesIntoRootIfNeeded(htmlStaticRoot)
+                            self.FrontEndFingerprints[htmlStaticRoot] = self._GetFrontEndFingerprint(htmlStaticRoot)
+            self.SearchRootDirs = searchRootDirs
+            self.FrontEndRootDirs = frontEndRootDirs
         except Exception as e:
             Sentry.Exception("UiInjector _ExecuteInjectAndUpdate.", e)
 
 
+    # Returns True if the index and our static files haven't changed since we last found the frontend was up to date.
+    def _IsFrontEndUpToDate(self, staticHtmlRootPath) -> bool:
+        fingerprint = self.FrontEndFingerprints.get(staticHtmlRootPath, None)
+        if fingerprint is None or fingerprint != self._GetFrontEndFingerprint(staticHtmlRootPath):
+            return False
+        # Make sure our static files are still there, since we don't watch the files in the oe dir.
+        oeStaticFileRoot = os.path.join(staticHtmlRootPath, "oe")
+        return os.path.exists(os.path.join(oeStaticFileRoot, f"ui.{self.StaticFileHash}.js")) and os.path.exists(os.path.join(oeStaticFileRoot, f"ui.{self.StaticFileHash}.css"))
+
+
+    # Returns the (index size, index mtime, static file hash) of the frontend, or None if the index can't be found.
+    def _GetFrontEndFingerprint(self, staticHtmlRootPath):
+        try:
+            stat = os.stat(os.path.join(staticHtmlRootPath, "index.html"))
+            return (stat.st_size, stat.st_mtime_ns, self.StaticFileHash)
+        except OSError:
+            return None
+
+
     # Ensures we can get paths to the static files in our repo and hashes them.
+    # The files are only hashed again if their size or mtime changed.
     def _FindStaticFilesAndGetHash(self):
         expectedRoot = os.path.join(os.path.join(self.OeRepoRoot, "moonraker_octoeverywhere"), "static")
         self.StaticUiJsFilePath = os.path.join(expectedRoot, "oe-ui.js")
@@ -110,6 +179,11 @@ class UiInjector():
             raise Exception("Failed to find static js ui file "+self.StaticUiJsFilePath)
         if os.path.exists(self.StaticUiCssFilePath) is False:
             raise Exception("Failed to find static css ui file "+self.StaticUiCssFilePath)
+        jsStat = os.stat(self.StaticUiJsFilePath)
+        cssStat = os.stat(self.StaticUiCssFilePath)
+        fingerprint = (jsStat.st_size, jsStat.st_mtime_ns, cssStat.st_size, cssStat.st_mtime_ns)
+        if self.StaticFileHash is not None and fingerprint == self.StaticFileFingerprint:
+            return
         # Hash them
         bufferSize = 65536 # 64kb
         sha1 = hashlib.sha1()
@@ -128,6 +202,7 @@ class UiInjector():
         #pylint: disable=consider-using-f-string
         self.StaticFileHash = "{0}".format(sha1.hexdigest())
         self.StaticFileHash = self.StaticFileHash[:10]
+        self.StaticFileFingerprint = fingerprint
         self.Logger.debug("Static UI Files Hash: "+self.StaticFileHash)
 
 
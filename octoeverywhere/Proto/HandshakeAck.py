@@ -92,8 +92,42 @@ class HandshakeAck(object):
             return bool(self._tab.Get(octoflatbuffers.number_types.BoolFlags, o + self._tab.Pos))
         return False
 
+    # HandshakeAck
+    def AcceptedZstandardDictionaryIds(self, j: int):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(20))
+        if o != 0:
+            a = self._tab.Vector(o)
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, a + octoflatbuffers.number_types.UOffsetTFlags.py_type(j * 4))
+        return 0
+
+    # HandshakeAck
+    def AcceptedZstandardDictionaryIdsAsNumpy(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(20))
+        if o != 0:
+            return self._tab.GetVectorAsNumpy(octoflatbuffers.number_types.Uint32Flags, o)
+        return 0
+
+    # HandshakeAck
+    def AcceptedZstandardDictionaryIdsLength(self) -> int:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(20))
+        if o != 0:
+            return self._tab.VectorLen(o)
+        return 0
+
+    # HandshakeAck
+    def AcceptedZstandardDictionaryIdsIsNone(self) -> bool:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(20))
+        return o == 0
+
+    # HandshakeAck
+    def FlowControlEnabled(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(22))
+        if o != 0:
+            return bool(self._tab.Get(octoflatbuffers.number_types.BoolFlags, o + self._tab.Pos))
+        return False
+
 def HandshakeAckStart(builder: octoflatbuffers.Builder):
-    builder.StartObject(8)
+    builder.StartObject(10)
 
 def Start(builder: octoflatbuffers.Builder):
     HandshakeAckStart(builder)
@@ -152,6 +186,24 @@ def HandshakeAckAddRequiresRekey(builder: octoflatbuffers.Builder, requiresRekey
 def AddRequiresRekey(builder: octoflatbuffers.Builder, requiresRekey: bool):
     HandshakeAckAddRequiresRekey(builder, requiresRekey)
 
+def HandshakeAckAddAcceptedZstandardDictionaryIds(builder: octoflatbuffers.Builder, acceptedZstandardDictionaryIds: int):
+    builder.PrependUOffsetTRelativeSlot(8, octoflatbuffers.number_types.UOffsetTFlags.py_type(acceptedZstandardDictionaryIds), 0)
+
+def AddAcceptedZstandardDictionaryIds(builder: octoflatbuffers.Builder, acceptedZstandardDictionaryIds: int):
+    HandshakeAckAddAcceptedZstandardDictionaryIds(builder, acceptedZstandardDictionaryIds)
+
+def HandshakeAckStartAcceptedZstandardDictionaryIdsVector(builder, numElems: int) -> int:
+    return builder.StartVector(4, numElems, 4)
+
+def StartAcceptedZstandardDictionaryIdsVector(builder, numElems: int) -> int:
+    return HandshakeAckStartAcceptedZstandardDictionaryIdsVector(builder, numElems)
+
+def HandshakeAckAddFlowControlEnabled(builder: octoflatbuffers.Builder, flowControlEnabled: bool):
+    builder.PrependBoolSlot(9, flowControlEnabled, 0)
+
+def AddFlowControlEnabled(builder: octoflatbuffers.Builder, flowControlEnabled: bool):
+    HandshakeAckAddFlowControlEnabled(builder, flowControlEnabled)
+
 def HandshakeAckEnd(builder: octoflatbuffers.Builder) -> int:
     return builder.EndObject()
 
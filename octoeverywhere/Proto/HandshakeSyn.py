@@ -176,8 +176,42 @@ class HandshakeSyn(object):
             return self._tab.String(o + self._tab.Pos)
         return None
 
+    # HandshakeSyn
+    def ZstandardDictionaryIds(self, j: int):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(40))
+        if o != 0:
+            a = self._tab.Vector(o)
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, a + octoflatbuffers.number_types.UOffsetTFlags.py_type(j * 4))
+        return 0
+
+    # HandshakeSyn
+    def ZstandardDictionaryIdsAsNumpy(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(40))
+        if o != 0:
+            return self._tab.GetVectorAsNumpy(octoflatbuffers.number_types.Uint32Flags, o)
+        return 0
+
+    # HandshakeSyn
+    def ZstandardDictionaryIdsLength(self) -> int:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(40))
+        if o != 0:
+            return self._tab.VectorLen(o)
+        return 0
+
+    # HandshakeSyn
+    def ZstandardDictionaryIdsIsNone(self) -> bool:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(40))
+        return o == 0
+
+    # HandshakeSyn
+    def ReceiveWindowBytes(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(42))
+        if o != 0:
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, o + self._tab.Pos)
+        return 0
+
 def HandshakeSynStart(builder: octoflatbuffers.Builder):
-    builder.StartObject(18)
+    builder.StartObject(20)
 
 def Start(builder: octoflatbuffers.Builder):
     HandshakeSynStart(builder)
@@ -296,6 +330,24 @@ def HandshakeSynAddDeviceId(builder: octoflatbuffers.Builder, deviceId: int):
 def AddDeviceId(builder: octoflatbuffers.Builder, deviceId: int):
     HandshakeSynAddDeviceId(builder, deviceId)
 
+def HandshakeSynAddZstandardDictionaryIds(builder: octoflatbuffers.Builder, zstandardDictionaryIds: int):
+    builder.PrependUOffsetTRelativeSlot(18, octoflatbuffers.number_types.UOffsetTFlags.py_type(zstandardDictionaryIds), 0)
+
+def AddZstandardDictionaryIds(builder: octoflatbuffers.Builder, zstandardDictionaryIds: int):
+    HandshakeSynAddZstandardDictionaryIds(builder, zstandardDictionaryIds)
+
+def HandshakeSynStartZstandardDictionaryIdsVector(builder, numElems: int) -> int:
+    return builder.StartVector(4, numElems, 4)
+
+def StartZstandardDictionaryIdsVector(builder, numElems: int) -> int:
+    return HandshakeSynStartZstandardDictionaryIdsVector(builder, numElems)
+
+def HandshakeSynAddReceiveWindowBytes(builder: octoflatbuffers.Builder, receiveWindowBytes: int):
+    builder.PrependUint32Slot(19, receiveWindowBytes, 0)
+
+def AddReceiveWindowBytes(builder: octoflatbuffers.Builder, receiveWindowBytes: int):
+    HandshakeSynAddReceiveWindowBytes(builder, receiveWindowBytes)
+
 def HandshakeSynEnd(builder: octoflatbuffers.Builder) -> int:
     return builder.EndObject()
 
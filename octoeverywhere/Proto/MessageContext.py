@@ -9,3 +9,4 @@ class MessageContext(object):
     WebStreamMsg = 3
     OctoNotification = 4
     OctoSummon = 5
+    WebStreamWindowUpdate = 6
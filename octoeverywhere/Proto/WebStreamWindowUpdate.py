@@ -0,0 +1,62 @@
+# automatically generated by the FlatBuffers compiler, do not modify
+
+# namespace: Proto
+
+import octoflatbuffers
+from typing import Any
+from typing import Optional
+class WebStreamWindowUpdate(object):
+    __slots__ = ['_tab']
+
+    @classmethod
+    def GetRootAs(cls, buf, offset: int = 0):
+        n = octoflatbuffers.encode.Get(octoflatbuffers.packer.uoffset, buf, offset)
+        x = WebStreamWindowUpdate()
+        x.Init(buf, n + offset)
+        return x
+
+    @classmethod
+    def GetRootAsWebStreamWindowUpdate(cls, buf, offset=0):
+        """This method is deprecated. Please switch to GetRootAs."""
+        return cls.GetRootAs(buf, offset)
+    # WebStreamWindowUpdate
+    def Init(self, buf: bytes, pos: int):
+        self._tab = octoflatbuffers.table.Table(buf, pos)
+
+    # WebStreamWindowUpdate
+    def StreamId(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(4))
+        if o != 0:
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, o + self._tab.Pos)
+        return 0
+
+    # WebStreamWindowUpdate
+    def WindowIncrementBytes(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(6))
+        if o != 0:
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, o + self._tab.Pos)
+        return 0
+
+def WebStreamWindowUpdateStart(builder: octoflatbuffers.Builder):
+    builder.StartObject(2)
+
+def Start(builder: octoflatbuffers.Builder):
+    WebStreamWindowUpdateStart(builder)
+
+def WebStreamWindowUpdateAddStreamId(builder: octoflatbuffers.Builder, streamId: int):
+    builder.PrependUint32Slot(0, streamId, 0)
+
+def AddStreamId(builder: octoflatbuffers.Builder, streamId: int):
+    WebStreamWindowUpdateAddStreamId(builder, streamId)
+
+def WebStreamWindowUpdateAddWindowIncrementBytes(builder: octoflatbuffers.Builder, windowIncrementBytes: int):
+    builder.PrependUint32Slot(1, windowIncrementBytes, 0)
+
+def AddWindowIncrementBytes(builder: octoflatbuffers.Builder, windowIncrementBytes: int):
+    WebStreamWindowUpdateAddWindowIncrementBytes(builder, windowIncrementBytes)
+
+def WebStreamWindowUpdateEnd(builder: octoflatbuffers.Builder) -> int:
+    return builder.EndObject()
+
+def End(builder: octoflatbuffers.Builder) -> int:
+    return WebStreamWindowUpdateEnd(builder)
@@ -0,0 +1,107 @@
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..threadbudget import ThreadBudget
+
+
+# Reads the next chunk of a http body on a background thread, while the web stream thread compresses and sends the current chunk.
+#
+# For big bodies, the web stream thread would otherwise switch between waiting on the read and doing the compression and send work.
+# With this, the read of the next chunk happens while the current one is processed, so the cores and the local connection are busy at the same time.
+# Only one chunk is ever read ahead, so the extra memory is bound to one read buffer.
+# If the thread budget doesn't allow another thread, the reads are done inline on the web stream thread, like they would be without this.
+class BodyReadAhead:
+
+    # Only bodies of at least this size use a read ahead, smaller bodies are done in a few reads anyways.
+    c_MinBodySizeBytes = 4 * 1024 * 1024
+
+    # How long Close will wait for a read that's in progress.
+    c_CloseWaitTimeoutSec = 5.0
+
+
+    # readFunc is called with the read size, and must return the data or None if the body is done.
+    def __init__(self, logger:logging.Logger, readFunc, readSizeBytes:int, totalSizeBytes:int) -> None:
+        self.Logger = logger
+        self.ReadFunc = readFunc
+        self.ReadSizeBytes = readSizeBytes
+        self.RemainingBytes = totalSizeBytes
+        self.IsClosed = False
+        self.IsDone = False
+        self.Data = None
+        self.ReadRequestEvent = threading.Event()
+        self.ReadDoneEvent = threading.Event()
+        # Start reading the first chunk right away.
+        self.ReadRequestEvent.set()
+        self.Thread = ThreadBudget.StartThread("BodyReadAhead", self._ReadThread, daemon=True, required=False)
+
+
+    # Returns true if a body should use a read ahead.
+    @staticmethod
+    def ShouldUse(contentLength_NoneIfNotKnown:int) -> bool:
+        return contentLength_NoneIfNotKnown is not None and contentLength_NoneIfNotKnown >= BodyReadAhead.c_MinBodySizeBytes
+
+
+    # Returns the next chunk of the body, or None if the body is done.
+    # Before this returns, the read of the chunk after this one is started.
+    def Read(self):
+        if self.IsDone:
+            return None
+        if self.Thread is None:
+            data = None
+            if self.IsClosed is False and self.RemainingBytes > 0:
+                data = self.ReadFunc(min(self.ReadSizeBytes, self.RemainingBytes))
+            if data is None:
+                self.IsDone = True
+            else:
+                self.RemainingBytes -= len(data)
+            return data
+        # If we are closed, the read thread might have already exited, so don't wait on it.
+        if self.IsClosed:
+            self.IsDone = True
+            return None
+        self.ReadDoneEvent.wait()
+        self.ReadDoneEvent.clear()
+        data = self.Data
+        self.Data = None
+        if data is None or self.RemainingBytes <= 0 or self.IsClosed:
+            self.IsDone = True
+        else:
+            self.ReadRequestEvent.set()
+        return data
+
+
+    # Stops the read ahead. If waitForRead is set, this will wait for a read in progress to finish,
+    # which must be done before the response is closed.
+    def Close(self, waitForRead:bool = True) -> None:
+        self.IsClosed = True
+        self.ReadRequestEvent.set()
+        if waitForRead and self.Thread is not None and self.Thread.is_alive() and threading.current_thread() is not self.Thread:
+            self.Thread.join(BodyReadAhead.c_CloseWaitTimeoutSec)
+
+
+    def _ReadThread(self):
+        # Set when the last chunk has been handed to Read, so there's nothing left to wake it up for.
+        lastChunkPublished = False
+        try:
+            while True:
+                self.ReadRequestEvent.wait()
+                self.ReadRequestEvent.clear()
+                if self.IsClosed:
+                    return
+                data = self.ReadFunc(min(self.ReadSizeBytes, self.RemainingBytes))
+                if data is not None:
+                    self.RemainingBytes -= len(data)
+                self.Data = data
+                if data is None or self.RemainingBytes <= 0:
+                    lastChunkPublished = True
+                self.ReadDoneEvent.set()
+                if lastChunkPublished:
+                    return
+        except Exception as e:
+            Sentry.Exception("BodyReadAhead read thread failed.", e)
+        finally:
+            # However the thread exits, make sure a Read waiting on us is woken up, or it would wait forever.
+            if lastChunkPublished is False:
+                self.Data = None
+                self.ReadDoneEvent.set()
@@ -0,0 +1,182 @@
+import time
+import queue
+import logging
+import threading
+
+
+# Limits how much data the web streams of a session can have buffered in memory.
+#
+# All of the web streams share one websocket to the server, and the messages for each stream are queued for the stream's thread.
+# If the server sends data faster than a stream can use it, for example a large upload into a slow local server, the queue would grow without limit.
+# The same is true for the send queue, if the local server sends data faster than the link to the server can take it.
+#
+# There are two ways we limit the inbound data:
+#   - If the server supports flow control, we give it a window of data it can send for each stream, and as the stream takes data from
+#     it's queue, we send window updates to tell the server it can send more. Only the stream that's slow is slowed down.
+#   - If the server doesn't support flow control, we can't slow it down, so the data is always accepted. We never block the websocket receive thread,
+#     since that would stall every other stream, ping and control message on the session.
+#     Uploads aren't streamed in this case, so the stream thread takes the data from the queue as fast as it comes in.
+# The data in all of the stream queues and the send queue is counted against one budget. When it's over the budget, window updates and large
+# sends wait until there's room again.
+#
+# If a stream waits for the max block time, it's marked as overrun and never waits again, so one stuck stream can only block once.
+class FlowControl:
+
+    # The window we give the server for each stream, which is how much data it can send for the stream before we tell it we have taken some.
+    c_StreamWindowBytes = 2 * 1024 * 1024
+    # We only send a window update once this much has been taken, so we don't send a message for every message we get.
+    c_WindowUpdateThresholdBytes = 512 * 1024
+    # The most data we want buffered in memory for the session, across all of the stream queues and the send queue.
+    c_MaxBufferedBytes = 32 * 1024 * 1024
+    # Sends smaller than this never wait, so control messages and small responses are never held up.
+    c_MinBlockingSendBytes = 16 * 1024
+    # The longest we block a thread waiting for room. After this, the stream is overrun and doesn't wait again, so one stuck stream can't keep blocking the others.
+    c_MaxBlockSec = 30.0
+    # The send queue doesn't tell us when it drains, so while waiting we check again this often.
+    c_RecheckSec = 0.05
+
+
+    def __init__(self, logger:logging.Logger, getSendQueueBytesFunc) -> None:
+        self.Logger = logger
+        self.GetSendQueueBytes = getSendQueueBytesFunc
+        # Set when the server tells us in the handshake it will respect the stream windows.
+        self.IsEnabled = False
+        # Protects the byte counts, and is notified when data is taken from a stream queue.
+        self.Condition = threading.Condition()
+        self.InboundBytes = 0
+
+
+    # Called when the handshake is done, with if the server supports flow control.
+    def SetEnabled(self, enabled:bool) -> None:
+        self.IsEnabled = enabled
+
+
+    # Returns how much data the session has buffered in the stream queues and the send queue.
+    def GetBufferedBytes(self) -> int:
+        with self.Condition:
+            return self._GetBufferedBytesLocked()
+
+
+    # Called by a stream before it sends a message. If the session is over the buffer budget, this blocks until there's room.
+    # The stream's own queued data isn't counted, since the stream can't take it from the queue while it's blocked here.
+    def WaitForSendRoom(self, msgSize:int, msgQueue:"WebStreamMsgQueue", isClosedFunc) -> None:
+        if msgSize < FlowControl.c_MinBlockingSendBytes:
+            return
+        def hasRoom():
+            return self._GetBufferedBytesLocked() - msgQueue.QueuedBytes < FlowControl.c_MaxBufferedBytes
+        msgQueue.WaitForRoom(hasRoom, isClosedFunc)
+
+
+    # Waits until hasRoomFunc returns True, which is called under the lock. Returns False if the wait was given up on.
+    def WaitForRoom(self, hasRoomFunc, isClosedFunc) -> bool:
+        endSec = None
+        with self.Condition:
+            while hasRoomFunc() is False:
+                if isClosedFunc():
+                    return False
+                if endSec is None:
+                    endSec = time.time() + FlowControl.c_MaxBlockSec
+                waitSec = endSec - time.time()
+                if waitSec <= 0:
+                    self.Logger.warn(f"FlowControl waited {FlowControl.c_MaxBlockSec}s for room, the stream is overrun and won't wait again. Buffered: {self._GetBufferedBytesLocked()}")
+                    return False
+                self.Condition.wait(min(waitSec, FlowControl.c_RecheckSec))
+        return True
+
+
+    # Returns True if the session is under the buffer budget. Must be called under lock.
+    def HasRoomLocked(self) -> bool:
+        return self._GetBufferedBytesLocked() < FlowControl.c_MaxBufferedBytes
+
+
+    # Must be called under lock.
+    def _GetBufferedBytesLocked(self) -> int:
+        sendQueueBytes = 0
+        try:
+            sendQueueBytes = self.GetSendQueueBytes()
+        except Exception:
+            pass
+        return self.InboundBytes + sendQueueBytes
+
+
+# The queue of messages from the server for one web stream, which is bounded by the bytes of data in it.
+#
+# Put is called on the websocket receive thread and Get on the stream's thread. As the stream takes data, the window is given back to the server.
+class WebStreamMsgQueue:
+
+    def __init__(self, flowControl:FlowControl, sendWindowUpdateFunc) -> None:
+        self.FlowControl = flowControl
+        self.SendWindowUpdate = sendWindowUpdateFunc
+        # Holds tuples of (msg, dataBytes)
+        self.Queue = queue.Queue()
+        self.QueuedBytes = 0
+        self.TakenBytesNotSent = 0
+        self.IsClosed = False
+        # Set once the stream waits for the max block time, after that it never waits again.
+        self.IsOverrun = False
+
+
+    # Adds a message to the queue. None can be added to wake up the stream thread.
+    # This is called on the websocket receive thread, so it never blocks.
+    # Returns False if the message wasn't added because the server sent more than the window it agreed to, in which case the caller must close the stream.
+    def Put(self, webStreamMsg) -> bool:
+        dataBytes = 0 if webStreamMsg is None else webStreamMsg.DataLength()
+        if dataBytes > 0:
+            with self.FlowControl.Condition:
+                if self.IsClosed:
+                    return True
+                # If the server respects our window, it won't send more than the window for this stream, so if it does, the stream must be closed.
+                # Without flow control the server doesn't know about the window, so there's no limit.
+                # We always allow a message into an empty queue, so every stream can make progress.
+                if self.FlowControl.IsEnabled and self.QueuedBytes > 0 and self.QueuedBytes + dataBytes > FlowControl.c_StreamWindowBytes:
+                    return False
+                self.QueuedBytes += dataBytes
+                self.FlowControl.InboundBytes += dataBytes
+        self.Queue.put((webStreamMsg, dataBytes))
+        return True
+
+
+    # Returns the next message. Raises queue.Empty if there's no message before the timeout.
+    def Get(self, timeout:float):
+        webStreamMsg, dataBytes = self.Queue.get(timeout=timeout)
+        if dataBytes > 0:
+            with self.FlowControl.Condition:
+                # If the queue was closed, the bytes have already been removed.
+                if self.IsClosed is False:
+                    self.QueuedBytes -= dataBytes
+                    self.FlowControl.InboundBytes -= dataBytes
+                self.FlowControl.Condition.notify_all()
+            self._GiveBackWindow(dataBytes)
+        return webStreamMsg
+
+
+    # Closes the queue, which drops any data in it from the session's buffered count and wakes up anything waiting on it.
+    def Close(self) -> None:
+        with self.FlowControl.Condition:
+            self.IsClosed = True
+            self.FlowControl.InboundBytes -= self.QueuedBytes
+            self.QueuedBytes = 0
+            self.FlowControl.Condition.notify_all()
+        self.Queue.put((None, 0))
+
+
+    # Waits for room in the session, unless this stream is overrun. If the wait times out, the stream is marked as overrun.
+    def WaitForRoom(self, hasRoomFunc, isClosedFunc) -> None:
+        if self.IsOverrun:
+            return
+        if self.FlowControl.WaitForRoom(hasRoomFunc, isClosedFunc) is False and isClosedFunc() is False:
+            self.IsOverrun = True
+
+
+    # Called on the stream thread when data is taken from the queue.
+    def _GiveBackWindow(self, dataBytes:int) -> None:
+        if self.FlowControl.IsEnabled is False or self.IsClosed:
+            return
+        self.TakenBytesNotSent += dataBytes
+        if self.TakenBytesNotSent < FlowControl.c_WindowUpdateThresholdBytes:
+            return
+        # If the session is over budget, hold the window back until there's room, which slows the server down for this stream.
+        self.WaitForRoom(self.FlowControl.HasRoomLocked, lambda: self.IsClosed)
+        windowIncrementBytes = self.TakenBytesNotSent
+        self.TakenBytesNotSent = 0
+        self.SendWindowUpdate(windowIncrementBytes)
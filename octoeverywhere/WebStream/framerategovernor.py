@@ -0,0 +1,106 @@
+import time
+import logging
+
+
+# Limits the frame rate of a webcam stream to what the connection to the server can actually deliver.
+#
+# All of the web streams share one websocket to the server, so if a webcam stream pushes frames faster than the link can send them,
+# the send queue grows and the latency goes up for the webcam and every other stream. The governor watches how long messages are waiting
+# in the send queue, and if it's over the target, it lowers the frame rate. When the queue is empty again, the frame rate slowly goes back up.
+#
+# Frames are dropped by time, so the frame that's sent is always the newest one we have.
+#  - For streams we read from a server (mjpeg), ShouldSendFrame() is called after each frame is read, and the frame is dropped if it returns False.
+#  - For streams that give us the latest frame when asked (QuickCam), WaitForNextFrameSlot() is called before getting the frame.
+class FrameRateGovernor:
+
+    # The send queue delay we try to stay under.
+    c_TargetSendQueueDelaySec = 0.25
+
+    # When we are at the max fps, we don't limit the stream at all.
+    c_MaxFps = 30.0
+    c_MinFps = 1.0
+
+    # How often we adjust the fps, and by how much.
+    c_AdjustIntervalSec = 0.5
+    c_DecreaseMultiplier = 0.7
+    c_IncreaseFpsStep = 1.0
+
+    # How much each new delay sample counts in the smoothed delay.
+    c_DelaySmoothingFactor = 0.3
+
+    # The header we send back to the client with the fps the stream is starting at.
+    c_EffectiveFpsHeaderKey = "x-oe-effective-fps"
+
+    # The fps the last stream settled on. Streams usually run on the same link, so new streams start at this rate
+    # rather than flooding the link and backing off again.
+    _LastSettledFps = c_MaxFps
+
+
+    def __init__(self, logger:logging.Logger, getSendQueueDelaySecFunc) -> None:
+        self.Logger = logger
+        self.GetSendQueueDelaySec = getSendQueueDelaySecFunc
+        self.Fps = FrameRateGovernor._LastSettledFps
+        self.NextFrameTimeSec = 0.0
+        self.LastAdjustTimeSec = time.time()
+        self.SmoothedDelaySec = 0.0
+        self.SentFrames = 0
+        self.DroppedFrames = 0
+
+
+    def GetEffectiveFps(self) -> float:
+        return self.Fps
+
+
+    def GetEffectiveFpsStr(self) -> str:
+        return f"{self.Fps:.1f}"
+
+
+    # For streams that push frames. Call after each frame is read, returns True if the frame should be sent, False if it should be dropped.
+    def ShouldSendFrame(self) -> bool:
+        now = time.time()
+        self._Update(now)
+        if now < self.NextFrameTimeSec:
+            self.DroppedFrames += 1
+            return False
+        self._OnFrameSent(now)
+        return True
+
+
+    # For streams where we pull the latest frame. Blocks until the next frame should be sent.
+    def WaitForNextFrameSlot(self) -> None:
+        now = time.time()
+        self._Update(now)
+        waitSec = self.NextFrameTimeSec - now
+        if waitSec > 0:
+            time.sleep(waitSec)
+            now = time.time()
+        self._OnFrameSent(now)
+
+
+    def _OnFrameSent(self, now:float) -> None:
+        self.SentFrames += 1
+        if self.Fps >= FrameRateGovernor.c_MaxFps:
+            self.NextFrameTimeSec = 0.0
+            return
+        # Add the interval to the last slot rather than now, so frames that show up a little late don't lower the rate.
+        # But don't let it fall behind by more than one interval, or we would send a burst of frames.
+        intervalSec = 1.0 / self.Fps
+        self.NextFrameTimeSec = max(self.NextFrameTimeSec + intervalSec, now - intervalSec)
+
+
+    def _Update(self, now:float) -> None:
+        self.SmoothedDelaySec += (self.GetSendQueueDelaySec() - self.SmoothedDelaySec) * FrameRateGovernor.c_DelaySmoothingFactor
+        if now - self.LastAdjustTimeSec < FrameRateGovernor.c_AdjustIntervalSec:
+            return
+        self.LastAdjustTimeSec = now
+        fps = self.Fps
+        if self.SmoothedDelaySec > FrameRateGovernor.c_TargetSendQueueDelaySec:
+            fps = max(FrameRateGovernor.c_MinFps, fps * FrameRateGovernor.c_DecreaseMultiplier)
+        elif self.SmoothedDelaySec < FrameRateGovernor.c_TargetSendQueueDelaySec / 2 and fps < FrameRateGovernor.c_MaxFps:
+            fps = min(FrameRateGovernor.c_MaxFps, fps + FrameRateGovernor.c_IncreaseFpsStep)
+        if fps == self.Fps:
+            return
+        self.Fps = fps
+        FrameRateGovernor._LastSettledFps = fps
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"Frame rate governor set the fps to {fps:.1f}, send queue delay {self.SmoothedDelaySec*1000.0:.0f}ms, sent {self.SentFrames} dropped {self.DroppedFrames}")
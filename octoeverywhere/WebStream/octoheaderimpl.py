@@ -3,7 +3,8 @@ import logging
 from ..sentry import Sentry
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..octohttprequest import OctoHttpRequest
-from ..Proto.HttpInitialContext import HttpInitialContext
+from ..Proto import HttpHeader
+from ..Proto import HttpInitialContext
 
 # Indicates the base protocol, not if it's secure or not.
 class BaseProtocol:
@@ -11,20 +12,103 @@ class BaseProtocol:
     WebSocket = 2
 
 
+# What GatherRequestHeaders does with each request header.
+class RequestHeaderAction:
+    Keep = 0
+    Drop = 1
+    SetToHostAddress = 2
+    SetToHostUrl = 3
+
+
+# The response headers the http helper cares about.
+class ResponseHeaderKind:
+    Other = 0
+    Drop = 1
+    ContentLength = 2
+    ContentType = 3
+    Location = 4
+
+
 class HeaderHelper:
 
     c_xForwardedForProtoHeaderName = "X-Forwarded-Proto"
     c_xForwardedForHostHeaderName = "X-Forwarded-Host"
 
+    # The actions for request headers, keyed by the lower case header name. Any header not in this table is kept.
+    # These tables are never edited, the per name results are cached in the dicts below.
+    c_RequestHeaderActions = {
+        # We don't want to accept encoding because it's just a waste of CPU to send over
+        # local host. We will do our own encoding when we send the data over the websocket.
+        "accept-encoding" : RequestHeaderAction.Drop,
+        # We don't want to send the transfer encoding since it' won't be accurate any longer.
+        # If the request was compressed, it will be de-compressed by the server and then we use a different
+        # compression system over the wire.
+        # If the request was chunked, our system will read the entire message and send it on the wire
+        # in multiple stream messages.
+        # Thus, we don't need to / shouldn't include this header.
+        "transfer-encoding" : RequestHeaderAction.Drop,
+        # We don't support https over the local host.
+        "upgrade-insecure-requests" : RequestHeaderAction.Drop,
+        # We should never send these to OctoPrint, or it will detect the IP as external and show
+        # the external connection warning.
+        "x-forwarded-for" : RequestHeaderAction.Drop,
+        "x-real-ip" : RequestHeaderAction.Drop,
+        # There's no need to send this as well.
+        "x-original-proto" : RequestHeaderAction.Drop,
+        # Update any headers we need to for the local call.
+        "host" : RequestHeaderAction.SetToHostAddress,
+        "referer" : RequestHeaderAction.SetToHostUrl,
+        "origin" : RequestHeaderAction.SetToHostUrl,
+    }
+
+    # The kinds of response headers, keyed by the lower case header name. Any header not in this table is Other.
+    c_ResponseHeaderKinds = {
+        # Since we send the entire result as one non-encoded
+        # payload we want to drop this header. Otherwise the server might emit it to
+        # the client, when it actually doesn't match what the server sends to the client.
+        # Note: Typically, if the OctoPrint web server sent something chunk encoded,
+        # our web server will also send it to the client via chunk encoding. But it will handle
+        # that on it's own and set the header accordingly.
+        "transfer-encoding" : ResponseHeaderKind.Drop,
+        # Don't send this easter egg.
+        "x-clacks-overhead" : ResponseHeaderKind.Drop,
+        "content-length" : ResponseHeaderKind.ContentLength,
+        "content-type" : ResponseHeaderKind.ContentType,
+        "location" : ResponseHeaderKind.Location,
+    }
+
+    # Browsers send the same header names in the same case over and over, so we cache the lookups by the exact name.
+    # For request headers the key is the raw name bytes from the message, so we don't even need to decode the name.
+    # The caches are bounded, if they get too large they are just cleared, since that means something is sending random header names.
+    c_MaxHeaderNameCacheSize = 512
+    _RequestHeaderNameCache = {}
+    _ResponseHeaderKindCache = {}
+
+    # The values we set for the host based headers, these only change if the local host address changes.
+    # This is a (hostAddress, hostUrl) tuple, so it's always swapped as one and a reader can never get an address paired with another address's url.
+    _HostValues:tuple = (None, None)
+
+    # Location header corrections, keyed by (urlStart, locationValue).
+    c_MaxLocationCacheSize = 256
+    _LocationCache = {}
+
+
     # Called by slipstream and the main http class to gather and add required headers.
     @staticmethod
-    def GatherRequestHeaders(logger, httpInitialContextOptional:HttpInitialContext, protocol) :
+    def GatherRequestHeaders(logger, httpInitialContextOptional:HttpInitialContext.HttpInitialContext, protocol) :
 
+        # Only rebuild the host values if the local host address changed.
         hostAddress = OctoHttpRequest.GetLocalhostAddress()
+        hostValues = HeaderHelper._HostValues
+        if hostValues[0] != hostAddress:
+            hostValues = (hostAddress, "http://" + hostAddress)
+            HeaderHelper._HostValues = hostValues
+        hostUrl = hostValues[1]
 
         # Get the count of headers in the message.
         sendHeaders = {}
         if httpInitialContextOptional is not None:
+            nameCache = HeaderHelper._RequestHeaderNameCache
             headersLen = httpInitialContextOptional.HeadersLength()
             # Convert each header and fix them up.
             i = 0
@@ -35,48 +119,37 @@ class HeaderHelper:
 
                 # Get the values & validate
                 # These Key() and Value() calls are relatively what expensive, so we only call them once.
-                name = OctoStreamMsgBuilder.BytesToString(header.Key())
-                value = OctoStreamMsgBuilder.BytesToString(header.Value())
-                if name is None or value is None:
+                nameBytes = header.Key()
+                if nameBytes is None:
                     logger.warn("GatherRequestHeaders found a header that has a null name or value.")
                     continue
-                lowerName = name.lower()
+
+                # Find what we need to do with this header.
+                cached = nameCache.get(nameBytes, None)
+                if cached is None:
+                    name = OctoStreamMsgBuilder.BytesToString(nameBytes)
+                    cached = (name, HeaderHelper.c_RequestHeaderActions.get(name.lower(), RequestHeaderAction.Keep))
+                    if len(nameCache) >= HeaderHelper.c_MaxHeaderNameCacheSize:
+                        nameCache.clear()
+                    nameCache[nameBytes] = cached
+                name, action = cached
 
                 # Filter out headers we don't want to send.
-                if lowerName == "accept-encoding":
-                    # We don't want to accept encoding because it's just a waste of CPU to send over
-                    # local host. We will do our own encoding when we send the data over the websocket.
+                if action == RequestHeaderAction.Drop:
                     continue
-                if lowerName == "transfer-encoding":
-                    # We don't want to send the transfer encoding since it' won't be accurate any longer.
-                    # If the request was compressed, it will be de-compressed by the server and then we use a different
-                    # compression system over the wire.
-                    # If the request was chunked, our system will read the entire message and send it on the wire
-                    # in multiple stream messages.
-                    # Thus, we don't need to / shouldn't include this header.
-                    continue
-                if lowerName == "upgrade-insecure-requests":
-                    # We don't support https over the local host.
-                    continue
-                if lowerName == "x-forwarded-for":
-                    # We should never send these to OctoPrint, or it will detect the IP as external and show
-                    # the external connection warning.
-                    continue
-                if lowerName == "x-real-ip":
-                    # We should never send these to OctoPrint, or it will detect the IP as external and show
-                    # the external connection warning.
-                    continue
-                if lowerName == "x-original-proto":
-                    # There's no need to send this as well.
+
+                value = header.Value()
+                if value is None:
+                    logger.warn("GatherRequestHeaders found a header that has a null name or value.")
                     continue
 
                 # Update any headers we need to for the local call.
-                if lowerName == "host" :
+                if action == RequestHeaderAction.Keep:
+                    value = OctoStreamMsgBuilder.BytesToString(value)
+                elif action == RequestHeaderAction.SetToHostAddress:
                     value = hostAddress
-                if lowerName == "referer" :
-                    value = "http://" + hostAddress
-                if lowerName == "origin" :
-                    value = "http://" + hostAddress
+                else:
+                    value = hostUrl
 
                 # Add the header. (use the original case)
                 sendHeaders[name] = value
@@ -115,6 +188,58 @@ class HeaderHelper:
 
         return sendHeaders
 
+
+    # Returns the ResponseHeaderKind for a response header name, in any case.
+    @staticmethod
+    def GetResponseHeaderKind(name:str) -> int:
+        kind = HeaderHelper._ResponseHeaderKindCache.get(name, None)
+        if kind is None:
+            kind = HeaderHelper.c_ResponseHeaderKinds.get(name.lower(), ResponseHeaderKind.Other)
+            if len(HeaderHelper._ResponseHeaderKindCache) >= HeaderHelper.c_MaxHeaderNameCacheSize:
+                HeaderHelper._ResponseHeaderKindCache.clear()
+            HeaderHelper._ResponseHeaderKindCache[name] = kind
+        return kind
+
+
+    # Writes the response headers directly into a HttpInitialContext header vector in the builder, dropping any headers we shouldn't send.
+    # Returns the vector offset, or None if there are no headers to send.
+    @staticmethod
+    def BuildResponseHeaderVector(builder, headers) -> int:
+        headerTableOffsets = []
+        for name, value in headers.items():
+            if HeaderHelper.GetResponseHeaderKind(name) == ResponseHeaderKind.Drop:
+                continue
+
+            # Most headers are the same in every response, like the content type and server, so they are interned.
+            headerTableOffsets.append(OctoStreamMsgBuilder.CreateInternedTable(builder, (name, value), HeaderHelper._BuildHeaderTable, name, value))
+
+        # Check if there were any headers, if not, return null so we don't set the vector.
+        if len(headerTableOffsets) == 0:
+            return None
+
+        # Build the heaver vector
+        HttpInitialContext.StartHeadersVector(builder, len(headerTableOffsets))
+        for offset in headerTableOffsets:
+            # This function was very hard to find, I eventually found an example in the
+            # py samples in the flatbuffer repo.
+            builder.PrependUOffsetTRelative(offset)
+        return builder.EndVector()
+
+
+    # Builds a single header table and returns its offset.
+    @staticmethod
+    def _BuildHeaderTable(builder, name:str, value:str) -> int:
+        # Allocate strings
+        # Header names repeat a lot, so the builder can share them within the message.
+        keyOffset = builder.CreateSharedString(name)
+        valueOffset = builder.CreateString(value)
+        # Create the header table
+        HttpHeader.Start(builder)
+        HttpHeader.AddKey(builder, keyOffset)
+        HttpHeader.AddValue(builder, valueOffset)
+        return HttpHeader.End(builder)
+
+
     # Called only for websockets to get headers.
     @staticmethod
     def GatherWebsocketRequestHeaders(logger:logging.Logger, httpInitialContext) -> dict:
@@ -193,6 +318,12 @@ class HeaderHelper:
         # Note, there should be no trailing /
         urlStart = sendHeaders[HeaderHelper.c_xForwardedForProtoHeaderName] + "://" + sendHeaders[HeaderHelper.c_xForwardedForHostHeaderName]
 
+        # Most redirects are the same few locations over and over, so check the cache first.
+        cacheKey = (urlStart, locationValue)
+        correctedUrl = HeaderHelper._LocationCache.get(cacheKey, None)
+        if correctedUrl is not None:
+            return correctedUrl
+
         try:
             # Parse the existing URL to get the path.
             # pylint: disable=import-outside-toplevel
@@ -202,8 +333,10 @@ class HeaderHelper:
             # If the redirect starts with ./ it's referencing the current uri path.
             # For example, if the request uri was https://test.com/hello/world and the redirect is ./overhere?test=1
             # The correct URI is https://test.com/hello/world/overhere?test=1
+            # These depend on the request uri, so they aren't cached.
             path = r.path
-            if path.startswith("./"):
+            isRelativeToRequestPath = path.startswith("./")
+            if isRelativeToRequestPath:
                 # Parse the request uri to pull the path out.
                 ogUri = urlparse(requestUri)
                 path = ogUri.path
@@ -218,12 +351,15 @@ class HeaderHelper:
             # The path value will start with a / if there was one in the original path.
             # If there was no slash (http://octoeverywhere.com) path is an empty string.
             # If there is no query string, it's an empty string as well.
-            correctedUrl = urlStart + r.path
             correctedUrl = urlStart + path
             if len(r.query) > 0:
                 correctedUrl += "?" + r.query
 
             logger.info("We corrected a response location header "+locationValue+" -> "+correctedUrl)
+            if isRelativeToRequestPath is False:
+                if len(HeaderHelper._LocationCache) >= HeaderHelper.c_MaxLocationCacheSize:
+                    HeaderHelper._LocationCache.clear()
+                HeaderHelper._LocationCache[cacheKey] = correctedUrl
             return correctedUrl
 
         except Exception as e:
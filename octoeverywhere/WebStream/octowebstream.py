@@ -3,14 +3,14 @@
 import threading
 import traceback
 import time
-import queue
 
 from ..sentry import Sentry
+from ..threadbudget import ThreadBudget
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from .octowebstreamhttphelper import OctoWebStreamHttpHelper
 from .octowebstreamwshelper import OctoWebStreamWsHelper
+from .flowcontrol import WebStreamMsgQueue
 from ..Proto import WebStreamMsg
-from ..Proto import MessageContext
 from ..Proto import MessagePriority
 from ..debugprofiler import DebugProfiler, DebugProfilerFeatures
 
@@ -19,6 +19,9 @@ from ..debugprofiler import DebugProfiler, DebugProfilerFeatures
 #
 class OctoWebStream(threading.Thread):
 
+    # The origin web stream threads are counted under in the thread budget.
+    c_ThreadOrigin = "WebStream"
+
     # Created when an open message is sent for a new web stream from the server.
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, verbose=None):
         threading.Thread.__init__(self, group=group, target=target, name=name)
@@ -29,7 +32,7 @@ class OctoWebStream(threading.Thread):
         self.IsClosed = False
         self.HasSentCloseMessage = False
         self.StateLock = threading.Lock()
-        self.MsgQueue = queue.Queue()
+        self.MsgQueue = WebStreamMsgQueue(self.OctoSession.FlowControl, self.sendWindowUpdate)
         self.HttpHelper = None
         self.WsHelper = None
         self.IsHelperClosed = False
@@ -65,7 +68,10 @@ class OctoWebStream(threading.Thread):
             self.Close()
         else:
             # Otherwise, put the message into the queue, so the thread will pick it up.
-            self.MsgQueue.put(webStreamMsg)
+            # This never blocks. If the server supports flow control but sent more than the stream's window, the stream is closed.
+            if self.MsgQueue.Put(webStreamMsg) is False:
+                self.Logger.warn("Web stream "+str(self.Id)+" has more than its window of data queued, closing the stream.")
+                self.Close()
 
 
     # Closes the web stream and all related elements.
@@ -98,8 +104,8 @@ class OctoWebStream(threading.Thread):
         # Remove ourselves from the session map
         self.OctoSession.WebStreamClosed(self.Id)
 
-        # Put an empty message on the queue to wake it up to exit.
-        self.MsgQueue.put(None)
+        # Close the queue, which puts an empty message on the queue to wake it up to exit.
+        self.MsgQueue.Close()
 
         # Ensure we have sent the close message
         self.ensureCloseMessageSent()
@@ -122,16 +128,33 @@ class OctoWebStream(threading.Thread):
         self.ClosedDueToRequestConnectionError = True
 
 
+    # Starts the web stream thread if the thread budget allows it.
+    # Returns False if the thread couldn't be started, in which case the caller must close the stream.
+    def TryStart(self) -> bool:
+        if ThreadBudget.TryAcquire(OctoWebStream.c_ThreadOrigin) is False:
+            return False
+        try:
+            self.start()
+            return True
+        except RuntimeError as e:
+            ThreadBudget.Release(OctoWebStream.c_ThreadOrigin)
+            self.Logger.warn("Web stream "+str(self.Id)+" failed to start its thread. "+str(e))
+            return False
+
+
     # This is our main thread, where we will process all incoming messages.
     def run(self):
         # Enable the profiler if needed- it will do nothing if not enabled.
-        with DebugProfiler(self.Logger, DebugProfilerFeatures.WebStream):
-            try:
-                self.mainThread()
-            except Exception as e:
-                Sentry.Exception("Exception in web stream ["+str(self.Id)+"] connect loop.", e)
-                traceback.print_exc()
-                self.OctoSession.OnSessionError(0)
+        try:
+            with DebugProfiler(self.Logger, DebugProfilerFeatures.WebStream):
+                try:
+                    self.mainThread()
+                except Exception as e:
+                    Sentry.Exception("Exception in web stream ["+str(self.Id)+"] connect loop.", e)
+                    traceback.print_exc()
+                    self.OctoSession.OnSessionError(0)
+        finally:
+            ThreadBudget.Release(OctoWebStream.c_ThreadOrigin)
 
 
     def mainThread(self):
@@ -144,7 +167,7 @@ class OctoWebStream(threading.Thread):
             # which can accidentally re-process old messages.
             webStreamMsg:WebStreamMsg.WebStreamMsg = None
             try:
-                webStreamMsg = self.MsgQueue.get(timeout=60)
+                webStreamMsg = self.MsgQueue.Get(timeout=60)
             except Exception as _:
                 # We get this exception on the timeout.
                 pass
@@ -240,8 +263,51 @@ class OctoWebStream(threading.Thread):
                 wsHelper.Close()
 
 
+    # Called by the helpers to know how backed up the connection to the server is.
+    def GetSendQueueDelaySec(self) -> float:
+        try:
+            return self.OctoSession.GetSendQueueDelaySec()
+        except Exception:
+            return 0.0
+
+
+    # Returns True if the server respects the stream windows, so it will slow down when we are slow to take the data.
+    def IsFlowControlEnabled(self) -> bool:
+        return self.OctoSession.FlowControl.IsEnabled
+
+
+    # Called by the http helper when it's streaming an upload, to get the next message with upload data.
+    # Returns None if the stream closed or no message came in time.
+    def GetNextUploadMessage(self, timeoutSec:float) -> WebStreamMsg.WebStreamMsg:
+        endSec = time.time() + timeoutSec
+        while self.IsClosed is False:
+            waitSec = endSec - time.time()
+            if waitSec <= 0:
+                return None
+            try:
+                webStreamMsg = self.MsgQueue.Get(timeout=waitSec)
+            except Exception as _:
+                # We get this exception on the timeout.
+                return None
+            # Like the main thread, skip empty wake ups and messages with nothing for the helper.
+            if webStreamMsg is None or webStreamMsg.IsControlFlagsOnly():
+                continue
+            return webStreamMsg
+        return None
+
+
+    # Called by the message queue when the stream has taken data, to tell the server it can send more.
+    def sendWindowUpdate(self, windowIncrementBytes:int):
+        buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.BuildWebStreamWindowUpdate(self.Id, windowIncrementBytes)
+        self.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes)
+
+
     # Called by the helpers to send messages to the server.
     def SendToOctoStream(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, isCloseFlagSet = False, silentlyFail = False):
+        # If the session has too much data buffered, large messages wait for room, which slows down reading from the local server.
+        if isCloseFlagSet is False:
+            self.OctoSession.FlowControl.WaitForSendRoom(msgSize, self.MsgQueue, lambda: self.IsClosed)
+
         # Make sure we aren't closed. If we are, don't allow the message to be sent.
         with self.StateLock:
             if self.IsClosed is True:
@@ -284,14 +350,7 @@ class OctoWebStream(threading.Thread):
         # Since the send function does the checking to ensure only one close message
         # gets sent, we will always try to create and send a message.
         try:
-            builder = OctoStreamMsgBuilder.CreateBuffer(200)
-            WebStreamMsg.Start(builder)
-            WebStreamMsg.AddStreamId(builder, self.Id)
-            WebStreamMsg.AddIsControlFlagsOnly(builder, True)
-            WebStreamMsg.AddIsCloseMsg(builder, True)
-            WebStreamMsg.AddCloseDueToRequestConnectionFailure(builder, self.ClosedDueToRequestConnectionError)
-            webStreamMsgOffset = WebStreamMsg.End(builder)
-            buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+            buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.BuildWebStreamCloseMsg(self.Id, self.ClosedDueToRequestConnectionError)
             # Set the flag to silently fail, since the message might have already been sent by the helper.
             self.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, True, True)
         except Exception as e:
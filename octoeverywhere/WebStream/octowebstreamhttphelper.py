@@ -1,4 +1,6 @@
 import time
+import socket
+import select
 import logging
 import threading
 
@@ -8,20 +10,25 @@ import octoflatbuffers
 
 from .octoheaderimpl import HeaderHelper
 from .octoheaderimpl import BaseProtocol
+from .octoheaderimpl import ResponseHeaderKind
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
+from .framerategovernor import FrameRateGovernor
+from .bodyreadahead import BodyReadAhead
 from ..Webcam.webcamhelper import WebcamHelper
+from ..Webcam.streamframetap import StreamFrameTap
 from ..commandhandler import CommandHandler
 from ..compression import Compression, CompressionContext
+from ..zstandarddictionary import ZStandardPayloadClass
 from ..sentry import Sentry
 from ..compat import Compat
-from ..Proto import HttpHeader
 from ..Proto import WebStreamMsg
 from ..Proto import MessageContext
 from ..Proto import HttpInitialContext
 from ..Proto import DataCompression
 from ..Proto import OeAuthAllowed
 from ..Proto.PathTypes import PathTypes
+from ..threadbudget import ThreadBudget
 
 # A wrapper that allows us to pass around a ref to the per message builder object.
 class MsgBuilderContext:
@@ -34,9 +41,22 @@ class MsgBuilderContext:
 
     def __init__(self):
         self.Builder:octoflatbuffers.Builder = None
+        self.IsPooled = False
 
     def CreateBuilder(self, knownBodySizeBytes = 0):
-        self.Builder = octoflatbuffers.Builder(knownBodySizeBytes + self.c_MsgStreamOverheadSize)
+        # Small messages, like most api responses and the messages with no body, use a pooled builder.
+        sizeBytes = knownBodySizeBytes + self.c_MsgStreamOverheadSize
+        self.IsPooled = sizeBytes <= OctoStreamMsgBuilder.c_PooledBuilderSizeBytes
+        if self.IsPooled:
+            self.Builder = OctoStreamMsgBuilder.GetPooledBuilder()
+        else:
+            self.Builder = octoflatbuffers.Builder(sizeBytes)
+
+    # Wraps the message in the OctoStreamMsg and finalizes it, returning the buffer, the message start offset, and the message size.
+    def Finalize(self, contextType, contextOffset):
+        if self.IsPooled:
+            return OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalizePooled(self.Builder, contextType, contextOffset)
+        return OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(self.Builder, contextType, contextOffset)
 
 
 #
@@ -66,10 +86,20 @@ class OctoWebStreamHttpHelper:
         self.IsUsingFullBodyBuffer = False
         self.IsUsingCustomBodyStreamCallbacks = False
 
+        # Set for webcam streams, to limit the frame rate to what the connection can send.
+        self.FrameGovernor:FrameRateGovernor = None
+        # Set for webcam streams, so frames can be shared with things that would otherwise request a snapshot.
+        self.FrameTap:StreamFrameTap = None
+
+        # Set for large bodies, to read the next chunk while the current one is compressed and sent.
+        self.BodyReadAhead:BodyReadAhead = None
+
         # If this doesn't not equal None, it means we know how much data to expect.
         self.KnownFullStreamUploadSizeBytes = None
         self.UploadBytesReceivedSoFar = 0
         self.UploadBuffer = None
+        # Set for large uploads, which are sent to the http server as the data comes in, rather than being buffered.
+        self.StreamedUploadBody:StreamedUploadBody = None
 
         # Unknown body size chunk reader
         # If this is not None, we are doing the unknown body read. Then the rest of the body reads must use this same system.
@@ -102,13 +132,25 @@ class OctoWebStreamHttpHelper:
         # Set the flag so all of the looping http operations will stop.
         self.IsClosed = True
 
-        # Important! If we are doing a unknown chunk read, we need to set the wait event to unblock the stream read thread.
-        # This will cause the thread to wake up, it will see the IsClosed flag, return, and then allow the web request to close,
-        # which will end the unknown body read thread.
-        if self.UnknownBodyChunkReadContext is not None:
+        # Stop any read ahead, but don't wait on it, since this must be quick.
+        bodyReadAhead = self.BodyReadAhead
+        if bodyReadAhead is not None:
+            bodyReadAhead.Close(False)
+
+        # Important! If we are doing a unknown chunk read, the web stream thread might be blocked waiting on the next chunk, which can be
+        # a long time for event streams and long polls. We shutdown the socket to unblock the read, which will then see the IsClosed flag and return.
+        # If the body has been fully read, the connection might already be back in the pool, so we don't touch it.
+        context = self.UnknownBodyChunkReadContext
+        if context is not None:
+            if context.Socket is not None and context.ReadComplete is False:
+                try:
+                    context.Socket.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+            # For the thread reader, set the wait event to unblock the stream read thread.
             # Call set under lock, to ensure the other thread doesn't clear it without us seeing it.
-            with self.UnknownBodyChunkReadContext.BufferLock:
-                self.UnknownBodyChunkReadContext.BufferDataReadyEvent.set()
+            with context.BufferLock:
+                context.BufferDataReadyEvent.set()
 
 
     # Called when a new message has arrived for this stream from the server.
@@ -119,6 +161,18 @@ class OctoWebStreamHttpHelper:
         # Note this is called on a single thread and will always handle messages
         # in order as they were sent.
 
+        # For large uploads that come in many messages, we start the http request with the first message and the rest
+        # of the data is read from the stream's queue as it's sent. This way we don't need the full upload in memory and
+        # flow control can slow the server down when the http server is slow to take the upload.
+        if self.shouldStreamUpload(webStreamMsg):
+            self.StreamedUploadBody = StreamedUploadBody(self, webStreamMsg)
+            with self.CompressionContext:
+                try:
+                    self.executeHttpRequest()
+                finally:
+                    self.closeBodyReadAhead()
+            return True
+
         # This http call might have data sent to us in multiple messages.
         # If this message has data, put it into our buffer.
         if webStreamMsg.DataLength() > 0:
@@ -134,7 +188,10 @@ class OctoWebStreamHttpHelper:
             # Do the request. This will block this thread until it's done and the entire response is sent.
             # We want to make sure we destroy the compression context after this returns, no matter what.
             with self.CompressionContext:
-                self.executeHttpRequest()
+                try:
+                    self.executeHttpRequest()
+                finally:
+                    self.closeBodyReadAhead()
 
             # Return true since this stream is now done
             return True
@@ -157,7 +214,8 @@ class OctoWebStreamHttpHelper:
         if self.WebStreamOpenMsg is None:
             raise Exception("ExecuteHttpRequest but there is no open message")
         # Make sure if there was a defined upload size, we have all of the data.
-        if self.KnownFullStreamUploadSizeBytes is not None:
+        # Streamed uploads are checked as they are read.
+        if self.KnownFullStreamUploadSizeBytes is not None and self.StreamedUploadBody is None:
             if self.UploadBytesReceivedSoFar != self.KnownFullStreamUploadSizeBytes:
                 raise Exception("Http request tried to execute, but we haven't gotten all of the upload payload. Total:"+str(self.KnownFullStreamUploadSizeBytes)+"; rec so far:"+str(self.UploadBytesReceivedSoFar))
 
@@ -198,10 +256,18 @@ class OctoWebStreamHttpHelper:
         # 3) Finally, check if the request is cached in Slipstream.
         octoHttpResult = None
         isFromCache = False
-        if WebcamHelper.Get().IsSnapshotOrWebcamStreamOracleRequest(sendHeaders):
+        isWebcamRequest = WebcamHelper.Get().IsSnapshotOrWebcamStreamOracleRequest(sendHeaders)
+        isCommandRequest = isWebcamRequest is False and CommandHandler.Get().IsCommandRequest(httpInitialContext)
+        # The special case requests need the full upload, so if it's being streamed, read it all now.
+        if self.StreamedUploadBody is not None and (isWebcamRequest or isCommandRequest):
+            self.UploadBuffer = self.StreamedUploadBody.ReadAll()
+            self.StreamedUploadBody = None
+        if isWebcamRequest:
             octoHttpResult = WebcamHelper.Get().MakeSnapshotOrWebcamStreamRequest(httpInitialContext, method, sendHeaders, self.UploadBuffer)
+            if octoHttpResult is not None and WebcamHelper.Get().IsWebcamStreamOracleRequest(sendHeaders):
+                self.FrameTap = WebcamHelper.Get().GetStreamFrameTap(WebcamHelper.Get().GetOracleRequestCameraIndex(sendHeaders))
         # If this is a special command for OctoEverywhere, we handle it differently.
-        elif CommandHandler.Get().IsCommandRequest(httpInitialContext):
+        elif isCommandRequest:
             # This HandleCommand wil return a mock  OctoHttpResult, including a full mock response object.
             octoHttpResult = CommandHandler.Get().HandleCommand(httpInitialContext, self.UploadBuffer)
         else:
@@ -223,7 +289,8 @@ class OctoWebStreamHttpHelper:
                 isFromCache = True
             else:
                 # If we don't have a valid result yet, do the normal http path.
-                octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+                uploadBody = self.UploadBuffer if self.StreamedUploadBody is None else self.StreamedUploadBody
+                octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, uploadBody)
 
 
         # If None is returned, it failed.
@@ -295,12 +362,12 @@ class OctoWebStreamHttpHelper:
             contentTypeLower:str =None
             headers = octoHttpResult.Headers
             for name, value in headers.items():
-                nameLower = name.lower()
+                headerKind = HeaderHelper.GetResponseHeaderKind(name)
 
-                if nameLower == c_contentLengthHeaderKeyLower:
+                if headerKind == ResponseHeaderKind.ContentLength:
                     contentLength = int(value)
 
-                elif nameLower == "content-type":
+                elif headerKind == ResponseHeaderKind.ContentType:
                     contentTypeLower = value.lower()
 
                     # Look for a boundary string, something like this: `multipart/x-mixed-replace;boundary=boundarydonotcross`
@@ -314,15 +381,23 @@ class OctoWebStreamHttpHelper:
                             self.Logger.error("We found a boundary stream, but didn't find the boundary string. "+ contentTypeLower)
                             continue
 
-                elif nameLower == "location":
+                elif headerKind == ResponseHeaderKind.Location:
                     # We have noticed that some proxy servers aren't setup correctly to forward the x-forwarded-for and such headers.
                     # So when the web server responds back with a 301 or 302, the location header might not have the correct hostname, instead an ip like 127.0.0.1.
                     octoHttpResult.Headers[name] = HeaderHelper.CorrectLocationResponseHeaderIfNeeded(self.Logger, uri, value, sendHeaders)
 
+            # If this is a webcam stream, limit the frame rate to what the connection can actually send.
+            # We also tell the client what frame rate we are starting at.
+            if boundaryStr is not None and contentTypeLower is not None and contentTypeLower.startswith("multipart/x-mixed-replace"):
+                self.FrameGovernor = FrameRateGovernor(self.Logger, self.WebStream.GetSendQueueDelaySec)
+                octoHttpResult.Headers[FrameRateGovernor.c_EffectiveFpsHeaderKey] = self.FrameGovernor.GetEffectiveFpsStr()
+
             # We also look at the content-type to determine if we should add compression to this request or not.
             # general rule of thumb is that compression is quite cheap but really helps with text, so we should compress when we
             # can.
             compressBody = self.shouldCompressBody(contentTypeLower, octoHttpResult, contentLength)
+            if compressBody:
+                self.CompressionContext.SetPayloadClass(ZStandardPayloadClass.FromContentType(contentTypeLower))
 
             # If the content length is known, tell the compression system, which will help performance.
             if contentLength is not None:
@@ -468,7 +543,10 @@ class OctoWebStreamHttpHelper:
                     # If this is a multipart stream (webcam streaming), every 1 second a value will be dumped into MultipartReadsPerSecond
                     # when it's there, we want to send it to the server for telemetry, and then zero it out.
                     if self.Logger.isEnabledFor(logging.DEBUG):
-                        self.Logger.debug(f"Multipart Stats; reads per second: {str(self.MultipartReadsPerSecond)}, body read high water mark {str(format(self.BodyReadTimeHighWaterMarkSec*1000.0, '.2f'))}ms, socket write high water mark {str(format(self.ServiceUploadTimeHighWaterMarkSec*1000.0, '.2f'))}ms")
+                        governorStr = ""
+                        if self.FrameGovernor is not None:
+                            governorStr = f", governor fps {self.FrameGovernor.GetEffectiveFpsStr()} sent {self.FrameGovernor.SentFrames} dropped {self.FrameGovernor.DroppedFrames}"
+                        self.Logger.debug(f"Multipart Stats; reads per second: {str(self.MultipartReadsPerSecond)}, body read high water mark {str(format(self.BodyReadTimeHighWaterMarkSec*1000.0, '.2f'))}ms, socket write high water mark {str(format(self.ServiceUploadTimeHighWaterMarkSec*1000.0, '.2f'))}ms{governorStr}")
                     if self.MultipartReadsPerSecond > 255 or self.MultipartReadsPerSecond < 0:
                         self.Logger.warn("self.MultipartReadsPerSecond is larger than uint8. "+str(self.MultipartReadsPerSecond))
                         self.MultipartReadsPerSecond  = 255
@@ -490,7 +568,7 @@ class OctoWebStreamHttpHelper:
                 webStreamMsgOffset = WebStreamMsg.End(builderContext.Builder)
 
                 # Wrap in the OctoStreamMsg and finalize.
-                buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builderContext.Builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+                buffer, msgStartOffsetBytes, msgSizeBytes = builderContext.Finalize(MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
 
                 # Send the message.
                 # If this is the last, we need to make sure to set that we have set the closed flag.
@@ -512,51 +590,48 @@ class OctoWebStreamHttpHelper:
                 isFirstResponse = False
                 messageCount += 1
 
+            # Any read ahead must be stopped before the response is closed.
+            self.closeBodyReadAhead()
+
             # Log about it - only if debug is enabled. Otherwise, we don't want to waste time making the log string.
             responseWriteDone = time.time()
             if self.Logger.isEnabledFor(logging.DEBUG):
                 self.Logger.debug(self.getLogMsgPrefix() + method+" [upload:"+str(format(requestExecutionStart - self.OpenedTime, '.3f'))+"s; request_exe:"+str(format(requestExecutionEnd - requestExecutionStart, '.3f'))+"s; send:"+str(format(responseWriteDone - requestExecutionEnd, '.3f'))+"s; body_read:"+str(format(self.BodyReadTimeSec, '.3f'))+"s; compress:"+str(format(self.CompressionTimeSec, '.3f'))+"s; octo_stream_upload:"+str(format(self.ServiceUploadTimeSec, '.3f'))+"s] size:("+str(nonCompressedContentReadSizeBytes)+"->"+str(contentReadBytes)+") compressed:"+str(compressBody)+" msgcount:"+str(messageCount)+" microreads:"+str(self.UnknownBodyChunkReadContext is not None)+" type:"+str(contentTypeLower)+" status:"+str(octoHttpResult.StatusCode)+" cached:"+str(isFromCache)+" for " + uri)
 
 
+    def closeBodyReadAhead(self):
+        bodyReadAhead = self.BodyReadAhead
+        if bodyReadAhead is not None:
+            self.BodyReadAhead = None
+            bodyReadAhead.Close()
+
+
     def buildHeaderVector(self, builder, octoHttpResult:OctoHttpRequest.Result):
         # Gather up the headers to return.
-        headerTableOffsets = []
-        headers = octoHttpResult.Headers
-        for name, value in headers.items():
-            nameLower = name.lower()
-
-            # Since we send the entire result as one non-encoded
-            # payload we want to drop this header. Otherwise the server might emit it to
-            # the client, when it actually doesn't match what the server sends to the client.
-            # Note: Typically, if the OctoPrint web server sent something chunk encoded,
-            # our web server will also send it to the client via chunk encoding. But it will handle
-            # that on it's own and set the header accordingly.
-            if nameLower == "transfer-encoding":
-                continue
-            # Don't send this easter egg.
-            if nameLower == "x-clacks-overhead":
-                continue
-
-            # Allocate strings
-            keyOffset = builder.CreateString(name)
-            valueOffset = builder.CreateString(value)
-            # Create the header table
-            HttpHeader.Start(builder)
-            HttpHeader.AddKey(builder, keyOffset)
-            HttpHeader.AddValue(builder, valueOffset)
-            headerTableOffsets.append(HttpHeader.End(builder))
-
-        # Check if there were any headers, if not, return null so we don't set the vector.
-        if len(headerTableOffsets) == 0:
-            return None
+        return HeaderHelper.BuildResponseHeaderVector(builder, octoHttpResult.Headers)
+
 
-        # Build the heaver vector
-        HttpInitialContext.StartHeadersVector(builder, len(headerTableOffsets))
-        for offset in headerTableOffsets:
-            # This function was very hard to find, I eventually found an example in the
-            # py samples in the flatbuffer repo.
-            builder.PrependUOffsetTRelative(offset)
-        return builder.EndVector()
+    # Returns True if this is the first message of an upload that's large enough to stream to the http server.
+    def shouldStreamUpload(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        # We only stream when we know the size, so we can set the content-length and know when it's done.
+        if self.KnownFullStreamUploadSizeBytes is None or self.KnownFullStreamUploadSizeBytes < StreamedUploadBody.c_MinStreamedUploadSizeBytes:
+            return False
+        # The upload is read from the stream's queue only as fast as the http server takes it, so without flow control the server
+        # can't be slowed down and the data would pile up in the queue. In that case the upload is buffered like it was before.
+        if self.WebStream.IsFlowControlEnabled() is False:
+            return False
+        # It must be the first message and there must be more to come.
+        return self.UploadBuffer is None and webStreamMsg.DataLength() > 0 and webStreamMsg.IsDataTransmissionDone() is False
+
+
+    # Called by the streamed upload body, returns the message's data as it should be sent to the http server.
+    def GetUploadDataFromMsg(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
+        buf = self.decompressBufferIfNeeded(webStreamMsg)
+        if len(buf) + self.UploadBytesReceivedSoFar > self.KnownFullStreamUploadSizeBytes:
+            self.Logger.warn(self.getLogMsgPrefix() + " received more bytes than it was expecting for the upload. thisMsg:"+str(len(buf))+"; so far:"+str(self.UploadBytesReceivedSoFar) + "; expected:"+str(self.KnownFullStreamUploadSizeBytes))
+            raise Exception("Too many bytes received for http upload stream")
+        self.UploadBytesReceivedSoFar += len(buf)
+        return buf
 
 
     def finalizeUnknownUploadSizeIfNeeded(self):
@@ -789,6 +864,7 @@ class OctoWebStreamHttpHelper:
         # Some requests like snapshot requests will already have a fully read body. In this case we use the existing body buffer instead of reading from the body.
         finalDataBuffer = None
         finalDataBufferMv_CanBeNone = None
+        readBufferSliceMv_CanBeNone = None
         try:
             bodyReadStartSec = time.time()
             if self.IsUsingFullBodyBuffer:
@@ -797,6 +873,9 @@ class OctoWebStreamHttpHelper:
             elif self.IsUsingCustomBodyStreamCallbacks:
                 # In this case we just call this callback, and send whatever it sends. Note that even if this is a boundary stream, we just send back what it sends.
                 # If None is returned, we are done.
+                # For webcam streams the callback returns the latest frame, so we wait until we should send the next frame before we get it.
+                if self.FrameGovernor is not None:
+                    self.FrameGovernor.WaitForNextFrameSlot()
                 finalDataBuffer = octoHttpResult.GetCustomBodyStreamCallback()
             else:
                 # If the boundary string exist and is not empty, we will use it to try to read the data.
@@ -805,6 +884,14 @@ class OctoWebStreamHttpHelper:
                 if self.ChunkedBodyHasNoContentLengthHeaders is False and boundaryStr_opt is not None and len(boundaryStr_opt) != 0:
                     # Try to read a single boundary chunk
                     readLength = self.readStreamChunk(octoHttpResult, boundaryStr_opt)
+                    # If the connection can't keep up with the webcam, drop frames until the governor says to send one.
+                    # We still have to read every frame, but the one we send is always the newest.
+                    if self.FrameGovernor is not None:
+                        while readLength != 0 and self.IsClosed is False and self.FrameGovernor.ShouldSendFrame() is False:
+                            readLength = self.readStreamChunk(octoHttpResult, boundaryStr_opt)
+                    # If something asked for a frame from this stream, give it a copy of this one.
+                    if readLength != 0 and self.FrameTap is not None and self.FrameTap.IsFrameWanted:
+                        self.FrameTap.OfferChunk(self.BodyReadTempBuffer, readLength)
                     # If we get a length, we have a buffer to use.
                     if readLength != 0:
                         # We create a memory view from the buffer, which is a zero copy operation and zero copy slicing.
@@ -812,11 +899,15 @@ class OctoWebStreamHttpHelper:
                         # memory views when we are done.
                         finalDataBufferMv_CanBeNone = memoryview(self.BodyReadTempBuffer)
                         finalDataBuffer = finalDataBufferMv_CanBeNone[0:readLength]
+                        readBufferSliceMv_CanBeNone = finalDataBuffer
                 else:
                     if self.UnknownBodyChunkReadContext is not None or (responseHandlerContext is None and self.shouldDoUnknownBodyChunkRead(contentTypeLower_NoneIfNotKnown, contentLength_NoneIfNotKnown)):
                         # According to the HTTP 1.1 spec, if there's no content length and no boundary string, then the body is chunk based transfer encoding.
-                        # Note that once we do on read as an unknown body size chunk read, we need to always do it, since there's a thread reading the body.
-                        finalDataBuffer = self.doUnknownBodyChunkRead(octoHttpResult)
+                        # Note that once we do on read as an unknown body size chunk read, we need to always do it, since it owns the body read state.
+                        finalDataBuffer = self.doUnknownBodyChunkRead(octoHttpResult, contentTypeLower_NoneIfNotKnown)
+                        # If the read was buffered, this is a memory view into the read buffer, which we need to release when we are done.
+                        if isinstance(finalDataBuffer, memoryview):
+                            readBufferSliceMv_CanBeNone = finalDataBuffer
                     else:
                         # If there is no boundary string, but we know the content length, it's safe to just read.
                         # This will block until either the full defaultBodyReadSizeBytes is read or the full request has been received.
@@ -831,7 +922,13 @@ class OctoWebStreamHttpHelper:
                             else:
                                 # Use a 2mb buffer.
                                 defaultBodyReadSizeBytes = 1024 * 1024 * 2
-                        finalDataBuffer = self.doBodyRead(octoHttpResult, defaultBodyReadSizeBytes)
+                        # For large bodies, read the next chunk while this one is compressed and sent.
+                        elif self.BodyReadAhead is None and BodyReadAhead.ShouldUse(contentLength_NoneIfNotKnown):
+                            self.BodyReadAhead = BodyReadAhead(self.Logger, lambda readSize: self.doBodyRead(octoHttpResult, readSize), defaultBodyReadSizeBytes, contentLength_NoneIfNotKnown)
+                        if self.BodyReadAhead is not None:
+                            finalDataBuffer = self.BodyReadAhead.Read()
+                        else:
+                            finalDataBuffer = self.doBodyRead(octoHttpResult, defaultBodyReadSizeBytes)
 
             # Keep track of read times.
             thisBodyReadTimeSec = time.time() - bodyReadStartSec
@@ -894,9 +991,10 @@ class OctoWebStreamHttpHelper:
             return (originalBufferSize, len(finalDataBuffer), builderContext.Builder.CreateByteVector(finalDataBuffer))
         finally:
             # If we used a memory view, release it.
-            # This also means that the finalDataBuffer is a memory view.
+            # Note we can't use finalDataBuffer for this, since it's replaced by the compressed buffer if we compressed.
+            if readBufferSliceMv_CanBeNone is not None:
+                readBufferSliceMv_CanBeNone.release()
             if finalDataBufferMv_CanBeNone is not None:
-                finalDataBuffer.release()
                 finalDataBufferMv_CanBeNone.release()
 
 
@@ -1112,6 +1210,7 @@ class OctoWebStreamHttpHelper:
             return None
 
 
+    # Only used if urllib3 doesn't support read1, see doUnknownBodyChunkRead.
     def doUnknownBodyChunkReadThread(self):
         try:
             if self.Logger.isEnabledFor(logging.DEBUG):
@@ -1169,41 +1268,126 @@ class OctoWebStreamHttpHelper:
     #   2) We then tired to do micro reads to build a buffer but it allowed us to return if there was enough. But this still failed because read still needs to fill the buffer,
     #      so if we wanted to read the last 5 bytes of the buffer but set our size to 10, it would block until the final 5 bytes were read.
     #
-    # So, the right way to do this is with response.raw.stream().
-    # This will read each chunk as it comes in, and return each complete chunk. This is the same way a web browser will handle the data, where it won't handle the data until the entire
-    # chunk is read. So there's no need to stream sub-chunks.
+    # So, the right way to do this is with response.raw.read1(), which blocks only until some data is ready and then returns whatever is there.
+    # For chunked bodies, it will return the data of the current chunk as it comes in. That means we wake up as soon as there's data, without any thread or polling.
+    #
+    # Once we have some data, we might want to buffer more before sending it, so the compression and stream is more efficient.
+    # To do that, we wait on the socket with select, but only up to the flush latency of the content type, measured from when this read started.
+    # If more data comes in, we append it into the read buffer, until the buffer is full or the latency is hit.
+    # Event streams are flushed on every read, since each event should be delivered right away.
     #
-    # There's still a problem with stream, which is it will block until the next chunk is ready. But for us, once we have data, we want to send it. Thus we must spin off a thread to do
-    # the stream reading, and then transfer the buffer. Also stream() is a generator, so it can't be re-entered.
+    # Returns None when the body is done, otherwise a bytes object or a memoryview into the read buffer, which must be released.
     #
-    def doUnknownBodyChunkRead(self, httpResult:OctoHttpRequest.Result):
+    def doUnknownBodyChunkRead(self, httpResult:OctoHttpRequest.Result, contentTypeLower_CanBeNone:str):
+
+        # If this is the first time, setup the unknown body read info.
+        # Once this is defined, this body read method must be used for the rest of the request.
+        context = self.UnknownBodyChunkReadContext
+        if context is None:
+            context = UnknownBodyChunkReadContext(httpResult, contentTypeLower_CanBeNone)
+            self.UnknownBodyChunkReadContext = context
+            # Older versions of urllib3 (< 2.0, used on the Sonic Pad) don't have read1, so we have to use the thread reader.
+            if context.CanUseRead1 is False:
+                context.Thread = ThreadBudget.StartThread("UnknownBodyChunkRead", self.doUnknownBodyChunkReadThread)
+
+        if context.Thread is not None:
+            return self.doUnknownBodyChunkReadFromThread()
+
+        # Once the read is complete, there's nothing else to do.
+        if context.ReadComplete:
+            return None
+
+        # The flush latency is from when we start the read, so if we have already been waiting a while for data, we send it right away.
+        response = httpResult.ResponseForBodyRead
+        firstData = None
+        filledBytes = 0
+        bufferedBytes = 0
+        flushDeadlineSec = time.time() + context.FlushLatencySec
+        try:
+            while self.IsClosed is False:
+                # Read whatever is ready, up to the space left in the buffer. This will block until some data is ready or the body is done.
+                # The first read might still be held in firstData, so the space left is based on everything we have buffered, so we never grow the buffer.
+                data = response.raw.read1(context.FlushSizeBytes - bufferedBytes)
+                if data is None or len(data) == 0:
+                    context.ReadComplete = True
+                    break
 
+                # Optimize for the single read case, where we don't need to copy the data into the buffer.
+                if firstData is None and filledBytes == 0:
+                    firstData = data
+                else:
+                    # We have more than one read, so copy everything into the read buffer.
+                    if context.Buffer is None:
+                        context.Buffer = bytearray(context.FlushSizeBytes)
+                    if firstData is not None:
+                        context.Buffer[0:len(firstData)] = firstData
+                        filledBytes = len(firstData)
+                        firstData = None
+                    context.Buffer[filledBytes:filledBytes+len(data)] = data
+                    filledBytes += len(data)
+
+                # Check if we should flush now.
+                bufferedBytes = filledBytes if firstData is None else len(firstData)
+                if bufferedBytes >= context.FlushSizeBytes or context.FlushLatencySec <= 0 or context.Socket is None:
+                    break
+
+                # Wait for more data, but only until the flush latency.
+                if self.waitForSocketData(context.Socket, flushDeadlineSec - time.time()) is False:
+                    break
+
+        except Exception as e:
+            # Any exception will end the body read, but we will still send what we have.
+            context.ReadComplete = True
+            # If the web stream is already closed, don't bother logging the exception, since it's most likely from the socket shutdown.
+            # There doesn't seem to be an exception type for IncompleteRead, so we will just catch it like this.
+            if self.IsClosed is False:
+                if "IncompleteRead" in str(e):
+                    self.Logger.warn("doUnknownBodyChunkRead failed with an IncompleteRead, so the stream is done.")
+                else:
+                    Sentry.Exception(self.getLogMsgPrefix()+ " exception thrown in doUnknownBodyChunkRead. Ending body read.", e)
+
+        if firstData is not None:
+            return firstData
+        if filledBytes == 0:
+            return None
+        bufferMv = memoryview(context.Buffer)
+        with bufferMv:
+            return bufferMv[0:filledBytes]
+
+
+    # Waits up to timeoutSec for the socket to have data to read. Returns True if there's data ready.
+    @staticmethod
+    def waitForSocketData(sock, timeoutSec:float) -> bool:
+        # SSL sockets can have decrypted data buffered that select won't see.
+        if hasattr(sock, "pending") and sock.pending() > 0:
+            return True
+        if timeoutSec <= 0:
+            return False
+        readable, _, _ = select.select([sock], [], [], timeoutSec)
+        return len(readable) > 0
+
+
+    # Only used if urllib3 doesn't support read1. The thread reads each chunk as it comes in, and the web stream thread waits on them.
+    def doUnknownBodyChunkReadFromThread(self):
         # Even though we read complete chunks as they come in, we might want to buffer smaller chunks up
         # before sending them so the compression and stream is more efficient.
         # This does need to be small, because we wan't reading this min time period back to back,
         # we are reading a chunk, doing all of the send logic, and then spinning back to here.
         # So if we set this at exactly 16.6 for a 60fps stream, for example, we will fall behind.
-        minBufferBuildTimeSec = 0.010 # 10ms
+        minBufferBuildTimeSec = self.UnknownBodyChunkReadContext.FlushLatencySec
 
         # Just as a sanity check, we will define the max amount of time we will wait for one chunk.
         # This will make sure we don't get stuck in a loop if there are any bugs.
         maxChunkReadTimeSec = 20 * 60 * 60 # 20 hours
 
-        # If this is the first time, setup the unknown body read info.
-        # Once this is defined, this body read method must be used for the rest of the request.
-        if self.UnknownBodyChunkReadContext is None:
-            context = UnknownBodyChunkReadContext(httpResult)
-            context.Thread = threading.Thread(target=self.doUnknownBodyChunkReadThread)
-            self.UnknownBodyChunkReadContext = context
-            context.Thread.start()
-
         try:
             startSec = time.time()
             chunkBufferList = None
 
             # Since we will always sleep for at least the min time, there's no need to do work until the min time is meet.
             # If we did do the loop, we would just end up spinning and sleeping again.
-            time.sleep(minBufferBuildTimeSec)
+            if minBufferBuildTimeSec > 0:
+                time.sleep(minBufferBuildTimeSec)
 
             # Try to read a chunk or wait for the read to be done.
             # Only try to read while the stream is open.
@@ -1314,18 +1498,105 @@ class OctoWebStreamHttpHelper:
         return str(format(value, '.3f'))
 
 
-# Used to capture the context of the unknown body read thread.
+# Used to capture the context of the unknown body read.
 class UnknownBodyChunkReadContext:
 
-    def __init__(self, httpResult:OctoHttpRequest.Result) -> None:
+    # How the unknown body size reader batches data before it's sent, keyed by the content type (without any params).
+    #   FlushSizeBytes  - Once this much data is buffered, it's sent right away. This is also the size of the read buffer.
+    #   FlushLatencySec - The max time we will hold data waiting for more to arrive. 0 means every read is sent as soon as it arrives.
+    # Event streams are latency first, each event should be delivered as soon as it comes in.
+    c_FlushPolicies = {
+        "text/event-stream" : (64 * 1024, 0.0),
+    }
+    # Most other streams are things like long polls or chunked file downloads, so we buffer a bit to make the compression and stream more efficient.
+    c_DefaultFlushPolicy = (256 * 1024, 0.010)
+
+
+    def __init__(self, httpResult:OctoHttpRequest.Result, contentTypeLower_CanBeNone:str) -> None:
         self.HttpResult = httpResult
+
+        # Find the flush policy for this content type.
+        policy = UnknownBodyChunkReadContext.c_DefaultFlushPolicy
+        if contentTypeLower_CanBeNone is not None:
+            policy = UnknownBodyChunkReadContext.c_FlushPolicies.get(contentTypeLower_CanBeNone.split(";", 1)[0].strip(), policy)
+        self.FlushSizeBytes, self.FlushLatencySec = policy
+
+        # The buffer is only allocated if we need to append more than one read.
+        self.Buffer:bytearray = None
+
+        # Set to true when the read is done either from the end of the body or an error.
+        # Once true, it will never read again, but for the thread reader we do need to process the BufferList
+        self.ReadComplete = False
+
+        # The socket is used to wait for more data and to unblock the read on close. If we can't get it, we just flush on every read.
+        self.Socket = None
+        response = httpResult.ResponseForBodyRead
+        self.CanUseRead1 = response is not None and hasattr(response.raw, "read1")
+        if self.CanUseRead1:
+            try:
+                # pylint: disable=protected-access
+                connection = getattr(response.raw, "_connection", None)
+                if connection is not None:
+                    self.Socket = getattr(connection, "sock", None)
+            except Exception:
+                self.Socket = None
+
+        # Only used by the thread reader.
         self.Thread:threading.Thread = None
         self.BufferLock = threading.Lock()
         self.BufferDataReadyEvent = threading.Event()
-
         # We use a list so we can efficiently append all of the pending buffers at once when they are being sent.
         self.BufferList = []
 
-        # Set to true when the read is done either from the end of the body or an error.
-        # Once true, it will never read again, but we do need to process the BufferList
-        self.ReadComplete = False
+
+# The body of a large upload that's streamed to the http server as the messages come in from the server.
+#
+# Requests uses the length for the content-length header and then iterates it on the web stream thread to send the body.
+# The first message is given when it's created, and the rest are taken from the web stream's queue. As they are taken,
+# the flow control window is given back to the server, so the upload only goes as fast as the http server takes it.
+class StreamedUploadBody:
+
+    # Uploads smaller than this are buffered, since they are fast and it's possible to retry them on a fallback url.
+    c_MinStreamedUploadSizeBytes = 4 * 1024 * 1024
+    # How long we wait for the next message of the upload before we give up.
+    c_NextMessageTimeoutSec = 120.0
+
+    def __init__(self, httpHelper:OctoWebStreamHttpHelper, firstMsg:WebStreamMsg.WebStreamMsg) -> None:
+        self.HttpHelper = httpHelper
+        self.FirstMsg = firstMsg
+        self.SizeBytes = httpHelper.KnownFullStreamUploadSizeBytes
+        self.HasStarted = False
+
+
+    def __len__(self) -> int:
+        return self.SizeBytes
+
+
+    def __iter__(self):
+        # The messages are taken from the queue as they are read, so the body can only be sent once.
+        # If the first attempt failed before reading any data, like a connection error, a fallback url can still read it.
+        if self.HasStarted:
+            raise Exception("The streamed upload body was already sent, it can't be sent again.")
+        self.HasStarted = True
+        helper = self.HttpHelper
+        msg = self.FirstMsg
+        self.FirstMsg = None
+        while True:
+            yield helper.GetUploadDataFromMsg(msg)
+            if helper.UploadBytesReceivedSoFar >= self.SizeBytes:
+                return
+            if msg.IsDataTransmissionDone():
+                raise Exception("The streamed upload ended before all of the data was received. Total:"+str(self.SizeBytes)+"; rec so far:"+str(helper.UploadBytesReceivedSoFar))
+            msg = helper.WebStream.GetNextUploadMessage(StreamedUploadBody.c_NextMessageTimeoutSec)
+            if msg is None:
+                raise Exception("The streamed upload stopped before all of the data was received. Total:"+str(self.SizeBytes)+"; rec so far:"+str(helper.UploadBytesReceivedSoFar))
+
+
+    # Reads the full body into one buffer, for the handlers that need it all at once.
+    def ReadAll(self) -> bytearray:
+        buffer = bytearray(self.SizeBytes)
+        pos = 0
+        for buf in self:
+            buffer[pos:pos+len(buf)] = buf
+            pos += len(buf)
+        return buffer
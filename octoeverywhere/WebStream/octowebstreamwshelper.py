@@ -11,6 +11,7 @@ from ..compat import Compat
 from ..websocketimpl import Client
 from ..localip import LocalIpHelper
 from ..compression import Compression, CompressionContext
+from ..zstandarddictionary import ZStandardPayloadClass
 from .octoheaderimpl import HeaderHelper
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
@@ -29,6 +30,14 @@ from ..Proto import DataCompression
 #
 class OctoWebStreamWsHelper:
 
+    # Limits for the messages we will hold while waiting for the local websocket to open.
+    # If the pre-open queue fills, the web stream thread blocks until the websocket opens or the stream closes.
+    c_MaxPreOpenQueueMsgs = 200
+    c_MaxPreOpenQueueBytes = 2 * 1024 * 1024
+
+    # The marker we look for in OctoPrint's connected message, see onWsData for details.
+    c_ConfigHashMarker = b"config_hash"
+
     # Called by the main socket thread so this should be quick!
     # Throwing from here will shutdown the entire connection.
     def __init__(self, streamId, logger, webStream, webStreamOpenMsg, openedTime):
@@ -51,6 +60,13 @@ class OctoWebStreamWsHelper:
         self.IsWsObjOpened = False
         self.IsWsObjClosed = False
 
+        # Messages from the server that arrive before the websocket is open are held here, in order, and flushed by onWsOpened.
+        # The event is set whenever there might be room in the queue or the state changed, so a blocked web stream thread can wake up.
+        # All of these are protected by the StateLock.
+        self.PreOpenQueue = []
+        self.PreOpenQueueBytes = 0
+        self.PreOpenQueueEvent = threading.Event()
+
         # Capture the initial http context
         self.HttpInitialContext = webStreamOpenMsg.HttpInitialContext()
         if self.HttpInitialContext is None:
@@ -66,6 +82,9 @@ class OctoWebStreamWsHelper:
         self.Headers = HeaderHelper.GatherWebsocketRequestHeaders(self.Logger, self.HttpInitialContext)
         self.SubProtocolList = HeaderHelper.GetWebSocketSubProtocols(self.Logger, self.HttpInitialContext)
 
+        # The path tells us what kind of messages this websocket sends, which picks the compression dictionary.
+        self.CompressionContext.SetPayloadClass(ZStandardPayloadClass.FromWebsocketPath(OctoStreamMsgBuilder.BytesToString(self.HttpInitialContext.Path())))
+
         # It might take multiple attempts depending on the network setup of the client.
         # This value keeps track of them.
         self.ConnectionAttempt = 0
@@ -240,6 +259,11 @@ class OctoWebStreamWsHelper:
             # We must capture this in the same lock as self.IsClosed
             wsToClose = self.Ws
 
+            # Drop anything we were holding for the websocket to open, and wake the web stream thread if it's waiting on the queue.
+            self.PreOpenQueue = []
+            self.PreOpenQueueBytes = 0
+            self.PreOpenQueueEvent.set()
+
         self.Logger.info(self.getLogMsgPrefix()+"websocket closed after " +str(time.time() - self.OpenedTime) + " seconds")
 
         # The initial connection is created (or at least started) in the constructor, but there's re-attempt logic
@@ -265,18 +289,6 @@ class OctoWebStreamWsHelper:
     # as long as it gets cleaned up when the socket closes.
     def IncomingServerMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
 
-        # We can get messages from this web stream before the actual websocket has opened and is ready for messages.
-        # If this happens, when we try to send the message on the socket and we will get an error saying "the socket is closed" (which is incorrect, it's not open yet).
-        # So we need to delay until we know the socket is ready or the webstream is shutdown.
-        while self.IsWsObjOpened is False:
-            # Check if the webstream has closed or the socket object is now reporting closed.
-            if self.IsWsObjClosed is True or self.IsClosed:
-                return True
-
-            # Sleep for a bit to wait for the socket open. The socket will open super quickly (5-10ms), so don't delay long.
-            # Sleep for 5ms.
-            time.sleep(0.005)
-
         # Note it's ok for this to be empty. Since DataAsByteArray returns 0 if it doesn't
         # exist, we need to check for it.
         buffer = webStreamMsg.DataAsByteArray()
@@ -300,6 +312,13 @@ class OctoWebStreamWsHelper:
         else:
             raise Exception("Web stream ws was sent a data type that's unknown. "+str(msgType))
 
+        # We can get messages from this web stream before the actual websocket has opened and is ready for messages.
+        # If that's the case, the message is queued and will be sent by onWsOpened, in order, once the websocket opens.
+        if self.IsWsObjOpened is False:
+            result = self.queuePreOpenMessage(buffer, sendType)
+            if result is not None:
+                return result
+
         # Before we send, make sure we have a local websocket still and it's not closed.
         # If the websocket object is closed ignore this message. It will throw if the socket is closed
         # which will take down the entire OctoStream. But since it's closed the web stream is already cleaning up.
@@ -320,6 +339,71 @@ class OctoWebStreamWsHelper:
         return False
 
 
+    # Called on the web stream thread when a message arrives before the websocket is open.
+    # Returns False if the message was queued, True if the web stream should close, or None if the websocket opened and the message should be sent now.
+    def queuePreOpenMessage(self, buffer, sendType):
+        while True:
+            with self.StateLock:
+                # Check if the webstream has closed or the socket object is now reporting closed.
+                if self.IsWsObjClosed is True or self.IsClosed:
+                    return True
+                # If the websocket opened, the queue has been fully flushed, so the message can be sent directly.
+                if self.IsWsObjOpened:
+                    return None
+                # Queue the message if there's room. We always allow one message, no matter the size, so a large message can't get stuck.
+                if len(self.PreOpenQueue) == 0 or (len(self.PreOpenQueue) < self.c_MaxPreOpenQueueMsgs and self.PreOpenQueueBytes + len(buffer) <= self.c_MaxPreOpenQueueBytes):
+                    self.PreOpenQueue.append((buffer, sendType))
+                    self.PreOpenQueueBytes += len(buffer)
+                    return False
+                # The queue is full, we need to wait for the websocket to open or the stream to close.
+                self.PreOpenQueueEvent.clear()
+            self.PreOpenQueueEvent.wait()
+
+
+    # OctoPrint has a "connected" message that includes a config hash that indicates the has of the current
+    # settings of OctoPrint. Since OctoEverywhere might modify the settings, for example update the webcam absolute urls,
+    # we need to indicate the hash has changed. For web clients, there's no effect, since they will always load the websocket with this value.
+    # But, for any kind of app that might be switching between LAN and OE connections, they might use this to know if the settings changed.
+    # If we don't update it, they might not pull the OE updated settings when switching from LAN to OE, and then the webcam won't work.
+    #
+    # Thus, we will search the first few text messages for the marker we expect. Note that we don't parse the json or decode the string, to make sure it's not changed at all.
+    # If we find the value we expect, we inject a constant as a prefix, to ensure the same has from OE is used, but it will always be unique for OE.
+    # The only issue this could cause is if any system is expecting the hash to be a fixed length, (which it kind of should be) this will break that assumption.
+    #
+    # Returns the buffer to send, which is the original buffer if nothing was changed.
+    def tryToUpdateConfigHash(self, buffer:bytes):
+        self.LookingForConnectMsgAttempts += 1
+        try:
+            indexOfConfigHash = buffer.find(OctoWebStreamWsHelper.c_ConfigHashMarker)
+            if indexOfConfigHash == -1:
+                if self.LookingForConnectMsgAttempts >= 5:
+                    self.Logger.warn(self.getLogMsgPrefix()+" failed to to find OctoPrint connect message in the first few WS messages.")
+                return buffer
+            # We found it!
+            # Notes:
+            #   We don't want to assume any kind of white space, so we parse each token we need to find.
+            #   This should always really be the same, but we are trying to be robust.
+            indexOfConfigHash += len(OctoWebStreamWsHelper.c_ConfigHashMarker)
+            # Try to find the closing quote of the key.
+            closeKeyQuote = buffer.find(b"\"", indexOfConfigHash)
+            if closeKeyQuote == -1:
+                raise Exception("Failed to find closing key quote. "+str(buffer))
+            closeKeyQuote += 1
+            # Try to find the quote that opens the hash string.
+            openStringQuote = buffer.find(b"\"", closeKeyQuote)
+            if openStringQuote == -1:
+                raise Exception("Failed to find open key quote. "+str(buffer))
+            openStringQuote += 1
+            # We don't need to find the end quote, we just need to inject our key into the string.
+            # since the hash is all lower case letters and numbers, use a similar thing for our header.
+            buffer = buffer[:openStringQuote] + b"oe" + buffer[openStringQuote:]
+            # Set this number high, so we dont have to look anymore.
+            self.LookingForConnectMsgAttempts = 9999
+        except Exception as ex:
+            Sentry.Exception("Websocket stream helper failed to parse websocket for config hash mod.", ex)
+        return buffer
+
+
     def onWsData(self, ws, buffer:bytes, msgType):
         # Only handle callbacks for the current websocket.
         if self.Ws is not None and self.Ws != ws:
@@ -337,50 +421,9 @@ class OctoWebStreamWsHelper:
             else:
                 raise Exception("Web stream ws helper got a message type that's not supported. "+str(msgType))
 
-            # What is this?
-            #
-            # OctoPrint has a "connected" message that includes a config hash that indicates the has of the current
-            # settings of OctoPrint. Since OctoEverywhere might modify the settings, for example update the webcam absolute urls,
-            # we need to indicate the hash has changed. For web clients, there's no effect, since they will always load the websocket with this value.
-            # But, for any kind of app that might be switching between LAN and OE connections, they might use this to know if the settings changed.
-            # If we don't update it, they might not pull the OE updated settings when switching from LAN to OE, and then the webcam won't work.
-            #
-            # Thus, we will search the first few messages for the string we expect. Note that we don't parse the json, to make sure it's not changed at all.
-            # If we find the string value we expect, we inject a constant as a prefix, to ensure the same has from OE is used, but it will always be unique for OE.
-            # The only issue this could cause is if any system is expecting the hash to be a fixed length, (which it kind of should be) this will break that assumption.
-            if Compat.IsOctoPrint() and self.LookingForConnectMsgAttempts < 5:
-                self.LookingForConnectMsgAttempts += 1
-                try:
-                    c_configHashStringSearch = "config_hash"
-                    msgStr = buffer.decode(encoding="utf-8")
-                    indexOfConfigHash = msgStr.find(c_configHashStringSearch)
-                    if indexOfConfigHash != -1:
-                        # We found it!
-                        # Notes:
-                        #   We don't want to assume any kind of white space, so we parse each token we need to find.
-                        #   This should always really be the same, but we are trying to be robust.
-                        indexOfConfigHash += len(c_configHashStringSearch)
-                        # Try to find the closing quote of the key.
-                        closeKeyQuote = msgStr.find("\"", indexOfConfigHash)
-                        if closeKeyQuote == -1:
-                            raise Exception("Failed to find closing key quote. "+msgStr)
-                        closeKeyQuote += 1
-                        # Try to find the quote that opens the hash string.
-                        openStringQuote = msgStr.find("\"", closeKeyQuote)
-                        if openStringQuote == -1:
-                            raise Exception("Failed to find open key quote. "+msgStr)
-                        openStringQuote += 1
-                        # We don't need to find the end quote, we just need to inject our key into the string.
-                        # since the hash is all lower case letters and numbers, use a similar thing for our header.
-                        newStr = msgStr[:openStringQuote] + "oe" + msgStr[openStringQuote:]
-                        buffer = newStr.encode(encoding="utf-8")
-                        # Set this number high, so we dont have to look anymore.
-                        self.LookingForConnectMsgAttempts = 9999
-                    elif self.LookingForConnectMsgAttempts >= 5:
-                        self.Logger.warn(self.getLogMsgPrefix()+" failed to to find OctoPrint connect message in the first few WS messages.")
-                except Exception as ex:
-                    Sentry.Exception("Websocket stream helper failed to parse websocket for config hash mod.", ex)
-
+            # For OctoPrint, look for the config hash in the first few text messages. See tryToUpdateConfigHash for details.
+            if sendType == WebSocketDataTypes.WebSocketDataTypes.Text and self.LookingForConnectMsgAttempts < 5 and Compat.IsOctoPrint():
+                buffer = self.tryToUpdateConfigHash(buffer)
 
             # Figure out if we should compress the data.
             usingCompression = len(buffer) >= Compression.MinSizeToCompress
@@ -392,7 +435,13 @@ class OctoWebStreamWsHelper:
                 buffer = compressionResult.Bytes
 
             # Send the message along!
-            builder = OctoStreamMsgBuilder.CreateBuffer(len(buffer) + 200)
+            # Most websocket messages are small, so they use a pooled builder, and the message is copied out of it.
+            builderSizeBytes = len(buffer) + 200
+            isPooledBuilder = builderSizeBytes <= OctoStreamMsgBuilder.c_PooledBuilderSizeBytes
+            if isPooledBuilder:
+                builder = OctoStreamMsgBuilder.GetPooledBuilder()
+            else:
+                builder = OctoStreamMsgBuilder.CreateBuffer(builderSizeBytes)
 
             # Note its ok to have an empty buffer, we still want to send the ping.
             dataOffset = None
@@ -410,7 +459,10 @@ class OctoWebStreamWsHelper:
             if dataOffset is not None:
                 WebStreamMsg.AddData(builder, dataOffset)
             webStreamMsgOffset = WebStreamMsg.End(builder)
-            buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+            if isPooledBuilder:
+                buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalizePooled(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+            else:
+                buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
 
             # Send it!
             self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes)
@@ -424,8 +476,10 @@ class OctoWebStreamWsHelper:
         if self.Ws is not None and self.Ws != ws:
             return
 
-        # Indicate the socket is closed.
-        self.IsWsObjClosed = True
+        # Indicate the socket is closed, and wake the web stream thread if it's waiting on the pre-open queue.
+        with self.StateLock:
+            self.IsWsObjClosed = True
+        self.PreOpenQueueEvent.set()
 
         # Make sure the stream is closed.
         self.WebStream.Close()
@@ -468,11 +522,33 @@ class OctoWebStreamWsHelper:
         if self.Ws is not None and self.Ws != ws:
             return
 
-        # Update the state to indicate we are ready to take messages.
-        self.IsWsObjClosed = False
-        self.IsWsObjOpened = True
         self.SuccessfullyOpenedSocket = True
+
+        # Flush any messages that arrived before the websocket opened, in order.
+        # The opened flag is only set once the queue is empty under the lock, so the web stream thread can't send ahead of a queued message.
+        # Sending only adds the message to the websocket's send queue, so this is quick.
+        flushedMsgs = 0
+        while True:
+            with self.StateLock:
+                queue = self.PreOpenQueue
+                self.PreOpenQueue = []
+                self.PreOpenQueueBytes = 0
+                if len(queue) == 0:
+                    # Update the state to indicate we are ready to take messages.
+                    self.IsWsObjClosed = False
+                    self.IsWsObjOpened = True
+                    break
+                # Wake the web stream thread if it's waiting on a full queue.
+                self.PreOpenQueueEvent.set()
+            for buffer, sendType in queue:
+                ws.SendWithOptCode(buffer, optCode=sendType)
+            flushedMsgs += len(queue)
+        self.PreOpenQueueEvent.set()
+
         self.Logger.info(self.getLogMsgPrefix()+"opened, attempt "+str(self.ConnectionAttempt) + " after " +str(time.time() - self.OpenedTime) + " seconds")
+        if flushedMsgs > 0 and self.FirstWsMessageSentToLocal is False:
+            self.Logger.info(self.getLogMsgPrefix()+"first message sent to local server after " +str(time.time() - self.OpenedTime) + " seconds, "+str(flushedMsgs)+" queued before open")
+            self.FirstWsMessageSentToLocal = True
 
 
     def getLogMsgPrefix(self):
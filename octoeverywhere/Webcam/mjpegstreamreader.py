@@ -0,0 +1,253 @@
+import re
+import logging
+
+import requests
+
+
+# A small pool of frame buffers, which are reused once the owner of the frame gives them back.
+#
+# Only buffers that are released with Release are reused, so a frame that's handed to something that might keep it, like another thread,
+# is safe as long as it's never released. Those buffers are just left to the garbage collector.
+# This saves allocating and freeing a large buffer for every frame, which is costly for frames over the mmap threshold.
+class FrameBufferPool:
+
+    def __init__(self, maxBuffers:int) -> None:
+        self.MaxBuffers = maxBuffers
+        self.FreeBuffers = []
+
+
+    # Returns a buffer that holds a copy of the data.
+    def GetCopy(self, data) -> bytearray:
+        if len(self.FreeBuffers) == 0:
+            return bytearray(data)
+        buf = self.FreeBuffers.pop()
+        buf[:] = data
+        return buf
+
+
+    # Returns a buffer of the given size, the contents are not cleared.
+    def GetBuffer(self, size:int) -> bytearray:
+        if len(self.FreeBuffers) == 0:
+            return bytearray(size)
+        buf = self.FreeBuffers.pop()
+        if len(buf) > size:
+            del buf[size:]
+        elif len(buf) < size:
+            buf.extend(bytes(size - len(buf)))
+        return buf
+
+
+    # Gives a buffer back to the pool. The caller must not use the buffer after this, or hold any memoryviews of it.
+    def Release(self, buf:bytearray) -> None:
+        if isinstance(buf, bytearray) and len(self.FreeBuffers) < self.MaxBuffers:
+            self.FreeBuffers.append(buf)
+
+
+# Reads jpeg frames from a mjpeg stream, one at a time, keeping the connection open between frames.
+#
+# Each frame is found by it's Content-Length header if it has one, otherwise by finding the end of the jpeg.
+# Streams that send jpegs with no multipart headers at all are also supported.
+# Everything is parsed as bytes, the stream is never decoded as a string.
+#
+# Data that's read past the end of a frame is kept for the next frame, so the reader must be used for all reads of the stream.
+class MjpegStreamReader:
+
+    # The most we ask for in one read, it's returned as soon as any data is ready, so this doesn't add latency.
+    c_ReadSize = 64 * 1024
+    # While we are looking for the part headers, we read less, so when the frame has a Content-Length most of it is read right into the frame buffer.
+    c_HeaderReadSize = 1024
+    # Older versions of urllib3 (before 2.0) don't have read1, and read waits until it has all of the bytes asked for.
+    # So in that case we read less at a time, so we don't wait on the next frame to finish the current one.
+    c_NoRead1ReadSize = 4 * 1024
+    # Limits, so a stream that's not what we expect doesn't make us buffer forever.
+    c_MaxHeaderSize = 16 * 1024
+    c_MaxFrameSize = 20 * 1024 * 1024
+
+    c_ContentLengthRegex = re.compile(rb"content-length[ \t]*:[ \t]*(\d+)", re.IGNORECASE)
+    c_ContentTypeRegex = re.compile(rb"content-type[ \t]*:[ \t]*([^\r\n]+)", re.IGNORECASE)
+    c_DefaultContentType = "image/jpeg"
+
+    # If poolSize is greater than 0, frames are returned from a buffer pool, which is useful for readers that read a lot of frames.
+    # The pool only reuses frames that are given back with ReleaseFrame, so the caller decides which frames are safe to reuse.
+    def __init__(self, logger:logging.Logger, response:requests.Response, poolSize:int = 0) -> None:
+        self.Logger = logger
+        # We use the raw response, so we can control directly how much we read. read1 returns what's ready without waiting for more.
+        self.Raw = response.raw
+        self.Read1 = self.Raw.read1 if hasattr(self.Raw, "read1") else self._ReadNoRead1
+        self.ReadInto = self.Raw.readinto
+        self.Buffer = bytearray()
+        self.Pool = FrameBufferPool(poolSize) if poolSize > 0 else None
+        # The content type of the last frame read.
+        self.ContentType:str = MjpegStreamReader.c_DefaultContentType
+        self._ContentTypeBytes = None
+
+
+    # Reads the next frame from the stream. The frame is only the jpeg, without the part headers.
+    # Returns None if the stream ended or the frame couldn't be parsed. IO errors from the stream are raised.
+    def ReadFrame(self) -> bytearray:
+        buf = self.Buffer
+
+        # Skip anything before the start of the part headers or the jpeg, like the \r\n that ends the last part.
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in (0x0D, 0x0A):
+                pos += 1
+            if len(buf) - pos >= 2:
+                break
+            if self._Fill(MjpegStreamReader.c_HeaderReadSize) is False:
+                return None
+
+        # If there are no part headers, the jpeg starts right away.
+        frameSize = None
+        if buf[pos] == 0xFF and buf[pos+1] == 0xD8:
+            bodyStart = pos
+        else:
+            # Find the end of the part headers.
+            # Example: --boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n
+            headerEnd = buf.find(b"\r\n\r\n", pos)
+            while headerEnd == -1:
+                if len(buf) - pos > MjpegStreamReader.c_MaxHeaderSize:
+                    self.Logger.info("MjpegStreamReader - Failed, no end of the part headers found.")
+                    return None
+                searchStart = max(pos, len(buf) - 3)
+                if self._Fill(MjpegStreamReader.c_HeaderReadSize) is False:
+                    return None
+                headerEnd = buf.find(b"\r\n\r\n", searchStart)
+            headers = bytes(buf[pos:headerEnd])
+            bodyStart = headerEnd + 4
+            match = MjpegStreamReader.c_ContentLengthRegex.search(headers)
+            if match is not None:
+                frameSize = int(match.group(1))
+            match = MjpegStreamReader.c_ContentTypeRegex.search(headers)
+            if match is not None:
+                self._SetContentType(match.group(1))
+
+        # Find the end of the frame.
+        if frameSize is not None:
+            if frameSize > MjpegStreamReader.c_MaxFrameSize:
+                self.Logger.warning(f"MjpegStreamReader - Failed, the frame size {frameSize} is too large.")
+                return None
+            frameEnd = bodyStart + frameSize
+            if len(buf) < frameEnd:
+                # We know the size, so read the rest of the frame right into the frame buffer.
+                return self._ReadRestOfFrame(bodyStart, frameSize)
+        else:
+            frameEnd = self._FindJpegEnd(bodyStart)
+            if frameEnd == -1:
+                return None
+
+        # Copy the frame out and drop it from the buffer, anything past it is the start of the next part.
+        if self.Pool is None:
+            frame = buf[bodyStart:frameEnd]
+        else:
+            with memoryview(buf) as view:
+                with view[bodyStart:frameEnd] as frameView:
+                    frame = self.Pool.GetCopy(frameView)
+        del buf[:frameEnd]
+        return frame
+
+
+    # Gives a frame from ReadFrame back to the reader, so its buffer can be reused for a later frame.
+    # Only call this when nothing else has the frame, since the buffer will be overwritten. Frames that are shared don't need to be released.
+    def ReleaseFrame(self, frame:bytearray) -> None:
+        if self.Pool is not None and frame is not None:
+            self.Pool.Release(frame)
+
+
+    # Reads the rest of a frame that's partly in the buffer, right into the frame buffer.
+    # Returns None if the stream ended.
+    def _ReadRestOfFrame(self, bodyStart:int, frameSize:int) -> bytearray:
+        buf = self.Buffer
+        frame = self.Pool.GetBuffer(frameSize) if self.Pool is not None else bytearray(frameSize)
+        received = len(buf) - bodyStart
+        with memoryview(frame) as frameView:
+            frameView[:received] = buf[bodyStart:]
+            buf.clear()
+            while received < frameSize:
+                with frameView[received:] as restView:
+                    read = self.ReadInto(restView)
+                if not read:
+                    return None
+                received += read
+        return frame
+
+
+    # Given the start of a jpeg in the buffer, reads until the end of the jpeg is in the buffer, and returns the index after it.
+    # Returns -1 on failure.
+    def _FindJpegEnd(self, start:int) -> int:
+        buf = self.Buffer
+        if self._EnsureBuffered(start + 2) is False:
+            return -1
+        if buf[start] != 0xFF or buf[start+1] != 0xD8:
+            self.Logger.info("MjpegStreamReader - Failed, the part has no Content-Length and isn't a jpeg.")
+            return -1
+
+        # Skip the header segments, since they can hold data that looks like the end of the image, like a thumbnail in the exif data.
+        # Once we get to the image data, 0xFF is always followed by 0x00 or a restart marker, so the first 0xFF 0xD9 is the end of the image.
+        pos = start + 2
+        while True:
+            if pos - start > MjpegStreamReader.c_MaxFrameSize or self._EnsureBuffered(pos + 4) is False:
+                return -1
+            if buf[pos] != 0xFF:
+                # This isn't a segment header, so we don't know where the image data starts. Fall back to searching for the end marker.
+                break
+            marker = buf[pos+1]
+            if marker == 0xFF:
+                # Fill bytes.
+                pos += 1
+            elif marker == 0xD9:
+                return pos + 2
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                # Markers with no length.
+                pos += 2
+            else:
+                pos += 2 + ((buf[pos+2] << 8) | buf[pos+3])
+                if marker == 0xDA:
+                    # The start of the image data.
+                    break
+
+        # Searching for a single byte is much faster than searching for two, and 0xFF is rare in the image data,
+        # so we find each 0xFF and check the byte after it.
+        while True:
+            pos = buf.find(b"\xff", pos)
+            while pos != -1 and pos + 1 < len(buf):
+                if buf[pos+1] == 0xD9:
+                    return pos + 2
+                pos = buf.find(b"\xff", pos + 1)
+            if len(buf) - start > MjpegStreamReader.c_MaxFrameSize:
+                self.Logger.warning("MjpegStreamReader - Failed, the end of the jpeg wasn't found.")
+                return -1
+            # If the last byte is 0xFF, the marker might be split between reads, so we check it again.
+            pos = len(buf) if pos == -1 else pos
+            if self._Fill() is False:
+                return -1
+
+
+    # Reads until the buffer has at least the given number of bytes. Returns False if the stream ended.
+    def _EnsureBuffered(self, size:int) -> bool:
+        while len(self.Buffer) < size:
+            if self._Fill() is False:
+                return False
+        return True
+
+
+    # Reads more data into the buffer. Returns False if the stream ended.
+    def _Fill(self, readSize:int = c_ReadSize) -> bool:
+        data = self.Read1(readSize)
+        if not data:
+            return False
+        self.Buffer += data
+        return True
+
+
+    # Used when the raw response doesn't have read1.
+    def _ReadNoRead1(self, readSize:int) -> bytes:
+        return self.Raw.read(min(readSize, MjpegStreamReader.c_NoRead1ReadSize))
+
+
+    def _SetContentType(self, contentTypeBytes:bytes) -> None:
+        # The content type is almost always the same, so only convert it to a string when it changes.
+        if contentTypeBytes == self._ContentTypeBytes:
+            return
+        self._ContentTypeBytes = contentTypeBytes
+        self.ContentType = contentTypeBytes.strip().decode("ascii", errors="ignore")
@@ -14,9 +14,11 @@ from enum import Enum
 from octoeverywhere.sentry import Sentry
 
 from .webcamutil import WebcamUtil
+from .mjpegstreamreader import MjpegStreamReader
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
 from .webcamstreaminstance import WebcamStreamInstance
+from ..threadbudget import ThreadBudget
 
 
 # Indicates the stream type for the QuickCam class.
@@ -90,7 +92,8 @@ class QuickCamManager:
     # On failure, return None
     # On success, this will return a valid OctoHttpRequest that's fully filled out.
     # This must return an OctoHttpRequest object with a custom body read stream.
-    def TryGetStream(self, webcamSettingsItem:WebcamSettingItem):
+    # If frameTransform is set, it's used to transform each frame before it's sent, see WebcamStreamInstance.
+    def TryGetStream(self, webcamSettingsItem:WebcamSettingItem, frameTransform = None, mustTransform:bool = False):
         # To know if we need to use Quick cam, we check the protocols.
         # We check both the snapshot and streaming URL, since we can get a snapshot from either
         url = webcamSettingsItem.StreamUrl
@@ -104,7 +107,7 @@ class QuickCamManager:
 
         # We must create a new instance of this class per stream to ensure all of the vars stay in it's context and the streams are cleaned up properly.
         # Create the stream instance and start the web request.
-        sm = WebcamStreamInstance(self.Logger, qc)
+        sm = WebcamStreamInstance(self.Logger, qc, frameTransform, mustTransform)
         return sm.StartWebRequest()
 
 
@@ -262,14 +265,10 @@ class QuickCam:
                 return
             self.Logger.info("QuickCam capture thread starting.")
             self.IsCaptureThreadRunning = True
-            t = threading.Thread(target=self._captureThread, name=f"QuickCamCaptureThread-{self.Type}")
-            t.daemon = True
-            t.start()
+            ThreadBudget.StartThread("QuickCamCapture", self._captureThread, name=f"QuickCamCaptureThread-{self.Type}", daemon=True)
             # We only use this thread for jmpeg right now, since it's the only one that can stall and we can do something about (for Elegoo)
             if self.Type == QuickCamStreamTypes.JMPEG:
-                m = threading.Thread(target=self._stallMonitor, name=f"QuickCamCaptureThread-StallMonitor-{self.Type}")
-                m.daemon = True
-                m.start()
+                ThreadBudget.StartThread("QuickCamStallMonitor", self._stallMonitor, name=f"QuickCamCaptureThread-StallMonitor-{self.Type}", daemon=True)
 
 
     # Does the image image capture work.
@@ -548,7 +547,7 @@ class QuickCam_Jmpeg:
     def __init__(self, logger:logging.Logger):
         self.Logger = logger
         self.OctoResult:OctoHttpRequest.Result = None
-        self.IsFirstImagePull = True
+        self.Reader:MjpegStreamReader = None
 
 
     # ~~ Interface Function ~~
@@ -574,15 +573,21 @@ class QuickCam_Jmpeg:
         if self.OctoResult.StatusCode != 200:
             raise Exception(f"QuickCam_Jmpeg failed to get a valid OctoHttpRequest result. Status code: {self.OctoResult.StatusCode}")
 
-        # Try to get an image from the stream using the common logic.
-        result = WebcamUtil.GetSnapshotFromStream(self.Logger, self.OctoResult, validateMultiStreamHeader=self.IsFirstImagePull)
-        self.IsFirstImagePull = False
-        if result is None:
+        # On the first image, validate the stream and create the reader, which keeps reading frames from the same connection.
+        # The frames are held by the current image and shared with the streams on other threads, so they are never reused and the reader doesn't use a buffer pool.
+        if self.Reader is None:
+            self.Reader = WebcamUtil.CreateMjpegStreamReader(self.Logger, self.OctoResult)
+            if self.Reader is None:
+                raise Exception("QuickCam_Jmpeg failed to create a reader for the stream.")
+
+        # Get the next image from the stream.
+        img = self.Reader.ReadFrame()
+        if img is None:
             raise Exception("QuickCam_Jmpeg failed to get an image from the stream.")
 
         # We must use the ensure jpeg header info function to ensure the image is a valid jpeg.
         # We know, for example, the Elegoo OS webcam server doesn't send the jpeg header info properly.
-        return WebcamUtil.EnsureJpegHeaderInfo(self.Logger, result.ImageBuffer)
+        return WebcamUtil.EnsureJpegHeaderInfo(self.Logger, img)
 
 
     # Allows us to using the with: scope.
@@ -670,8 +675,7 @@ class QuickCam_RTSP:
         self.PipeSelect.register(self.Process.stdout, selectors.EVENT_READ)
 
         # Since we setup the stderr pipe, we must read from it. If it fills it's buffer it will block the ffmpeg process.
-        self.ErrorReaderThread = threading.Thread(target=self._ErrorReader)
-        self.ErrorReaderThread.start()
+        self.ErrorReaderThread = ThreadBudget.StartThread("QuickCamFfmpegErrorReader", self._ErrorReader)
 
         if QuickCam_RTSP.c_DebugLogging:
             self.Logger.debug("Ffmpeg process started.")
@@ -0,0 +1,61 @@
+import time
+import threading
+
+
+# Lets things that need a webcam frame every so often, like FinalSnap, use a frame from a webcam stream that's already being relayed,
+# rather than making another request to the camera for a snapshot.
+#
+# There's one tap per webcam stream url. Copying a frame out of the stream isn't free, so a frame is only copied when one has been asked for,
+# for all of the other frames the stream only checks a flag.
+class StreamFrameTap:
+
+    _Lock = threading.Lock()
+    _Taps = {}
+
+
+    # Returns the tap for the stream url, creating it if needed.
+    @staticmethod
+    def Get(streamUrl:str) -> "StreamFrameTap":
+        with StreamFrameTap._Lock:
+            tap = StreamFrameTap._Taps.get(streamUrl, None)
+            if tap is None:
+                tap = StreamFrameTap()
+                StreamFrameTap._Taps[streamUrl] = tap
+            return tap
+
+
+    def __init__(self) -> None:
+        # Set by the consumer when it wants the next frame, the stream checks this for every frame, so it's a plain bool.
+        self.IsFrameWanted = False
+        self.Frame:bytes = None
+        self.FrameTimeSec = 0.0
+
+
+    # Called by the consumer to ask the stream for a copy of the next frame, if there's a stream running.
+    def RequestFrame(self) -> None:
+        self.IsFrameWanted = True
+
+
+    # Returns the last frame the stream gave us and the time it was taken, as a tuple of (frame, timeSec), if it's not older than maxAgeSec.
+    # Otherwise returns (None, None). The frame is only returned once, so it's not kept in memory longer than it needs to be.
+    def TakeFrame(self, maxAgeSec:float):
+        frame = self.Frame
+        frameTimeSec = self.FrameTimeSec
+        self.Frame = None
+        if frame is None or time.time() - frameTimeSec > maxAgeSec:
+            return (None, None)
+        return (frame, frameTimeSec)
+
+
+    # Called by the stream with a buffer that holds a multipart chunk in the first chunkLength bytes, which is the part headers, the jpeg, and then the part end.
+    # This should only be called if IsFrameWanted is set.
+    def OfferChunk(self, buffer:bytearray, chunkLength:int) -> None:
+        self.IsFrameWanted = False
+        # Find the jpeg in the chunk, from the start of image marker to the end of image marker.
+        start = buffer.find(b"\xff\xd8", 0, chunkLength)
+        end = buffer.rfind(b"\xff\xd9", 0, chunkLength)
+        if start == -1 or end == -1 or end < start:
+            return
+        with memoryview(buffer) as view:
+            self.Frame = bytes(view[start:end+2])
+        self.FrameTimeSec = time.time()
@@ -0,0 +1,68 @@
+import time
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..boundedexecutor import Executors
+
+# Caches the webcam config from the platform helper, so the webcam config is never gotten on the thread handling a request, other than the first time.
+#
+# Getting the config can be slow on some platforms, OctoPrint calls into the webcam plugins and Bambu might wait on the printer state,
+# and it's gotten many times for every snapshot. So we always return the last known config, and if it's old, we refresh it in the background.
+# If the platform fails to get the config, we keep using the last one it returned. An empty list is a valid config, it means all of the webcams were removed.
+class WebcamConfigCache:
+
+    # How old the config can be before we refresh it in the background.
+    c_RefreshIntervalSec = 5.0
+
+    def __init__(self, logger:logging.Logger, webcamPlatformHelperInterface) -> None:
+        self.Logger = logger
+        self.WebcamPlatformHelperInterface = webcamPlatformHelperInterface
+        self.Lock = threading.Lock()
+        self.Config:list = None
+        self.HasConfig = False
+        self.UpdateTimeSec = 0.0
+        self.IsRefreshing = False
+
+
+    # Returns a new list with the last known webcam config, or None if the platform hasn't returned any webcams.
+    def Get(self) -> list:
+        with self.Lock:
+            hasConfig = self.HasConfig
+            startRefresh = hasConfig and self.IsRefreshing is False and time.time() - self.UpdateTimeSec > WebcamConfigCache.c_RefreshIntervalSec
+            if startRefresh:
+                self.IsRefreshing = True
+        # The first time, there's nothing to return, so we have to get it now.
+        if hasConfig is False:
+            self._Refresh()
+        elif startRefresh:
+            if Executors.Io(self._Refresh) is False:
+                with self.Lock:
+                    self.IsRefreshing = False
+        with self.Lock:
+            if self.Config is None:
+                return None
+            return list(self.Config)
+
+
+    # Makes the next Get refresh the config in the background, even if it's not old.
+    def Invalidate(self) -> None:
+        with self.Lock:
+            self.UpdateTimeSec = 0.0
+
+
+    def _Refresh(self) -> None:
+        try:
+            config = self.WebcamPlatformHelperInterface.GetWebcamConfig()
+            with self.Lock:
+                # None means the platform failed to get the config, so we keep the one we have, so a failure doesn't remove the webcams.
+                # An empty list is a successful get, so it replaces the config.
+                if config is not None:
+                    self.Config = list(config)
+                self.HasConfig = True
+                self.UpdateTimeSec = time.time()
+        except Exception as e:
+            Sentry.Exception("WebcamConfigCache failed to get the webcam config.", e)
+        finally:
+            with self.Lock:
+                self.IsRefreshing = False
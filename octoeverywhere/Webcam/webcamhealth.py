@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+# Keeps track of how well each webcam is working, from the snapshots we get from it.
+#
+# For each webcam, we keep the result of the last few snapshots and a smoothed latency of the successful ones.
+# This is used to pick a working webcam as the default when the user hasn't picked one and the first webcam isn't working.
+class WebcamHealth:
+
+    # How many of the most recent snapshot results we keep for each webcam.
+    c_HistoryLength = 10
+    # A webcam needs at least this many results before we consider it unhealthy.
+    c_MinResultsForUnhealthy = 3
+    # A webcam with a failure rate at or above this is unhealthy.
+    c_UnhealthyFailureRate = 0.8
+    # How much each new latency moves the smoothed latency.
+    c_LatencySmoothingFactor = 0.3
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Webcam key -> [deque of bools, smoothed latency sec or None]
+        self.Stats = {}
+
+
+    # Records the result of a snapshot from the webcam.
+    def Report(self, key:str, success:bool, latencySec:float) -> None:
+        if key is None:
+            return
+        with self.Lock:
+            stats = self.Stats.get(key, None)
+            if stats is None:
+                stats = [deque(maxlen=WebcamHealth.c_HistoryLength), None]
+                self.Stats[key] = stats
+            stats[0].append(success)
+            if success:
+                if stats[1] is None:
+                    stats[1] = latencySec
+                else:
+                    stats[1] += (latencySec - stats[1]) * WebcamHealth.c_LatencySmoothingFactor
+
+
+    # Returns True if we have enough results to know the webcam isn't working.
+    def IsUnhealthy(self, key:str) -> bool:
+        with self.Lock:
+            stats = self.Stats.get(key, None)
+            if stats is None or len(stats[0]) < WebcamHealth.c_MinResultsForUnhealthy:
+                return False
+            return WebcamHealth._GetFailureRate(stats) >= WebcamHealth.c_UnhealthyFailureRate
+
+
+    # Returns True if the webcam's most recent snapshot worked.
+    def IsWorking(self, key:str) -> bool:
+        with self.Lock:
+            stats = self.Stats.get(key, None)
+            return stats is not None and len(stats[0]) > 0 and stats[0][-1]
+
+
+    # Returns a dict of the stats for the webcam, for logging and the status command, or None if there are no results.
+    def GetStats(self, key:str) -> dict:
+        with self.Lock:
+            stats = self.Stats.get(key, None)
+            if stats is None or len(stats[0]) == 0:
+                return None
+            return {
+                "Results": len(stats[0]),
+                "FailureRate": round(WebcamHealth._GetFailureRate(stats), 2),
+                "LatencyMs": None if stats[1] is None else int(stats[1] * 1000),
+            }
+
+
+    @staticmethod
+    def _GetFailureRate(stats) -> float:
+        results = stats[0]
+        failures = 0
+        for r in results:
+            if r is False:
+                failures += 1
+        return float(failures) / float(len(results))
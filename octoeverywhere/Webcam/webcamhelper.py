@@ -1,13 +1,20 @@
 import logging
 import os
 import json
+import time
+import threading
 from typing import List
 
 from ..sentry import Sentry
+from ..boundedexecutor import Executors
 from .webcamutil import WebcamUtil
 from .quickcam import QuickCamManager
+from .streamframetap import StreamFrameTap
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
+from .webcamconfigcache import WebcamConfigCache
+from .webcamhealth import WebcamHealth
+from .webcamtranscoder import WebcamTranscodeTier, WebcamTranscoder, TranscodedMjpegStream
 
 # The point of this class is to abstract the logic that needs to be done to reliably get a webcam snapshot and stream from many types of
 # printer setups. The main entry point is GetSnapshot() which will try a number of ways to get a snapshot from whatever camera system is
@@ -27,6 +34,11 @@ class WebcamHelper:
     # A header we apply to all snapshot and webcam streams so the client can get the correct transforms the user has setup.
     c_OeWebcamTransformHeaderKey = "x-oe-webcam-transform"
 
+    # How long GetSnapshots waits for each webcam.
+    c_AllSnapshotsTimeoutSec = 10.0
+    # While the default has failed over to another webcam, the first webcam is checked again this often, so we switch back once it works.
+    c_FailoverReprobeIntervalSec = 60.0
+
     # Logic for a static singleton
     _Instance = None
 
@@ -45,6 +57,11 @@ class WebcamHelper:
     def __init__(self, logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath:str):
         self.Logger = logger
         self.WebcamPlatformHelperInterface = webcamPlatformHelperInterface
+        self.ConfigCache = WebcamConfigCache(logger, webcamPlatformHelperInterface)
+        self.Health = WebcamHealth()
+        self.IsHealthProbeRunning = False
+        self.IsFailoverReprobeRunning = False
+        self.LastFailoverReprobeSec = 0.0
 
         # Init local webcam settings stuffs.
         self.SettingsFilePath = os.path.join(pluginDataFolderPath, "webcam-settings.json")
@@ -102,10 +119,11 @@ class WebcamHelper:
     # returns, to ensure the rest of the octostream http logic can handle the response.
     def MakeSnapshotOrWebcamStreamRequest(self, httpInitialContext, method, sendHeaders, uploadBuffer) -> OctoHttpRequest.Result:
         cameraIndexOpt = self.GetOracleRequestCameraIndex(sendHeaders)
+        transcodeTier = WebcamTranscodeTier.FromHeaders(sendHeaders)
         if self.IsSnapshotOracleRequest(sendHeaders):
-            return self.GetSnapshot(cameraIndexOpt)
+            return self.GetSnapshot(cameraIndexOpt, transcodeTier)
         elif self.IsWebcamStreamOracleRequest(sendHeaders):
-            return self.GetWebcamStream(cameraIndexOpt)
+            return self.GetWebcamStream(cameraIndexOpt, transcodeTier)
         else:
             raise Exception("Webcam helper MakeSnapshotOrWebcamStreamRequest was called but the request didn't have the oracle headers?")
 
@@ -115,22 +133,34 @@ class WebcamHelper:
     #
     # On failure, this returns None. Returning None will fail out the request.
     # On success, this will return a valid OctoHttpRequest.
-    def GetWebcamStream(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
+    #
+    # If transcodeTier is set and transcoding is available, each frame is transcoded to the tier.
+    def GetWebcamStream(self, cameraIndex:int = None, transcodeTier:WebcamTranscodeTier = None) -> OctoHttpRequest.Result:
+        if transcodeTier is not None and WebcamTranscoder.IsAvailable() is False:
+            transcodeTier = None
+        result, isTranscoded = self._GetWebcamStreamInternal(cameraIndex, transcodeTier)
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._GetWebcamStreamInternal(cameraIndex), cameraIndex)
+        return self._AddOeWebcamTransformHeader(result, cameraIndex, transcodeTier if isTranscoded else None)
 
 
-    def _GetWebcamStreamInternal(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
+    # Returns a tuple of the result and if the stream is being transcoded.
+    def _GetWebcamStreamInternal(self, cameraIndex:int = None, transcodeTier:WebcamTranscodeTier = None):
         # Get the webcam settings object for this request.
         # If there are no webcams, this will return None
         webcamSettingsObj = self._GetWebcamSettingObj(cameraIndex)
         if webcamSettingsObj is None:
-            return None
+            return (None, False)
+        frameTransform = None
+        # If the tier applies the transform, the client is told not to, so frames that aren't transcoded can't be sent.
+        mustTransform = False
+        if transcodeTier is not None:
+            frameTransform = self._GetTranscodeFrameTransform(webcamSettingsObj, transcodeTier)
+            mustTransform = transcodeTier.ApplyTransform and (webcamSettingsObj.FlipH or webcamSettingsObj.FlipV or webcamSettingsObj.Rotation != 0)
 
         # First, check if this webcam URL needs to be handled by the QuickCam system.
-        result = QuickCamManager.Get().TryGetStream(webcamSettingsObj)
+        result = QuickCamManager.Get().TryGetStream(webcamSettingsObj, frameTransform, mustTransform)
         if result is not None:
-            return result
+            return (result, frameTransform is not None)
 
         # Try to get the URL from the settings.
         webcamStreamUrl = webcamSettingsObj.StreamUrl
@@ -141,10 +171,27 @@ class WebcamHelper:
             # We use the allow redirects flag to make the API more robust, since some webcam images might need that.
             #
             # Whatever this returns, the rest of the request system will handle it, since it's expecting the OctoHttpRequest object
-            return OctoHttpRequest.MakeHttpCall(self.Logger, webcamStreamUrl, OctoHttpRequest.GetPathType(webcamStreamUrl), "GET", {}, allowRedirects=True)
+            result = OctoHttpRequest.MakeHttpCall(self.Logger, webcamStreamUrl, OctoHttpRequest.GetPathType(webcamStreamUrl), "GET", {}, allowRedirects=True)
+            if frameTransform is None or result is None or result.StatusCode != 200:
+                return (result, False)
+            # If the stream isn't a mjpeg stream, we can't transcode it, so it's sent as is.
+            transcodedResult = TranscodedMjpegStream.Create(self.Logger, result, frameTransform, StreamFrameTap.Get(webcamStreamUrl), mustTransform)
+            if transcodedResult is None:
+                self.Logger.info("The webcam stream isn't a mjpeg stream, so it can't be transcoded.")
+                return (result, False)
+            return (transcodedResult, True)
 
         # If we can't get the webcam stream URL, return None to fail out the request.
-        return None
+        return (None, False)
+
+
+    # Returns the StreamFrameTap for the webcam's stream, which can be used to get frames from the stream if it's already being relayed.
+    # Returns None if there's no webcam or it has no stream URL.
+    def GetStreamFrameTap(self, cameraIndex:int = None) -> StreamFrameTap:
+        webcamSettingsObj = self._GetWebcamSettingObj(cameraIndex)
+        if webcamSettingsObj is None or webcamSettingsObj.StreamUrl is None:
+            return None
+        return StreamFrameTap.Get(webcamSettingsObj.StreamUrl)
 
 
     # Tries to get a snapshot from the system using the snapshot URL or falling back to the mjpeg stream.
@@ -152,10 +199,97 @@ class WebcamHelper:
     #
     # On failure, this returns None. Returning None will fail out the request.
     # On success, this will return a valid OctoHttpRequest that's fully filled out. The stream will always already be fully read, and will be FullBodyBuffer var.
-    def GetSnapshot(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
+    #
+    # If transcodeTier is set and transcoding is available, the snapshot is transcoded to the tier.
+    def GetSnapshot(self, cameraIndex:int = None, transcodeTier:WebcamTranscodeTier = None) -> OctoHttpRequest.Result:
+        startSec = time.time()
         # Wrap the entire result in the _EnsureJpegHeaderInfo function, so ensure the returned snapshot can be used by all image processing libs.
+        result = self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraIndex))
+
+        # Keep track of how the webcam is doing.
+        success = result is not None and result.StatusCode == 200
+        webcamSettingsObj = self._GetWebcamSettingObj(cameraIndex)
+        if webcamSettingsObj is not None:
+            self.Health.Report(webcamSettingsObj.Name, success, time.time() - startSec)
+
+        # If the default webcam failed, check the other webcams in the background, so if it keeps failing and another webcam works, we can use that as the default.
+        if success is False and cameraIndex is None:
+            self._StartHealthProbeIfNeeded()
+
+        if success and transcodeTier is not None and WebcamTranscoder.IsAvailable():
+            transcoded = self._GetTranscodeFrameTransform(webcamSettingsObj, transcodeTier)(result.FullBodyBuffer)
+            if transcoded is None:
+                transcodeTier = None
+            else:
+                result.SetFullBodyBuffer(transcoded)
+                result.Headers["content-type"] = "image/jpeg"
+                result.Headers["content-length"] = str(len(transcoded))
+        else:
+            transcodeTier = None
+
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraIndex)), cameraIndex)
+        return self._AddOeWebcamTransformHeader(result, cameraIndex, transcodeTier)
+
+
+    # Returns a function that transcodes a frame from the webcam to the tier, which returns None if the frame couldn't be transcoded.
+    def _GetTranscodeFrameTransform(self, webcamSettingsObj:WebcamSettingItem, transcodeTier:WebcamTranscodeTier):
+        transcoder = WebcamTranscoder.Get(webcamSettingsObj.Name)
+        def frameTransform(frame):
+            return transcoder.Transcode(self.Logger, frame, transcodeTier, webcamSettingsObj)
+        return frameTransform
+
+
+    # Gets a snapshot from each of the webcam indexes at the same time, or all webcams if None is passed.
+    # Returns a list of OctoHttpResults in the same order, None for each webcam that failed or didn't return a snapshot within the timeout.
+    def GetSnapshots(self, cameraIndexes:List[int] = None, timeoutSec:float = c_AllSnapshotsTimeoutSec) -> list:
+        if cameraIndexes is None:
+            webcamItems = self.ListWebcams()
+            cameraIndexes = [] if webcamItems is None else list(range(len(webcamItems)))
+        results = [None] * len(cameraIndexes)
+        doneEvents = []
+        for i, cameraIndex in enumerate(cameraIndexes):
+            doneEvent = threading.Event()
+            doneEvents.append(doneEvent)
+            if Executors.Io(self._GetSnapshotForList, cameraIndex, results, i, doneEvent) is False:
+                doneEvent.set()
+        # Each webcam has the same deadline, so a slow webcam doesn't hold up the others, and we return as soon as they are all done.
+        deadlineSec = time.time() + timeoutSec
+        for i, doneEvent in enumerate(doneEvents):
+            if doneEvent.wait(max(0.0, deadlineSec - time.time())) is False:
+                self.Logger.info(f"GetSnapshots webcam index {cameraIndexes[i]} didn't return a snapshot within {timeoutSec} sec.")
+        # Copy the list, so results that come in after the timeout aren't returned.
+        return list(results)
+
+
+    def _GetSnapshotForList(self, cameraIndex:int, results:list, resultIndex:int, doneEvent:threading.Event) -> None:
+        try:
+            result = self.GetSnapshot(cameraIndex)
+            if result is not None and result.StatusCode == 200:
+                results[resultIndex] = result
+        finally:
+            doneEvent.set()
+
+
+    def _StartHealthProbeIfNeeded(self) -> None:
+        if self.IsHealthProbeRunning:
+            return
+        webcamItems = self.ListWebcams()
+        if webcamItems is None or len(webcamItems) < 2:
+            return
+        self.IsHealthProbeRunning = True
+        if Executors.Io(self._HealthProbe, len(webcamItems)) is False:
+            self.IsHealthProbeRunning = False
+        self.IsFailoverReprobeRunning = False
+        self.LastFailoverReprobeSec = 0.0
+
+
+    def _HealthProbe(self, webcamCount:int) -> None:
+        try:
+            self.GetSnapshots(list(range(webcamCount)))
+        finally:
+            self.IsHealthProbeRunning = False
+        self.IsFailoverReprobeRunning = False
+        self.LastFailoverReprobeSec = 0.0
 
 
     def _GetSnapshotInternal(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
@@ -260,7 +394,8 @@ class WebcamHelper:
     def ListWebcams(self) -> List[WebcamSettingItem]:
         try:
             # Get the webcams from the platform.
-            ret = self.WebcamPlatformHelperInterface.GetWebcamConfig()
+            # This is the last known config, which is refreshed in the background, so we never wait on the platform here.
+            ret = self.ConfigCache.Get()
 
             # Check if there are any plugin local items to return.
             # Note the cameras returned from ListWebcams() must always be first - the bambu logic depends on this! (see GetSnapshot_Override)
@@ -280,8 +415,9 @@ class WebcamHelper:
 
 
     # Checks if the result was success and if so adds the common header.
+    # If the images were transcoded with a tier that applies the transform, the client doesn't need to do anything, so the header is none.
     # Returns the octoHttpResult, so the function is chainable
-    def _AddOeWebcamTransformHeader(self, octoHttpResult, cameraIndex:int):
+    def _AddOeWebcamTransformHeader(self, octoHttpResult, cameraIndex:int, transcodeTier:WebcamTranscodeTier = None):
         if octoHttpResult is None or octoHttpResult.StatusCode > 300:
             return octoHttpResult
 
@@ -290,7 +426,8 @@ class WebcamHelper:
 
         # If there are any settings build a string with them all contaminated.
         settings = self._GetWebcamSettingObj(cameraIndex)
-        if settings.FlipH or settings.FlipV or settings.Rotation != 0:
+        transformApplied = transcodeTier is not None and transcodeTier.ApplyTransform
+        if transformApplied is False and (settings.FlipH or settings.FlipV or settings.Rotation != 0):
             transformStr = ""
             if settings.FlipH:
                 transformStr += "fliph "
@@ -421,21 +558,55 @@ class WebcamHelper:
     # Returns the default camera index. This will always return an int.
     # If there is not a default currently set, this returns the WebcamHelper.c_DefaultWebcamIndex, which is index 0.
     def GetDefaultCameraIndex(self, webcamItemList:List[WebcamSettingItem]) -> int:
-        # If there is no name currently, the default is 0.
-        if self.DefaultCameraName is None:
-            return WebcamHelper.c_DefaultWebcamIndex
-
         # Try to find the name that was last set.
+        if self.DefaultCameraName is not None:
+            count = 0
+            for i in webcamItemList:
+                if i.Name.lower() == self.DefaultCameraName:
+                    return count
+                count += 1
+
+        # If the user hasn't picked a webcam, the default is 0, unless it's not working and another webcam is.
+        # Once the first webcam's last snapshot works again, it's the default again.
+        if webcamItemList is not None and len(webcamItemList) > 1:
+            defaultName = webcamItemList[WebcamHelper.c_DefaultWebcamIndex].Name
+            if self.Health.IsUnhealthy(defaultName) and self.Health.IsWorking(defaultName) is False:
+                return self._GetFailoverCameraIndex(webcamItemList)
+
+        # Otherwise, return the default.
+        return WebcamHelper.c_DefaultWebcamIndex
+
+
+    # Returns the first working webcam, or the default if none are working.
+    # Snapshots of the default webcam don't come in while we are failed over, so this also checks it again from time to time.
+    def _GetFailoverCameraIndex(self, webcamItemList:List[WebcamSettingItem]) -> int:
+        self._StartFailoverReprobeIfNeeded()
         count = 0
         for i in webcamItemList:
-            if i.Name.lower() == self.DefaultCameraName:
+            if self.Health.IsWorking(i.Name):
                 return count
             count += 1
-
-        # We didn't find it, return the default.
         return WebcamHelper.c_DefaultWebcamIndex
 
 
+    def _StartFailoverReprobeIfNeeded(self) -> None:
+        now = time.time()
+        if self.IsFailoverReprobeRunning or now - self.LastFailoverReprobeSec < WebcamHelper.c_FailoverReprobeIntervalSec:
+            return
+        self.LastFailoverReprobeSec = now
+        self.IsFailoverReprobeRunning = True
+        if Executors.Io(self._FailoverReprobe) is False:
+            self.IsFailoverReprobeRunning = False
+
+
+    def _FailoverReprobe(self) -> None:
+        try:
+            # The snapshot result is reported to the health tracker, so if it works, the default switches back.
+            self.GetSnapshot(WebcamHelper.c_DefaultWebcamIndex)
+        finally:
+            self.IsFailoverReprobeRunning = False
+
+
     # Returns a list of any plugin local webcam settings objects.
     # These objects will be merged into the main list of webcams settings objects
     def GetPluginLocalWebcamList(self, returnDisabledItems:bool = False) -> List[WebcamSettingItem]:
@@ -10,11 +10,20 @@ class WebcamStreamInstance:
     # The string doesn't matter what it is, but we define it so it's consistent
     c_OeStreamBoundaryString = "oestreamboundary"
 
+    # If the frames must be transformed, this is how many frames in a row can fail to transform before the stream is ended.
+    c_MaxSkippedFramesInARow = 30
 
-    def __init__(self, logger:logging.Logger, quickCam) -> None:
+
+    # If frameTransform is set, each frame is passed through it before it's sent. It returns the frame to send, or None to send the original frame.
+    # If mustTransform is set, the client was told the frames are transformed, so the original frame would be shown wrong and it's skipped instead.
+    def __init__(self, logger:logging.Logger, quickCam, frameTransform = None, mustTransform:bool = False) -> None:
         self.Logger = logger
         self.QuickCam = quickCam
+        self.FrameTransform = frameTransform
+        self.MustTransform = mustTransform
+        self.SkippedFramesInARow = 0
         self.IsFirstSend = True
+        self.FrameEmitter = MultipartFrameEmitter(WebcamStreamInstance.c_OeStreamBoundaryString, "image/jpeg")
         self.StreamOpenTimeSec = time.time()
         self.ImageReadyEvent = threading.Event()
         self.AwaitingImage:bytearray = None
@@ -50,7 +59,8 @@ class WebcamStreamInstance:
 
 
     # Define a callback for our http body reading system to call when it needs data.
-    def _CustomBodyStreamRead(self) -> bytearray:
+    # Note the returned memoryview is only valid until the next call, since the buffer is reused.
+    def _CustomBodyStreamRead(self) -> memoryview:
         while True:
             # See if we can capture an image. There might already be a new image we don't even have to wait for.
             capturedImage = self.AwaitingImage
@@ -58,19 +68,28 @@ class WebcamStreamInstance:
                 # If so, clear the awaiting image and reset the event.
                 self.AwaitingImage = None
                 self.ImageReadyEvent.clear()
-
-                # Build the buffer to send
-                header = f"--{WebcamStreamInstance.c_OeStreamBoundaryString}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(capturedImage)}\r\n\r\n"
-                imageChunkBuffer = header.encode('utf-8') + capturedImage + b"\r\n" + header.encode('utf-8') + capturedImage + b"\r\n"
+                if self.FrameTransform is not None:
+                    transformedImage = self.FrameTransform(capturedImage)
+                    if transformedImage is not None:
+                        capturedImage = transformedImage
+                        self.SkippedFramesInARow = 0
+                    elif self.MustTransform:
+                        self.SkippedFramesInARow += 1
+                        if self.SkippedFramesInARow > WebcamStreamInstance.c_MaxSkippedFramesInARow:
+                            self.Logger.warn("WebcamStreamInstance ending the stream, the frames can't be transformed and the client expects them to be.")
+                            return None
+                        continue
 
                 # TODO - I don't know why, but chrome seems to delay the rendering of the image until it gets two?
-                # This could be something in the pipeline not flushing correctly, or other things. But for now, on the first send we double the image to make it render instantly.
+                # This could be something in the pipeline not flushing correctly, or other things. So we always send each frame twice,
+                # and on the first send we double it again to make it render instantly.
+                copies = 2
                 if self.IsFirstSend:
-                    imageChunkBuffer = imageChunkBuffer + imageChunkBuffer
+                    copies = 4
                     self.IsFirstSend = False
                     if self.Logger.isEnabledFor(logging.DEBUG):
                         self.Logger.debug(f"QuickCam took {round(time.time()-self.StreamOpenTimeSec, 3)} seconds from octostream stream open to first image sent.")
-                return imageChunkBuffer
+                return self.FrameEmitter.Emit(capturedImage, copies)
             # If we didn't get an image, wait on the event for a new one.
             self.ImageReadyEvent.wait()
 
@@ -79,3 +98,44 @@ class WebcamStreamInstance:
     def _CustomBodyStreamClosed(self) -> None:
         # It's important this is called so the stream will be detached!
         self.QuickCam.DetachImageStreamCallback(self._NewImageCallback)
+
+
+# Builds the multipart body for a stream of frames.
+# The part header is the same for every frame except the content length digits, so it's built once. Each frame is written into one
+# reusable buffer with slice assignment, and a memoryview of it is returned, so the image is only copied into the buffer and nowhere else.
+class MultipartFrameEmitter:
+
+    c_HeaderSuffix = b"\r\n\r\n"
+    c_PartSuffix = b"\r\n"
+
+    def __init__(self, boundaryStr:str, contentType:str) -> None:
+        self.HeaderPrefix = f"--{boundaryStr}\r\nContent-Type: {contentType}\r\nContent-Length: ".encode("utf-8")
+        self.Buffer = bytearray(0)
+        self.BufferMv = memoryview(self.Buffer)
+
+
+    # Returns a memoryview with the frame written as a multipart part, repeated `copies` times.
+    # The memoryview is only valid until the next call.
+    def Emit(self, frame, copies:int = 1) -> memoryview:
+        lengthDigits = str(len(frame)).encode("utf-8")
+        prefixLen = len(self.HeaderPrefix)
+        headerLen = prefixLen + len(lengthDigits) + len(MultipartFrameEmitter.c_HeaderSuffix)
+        partLen = headerLen + len(frame) + len(MultipartFrameEmitter.c_PartSuffix)
+        totalLen = partLen * copies
+
+        # If the buffer is too small, make a new one with some room, so frames that grow a little don't cause another allocation.
+        # We make a new buffer rather than resizing, since a bytearray can't be resized while memoryviews of it exist.
+        if len(self.Buffer) < totalLen:
+            self.Buffer = bytearray(totalLen + totalLen // 4)
+            self.BufferMv = memoryview(self.Buffer)
+
+        buffer = self.Buffer
+        buffer[0:prefixLen] = self.HeaderPrefix
+        buffer[prefixLen:headerLen - len(MultipartFrameEmitter.c_HeaderSuffix)] = lengthDigits
+        buffer[headerLen - len(MultipartFrameEmitter.c_HeaderSuffix):headerLen] = MultipartFrameEmitter.c_HeaderSuffix
+        buffer[headerLen:partLen - len(MultipartFrameEmitter.c_PartSuffix)] = frame
+        buffer[partLen - len(MultipartFrameEmitter.c_PartSuffix):partLen] = MultipartFrameEmitter.c_PartSuffix
+        # Any other copies are copied from the first part.
+        for i in range(1, copies):
+            buffer[partLen * i:partLen * (i + 1)] = self.BufferMv[0:partLen]
+        return self.BufferMv[0:totalLen]
@@ -0,0 +1,286 @@
+import io
+import time
+import zlib
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..pilimage import PilImage
+from ..octohttprequest import OctoHttpRequest
+from .webcamsettingitem import WebcamSettingItem
+from .webcamstreaminstance import WebcamStreamInstance, MultipartFrameEmitter
+from .mjpegstreamreader import MjpegStreamReader
+
+
+# Describes how a remote viewer wants webcam frames to be transcoded.
+#
+# The requested values are snapped down to a few fixed tiers, so viewers that ask for similar sizes share the same transcoded frames.
+class WebcamTranscodeTier:
+
+    # The existence of any of these headers on a snapshot or webcam stream request will make us transcode the images.
+    c_MaxWidthHeaderKey = "oe-webcam-max-width"         # The max width of the image, in pixels.
+    c_QualityHeaderKey = "oe-webcam-quality"            # The jpeg quality, from 1 to 100.
+    c_ApplyTransformHeaderKey = "oe-webcam-transform"   # If set, any flips and rotation are applied to the image, rather than by the client.
+
+    c_WidthTiers = [320, 480, 640, 960, 1280, 1920]
+    c_QualityTiers = [40, 60, 75, 85]
+    c_DefaultQuality = 75
+
+
+    def __init__(self, maxWidth:int, quality:int, applyTransform:bool) -> None:
+        self.MaxWidth = maxWidth
+        self.Quality = quality
+        self.ApplyTransform = applyTransform
+        self.Key = f"{maxWidth}-{quality}-{'t' if applyTransform else 'n'}"
+
+
+    # Returns the tier the request headers ask for, or None if the request doesn't want the images transcoded.
+    @staticmethod
+    def FromHeaders(requestHeadersDict) -> "WebcamTranscodeTier":
+        maxWidthStr = requestHeadersDict.get(WebcamTranscodeTier.c_MaxWidthHeaderKey, None)
+        qualityStr = requestHeadersDict.get(WebcamTranscodeTier.c_QualityHeaderKey, None)
+        applyTransform = WebcamTranscodeTier.c_ApplyTransformHeaderKey in requestHeadersDict
+        if maxWidthStr is None and qualityStr is None and applyTransform is False:
+            return None
+        try:
+            maxWidth = None
+            if maxWidthStr is not None:
+                maxWidth = WebcamTranscodeTier._SnapToTier(int(maxWidthStr), WebcamTranscodeTier.c_WidthTiers)
+            quality = WebcamTranscodeTier.c_DefaultQuality
+            if qualityStr is not None:
+                quality = WebcamTranscodeTier._SnapToTier(int(qualityStr), WebcamTranscodeTier.c_QualityTiers)
+            return WebcamTranscodeTier(maxWidth, quality, applyTransform)
+        except ValueError:
+            return None
+
+
+    # Returns the largest tier that's not larger than the value, or the smallest tier.
+    @staticmethod
+    def _SnapToTier(value:int, tiers:list) -> int:
+        ret = tiers[0]
+        for t in tiers:
+            if t <= value:
+                ret = t
+        return ret
+
+
+# Transcodes the frames from one webcam into smaller jpegs for remote viewers, for example, viewers on a mobile connection.
+#
+# There's one transcoder per webcam, which is shared by all viewers of the webcam. For each tier, only the output for the most recent source
+# frame is kept. Frames are matched by a checksum of the jpeg, so viewers with their own connection to the same camera also share the work.
+# If another viewer is already transcoding the same frame for the same tier, we wait for it rather than doing it again.
+class WebcamTranscoder:
+
+    # The most tiers we keep a frame for, per webcam.
+    c_MaxTiers = 4
+    # How long we wait on another viewer's transcode of the same frame.
+    c_WaitForOtherTranscodeSec = 2.0
+
+    _Lock = threading.Lock()
+    _Transcoders = {}
+
+
+    # Returns the transcoder for the webcam, creating it if needed.
+    @staticmethod
+    def Get(webcamKey:str) -> "WebcamTranscoder":
+        with WebcamTranscoder._Lock:
+            transcoder = WebcamTranscoder._Transcoders.get(webcamKey, None)
+            if transcoder is None:
+                transcoder = WebcamTranscoder()
+                WebcamTranscoder._Transcoders[webcamKey] = transcoder
+            return transcoder
+
+
+    # Returns True if we are able to transcode images on this system.
+    @staticmethod
+    def IsAvailable() -> bool:
+        return PilImage.Get() is not None
+
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Tier key -> _TranscodedFrame, the most recently used is last.
+        self.Frames = {}
+        # Tier key -> dict of stats.
+        self.Stats = {}
+
+
+    # Returns the frame transcoded for the tier, or None if it can't be transcoded.
+    def Transcode(self, logger:logging.Logger, frame, tier:WebcamTranscodeTier, webcamSettings:WebcamSettingItem) -> bytes:
+        fingerprint = (len(frame), zlib.crc32(frame))
+        with self.Lock:
+            stats = self.Stats.get(tier.Key, None)
+            if stats is None:
+                stats = {"Encodes": 0, "CacheHits": 0, "EncodeSec": 0.0, "InBytes": 0, "OutBytes": 0}
+                self.Stats[tier.Key] = stats
+            transcoded = self.Frames.pop(tier.Key, None)
+            isOwner = transcoded is None or transcoded.Fingerprint != fingerprint
+            if isOwner:
+                transcoded = _TranscodedFrame(fingerprint)
+            else:
+                stats["CacheHits"] += 1
+            self.Frames[tier.Key] = transcoded
+            while len(self.Frames) > WebcamTranscoder.c_MaxTiers:
+                del self.Frames[next(iter(self.Frames))]
+
+        # If another viewer is already working on this frame, wait for it.
+        # If it takes too long, we encode the frame ourselves, since sending the original frame would ignore the tier, including any transform the viewer asked us to apply.
+        if isOwner is False:
+            if transcoded.DoneEvent.wait(WebcamTranscoder.c_WaitForOtherTranscodeSec):
+                return transcoded.Frame
+            try:
+                return WebcamTranscoder._Encode(frame, tier, webcamSettings)
+            except Exception as e:
+                Sentry.Exception("WebcamTranscoder failed to transcode a frame after waiting for another viewer.", e)
+                return None
+
+        startSec = time.time()
+        try:
+            transcoded.Frame = WebcamTranscoder._Encode(frame, tier, webcamSettings)
+        except Exception as e:
+            Sentry.Exception("WebcamTranscoder failed to transcode a frame.", e)
+        finally:
+            transcoded.DoneEvent.set()
+        with self.Lock:
+            stats["Encodes"] += 1
+            stats["EncodeSec"] += time.time() - startSec
+            stats["InBytes"] += len(frame)
+            stats["OutBytes"] += 0 if transcoded.Frame is None else len(transcoded.Frame)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WebcamTranscoder tier {tier.Key} took {round((time.time()-startSec)*1000, 1)}ms")
+        return transcoded.Frame
+
+
+    # Returns a copy of the stats for each tier, as a dict of tier key -> dict.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {k: dict(v) for k, v in self.Stats.items()}
+
+
+    @staticmethod
+    def _Encode(frame, tier:WebcamTranscodeTier, webcamSettings:WebcamSettingItem) -> bytes:
+        Image = PilImage.Get()
+        if Image is None:
+            return None
+        pilImage = Image.open(io.BytesIO(frame))
+
+        # Draft mode makes the jpeg decoder scale the image down by 2, 4, or 8 while decoding, which is much faster than decoding the full image.
+        # It will never scale below the size we ask for, so the resize below does the rest.
+        if tier.MaxWidth is not None and pilImage.width > tier.MaxWidth:
+            height = int(pilImage.height * tier.MaxWidth / pilImage.width)
+            pilImage.draft("RGB", (tier.MaxWidth, height))
+            if pilImage.width > tier.MaxWidth:
+                pilImage = pilImage.resize((tier.MaxWidth, height), _GetPilConstant(Image, "Resampling", "BILINEAR"))
+        if pilImage.mode not in ("RGB", "L"):
+            pilImage = pilImage.convert("RGB")
+
+        # Note the order of the flips and the rotates are important, it must match how the client applies them.
+        if tier.ApplyTransform and webcamSettings is not None:
+            if webcamSettings.FlipH:
+                pilImage = pilImage.transpose(_GetPilConstant(Image, "Transpose", "FLIP_LEFT_RIGHT"))
+            if webcamSettings.FlipV:
+                pilImage = pilImage.transpose(_GetPilConstant(Image, "Transpose", "FLIP_TOP_BOTTOM"))
+            # Our rotation is clockwise while PIL is counter clockwise.
+            if webcamSettings.Rotation == 90:
+                pilImage = pilImage.transpose(_GetPilConstant(Image, "Transpose", "ROTATE_270"))
+            elif webcamSettings.Rotation == 180:
+                pilImage = pilImage.transpose(_GetPilConstant(Image, "Transpose", "ROTATE_180"))
+            elif webcamSettings.Rotation == 270:
+                pilImage = pilImage.transpose(_GetPilConstant(Image, "Transpose", "ROTATE_90"))
+
+        buffer = io.BytesIO()
+        pilImage.save(buffer, format="JPEG", quality=tier.Quality)
+        return buffer.getvalue()
+
+
+# In pillow ~9.1.0 the constants moved into enums, this gets them from either place.
+def _GetPilConstant(Image, enumName:str, name:str):
+    enum = getattr(Image, enumName, None)
+    if enum is not None:
+        return getattr(enum, name)
+    return getattr(Image, name)
+
+
+# The transcoded output of one source frame for one tier.
+class _TranscodedFrame:
+    def __init__(self, fingerprint) -> None:
+        self.Fingerprint = fingerprint
+        self.Frame:bytes = None
+        self.DoneEvent = threading.Event()
+
+
+# Wraps a mjpeg webcam stream, reading each frame and sending it on after it's passed through the frame transform function.
+# The transform function is given the frame and returns the frame to send, or None to send the original frame.
+# If mustTransform is set, frames that fail to transform are skipped, like WebcamStreamInstance does.
+class TranscodedMjpegStream:
+
+    def __init__(self, logger:logging.Logger, upstreamResult:OctoHttpRequest.Result, reader:MjpegStreamReader, frameTransform, frameTap = None, mustTransform:bool = False) -> None:
+        self.Logger = logger
+        self.UpstreamResult = upstreamResult
+        self.Reader = reader
+        self.FrameTransform = frameTransform
+        self.FrameTap = frameTap
+        self.MustTransform = mustTransform
+        self.SkippedFramesInARow = 0
+        self.IsFirstSend = True
+        self.FrameEmitter = MultipartFrameEmitter(WebcamStreamInstance.c_OeStreamBoundaryString, "image/jpeg")
+
+
+    # Returns a new result that streams the transcoded frames, or None if the upstream result isn't a mjpeg stream.
+    @staticmethod
+    def Create(logger:logging.Logger, upstreamResult:OctoHttpRequest.Result, frameTransform, frameTap = None, mustTransform:bool = False) -> OctoHttpRequest.Result:
+        #pylint: disable=import-outside-toplevel
+        from .webcamutil import WebcamUtil
+        reader = WebcamUtil.CreateMjpegStreamReader(logger, upstreamResult, True, poolSize=4)
+        if reader is None:
+            return None
+        return TranscodedMjpegStream(logger, upstreamResult, reader, frameTransform, frameTap, mustTransform).StartWebRequest()
+
+
+    # Returns the result with our callbacks setup for the stream body.
+    def StartWebRequest(self) -> OctoHttpRequest.Result:
+        headers = {
+            "content-type": f"multipart/x-mixed-replace; boundary={WebcamStreamInstance.c_OeStreamBoundaryString}",
+        }
+        return OctoHttpRequest.Result(200, headers, self.UpstreamResult.Url, self.UpstreamResult.DidFallback, customBodyStreamCallback=self._CustomBodyStreamRead, customBodyStreamClosedCallback=self._CustomBodyStreamClosed)
+
+
+    # Note the returned memoryview is only valid until the next call, since the buffer is reused.
+    def _CustomBodyStreamRead(self) -> memoryview:
+        originalFrame = None
+        while True:
+            frame = self.Reader.ReadFrame()
+            if frame is None:
+                return None
+            # If something wants an original frame from the stream, give it this one. The tap copies the frame.
+            if self.FrameTap is not None and self.FrameTap.IsFrameWanted:
+                self.FrameTap.OfferChunk(frame, len(frame))
+            transcoded = self.FrameTransform(frame)
+            if transcoded is not None:
+                self.SkippedFramesInARow = 0
+                # The transcoded frame can be shared with other viewers, so only the original frame is ever given back to the reader's pool.
+                if transcoded is not frame:
+                    self.Reader.ReleaseFrame(frame)
+                frame = transcoded
+                break
+            if self.MustTransform is False:
+                originalFrame = frame
+                break
+            self.Reader.ReleaseFrame(frame)
+            self.SkippedFramesInARow += 1
+            if self.SkippedFramesInARow > WebcamStreamInstance.c_MaxSkippedFramesInARow:
+                self.Logger.warn("TranscodedMjpegStream ending the stream, the frames can't be transformed and the client expects them to be.")
+                return None
+        # Like WebcamStreamInstance, the first frame is sent twice so browsers render it right away.
+        copies = 1
+        if self.IsFirstSend:
+            copies = 2
+            self.IsFirstSend = False
+        # The emitter copies the frame into its own buffer, so after this an original frame can be reused.
+        result = self.FrameEmitter.Emit(frame, copies)
+        self.Reader.ReleaseFrame(originalFrame)
+        return result
+
+
+    def _CustomBodyStreamClosed(self) -> None:
+        self.UpstreamResult.__exit__(None, None, None)
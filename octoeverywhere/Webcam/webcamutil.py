@@ -4,6 +4,7 @@ import urllib3
 
 from ..sentry import Sentry
 from ..octohttprequest import OctoHttpRequest
+from .mjpegstreamreader import MjpegStreamReader
 
 # A simple class to hold the result of a GetSnapshotFromStream call.
 class GetSnapshotFromStreamResult:
@@ -22,121 +23,67 @@ class WebcamUtil:
     @staticmethod
     def GetSnapshotFromStream(logger:logging.Logger, result:OctoHttpRequest.Result, validateMultiStreamHeader:bool = True) -> GetSnapshotFromStreamResult:
         try:
-            # Only validate if requested, so we don't have to do this constantly.
-            if validateMultiStreamHeader:
-                # We expect this to be a multipart stream if it's going to be a mjpeg stream.
-                isMultipartStream = False
-                contentTypeLower = ""
-                headers = result.Headers
-                for name in headers:
-                    nameLower = name.lower()
-                    if nameLower == "content-type":
-                        contentTypeLower = headers[name].lower()
-                        if contentTypeLower.startswith("multipart/"):
-                            isMultipartStream = True
-                        break
-
-                # If this isn't a multipart stream, get out of here.
-                if isMultipartStream is False:
-                    logger.info("GetSnapshotFromStream - Failed, not correct content type: "+str(contentTypeLower))
-                    return None
-
-            # Ensure we have a response object to read from.
-            responseForBodyRead = result.ResponseForBodyRead
-            if responseForBodyRead is None:
-                logger.warning("GetSnapshotFromStream - Failed, the result didn't have a requests lib Response object to read from.")
+            reader = WebcamUtil.CreateMjpegStreamReader(logger, result, validateMultiStreamHeader)
+            if reader is None:
                 return None
 
-            # Try to read some of the stream, so we can find the content type and the size of this first frame.
-            # We use the raw response, so we can control directly how much we read.
-            dataBuffer = responseForBodyRead.raw.read(300)
-            if dataBuffer is None:
-                logger.info("GetSnapshotFromStream - Failed, no data returned.")
+            # Read the first frame.
+            imageBuffer = reader.ReadFrame()
+            if imageBuffer is None:
+                logger.info("GetSnapshotFromStream - Failed, no frame was read from the stream.")
                 return None
 
-            # Decode the headers
-            # Example --boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-            #      or \r\n--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-            #      or boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-            headerStr = dataBuffer.decode(errors="ignore")
-
-            # Find out how long the headers are. The \r\n\r\n sequence ends the headers.
-            endOfAllHeadersMatch = "\r\n\r\n"
-            endOfHeaderMatch = "\r\n"
-            headerStrSize = headerStr.find(endOfAllHeadersMatch)
-            if headerStrSize == -1:
-                logger.info("GetSnapshotFromStream - Failed, no end of headers found.")
-                return None
+            # Success!
+            return GetSnapshotFromStreamResult(imageBuffer, reader.ContentType)
+        except Exception as e:
+            WebcamUtil.HandleStreamReadException(logger, e)
+        return None
 
-            # Add 4 bytes for the \r\n\r\n end of header sequence.
-            headerStrSize += 4
-
-            # Try to find the size of this chunk.
-            frameSizeInt = 0
-            contentType = None
-            headers = headerStr.split(endOfHeaderMatch)
-            for header in headers:
-                headerLower = header.lower()
-                if headerLower.startswith("content-type"):
-                    # We found the content-length header!
-                    p = header.split(':')
-                    if len(p) == 2:
-                        contentType = p[1].strip()
-
-                if headerLower.startswith("content-length"):
-                    # We found the content-length header!
-                    p = header.split(':')
-                    if len(p) == 2:
-                        frameSizeInt = int(p[1].strip())
-
-                # Break when done.
-                if frameSizeInt > 0 and contentType is not None:
+
+    # Creates a reader for the jmpeg stream, which can be used to read frame after frame from the stream.
+    # The OctoHttpResult should be checked for success before calling this function.
+    # If poolSize is greater than 0, the frames are returned from a buffer pool, which is best for readers that read a lot of frames. Frames are only reused once they are given back with ReleaseFrame.
+    # Returns None on failure.
+    @staticmethod
+    def CreateMjpegStreamReader(logger:logging.Logger, result:OctoHttpRequest.Result, validateMultiStreamHeader:bool = True, poolSize:int = 0) -> MjpegStreamReader:
+        # Only validate if requested, so we don't have to do this constantly.
+        if validateMultiStreamHeader:
+            # We expect this to be a multipart stream if it's going to be a mjpeg stream.
+            isMultipartStream = False
+            contentTypeLower = ""
+            headers = result.Headers
+            for name in headers:
+                nameLower = name.lower()
+                if nameLower == "content-type":
+                    contentTypeLower = headers[name].lower()
+                    if contentTypeLower.startswith("multipart/"):
+                        isMultipartStream = True
                     break
 
-            if frameSizeInt == 0 or contentType is None:
-                if frameSizeInt == 0:
-                    logger.info("GetSnapshotFromStream - Failed, failed to find frame size.")
-                if contentType is None:
-                    logger.info("GetSnapshotFromStream - Failed, failed to find the content type.")
+            # If this isn't a multipart stream, get out of here.
+            if isMultipartStream is False:
+                logger.info("GetSnapshotFromStream - Failed, not correct content type: "+str(contentTypeLower))
                 return None
 
-            # Read the entire first image into the buffer.
-            totalDesiredBufferSize = frameSizeInt + headerStrSize
-            toRead = totalDesiredBufferSize - len(dataBuffer)
-            if toRead > 0:
-                data = responseForBodyRead.raw.read(toRead)
-                if data is None:
-                    logger.error("GetSnapshotFromStream - Failed, failed to read the rest of the image buffer.")
-                    return None
-                dataBuffer += data
-
-            # If we got extra data trim it.
-            # This shouldn't happen, but just incase the api changes.
-            if len(dataBuffer) > totalDesiredBufferSize:
-                dataBuffer = dataBuffer[:totalDesiredBufferSize]
-
-            # Check we got what we wanted.
-            if len(dataBuffer) != totalDesiredBufferSize:
-                logger.warning("GetSnapshotFromStream - Failed, the data read loop didn't produce the expected data size. desired: "+str(totalDesiredBufferSize)+", got: "+str(len(dataBuffer)))
-                return None
+        # Ensure we have a response object to read from.
+        responseForBodyRead = result.ResponseForBodyRead
+        if responseForBodyRead is None:
+            logger.warning("GetSnapshotFromStream - Failed, the result didn't have a requests lib Response object to read from.")
+            return None
+        return MjpegStreamReader(logger, responseForBodyRead, poolSize)
 
-            # Get only the jpeg buffer
-            imageBuffer = dataBuffer[headerStrSize:]
-            if len(imageBuffer) != frameSizeInt:
-                logger.warning("GetSnapshotFromStream - Failed, final image size was not the frame size. expected: "+str(frameSizeInt)+", got: "+str(len(imageBuffer)))
 
-            # Success!
-            return GetSnapshotFromStreamResult(imageBuffer, contentType)
-        except Exception as e:
-            if e is ConnectionError and "Read timed out" in str(e):
-                logger.debug("GetSnapshotFromStream - Failed, got a timeout while reading the stream.")
-            elif e is urllib3.exceptions.ProtocolError and "IncompleteRead" in str(e):
-                logger.debug("GetSnapshotFromStream - Failed, got a incomplete read while reading the stream.")
-            elif e is urllib3.exceptions.ReadTimeoutError and "Read timed out" in str(e):
-                logger.debug("GetSnapshotFromStream - Failed, got a read timeout while reading stream.")
-            else:
-                Sentry.Exception("Failed to get fallback snapshot.", e)
-        return None
+    # Logs an exception from reading a stream, the common ones are expected and only logged as debug.
+    @staticmethod
+    def HandleStreamReadException(logger:logging.Logger, e:Exception) -> None:
+        if isinstance(e, ConnectionError) and "Read timed out" in str(e):
+            logger.debug("GetSnapshotFromStream - Failed, got a timeout while reading the stream.")
+        elif isinstance(e, urllib3.exceptions.ProtocolError) and "IncompleteRead" in str(e):
+            logger.debug("GetSnapshotFromStream - Failed, got a incomplete read while reading the stream.")
+        elif isinstance(e, urllib3.exceptions.ReadTimeoutError) and "Read timed out" in str(e):
+            logger.debug("GetSnapshotFromStream - Failed, got a read timeout while reading stream.")
+        else:
+            Sentry.Exception("Failed to get fallback snapshot.", e)
 
 
     # Checks if the jpeg header info is set correctly.
@@ -0,0 +1,256 @@
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+from .sentry import Sentry
+from .threadbudget import ThreadBudget
+
+
+# What a BoundedExecutor does when a task is submitted but the queue is full, or there are no workers and the thread budget is used.
+class RejectPolicy:
+    # The task isn't run, Submit returns False.
+    Reject = 0
+    # The oldest queued task is dropped to make room, for work where only the newest task matters.
+    # If the dropped task was submitted with an onDropped callback, it's called, so the task's owner knows it will never run.
+    DropOldest = 1
+    # The task is run on a new thread outside of the pool, for work that must never be dropped and must never block the caller.
+    NewThread = 2
+
+
+# A thread pool with a max number of worker threads and a max queue length.
+#
+# Workers are created as tasks come in, up to the max and only if the thread budget allows it, and exit after they are idle for a while.
+# So a pool that's not used doesn't hold any threads.
+class BoundedExecutor:
+
+    # How long a worker waits for a new task before it exits.
+    c_IdleTimeoutSec = 30.0
+
+    def __init__(self, logger:logging.Logger, name:str, maxThreads:int, maxQueue:int, rejectPolicy:int) -> None:
+        self.Logger = logger
+        self.Name = name
+        self.Origin = "Pool-" + name
+        self.MaxThreads = maxThreads
+        self.MaxQueue = maxQueue
+        self.RejectPolicy = rejectPolicy
+        self.Lock = threading.Lock()
+        self.WorkAvailable = threading.Condition(self.Lock)
+        self.Queue = deque()
+        self.WorkerCount = 0
+        self.IdleWorkerCount = 0
+        self.RejectedCount = 0
+
+
+    # Queues the function to be run on a worker thread.
+    # onDropped is optional, it's called with no args on the submitting thread if the task is dropped by the DropOldest policy.
+    # rejectPolicy is optional, if set it's used for this task instead of the executor's policy.
+    # Returns True if the task was queued or run, False if it was rejected.
+    def Submit(self, func, *args, onDropped=None, rejectPolicy:int=None) -> bool:
+        if rejectPolicy is None:
+            rejectPolicy = self.RejectPolicy
+        dropped = None
+        with self.Lock:
+            # If there are more idle workers than queued tasks, one of them will pick this up.
+            if self.IdleWorkerCount > len(self.Queue):
+                self.Queue.append((func, args, onDropped))
+                self.WorkAvailable.notify()
+                return True
+            # Otherwise try to add a worker.
+            if self.WorkerCount < self.MaxThreads and self._TryStartWorker():
+                self.Queue.append((func, args, onDropped))
+                return True
+            # If there are workers and room, queue it for a worker to pick up when it's done.
+            if self.WorkerCount > 0 and len(self.Queue) < self.MaxQueue:
+                self.Queue.append((func, args, onDropped))
+                return True
+            # The pool is full.
+            self.RejectedCount += 1
+            rejectedCount = self.RejectedCount
+            if rejectPolicy == RejectPolicy.DropOldest and self.WorkerCount > 0:
+                dropped = self.Queue.popleft()
+                self.Queue.append((func, args, onDropped))
+
+        if dropped is not None:
+            _, _, droppedOnDropped = dropped
+            if droppedOnDropped is not None:
+                self._RunTask(droppedOnDropped, ())
+            return True
+
+        if rejectPolicy == RejectPolicy.NewThread:
+            return self._RunOnNewThread(func, args, rejectedCount)
+        if rejectedCount < 10 or rejectedCount % 100 == 0:
+            self.Logger.warn(f"Executor {self.Name} is full and rejected a task. Workers: {self.WorkerCount}, Queued: {len(self.Queue)}, Total rejected: {rejectedCount}")
+        return False
+
+
+    # Returns a tuple of (workers, idle workers, queued tasks, rejected tasks)
+    def GetStats(self):
+        with self.Lock:
+            return (self.WorkerCount, self.IdleWorkerCount, len(self.Queue), self.RejectedCount)
+
+
+    # Waits until there are no queued or running tasks, or the timeout expires.
+    # Returns True if the executor is idle.
+    def WaitForIdle(self, timeoutSec:float) -> bool:
+        endSec = time.time() + timeoutSec
+        while True:
+            with self.Lock:
+                if len(self.Queue) == 0 and self.WorkerCount == self.IdleWorkerCount:
+                    return True
+            if time.time() > endSec:
+                return False
+            time.sleep(0.05)
+
+
+    # Must be called under lock.
+    def _TryStartWorker(self) -> bool:
+        self.WorkerCount += 1
+        if ThreadBudget.StartThread(self.Origin, self._Worker, name=f"{self.Origin}-{self.WorkerCount}", daemon=True, required=False) is None:
+            self.WorkerCount -= 1
+            return False
+        return True
+
+
+    # The thread is required, so the budget never refuses it. This only fails if the OS can't create the thread.
+    def _RunOnNewThread(self, func, args, rejectedCount:int) -> bool:
+        if rejectedCount < 10 or rejectedCount % 100 == 0:
+            self.Logger.warn(f"Executor {self.Name} is full, running a task on a new thread. Workers: {self.WorkerCount}, Queued: {len(self.Queue)}, Total overflowed: {rejectedCount}")
+        try:
+            ThreadBudget.StartThread(self.Origin + "-Overflow", self._RunTask, args=(func, args), daemon=True, required=True)
+            return True
+        except Exception as e:
+            Sentry.Exception(f"Executor {self.Name} failed to start an overflow thread.", e)
+        return False
+
+
+    def _Worker(self):
+        while True:
+            with self.Lock:
+                if len(self.Queue) == 0:
+                    self.IdleWorkerCount += 1
+                    self.WorkAvailable.wait(BoundedExecutor.c_IdleTimeoutSec)
+                    self.IdleWorkerCount -= 1
+                    if len(self.Queue) == 0:
+                        self.WorkerCount -= 1
+                        return
+                func, args, _ = self.Queue.popleft()
+            self._RunTask(func, args)
+
+
+    def _RunTask(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            Sentry.Exception(f"Executor {self.Name} task threw an exception.", e)
+
+
+# The shared executors for the process.
+#   Io        - Short blocking work, like http calls and file writes.
+#   Cpu       - Work that's mostly CPU bound, like compressing, limited to the number of cores.
+#   Callbacks - Callbacks that are fired on a different thread so the caller isn't blocked, like websocket events.
+#   Notifications - Sending notifications, which must never be dropped.
+#
+# Long running loops, like a websocket's receive loop, should use ThreadBudget.StartThread instead, since they would hold a pool worker forever.
+class Executors:
+
+    # When the process exits, how long we wait for io and notification tasks that are still running, like telemetry sent just before exiting.
+    # This is kept short so a queue of tasks can't hold up the exit. The workers are daemon threads so they don't hold the process open while they are idle.
+    c_ExitWaitTimeoutSec = 3.0
+
+    _Logger:logging.Logger = None
+    _Lock = threading.Lock()
+    _Io:BoundedExecutor = None
+    _Cpu:BoundedExecutor = None
+    _Callbacks:BoundedExecutor = None
+    _Notifications:BoundedExecutor = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        Executors._Logger = logger
+        ThreadBudget.Init(logger)
+
+
+    # Runs the function on the io executor. Returns False if it was rejected.
+    @staticmethod
+    def Io(func, *args) -> bool:
+        if Executors._Io is None:
+            Executors._CreateExecutors()
+        return Executors._Io.Submit(func, *args)
+
+
+    # Runs the function on the io executor. If the executor is full, the function is run on a new thread, for work that must never be dropped.
+    @staticmethod
+    def IoMustRun(func, *args) -> bool:
+        if Executors._Io is None:
+            Executors._CreateExecutors()
+        return Executors._Io.Submit(func, *args, rejectPolicy=RejectPolicy.NewThread)
+
+
+    # Runs the function on the cpu executor. If the executor is full, the oldest queued task is dropped, and its onDropped callback is called if it has one.
+    @staticmethod
+    def Cpu(func, *args, onDropped=None) -> bool:
+        if Executors._Cpu is None:
+            Executors._CreateExecutors()
+        return Executors._Cpu.Submit(func, *args, onDropped=onDropped)
+
+
+    # Runs the function on the callback executor. If the executor is full, the function is run on a new thread, never on the calling thread.
+    @staticmethod
+    def Callback(func, *args) -> bool:
+        if Executors._Callbacks is None:
+            Executors._CreateExecutors()
+        return Executors._Callbacks.Submit(func, *args)
+
+
+    # Runs the function on the notification executor. If the executor is full, the function is run on a new thread, so it's never dropped.
+    @staticmethod
+    def Notification(func, *args) -> bool:
+        if Executors._Io is None:
+            Executors._CreateExecutors()
+        return Executors._Notifications.Submit(func, *args)
+
+
+    # Returns a single line string of the executor stats, for logging.
+    @staticmethod
+    def GetStatsStr() -> str:
+        s = ""
+        for e in (Executors._Io, Executors._Cpu, Executors._Callbacks, Executors._Notifications):
+            if e is not None:
+                workers, idle, queued, rejected = e.GetStats()
+                s += f"{e.Name} [workers:{workers} idle:{idle} queued:{queued} rejected:{rejected}] "
+        return s
+
+
+    @staticmethod
+    def _CreateExecutors() -> None:
+        with Executors._Lock:
+            if Executors._Io is not None:
+                return
+            logger = Executors._Logger
+            if logger is None:
+                logger = logging.getLogger("octoeverywhere")
+            cpuCount = 1
+            try:
+                import multiprocessing #pylint: disable=import-outside-toplevel
+                cpuCount = max(1, multiprocessing.cpu_count())
+            except Exception:
+                pass
+            # Set the others before Io, since Io is what we check to see if they are created.
+            Executors._Cpu = BoundedExecutor(logger, "Cpu", cpuCount, 32, RejectPolicy.DropOldest)
+            Executors._Callbacks = BoundedExecutor(logger, "Callbacks", 16, 512, RejectPolicy.NewThread)
+            Executors._Notifications = BoundedExecutor(logger, "Notifications", 4, 64, RejectPolicy.NewThread)
+            Executors._Io = BoundedExecutor(logger, "Io", 16, 256, RejectPolicy.Reject)
+            atexit.register(Executors._OnExit)
+
+
+    @staticmethod
+    def _OnExit() -> None:
+        try:
+            endSec = time.time() + Executors.c_ExitWaitTimeoutSec
+            Executors._Notifications.WaitForIdle(Executors.c_ExitWaitTimeoutSec)
+            Executors._Io.WaitForIdle(max(0.0, endSec - time.time()))
+        except Exception:
+            pass
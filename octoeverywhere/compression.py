@@ -9,9 +9,10 @@ import subprocess
 import multiprocessing
 
 from .sentry import Sentry
-from .zstandarddictionary import ZStandardDictionary
+from .zstandarddictionary import ZStandardDictionary, ZStandardPayloadClass
 
 from .Proto.DataCompression import DataCompression
+from .threadbudget import ThreadBudget
 
 
 # A return type for the compression operation.
@@ -38,8 +39,13 @@ class CompressionContext:
         self.ResourceLock = threading.Lock()
         self.IsClosed = False
 
+        # The kind of data this context compresses, which picks the dictionary that's used.
+        self.PayloadClass = ZStandardPayloadClass.Default
+
         # Compression - can't be shared to be thread safe
         self.Compressor = None
+        self.CompressorDictId:int = None
+        self.CompressorIsLargeBody = False
         self.StreamWriter = None
         self.CompressionByteBuffer:bytes = None
         # The compression is more efficient if we know the size of the data of the og data.
@@ -47,6 +53,7 @@ class CompressionContext:
 
         # Decompression - can't be shared to be thread safe
         self.Decompressor = None
+        self.DecompressorDictId:int = None
         self.StreamReader = None
         self.DecompressionByteBuffer:bytes = None
 
@@ -91,11 +98,19 @@ class CompressionContext:
         if streamWriter is not None:
             streamWriter.__exit__(exc_type, exc_value, traceback)
         if compressor is not None:
-            Compression.Get().ReturnZStandardCompressor(compressor)
+            Compression.Get().ReturnZStandardCompressor(compressor, self.CompressorDictId, self.CompressorIsLargeBody)
         if streamReader is not None:
             streamReader.__exit__(exc_type, exc_value, traceback)
         if decompressor is not None:
-            Compression.Get().ReturnZStandardDecompressor(decompressor)
+            Compression.Get().ReturnZStandardDecompressor(decompressor, self.DecompressorDictId)
+
+
+    # Sets the kind of data this context compresses, see ZStandardPayloadClass.
+    # This must be set before compression starts, since the dictionary can't change in a stream.
+    def SetPayloadClass(self, payloadClass:int):
+        if self.Compressor is not None:
+            raise Exception("CompressionContext SetPayloadClass tried to be set after compression started")
+        self.PayloadClass = payloadClass
 
 
     # Ideally, we want to tell the system how much data is being compressed in total.
@@ -110,9 +125,12 @@ class CompressionContext:
         # A bytearray is a better option if we are continuously appending data, since we can allocate a bigger buffer
         # and copy into it. But 99% of the time we are only doing one compress callback at a time, in which case it's
         # better to just take the buffer given to us and use it.
+        # Large bodies get many callbacks per flush, so once there's a second one we switch to a bytearray.
         if self.CompressionByteBuffer is None:
             self.CompressionByteBuffer = data
         else:
+            if isinstance(self.CompressionByteBuffer, bytes):
+                self.CompressionByteBuffer = bytearray(self.CompressionByteBuffer)
             self.CompressionByteBuffer += data
 
 
@@ -125,7 +143,10 @@ class CompressionContext:
             if self.IsClosed:
                 raise Exception("The compression context is closed, we can't compress data")
             if self.Compressor is None:
-                self.Compressor = Compression.Get().RentZStandardCompressor()
+                self.CompressorDictId = ZStandardDictionary.Get().GetDictIdForPayloadClass(self.PayloadClass)
+                # Large bodies are compressed with the multithreaded compressor, see Compression.LargeBodyMinSizeBytes
+                self.CompressorIsLargeBody = Compression.Get().IsLargeBody(self.CompressionTotalSizeOfDataBytes)
+                self.Compressor = Compression.Get().RentZStandardCompressor(self.CompressorDictId, self.CompressorIsLargeBody)
                 if self.Compressor is None:
                     raise Exception("CompressionContext failed to rent a compressor")
 
@@ -194,7 +215,9 @@ class CompressionContext:
                 raise Exception("The compression context is closed, we can't decompress data")
             if self.Decompressor is None:
                 isFirstMessage = True
-                self.Decompressor = Compression.Get().RentZStandardDecompressor()
+                # The first message has the frame header, which has the id of the dictionary it was compressed with.
+                self.DecompressorDictId = Compression.Get().GetZStandardFrameDictId(data)
+                self.Decompressor = Compression.Get().RentZStandardDecompressor(self.DecompressorDictId)
                 if self.Decompressor is None:
                     raise Exception("CompressionContext failed to rent a decompressor")
 
@@ -234,6 +257,16 @@ class Compression:
     ZStandardPipPackageString = "zstandard>=0.21.0,<0.23.0"
     ZStandardMinCoreCountForInstall = 3
 
+    # Bodies at least this large are compressed with zstandard's multithreaded mode, if there's more than one core.
+    # In that mode zstandard splits the data into jobs that are compressed on worker threads in parallel, and the output is still one ordered stream.
+    # It has a big overhead for small or streamed messages, since every flush waits on the workers and ends the job, which also hurts the ratio.
+    # So everything else uses the single threaded mode.
+    LargeBodyMinSizeBytes = 4 * 1024 * 1024
+    # The job size each worker compresses. Each body read is ~2MB, so this splits a read over 4 workers.
+    # 512KB is the smallest job size zstandard allows.
+    LargeBodyJobSizeBytes = 512 * 1024
+    LargeBodyMaxThreadCount = 4
+
     _Instance = None
 
     @staticmethod
@@ -249,23 +282,23 @@ class Compression:
     def __init__(self, logger: logging.Logger, localFileStoragePath:str) -> None:
         self.Logger = logger
         self.LocalFileStoragePath = localFileStoragePath
-        self.ZStandardCompressorPool = []
+        # The compressor pools are keyed by dictionary id and if it's a large body compressor, since a compressor is bound to the dictionary and settings it was made with.
+        # The decompressor pools are keyed by dictionary id.
+        self.ZStandardCompressorPool = {}
         self.ZStandardCompressorPoolLock = threading.Lock()
         self.ZStandardCompressorCreatedCount = 0
 
-        self.ZStandardDecompressorPool = []
+        self.ZStandardDecompressorPool = {}
         self.ZStandardDecompressorPoolLock = threading.Lock()
         self.ZStandardDecompressorCreatedCount = 0
 
-        # Determine the thread count we will allow zstandard to use.
-        # If there are 3 or less cores, we will only use one thread.
-        # If there are 4 or more cores, we will use all but 2.
-        self.ZStandardThreadCount = 1
+        # Determine the worker thread count zstandard will use for large bodies.
+        # Note that for zstandard 1 thread means 1 worker thread, not single threaded mode, so we only use it if we have more than one core.
+        # The web stream thread is blocked while the workers compress, so we can use all but one core, but always at least 2 workers.
+        self.ZStandardLargeBodyThreadCount = 0
         cpuCores = multiprocessing.cpu_count()
-        if cpuCores <= 3:
-            self.ZStandardThreadCount = 1
-        else:
-            self.ZStandardThreadCount = cpuCores - 2
+        if cpuCores >= 2:
+            self.ZStandardLargeBodyThreadCount = min(Compression.LargeBodyMaxThreadCount, max(2, cpuCores - 1))
 
         # Always init the zstandard singleton, even if we aren't using zstandard.
         ZStandardDictionary.Init(logger)
@@ -283,7 +316,7 @@ class Compression:
 
             # Only set this flag after everything is setup and good.
             self.CanUseZStandardLib = True
-            self.Logger.info(f"Compression is using zstandard with {self.ZStandardThreadCount} threads")
+            self.Logger.info(f"Compression is using zstandard with {self.ZStandardLargeBodyThreadCount} threads for large bodies")
 
             # Once the state is set, make a few compressors and decompressors so they are cached and ready to go.
             c = self.RentZStandardCompressor()
@@ -338,13 +371,14 @@ class Compression:
 
     # Returns a compressor or None if it fails to load.
     # The compressor warps the zstandard lib context, they are reusable but not thread safe.
-    def RentZStandardCompressor(self):
+    def RentZStandardCompressor(self, dictId:int = ZStandardDictionary.c_PreTrainedDictId, isLargeBody:bool = False):
         if self.CanUseZStandardLib is False:
             return None
         try:
             with self.ZStandardCompressorPoolLock:
-                if len(self.ZStandardCompressorPool) > 0:
-                    return self.ZStandardCompressorPool.pop()
+                pool = self.ZStandardCompressorPool.get((dictId, isLargeBody), None)
+                if pool is not None and len(pool) > 0:
+                    return pool.pop()
 
                 # Report how many we have created for leak detection.
                 self.ZStandardCompressorCreatedCount += 1
@@ -353,30 +387,42 @@ class Compression:
 
                 #pylint: disable=import-outside-toplevel
                 import zstandard as zstd
-                # We must use the pre-trained dict, since the service uses it as well and it must match.
-                return zstd.ZstdCompressor(threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
+                # The dict must be one the service has as well, see ZStandardDictionary.
+                compressionDict = ZStandardDictionary.Get().GetDict(dictId)
+                if compressionDict is None:
+                    raise Exception(f"Unknown dictionary id {dictId}")
+                if isLargeBody:
+                    params = zstd.ZstdCompressionParameters.from_level(3, threads=self.ZStandardLargeBodyThreadCount, job_size=Compression.LargeBodyJobSizeBytes)
+                    return zstd.ZstdCompressor(dict_data=compressionDict, compression_params=params)
+                return zstd.ZstdCompressor(dict_data=compressionDict)
         except Exception as e:
             self.Logger.error(f"Failed to rent zstandard compressor. Error: {e}")
         return None
 
 
     # Puts the compressor back into the pool
-    def ReturnZStandardCompressor(self, compressor):
+    def ReturnZStandardCompressor(self, compressor, dictId:int = ZStandardDictionary.c_PreTrainedDictId, isLargeBody:bool = False):
         if compressor is None:
             return
         with self.ZStandardCompressorPoolLock:
-            self.ZStandardCompressorPool.append(compressor)
+            self.ZStandardCompressorPool.setdefault((dictId, isLargeBody), []).append(compressor)
+
+
+    # Returns true if a body of this size should use the multithreaded compressor.
+    def IsLargeBody(self, totalSizeBytes:int) -> bool:
+        return self.ZStandardLargeBodyThreadCount > 1 and totalSizeBytes >= Compression.LargeBodyMinSizeBytes
 
 
     # Returns a decompressor or None if it fails to load.
     # The decompressor warps the zstandard lib context, they are reusable but not thread safe.
-    def RentZStandardDecompressor(self):
+    def RentZStandardDecompressor(self, dictId:int = ZStandardDictionary.c_PreTrainedDictId):
         if self.CanUseZStandardLib is False:
             return None
         try:
             with self.ZStandardDecompressorPoolLock:
-                if len(self.ZStandardDecompressorPool) > 0:
-                    return self.ZStandardDecompressorPool.pop()
+                pool = self.ZStandardDecompressorPool.get(dictId, None)
+                if pool is not None and len(pool) > 0:
+                    return pool.pop()
 
                 # Report how many we have created for leak detection.
                 self.ZStandardDecompressorCreatedCount += 1
@@ -385,25 +431,41 @@ class Compression:
 
                 #pylint: disable=import-outside-toplevel
                 import zstandard as zstd
-                # We must use the pre-trained dict, since the service uses it as well and it must match.
-                return zstd.ZstdDecompressor(dict_data=ZStandardDictionary.Get().PreTrainedDict)
+                # The dict must match the one the data was compressed with.
+                compressionDict = ZStandardDictionary.Get().GetDict(dictId)
+                if compressionDict is None:
+                    raise Exception(f"Unknown dictionary id {dictId}")
+                return zstd.ZstdDecompressor(dict_data=compressionDict)
         except Exception as e:
             self.Logger.error(f"Failed to rent zstandard decompressor. Error: {e}")
         return None
 
 
     # Puts the decompressor back into the pool
-    def ReturnZStandardDecompressor(self, decompressor):
+    def ReturnZStandardDecompressor(self, decompressor, dictId:int = ZStandardDictionary.c_PreTrainedDictId):
         if decompressor is None:
             return
         with self.ZStandardDecompressorPoolLock:
-            self.ZStandardDecompressorPool.append(decompressor)
+            self.ZStandardDecompressorPool.setdefault(dictId, []).append(decompressor)
+
+
+    # Returns the dictionary id from the zstandard frame header of the data.
+    # If the frame doesn't say, it was compressed with the pre-trained dictionary.
+    def GetZStandardFrameDictId(self, data:bytes) -> int:
+        if self.CanUseZStandardLib is False:
+            return ZStandardDictionary.c_PreTrainedDictId
+        #pylint: disable=import-outside-toplevel
+        import zstandard as zstd
+        dictId = zstd.get_frame_parameters(data).dict_id
+        if dictId == 0:
+            return ZStandardDictionary.c_PreTrainedDictId
+        return dictId
 
 
     # If we can't use zstandard, we assume it's not installed since it doesn't install as a required dependency.
     # In that case, we will use this function to try to install it async, and it will be used on the next restart.
     def _TryInstallZStandardIfNeededAsync(self):
-        threading.Thread(target=self._TryInstallZStandardIfNeeded, daemon=True).start()
+        ThreadBudget.StartThread("ZStandardInstall", self._TryInstallZStandardIfNeeded, daemon=True, required=False)
 
 
     def _TryInstallZStandardIfNeeded(self):
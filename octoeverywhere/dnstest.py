@@ -1,8 +1,6 @@
 import time
 import logging
 
-import dns.resolver
-
 # Created to the DNS resolution of our URLS when the websocket claims it can't connect due to DNS issues.
 class DnsTest:
 
@@ -39,6 +37,8 @@ class DnsTest:
     def _TestUrl(self, url: str, recordType:str = "A") -> None:
         try:
             self.Logger.debug(f"Starting DNS resolve test for {url} with record type {recordType}")
+            # Only imported when the test runs, since this is only used when we fail to connect.
+            import dns.resolver #pylint: disable=import-outside-toplevel
             startSec = time.time()
             dnsResolver = dns.resolver.Resolver()
             dnsResolver.timeout = 5.0 # Timeout in seconds.
@@ -0,0 +1,184 @@
+import os
+import time
+import errno
+import select
+import struct
+import logging
+
+
+# Watches directories for changes to files with given names, using inotify when it's available.
+#
+# inotify is used through ctypes, so there's no extra dependency. If it's not available, like on other OSes or if the user is out of inotify watches,
+# IsEventDriven() returns False and WaitForChanges() waits the full timeout, so the caller falls back to polling.
+#
+# Each watched dir has an optional set of names we care about, events for other names in the dir are ignored.
+# Only events for finished changes are used, files that are closed after writing, created, deleted, or moved, so we don't react halfway through a write.
+class FileWatcher:
+
+    # From sys/inotify.h
+    c_InCloseWrite = 0x00000008
+    c_InMovedFrom  = 0x00000040
+    c_InMovedTo    = 0x00000080
+    c_InCreate     = 0x00000100
+    c_InDelete     = 0x00000200
+    c_InDeleteSelf = 0x00000400
+    c_InMoveSelf   = 0x00000800
+    c_InQOverflow  = 0x00004000
+    c_InIgnored    = 0x00008000
+    c_InOnlyDir    = 0x01000000
+    c_InNonBlock   = 0x00000800
+    c_InCloExec    = 0x00080000
+    c_WatchMask = c_InCloseWrite | c_InMovedFrom | c_InMovedTo | c_InCreate | c_InDelete | c_InDeleteSelf | c_InMoveSelf | c_InOnlyDir
+
+    # Each event is a header of (wd, mask, cookie, name length), followed by the name, padded with nulls.
+    c_EventHeader = struct.Struct("iIII")
+    c_ReadBufferSize = 64 * 1024
+
+
+    def __init__(self, logger:logging.Logger, name:str) -> None:
+        self.Logger = logger
+        self.Name = name
+        self.Libc = None
+        self.Fd = None
+        # wd -> (dir path, set of names or None for any name)
+        self.WatchesByWd = {}
+        # dir path -> wd
+        self.WdsByPath = {}
+        try:
+            import ctypes #pylint: disable=import-outside-toplevel
+            libc = ctypes.CDLL(None, use_errno=True)
+            if hasattr(libc, "inotify_init1") is False:
+                self.Logger.info(f"FileWatcher {name} will poll, inotify isn't supported on this system.")
+                return
+            fd = libc.inotify_init1(FileWatcher.c_InNonBlock | FileWatcher.c_InCloExec)
+            if fd < 0:
+                self.Logger.info(f"FileWatcher {name} will poll, inotify_init1 failed. {os.strerror(ctypes.get_errno())}")
+                return
+            self.Libc = libc
+            self.Fd = fd
+        except Exception as e:
+            self.Logger.info(f"FileWatcher {name} will poll, inotify failed to load. {e}")
+
+
+    # Returns True if changes are detected by events, False if the caller needs to poll.
+    def IsEventDriven(self) -> bool:
+        return self.Fd is not None
+
+
+    # Sets the dirs that are watched, as a dict of dir path -> set of file names we care about, or None for any name.
+    # Dirs that are no longer in the dict are no longer watched. Dirs that don't exist are skipped, so the caller should also watch the parent dir.
+    def SetWatches(self, watches:dict) -> None:
+        if self.Fd is None:
+            return
+        for path in list(self.WdsByPath.keys()):
+            if path not in watches:
+                self._RemoveWatch(path)
+        for path, names in watches.items():
+            names = None if names is None else set(names)
+            wd = self.WdsByPath.get(path, None)
+            if wd is not None and wd in self.WatchesByWd:
+                self.WatchesByWd[wd] = (path, names)
+                continue
+            if os.path.isdir(path) is False:
+                continue
+            wd = self.Libc.inotify_add_watch(self.Fd, os.fsencode(path), FileWatcher.c_WatchMask)
+            if wd < 0:
+                # This is usually ENOSPC, which means the user is out of inotify watches. We still get events from the other dirs, so we keep going.
+                import ctypes #pylint: disable=import-outside-toplevel
+                self.Logger.warn(f"FileWatcher {self.Name} failed to watch {path}. {os.strerror(ctypes.get_errno())}")
+                continue
+            self.WatchesByWd[wd] = (path, names)
+            self.WdsByPath[path] = wd
+
+
+    # Blocks until a change we care about happens, or the timeout expires.
+    # When there's a change, this keeps waiting until there have been no changes for debounceSec, but no longer than maxDebounceSec,
+    # so something that writes a lot of files, like a frontend update, only results in one call.
+    # Returns True if there was a change, False if the timeout expired. If there's no inotify, this always waits the full timeout and returns False.
+    def WaitForChanges(self, timeoutSec:float, debounceSec:float, maxDebounceSec:float) -> bool:
+        if self.Fd is None:
+            time.sleep(timeoutSec)
+            return False
+        endSec = time.monotonic() + timeoutSec
+        while True:
+            waitSec = endSec - time.monotonic()
+            if waitSec <= 0:
+                return False
+            if self._WaitForEvents(waitSec) and self._ReadEvents():
+                break
+        # Debounce until things are quiet.
+        debounceEndSec = time.monotonic() + maxDebounceSec
+        while True:
+            waitSec = min(debounceSec, debounceEndSec - time.monotonic())
+            if waitSec <= 0:
+                return True
+            if self._WaitForEvents(waitSec) is False:
+                return True
+            self._ReadEvents()
+
+
+    def Close(self) -> None:
+        fd = self.Fd
+        self.Fd = None
+        self.WatchesByWd = {}
+        self.WdsByPath = {}
+        if fd is not None:
+            try:
+                os.close(fd)
+            except Exception:
+                pass
+
+
+    # Returns True if there are events to read.
+    def _WaitForEvents(self, timeoutSec:float) -> bool:
+        try:
+            readable, _, _ = select.select([self.Fd], [], [], timeoutSec)
+            return len(readable) > 0
+        except InterruptedError:
+            return False
+
+
+    # Reads all of the pending events, returns True if any of them are for something we care about.
+    def _ReadEvents(self) -> bool:
+        isRelevant = False
+        while True:
+            try:
+                buffer = os.read(self.Fd, FileWatcher.c_ReadBufferSize)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return isRelevant
+                raise
+            if not buffer:
+                return isRelevant
+            offset = 0
+            headerSize = FileWatcher.c_EventHeader.size
+            while offset + headerSize <= len(buffer):
+                wd, mask, _, nameLen = FileWatcher.c_EventHeader.unpack_from(buffer, offset)
+                name = buffer[offset + headerSize : offset + headerSize + nameLen].rstrip(b"\0")
+                offset += headerSize + nameLen
+                # If events were lost, we have to assume something changed.
+                if mask & FileWatcher.c_InQOverflow:
+                    isRelevant = True
+                    continue
+                watch = self.WatchesByWd.get(wd, None)
+                if watch is None:
+                    continue
+                # The dir was deleted or moved, so the watch is gone. The caller needs to look again, and set the watches again.
+                if mask & (FileWatcher.c_InIgnored | FileWatcher.c_InDeleteSelf | FileWatcher.c_InMoveSelf):
+                    if mask & FileWatcher.c_InIgnored:
+                        self.WatchesByWd.pop(wd, None)
+                        if self.WdsByPath.get(watch[0], None) == wd:
+                            self.WdsByPath.pop(watch[0], None)
+                    isRelevant = True
+                    continue
+                names = watch[1]
+                if names is None or os.fsdecode(name) in names:
+                    isRelevant = True
+
+
+    def _RemoveWatch(self, path:str) -> None:
+        wd = self.WdsByPath.pop(path, None)
+        if wd is None:
+            return
+        if self.WatchesByWd.pop(wd, None) is not None:
+            self.Libc.inotify_rm_watch(self.Fd, wd)
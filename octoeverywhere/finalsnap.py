@@ -1,10 +1,11 @@
 import math
 import time
 import logging
-import threading
 
 from .sentry import Sentry
 from .repeattimer import RepeatTimer
+from .snapshothistory import SnapshotHistory
+from .Webcam.webcamhelper import WebcamHelper
 from .debugprofiler import DebugProfiler, DebugProfilerFeatures
 
 # A helper class to try to capture a better "print completed" image by taking images before the complete notification
@@ -28,14 +29,29 @@ class FinalSnap:
     # if we don't have a last extrude command sent time.
     c_onCompleteSnapDelaySec = 9
 
+    # The snapshots are stored as the webcam returned them, which can be a few MB each for 4k cameras.
+    # They are kept in memory up to the memory budget, which fits the full buffer depth for most cameras, so nothing is written to disk.
+    # Past the budget, all but the newest few are kept in a temp file ring buffer. The file is large enough for the full buffer depth of large snapshots.
+    c_inMemorySnapshots = 2
+    c_inMemoryBytes = 8 * 1024 * 1024
+    c_spillFileSizeBytes = 64 * 1024 * 1024
+
+    # When we know the printer is extruding, we take snapshots at the default interval.
+    # Once it hasn't extruded for a while, the print is most likely done and the snapshot we want was already taken,
+    # so we slow down, but keep taking them in case the print is still going. If we never get extrude reports, we always use the default interval.
+    c_noExtrudeTimeoutSec = 10
+    c_noExtrudeSnapIntervalSec = 8
+
 
     # Creates the object and starts the timer.
     def __init__(self, logger:logging.Logger, notificationHandler) -> None:
         self.Logger = logger
         self.LastExtrudeCommandSent:float = 0.0
         self.NotificationHandler = notificationHandler
-        self.SnapLock = threading.Lock()
-        self.SnapHistory = []
+        self.SnapHistory = SnapshotHistory(logger, FinalSnap._GetBufferDepth(logger), FinalSnap.c_inMemorySnapshots, FinalSnap.c_inMemoryBytes, FinalSnap.c_spillFileSizeBytes)
+        self.StreamFrameTap = None
+        self.SnapshotRequests = 0
+        self.StreamFramesUsed = 0
         self.Profiler = None
         self.Timer = RepeatTimer(self.Logger, "FinalSnap", FinalSnap.c_defaultSnapIntervalSec, self._snapCallback)
         self.Timer.start()
@@ -56,46 +72,35 @@ class FinalSnap:
         # Stop the timer
         self.Timer.Stop()
 
-        # Try to find the best snap.
-        with self.SnapLock:
-            if len(self.SnapHistory) > 0:
-
-                # Find to get our target delta time.
-                targetTimeDeltaSec:float = 0.0
+        try:
+            # Find to get our target delta time.
+            targetTimeDeltaSec:float = 0.0
 
-                # If we have a `LastExtrudeCommandSent` and it's in our buffer, we will use it.
-                # This is the most ideal indicator, because we know it's the last time the extruder did a positive extrude
-                # But, not all platforms or even all prints (like printing from an SD card) will know this value.
-                if self.LastExtrudeCommandSent != 0:
-                    targetTimeDeltaSec = time.time() - self.LastExtrudeCommandSent
+            # If we have a `LastExtrudeCommandSent` we will use it.
+            # This is the most ideal indicator, because we know it's the last time the extruder did a positive extrude
+            # But, not all platforms or even all prints (like printing from an SD card) will know this value.
+            if self.LastExtrudeCommandSent != 0:
+                targetTimeDeltaSec = time.time() - self.LastExtrudeCommandSent
 
-                # If we still dont have a targetTimeDeltaSec value, use our fixed value.
-                if targetTimeDeltaSec <= 0.0001:
-                    targetTimeDeltaSec = float(FinalSnap.c_onCompleteSnapDelaySec)
+            # If we still dont have a targetTimeDeltaSec value, use our fixed value.
+            if targetTimeDeltaSec <= 0.0001:
+                targetTimeDeltaSec = float(FinalSnap.c_onCompleteSnapDelaySec)
 
-                # Compute our ideal image position in our buffer.
-                # In terms of rounding, round up, to prefer a later image then the exact time.
-                targetArrayIndex = int(math.ceil(targetTimeDeltaSec / float(FinalSnap.c_defaultSnapIntervalSec)))
+            # Get the newest image that was taken at or before the target time, or the oldest we have if none are that old.
+            snapTimeSec, snap = self.SnapHistory.Get(targetTimeDeltaSec)
+            if snap is None:
+                # If we don't have an image, just return None.
+                self.Logger.info("Stopping final snap but there's no snapshot to use.")
+                return None
 
-                if targetArrayIndex < 0:
-                    self.Logger.error(f"FinalSnap target image index is less than 0? {targetArrayIndex}")
-                    # Set something like our default snap interval.
-                    targetArrayIndex = 5
-                if targetArrayIndex >= len(self.SnapHistory):
-                    self.Logger.warn(f"FinalSnap target image index is larger than our buffer. {targetArrayIndex} {len(self.SnapHistory)}")
-                    # Use the oldest image we have.
-                    targetArrayIndex = len(self.SnapHistory) - 1
+            self.Logger.info(f"Stopping final snap and using snapshot from ~{int(time.time() - snapTimeSec)} sec ago, target was ~{int(targetTimeDeltaSec)} sec ago. Snapshots taken: {self.SnapshotRequests}, stream frames used: {self.StreamFramesUsed}")
 
-                # Return the image selected.
-                # Clear the array to free up space of stored images, just incase this class leaks.
-                self.Logger.info(f"Stopping final snap and using snapshot from ~{targetTimeDeltaSec} sec ago, index slot {targetArrayIndex} / {len(self.SnapHistory)}")
-                snap = self.SnapHistory[targetArrayIndex]
-                self.SnapHistory.clear()
-                return snap
+            # The snapshots are stored as they came from the webcam, so the transforms and resizing are only done for the one we use.
+            return self.NotificationHandler.ProcessNotificationSnapshot(snap)
 
-        # If we don't have an image, just return None.
-        self.Logger.info("Stopping final snap but there's no snapshot to use.")
-        return None
+        finally:
+            # Clear the history to free up the memory and the temp file, just incase this class leaks.
+            self.SnapHistory.Close()
 
 
     # Fires when we should take a new snapshot.
@@ -106,39 +111,66 @@ class FinalSnap:
             if self.Profiler is None:
                 self.Profiler = DebugProfiler(self.Logger, DebugProfilerFeatures.FinalSnap)
 
+            # Adjust how often we take snapshots, based on if the printer is extruding.
+            self._UpdateInterval()
+
             # Try to get a snapshot.
-            snapshot = self.NotificationHandler.GetNotificationSnapshot()
+            snapshot, snapshotTimeSec = self._GetSnapshot()
             if snapshot is None:
                 self.Logger.info("FinalSnap failed to get a snapshot")
                 return
 
-            with self.SnapLock:
-                # Make sure we are still running, otherwise there's no reason to store the image.
-                if self.Timer.IsRunning() is False:
-                    return
-
-                # Add this most recent snapshot to the front.
-                self.SnapHistory.insert(0, snapshot)
-
-                # Figure out the desired buffer depth.
-                # `c_snapshotBufferDepth` should always be large enough, but we will make sure.
-                desiredBufferDepth = FinalSnap.c_snapshotBufferDepth
-                minBufferDepthForFixedTime = int(math.ceil(float(FinalSnap.c_onCompleteSnapDelaySec) / float(FinalSnap.c_defaultSnapIntervalSec)))
-                if minBufferDepthForFixedTime > desiredBufferDepth:
-                    self.Logger.warn(f"Final snap had to expand the default buffer size due to the time. {minBufferDepthForFixedTime}")
-                    desiredBufferDepth = minBufferDepthForFixedTime
-
-                # Sanity check.
-                if desiredBufferDepth < 1:
-                    self.Logger.error(f"FinalSnap desiredImageHistoryCount is < 1!! {desiredBufferDepth}")
-                    desiredBufferDepth = 1
-
-                while len(self.SnapHistory) > desiredBufferDepth:
-                    # Remove the oldest image, which is the image at the end of the list.
-                    self.SnapHistory.pop()
+            # Make sure we are still running, otherwise there's no reason to store the image.
+            if self.Timer.IsRunning() is False:
+                return
+            self.SnapHistory.Add(snapshot, snapshotTimeSec)
 
             # Report if needed
             self.Profiler.ReportIfNeeded()
 
         except Exception as e:
             Sentry.Exception("FinalSnap::_snapCallback failed to get snapshot.", e)
+
+
+    # Returns a snapshot as the webcam returned it and the time it was taken, as a tuple of (snapshot, timeSec). The snapshot is None on failure.
+    # If the webcam stream is being streamed right now, we use a frame from the stream rather than asking the webcam for a snapshot.
+    def _GetSnapshot(self):
+        if self.StreamFrameTap is None:
+            self.StreamFrameTap = WebcamHelper.Get().GetStreamFrameTap()
+        tap = self.StreamFrameTap
+        if tap is not None:
+            # The frame was requested on the last callback, so it's at most one interval old.
+            snapshot, snapshotTimeSec = tap.TakeFrame(self.Timer.GetInterval())
+            # Ask for a frame for the next callback.
+            tap.RequestFrame()
+            if snapshot is not None:
+                self.StreamFramesUsed += 1
+                return (snapshot, snapshotTimeSec)
+        self.SnapshotRequests += 1
+        return (self.NotificationHandler.GetRawNotificationSnapshot(), time.time())
+
+
+    def _UpdateInterval(self):
+        intervalSec = FinalSnap.c_defaultSnapIntervalSec
+        lastExtrudeSec = self.LastExtrudeCommandSent
+        if lastExtrudeSec != 0 and time.time() - lastExtrudeSec > FinalSnap.c_noExtrudeTimeoutSec:
+            intervalSec = FinalSnap.c_noExtrudeSnapIntervalSec
+        if self.Timer.GetInterval() != intervalSec:
+            self.Timer.SetInterval(intervalSec)
+
+
+    # Figure out the desired buffer depth.
+    @staticmethod
+    def _GetBufferDepth(logger:logging.Logger) -> int:
+        # `c_snapshotBufferDepth` should always be large enough, but we will make sure.
+        desiredBufferDepth = FinalSnap.c_snapshotBufferDepth
+        minBufferDepthForFixedTime = int(math.ceil(float(FinalSnap.c_onCompleteSnapDelaySec) / float(FinalSnap.c_defaultSnapIntervalSec)))
+        if minBufferDepthForFixedTime > desiredBufferDepth:
+            logger.warn(f"Final snap had to expand the default buffer size due to the time. {minBufferDepthForFixedTime}")
+            desiredBufferDepth = minBufferDepthForFixedTime
+
+        # Sanity check.
+        if desiredBufferDepth < 1:
+            logger.error(f"FinalSnap desiredImageHistoryCount is < 1!! {desiredBufferDepth}")
+            desiredBufferDepth = 1
+        return desiredBufferDepth
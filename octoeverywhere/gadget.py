@@ -9,6 +9,7 @@ from .snapshotresizeparams import SnapshotResizeParams
 from .repeattimer import RepeatTimer
 from .debugprofiler import DebugProfiler, DebugProfilerFeatures
 from .httpsessions import HttpSessions
+from .gadgetpipeline import GadgetSnapshotPipeline
 
 class Gadget:
 
@@ -26,6 +27,9 @@ class Gadget:
     # Assuming 20 second checks, 100 checks is about 30 minutes of data.
     c_maxScoreHistoryItems = 100
 
+    # How long we will wait for the inspection image after the inspection is due.
+    c_maxSnapshotWaitSec = 30
+
     def __init__(self, logger:logging.Logger, notificationHandler, printerStateInterface):
         self.Logger = logger
         self.NotificationHandler = notificationHandler
@@ -36,6 +40,12 @@ class Gadget:
         self.DefaultProtocolAndDomain = "https://gadget-v1-oeapi.octoeverywhere.com"
         self.FailedConnectionAttempts = 0
 
+        # The images are captured and processed ahead of when the inspection is due, so the interval isn't made longer by them.
+        self.SnapshotPipeline = GadgetSnapshotPipeline(logger, notificationHandler)
+        # The interval we were asked to wait and when the next inspection is due, measured from when the last one completed.
+        self.ScheduledIntervalSec = Gadget.c_defaultIntervalSec
+        self.InspectionDueSec = 0.0
+
         # If there is a current host lock, this is the hostname.
         # This is cleared on error and as the start of each print.
         self.HostLockHostname = None
@@ -58,6 +68,7 @@ class Gadget:
         # If set to 0, they are disabled.
         self.ImageScaleCenterCropSize = 0
         self.ImageScaleMaxHeight = 0
+        self.ImageJpegQuality = 0
 
 
     def SetServerProtocolAndDomain(self, protocolAndDomain:str):
@@ -79,6 +90,7 @@ class Gadget:
 
             # Start a new timer.
             self.Timer = RepeatTimer(self.Logger, "Gadget", Gadget.c_defaultIntervalSec, self._timerCallback)
+            self._updateTimerInterval(Gadget.c_defaultIntervalSec)
             self.Timer.start()
 
 
@@ -158,18 +170,18 @@ class Gadget:
             self.Timer = None
 
 
+    # Sets when the next inspection is due, measured from now, which should be when the last one completed.
+    # The timer fires early enough to get the image ready by then.
     def _updateTimerInterval(self, newIntervalSec):
+        self.ScheduledIntervalSec = newIntervalSec
+        self.InspectionDueSec = time.time() + newIntervalSec
         timer = self.Timer
         if timer is not None:
-            timer.SetInterval(newIntervalSec)
+            timer.SetInterval(max(0.1, newIntervalSec - self.SnapshotPipeline.GetLeadSec()))
 
 
     def _getTimerInterval(self):
-        timer = self.Timer
-        if timer is not None:
-            return timer.GetInterval()
-        else:
-            return Gadget.c_defaultIntervalSec
+        return self.ScheduledIntervalSec
 
 
     def _timerCallback(self):
@@ -183,6 +195,7 @@ class Gadget:
             # and we don't update it properly. In all cases either an error should update this or the response
             # from the inspect call.
             lastIntervalSec = self._getTimerInterval()
+            inspectionDueSec = self.InspectionDueSec
             self._updateTimerInterval(Gadget.c_defaultIntervalSec)
 
             # Check to ensure we should still be running. If the state is anything other than printing, we shouldn't be running
@@ -203,17 +216,43 @@ class Gadget:
             # If we have any resize args set by the server, apply them now.
             # Remember these are best effort, so they might not be applied to the output image.
             # These values must be greater than 1 or the SnapshotResizeParams can't take them.
+            # The server can also set the jpeg quality, which is used if the image is re-encoded.
             snapshotResizeParams = None
+            jpegQuality = self.ImageJpegQuality if 0 < self.ImageJpegQuality <= 100 else 95
             if self.ImageScaleCenterCropSize > 1:
                 # If this is set, it takes priority over any other options.
                 # Request a center crop square of the image scaled to the desired factor.
-                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleCenterCropSize, False, False, True)
+                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleCenterCropSize, False, False, True, jpegQuality)
             elif self.ImageScaleMaxHeight > 1:
                 # Request a max height of the desired size. If the image is smaller than this it will be ignored.
-                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleMaxHeight, True, False, False)
+                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleMaxHeight, True, False, False, jpegQuality)
+            else:
+                # The default notification size.
+                snapshotResizeParams = SnapshotResizeParams(1080, True, False, False, jpegQuality)
+
+            # Start getting the image, which is captured and processed on other threads while we wait for the inspection to be due.
+            jobId = self.SnapshotPipeline.Start(snapshotResizeParams)
+            snapshot = self.SnapshotPipeline.WaitForResult(jobId, max(0.0, inspectionDueSec - time.time()) + Gadget.c_maxSnapshotWaitSec)
+
+            # If the image was ready early, wait until the inspection is due.
+            waitSec = inspectionDueSec - time.time()
+            if waitSec > 0:
+                time.sleep(waitSec)
+
+            # If we were stopped while we waited, don't send anything.
+            timer = self.Timer
+            if timer is None or timer.IsRunning() is False:
+                return
+
+            # Next, check if there's a valid snapshot image.
+            if snapshot is None:
+                # If not, update our interval to be the default no snapshot interval and return.
+                self.Logger.debug("Gadget isn't making a prediction because it failed to get a snapshot.")
+                self._updateTimerInterval(Gadget.c_defaultIntervalSec_NoSnapshot)
+                return
 
-            # Now, get the common event args, which will include the snapshot.
-            requestData = self.NotificationHandler.BuildCommonEventArgs("inspect", None, None, snapshotResizeParams)
+            # Now, get the common event args, with the snapshot.
+            requestData = self.NotificationHandler.BuildCommonEventArgs("inspect", None, None, snapshotResizeParams, snapshot=snapshot)
 
             # Handle the result indicating we don't have the proper var to send yet.
             if requestData is None:
@@ -231,13 +270,6 @@ class Gadget:
             # Also add the score history, for the server.
             args["ScoreHistory"] = self.GetScoreHistoryFloats()
 
-            # Next, check if there's a valid snapshot image.
-            if len(files) == 0:
-                # If not, update our interval to be the default no snapshot interval and return.
-                self.Logger.debug("Gadget isn't making a prediction because it failed to get a snapshot.")
-                self._updateTimerInterval(Gadget.c_defaultIntervalSec_NoSnapshot)
-                return
-
             jsonResponse = None
             try:
                 # Setup the url.
@@ -334,6 +366,15 @@ class Gadget:
                 except Exception as e:
                     self.Logger.warn("Gadget failed to parse IS_MH from response."+str(e))
                     self.ImageScaleMaxHeight = 0
+            if "IS_Q" in resultObj:
+                try:
+                    newValue = int(resultObj["IS_Q"])
+                    if newValue != self.ImageJpegQuality:
+                        self.Logger.info("Gadget ImageJpegQuality set to: "+str(newValue))
+                        self.ImageJpegQuality = newValue
+                except Exception as e:
+                    self.Logger.warn("Gadget failed to parse IS_Q from response."+str(e))
+                    self.ImageJpegQuality = 0
 
             # Check if we have a log object in response. If so, the server wants us to log information into the local log file.
             if "Log" in resultObj and resultObj["Log"] is not None:
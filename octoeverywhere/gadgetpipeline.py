@@ -0,0 +1,101 @@
+import time
+import queue
+import logging
+
+from .sentry import Sentry
+from .boundedexecutor import Executors
+
+# Gets Gadget's inspection images ready ahead of time, so getting and processing the image doesn't add to the inspection interval.
+#
+# Each image goes through two stages, the capture on the io executor and then the resize and encode on the cpu executor.
+# The result is put on a bounded queue, which Gadget takes it from when the inspection is due.
+# The time the stages take is tracked, so Gadget knows how early it needs to start them.
+class GadgetSnapshotPipeline:
+
+    # How early we start getting the image, before we have measured how long it takes.
+    c_DefaultLeadSec = 1.0
+    # Limits on how early we start, so one slow snapshot doesn't make us take images long before they are used.
+    c_MinLeadSec = 0.25
+    c_MaxLeadSec = 15.0
+    # How much each new measurement moves the lead time.
+    c_LeadSmoothingFactor = 0.5
+
+    def __init__(self, logger:logging.Logger, notificationHandler) -> None:
+        self.Logger = logger
+        self.NotificationHandler = notificationHandler
+        # Only the newest result is kept, as (jobId, snapshot or None)
+        self.Results = queue.Queue(maxsize=1)
+        self.JobId = 0
+        self.LeadSec = GadgetSnapshotPipeline.c_DefaultLeadSec
+
+
+    # Returns how long before an inspection is due the image should be started.
+    def GetLeadSec(self) -> float:
+        return self.LeadSec
+
+
+    # Starts getting a new image, with the resize params, which can be None.
+    # Returns the job id, which is used to wait for the result.
+    def Start(self, snapshotResizeParams) -> int:
+        self.JobId += 1
+        jobId = self.JobId
+        if Executors.Io(self._CaptureStage, jobId, snapshotResizeParams, time.time()) is False:
+            self._Complete(jobId, None, 0)
+        return jobId
+
+
+    # Waits for the image from the job. Returns None if the image couldn't be gotten or it took longer than the timeout.
+    def WaitForResult(self, jobId:int, timeoutSec:float):
+        endSec = time.time() + timeoutSec
+        while True:
+            waitSec = endSec - time.time()
+            if waitSec <= 0:
+                return None
+            try:
+                resultJobId, snapshot = self.Results.get(timeout=waitSec)
+            except queue.Empty:
+                return None
+            # Results from jobs we gave up on are dropped.
+            if resultJobId == jobId:
+                return snapshot
+
+
+    def _CaptureStage(self, jobId:int, snapshotResizeParams, startSec:float):
+        snapshot = None
+        try:
+            snapshot = self.NotificationHandler.GetRawNotificationSnapshot()
+        except Exception as e:
+            Sentry.Exception("GadgetSnapshotPipeline failed to capture a snapshot.", e)
+        if snapshot is None:
+            self._Complete(jobId, None, 0)
+            return
+        # If the cpu executor is busy, it might drop this job to make room for newer work, so the job is completed as a failure.
+        if Executors.Cpu(self._PrepareStage, jobId, snapshot, snapshotResizeParams, startSec, onDropped=lambda: self._Complete(jobId, None, 0)) is False:
+            self._Complete(jobId, None, 0)
+
+
+    def _PrepareStage(self, jobId:int, snapshot, snapshotResizeParams, startSec:float):
+        result = None
+        try:
+            result = self.NotificationHandler.ProcessNotificationSnapshot(snapshot, snapshotResizeParams)
+        except Exception as e:
+            Sentry.Exception("GadgetSnapshotPipeline failed to process a snapshot.", e)
+        self._Complete(jobId, result, startSec)
+
+
+    def _Complete(self, jobId:int, snapshot, startSec:float):
+        # Only successful images are used to measure the lead time, since failures can be much faster or slower.
+        if snapshot is not None and startSec > 0:
+            tookSec = time.time() - startSec
+            leadSec = self.LeadSec + (tookSec - self.LeadSec) * GadgetSnapshotPipeline.c_LeadSmoothingFactor
+            self.LeadSec = min(GadgetSnapshotPipeline.c_MaxLeadSec, max(GadgetSnapshotPipeline.c_MinLeadSec, leadSec))
+        # Replace any result that wasn't taken.
+        while True:
+            try:
+                self.Results.put_nowait((jobId, snapshot))
+                return
+            except queue.Full:
+                try:
+                    self.Results.get_nowait()
+                except queue.Empty:
+                    pass
@@ -1,16 +1,47 @@
+import time
+import queue
+import socket
 import logging
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .sentry import Sentry
+from .repeattimer import RepeatTimer
+from .boundedexecutor import Executors
 
 # A common class to cache http sessions per host.
 # This makes the connections more efficient as we can reuse the connections and the session isn't created every time.
+#
+# Each session gets its own connection pool, which starts at the default urllib3 size and grows as we observe more
+# concurrent requests to the host, up to a max. This is important for the relay, since a page load can fire off a burst of
+# parallel asset requests, and the default pool of 10 will either open and drop extra connections or make the requests wait.
 class HttpSessions:
 
+    # The size the pool starts at and the max size it can grow to, per host.
+    c_InitialPoolSize = 10
+    c_MaxPoolSize = 64
+
+    # How often we look for idle connections and how long a connection can sit idle before it's closed.
+    # The idle time should be lower than most server keep alive timeouts, so we close them before the server does.
+    c_IdleReapIntervalSec = 30
+    c_MaxConnectionIdleSec = 60
+
+    # The number of connections opened to the primary local host when the relay connects.
+    c_PreWarmConnectionCount = 4
+
     _Instance = None
 
+    # poolBlock - When the pool is at the max size and all connections are in use, if True requests will wait for a connection.
+    #             If False, an extra connection will be opened and closed when the request is done.
+    # tcpNoDelay - Sets TCP_NODELAY on the sockets, which is the urllib3 default.
+    # tcpKeepalive - Enables TCP keepalive on the sockets, so dead connections are found while they are idle in the pool.
     @staticmethod
-    def Init(logger:logging.Logger):
-        HttpSessions._Instance = HttpSessions(logger)
+    def Init(logger:logging.Logger, poolBlock:bool = False, tcpNoDelay:bool = True, tcpKeepalive:bool = False):
+        HttpSessions._Instance = HttpSessions(logger, poolBlock, tcpNoDelay, tcpKeepalive)
 
 
     @staticmethod
@@ -18,10 +49,13 @@ class HttpSessions:
         return HttpSessions._Instance
 
 
-    def __init__(self, logger:logging.Logger):
+    def __init__(self, logger:logging.Logger, poolBlock:bool = False, tcpNoDelay:bool = True, tcpKeepalive:bool = False):
         self.Logger = logger
         self.Sessions = {}
         self.SessionsLock = threading.Lock()
+        self.PoolBlock = poolBlock
+        self.SocketOptions = HttpSessions._BuildSocketOptions(tcpNoDelay, tcpKeepalive)
+        self.IdleReapTimer = None
 
 
     # Returns a Session given the url or host.
@@ -33,31 +67,26 @@ class HttpSessions:
         return HttpSessions.Get()._GetSession(hostOrUrl)
 
 
+    # Returns a dict of host -> pool stats dict for all of the sessions.
+    @staticmethod
+    def GetStats() -> dict:
+        #pylint: disable=protected-access
+        return HttpSessions.Get()._GetStats()
+
+
+    # Opens connections to the given url's host on a background thread, so they are ready when the first requests come in.
+    # This is only done for http, since https connections need the per request TLS settings.
+    @staticmethod
+    def PreWarm(url:str, connectionCount:int = None):
+        #pylint: disable=protected-access
+        if connectionCount is None:
+            connectionCount = HttpSessions.c_PreWarmConnectionCount
+        Executors.IoMustRun(HttpSessions.Get()._PreWarm, url, connectionCount)
+
+
     def _GetSession(self, hostOrUrl:str) -> requests.Session:
         # Get the root host from what's passed.
-        host = ""
-        if hostOrUrl.startswith('/'):
-            # There's no way to specify a port, so all relative urls are assumed to be on the same host.
-            host = "relative"
-        else:
-            # Extract only the host.
-            # Examples can be:
-            #   https://127.0.0.1/
-            #   http://127.0.0.1
-            #   http://test.local:80/path
-            #   ws://test.local:80/path
-            protocolStart = hostOrUrl.find("://")
-            if protocolStart == -1:
-                self.Logger.error("Invalid url passed to GetSession: " + hostOrUrl)
-                host = "unknown"
-            else:
-                # Skip past the protocol and find the host end
-                protocolStart += 3
-                hostEnd = hostOrUrl.find("/", protocolStart)
-                if hostEnd == -1:
-                    # This means the url is "http://test.local" or "http://test.local:80"
-                    hostEnd = len(hostOrUrl)
-                host = hostOrUrl[:hostEnd]
+        host = HttpSessions._GetHost(self.Logger, hostOrUrl)
 
         # If one exists, we don't need to lock.
         s = self.Sessions.get(host, None)
@@ -79,6 +108,416 @@ class HttpSessions:
             # We don't need that, so we can just set it to False. Is saves about 20ms per request.
             s.trust_env = False
 
+            # Replace the default adapters with ours, so the pool can grow and we can track the stats.
+            adapter = HttpSessionAdapter(self.Logger, host, HttpSessionStats(), self.PoolBlock, self.SocketOptions)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+
+            # Start the idle reaper with the first session.
+            if self.IdleReapTimer is None:
+                self.IdleReapTimer = RepeatTimer(self.Logger, "HttpSessionIdleReaper", HttpSessions.c_IdleReapIntervalSec, self._ReapIdleConnections)
+                self.IdleReapTimer.daemon = True
+                self.IdleReapTimer.start()
+
             # Set the session and return it!
             self.Sessions[host] = s
             return s
+
+
+    @staticmethod
+    def _GetHost(logger:logging.Logger, hostOrUrl:str) -> str:
+        if hostOrUrl.startswith('/'):
+            # There's no way to specify a port, so all relative urls are assumed to be on the same host.
+            return "relative"
+        # Extract only the host.
+        # Examples can be:
+        #   https://127.0.0.1/
+        #   http://127.0.0.1
+        #   http://test.local:80/path
+        #   ws://test.local:80/path
+        protocolStart = hostOrUrl.find("://")
+        if protocolStart == -1:
+            logger.error("Invalid url passed to GetSession: " + hostOrUrl)
+            return "unknown"
+        # Skip past the protocol and find the host end
+        protocolStart += 3
+        hostEnd = hostOrUrl.find("/", protocolStart)
+        if hostEnd == -1:
+            # This means the url is "http://test.local" or "http://test.local:80"
+            hostEnd = len(hostOrUrl)
+        return hostOrUrl[:hostEnd]
+
+
+    @staticmethod
+    def _BuildSocketOptions(tcpNoDelay:bool, tcpKeepalive:bool) -> list:
+        options = []
+        if tcpNoDelay:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if tcpKeepalive:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # These aren't on all platforms, so only set them if they exist.
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10))
+            if hasattr(socket, "TCP_KEEPCNT"):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3))
+        return options
+
+
+    def _GetAdapters(self) -> list:
+        with self.SessionsLock:
+            sessions = list(self.Sessions.values())
+        adapters = []
+        for s in sessions:
+            adapter = s.get_adapter("http://")
+            if isinstance(adapter, HttpSessionAdapter):
+                adapters.append(adapter)
+        return adapters
+
+
+    def _GetStats(self) -> dict:
+        result = {}
+        for adapter in self._GetAdapters():
+            result[adapter.Host] = adapter.Stats.GetDict()
+        return result
+
+
+    def _ReapIdleConnections(self):
+        for adapter in self._GetAdapters():
+            adapter.ReapIdleConnections(HttpSessions.c_MaxConnectionIdleSec)
+
+
+    def _PreWarm(self, url:str, connectionCount:int):
+        try:
+            if url.startswith("http://") is False:
+                return
+            adapter = self._GetSession(url).get_adapter(url)
+            if isinstance(adapter, HttpSessionAdapter) is False:
+                return
+            opened = adapter.PreWarm(url, connectionCount)
+            self.Logger.info(f"Pre-warmed {opened} connections to {adapter.Host}")
+        except Exception as e:
+            Sentry.Exception("HttpSessions failed to pre-warm connections.", e)
+
+
+# Tracks the connection stats for a session.
+class HttpSessionStats:
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        # The number of times a connection was taken from the pool.
+        self.Checkouts = 0
+        # The number of times the connection taken from the pool was already connected.
+        self.PoolHits = 0
+        # The number of new TCP connections made.
+        self.NewConnections = 0
+        # The number of times a request had to wait for a connection, and the total wait time.
+        self.Waits = 0
+        self.WaitTimeSec = 0.0
+        # The number of connections closed and how long they were connected for.
+        self.ClosedConnections = 0
+        self.TotalConnectionLifetimeSec = 0.0
+        self.MaxConnectionLifetimeSec = 0.0
+        # The number of idle connections closed by the reaper.
+        self.IdleReaped = 0
+        # The number of connections in use right now, the most we have seen at once, and the current pool size.
+        self.InUse = 0
+        self.PeakInUse = 0
+        self.PoolSize = HttpSessions.c_InitialPoolSize
+
+
+    # Returns the number of connections in use after this checkout.
+    def OnCheckout(self, isPoolHit:bool, waitSec:float) -> int:
+        with self.Lock:
+            self.Checkouts += 1
+            if isPoolHit:
+                self.PoolHits += 1
+            if waitSec > 0:
+                self.Waits += 1
+                self.WaitTimeSec += waitSec
+            self.InUse += 1
+            if self.InUse > self.PeakInUse:
+                self.PeakInUse = self.InUse
+            return self.InUse
+
+
+    def OnCheckin(self):
+        with self.Lock:
+            if self.InUse > 0:
+                self.InUse -= 1
+
+
+    def OnConnect(self):
+        with self.Lock:
+            self.NewConnections += 1
+
+
+    def OnClose(self, lifetimeSec:float):
+        with self.Lock:
+            self.ClosedConnections += 1
+            self.TotalConnectionLifetimeSec += lifetimeSec
+            if lifetimeSec > self.MaxConnectionLifetimeSec:
+                self.MaxConnectionLifetimeSec = lifetimeSec
+
+
+    def OnIdleReaped(self, count:int):
+        with self.Lock:
+            self.IdleReaped += count
+
+
+    def GetDict(self) -> dict:
+        with self.Lock:
+            avgLifetimeSec = 0.0
+            if self.ClosedConnections > 0:
+                avgLifetimeSec = self.TotalConnectionLifetimeSec / self.ClosedConnections
+            return {
+                "Checkouts": self.Checkouts,
+                "PoolHits": self.PoolHits,
+                "NewConnections": self.NewConnections,
+                "Waits": self.Waits,
+                "WaitTimeSec": self.WaitTimeSec,
+                "ClosedConnections": self.ClosedConnections,
+                "AvgConnectionLifetimeSec": avgLifetimeSec,
+                "MaxConnectionLifetimeSec": self.MaxConnectionLifetimeSec,
+                "IdleReaped": self.IdleReaped,
+                "InUse": self.InUse,
+                "PeakInUse": self.PeakInUse,
+                "PoolSize": self.PoolSize,
+            }
+
+
+# The requests adapter we mount on each session, it creates our pool manager.
+class HttpSessionAdapter(HTTPAdapter):
+
+    def __init__(self, logger:logging.Logger, host:str, stats:HttpSessionStats, poolBlock:bool, socketOptions:list):
+        # These must be set before the base init, since it calls init_poolmanager.
+        self.Logger = logger
+        self.Host = host
+        self.Stats = stats
+        self.SocketOptions = socketOptions
+        super().__init__(pool_maxsize=HttpSessions.c_InitialPoolSize, pool_block=poolBlock)
+
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self.poolmanager = HttpSessionPoolManager(self.Logger, self.Stats, num_pools=connections, maxsize=maxsize, block=block, socket_options=self.SocketOptions, **pool_kwargs)
+
+
+    def ReapIdleConnections(self, maxIdleSec:float):
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if isinstance(pool, HttpSessionPoolMixin):
+                pool.ReapIdleConnections(maxIdleSec)
+
+
+    def PreWarm(self, url:str, connectionCount:int) -> int:
+        pool = self.poolmanager.connection_from_url(url)
+        if isinstance(pool, HttpSessionPoolMixin) is False:
+            return 0
+        return pool.PreWarm(connectionCount)
+
+
+# Creates our connection pools and gives them the session stats.
+class HttpSessionPoolManager(PoolManager):
+
+    def __init__(self, logger:logging.Logger, stats:HttpSessionStats, num_pools=10, headers=None, **connection_pool_kw):
+        super().__init__(num_pools, headers, **connection_pool_kw)
+        self.Logger = logger
+        self.Stats = stats
+        self.pool_classes_by_scheme = {"http": HttpSessionConnectionPool, "https": HttpSessionHttpsConnectionPool}
+
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        if isinstance(pool, HttpSessionPoolMixin):
+            pool.Logger = self.Logger
+            pool.Stats = self.Stats
+            # If the pool has grown before, start any new pools at the same size.
+            pool.Resize(self.Stats.PoolSize)
+        return pool
+
+
+# Tracks when the connection is connected and closed.
+class HttpSessionConnectionMixin:
+    Stats:HttpSessionStats = None
+    ConnectedTimeSec:float = None
+    LastUsedTimeSec:float = 0.0
+
+    def connect(self):
+        super().connect()
+        self.ConnectedTimeSec = time.monotonic()
+        if self.Stats is not None:
+            self.Stats.OnConnect()
+
+
+    def close(self):
+        connectedTimeSec = self.ConnectedTimeSec
+        self.ConnectedTimeSec = None
+        try:
+            super().close()
+        finally:
+            if connectedTimeSec is not None and self.Stats is not None:
+                self.Stats.OnClose(time.monotonic() - connectedTimeSec)
+
+
+class HttpSessionConnection(HttpSessionConnectionMixin, HTTPConnection):
+    pass
+
+
+class HttpSessionHttpsConnection(HttpSessionConnectionMixin, HTTPSConnection):
+    pass
+
+
+# Adds the stats, growing, idle reaping, and pre-warming to the urllib3 connection pools.
+class HttpSessionPoolMixin:
+    Logger:logging.Logger = None
+    Stats:HttpSessionStats = None
+    PoolSize = HttpSessions.c_InitialPoolSize
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.Stats = self.Stats
+        return conn
+
+
+    def _get_conn(self, timeout=None):
+        # If we would have to wait for a connection, grow the pool first if we can.
+        if self.block and self.pool is not None and self.pool.empty() and self.PoolSize < HttpSessions.c_MaxPoolSize:
+            self.Grow(self.PoolSize + 1)
+
+        start = time.monotonic()
+        conn = super()._get_conn(timeout)
+        waitSec = time.monotonic() - start
+        # We can only wait on the pool in block mode, and anything under a millisecond is just the queue and the dropped connection check.
+        if self.block is False or waitSec < 0.001:
+            waitSec = 0.0
+        if self.Stats is None:
+            return conn
+
+        # If the connection has a socket, it's already connected and will be reused.
+        inUse = self.Stats.OnCheckout(conn.sock is not None, waitSec)
+
+        # If we are using more connections than the pool can hold, grow it so the extra connections are kept when returned.
+        if inUse > self.PoolSize and self.PoolSize < HttpSessions.c_MaxPoolSize:
+            self.Grow(inUse)
+        return conn
+
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.LastUsedTimeSec = time.monotonic()
+        if self.Stats is not None:
+            self.Stats.OnCheckin()
+        super()._put_conn(conn)
+
+
+    # Grows the pool, in steps, so we don't resize on every new high.
+    def Grow(self, minSize:int):
+        newSize = min(HttpSessions.c_MaxPoolSize, max(minSize, self.PoolSize * 2))
+        if self.Resize(newSize) and self.Logger is not None:
+            self.Logger.info(f"Http session pool for {self.host}:{self.port} grown to {newSize}")
+
+
+    # Sets the max number of connections the pool will hold. This will only make the pool larger.
+    # Returns True if the pool size was changed.
+    def Resize(self, newSize:int) -> bool:
+        q = self.pool
+        if q is None:
+            return False
+        with q.mutex:
+            if newSize <= q.maxsize:
+                return False
+            added = newSize - q.maxsize
+            q.maxsize = newSize
+        self.PoolSize = newSize
+        if self.Stats is not None:
+            with self.Stats.Lock:
+                if newSize > self.Stats.PoolSize:
+                    self.Stats.PoolSize = newSize
+        # In block mode the queue is filled with empty slots, which is how it limits the number of connections.
+        # So we need to add the new slots, which will also wake anything waiting on a connection.
+        if self.block:
+            for _ in range(added):
+                try:
+                    q.put(None, block=False)
+                except queue.Full:
+                    break
+        return True
+
+
+    # Closes any connections that have been idle in the pool longer than the max idle time.
+    # Returns the number of connections closed.
+    def ReapIdleConnections(self, maxIdleSec:float) -> int:
+        q = self.pool
+        if q is None:
+            return 0
+        # Take everything out of the queue, it's LIFO so the most recently used connections come out first.
+        items = []
+        try:
+            while True:
+                items.append(q.get(block=False))
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        reaped = 0
+        # Put them back in reverse order so the order is the same. Idle connections are closed and replaced with an empty slot.
+        for conn in reversed(items):
+            if conn is not None and conn.sock is not None and now - conn.LastUsedTimeSec > maxIdleSec:
+                conn.close()
+                conn = None
+                reaped += 1
+            try:
+                q.put(conn, block=False)
+            except queue.Full:
+                # A connection was returned while we were working, there's no room for this one.
+                if conn is not None:
+                    conn.close()
+        if reaped > 0 and self.Stats is not None:
+            self.Stats.OnIdleReaped(reaped)
+        return reaped
+
+
+    # Opens connections so they are ready in the pool. Returns the number of connections opened.
+    def PreWarm(self, connectionCount:int) -> int:
+        q = self.pool
+        if q is None:
+            return 0
+        # Take the slots out of the pool first, so we don't get the same one twice.
+        slots = []
+        try:
+            while len(slots) < connectionCount:
+                slots.append(q.get(block=False))
+        except queue.Empty:
+            pass
+        opened = 0
+        for i, conn in enumerate(slots):
+            if conn is not None and conn.sock is not None:
+                continue
+            try:
+                if conn is None:
+                    conn = self._new_conn()
+                conn.connect()
+                conn.LastUsedTimeSec = time.monotonic()
+                slots[i] = conn
+                opened += 1
+            except Exception:
+                # The server might not be up yet, it's fine, the connection will be made when it's needed.
+                if conn is not None:
+                    conn.close()
+                slots[i] = None
+        for conn in reversed(slots):
+            try:
+                q.put(conn, block=False)
+            except queue.Full:
+                if conn is not None:
+                    conn.close()
+        return opened
+
+
+class HttpSessionConnectionPool(HttpSessionPoolMixin, HTTPConnectionPool):
+    ConnectionCls = HttpSessionConnection
+
+
+class HttpSessionHttpsConnectionPool(HttpSessionPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = HttpSessionHttpsConnection
@@ -1,9 +1,9 @@
 import time
 import logging
-import threading
 from typing import Tuple
 
 from .httpsessions import HttpSessions
+from .threadbudget import ThreadBudget
 
 class LinkHelper:
 
@@ -139,9 +139,7 @@ class LinkHelper:
     # This will async run a thread that will provide the user with a link to the printer.
     @staticmethod
     def RunLinkPluginConsolePrinterAsync(logger:logging.Logger, printerId:str, source:str=None) -> None:
-        t = threading.Thread(target=LinkHelper._RunLinkPluginConsolePrinterAsync, args=(logger, printerId, source))
-        t.daemon = True
-        t.start()
+        ThreadBudget.StartThread("LinkHelper", LinkHelper._RunLinkPluginConsolePrinterAsync, args=(logger, printerId, source), daemon=True, required=False)
 
 
     # Used by the plugins if they connect to the service and there's no account setup.
@@ -1,26 +1,48 @@
+import re
 import threading
 import time
 import os
 import json
-
-import dns.resolver
+import select
+import socket
 
 from .localip import LocalIpHelper
+from .sentry import Sentry
+from .threadbudget import ThreadBudget
 
 # A helper class to resolve mdns domain names to IP addresses, since the request lib doesn't support
 # the mdns lookup.
 class MDns:
 
-    # How old a cache entry can be before we try to refresh it.
+    # How old a cache entry can be before we try to refresh it, if the entry has no TTL from the DNS answer.
+    # This is only used for old cache files, all new entries store the TTL of the record that was returned.
     # We want to keep the cache fresh, so we don't get stuck with a stale DHCP ip address.
     CacheRefreshTimeSec = 20.0
 
-    # How old a cache entry can be before we stop using it.
-    # Allow cache entries to exist for up to 24 hours, so we don't have to do long lookups.
-    # The only down side to this is if the DHCP ip is hoping a lot, we might get stale IPs sometimes
-    # most DHCP systems don't change IPs often, and most of the time they are sticky.
-    # Remember! Since the cache entries persist between restarts, this also makes them live longer.
-    MaxCacheTimeSec = 24 * 60.0 * 60.0
+    # The TTL from the DNS answer is clamped to this range.
+    # mDNS responders usually use 120 seconds for host records, but some use very small or very large values.
+    # Since a refresh never blocks a caller, it's fine to refresh often, but we don't want to flood the network.
+    MinRecordTtlSec = 5.0
+    MaxRecordTtlSec = 120.0
+
+    # The mDNS multicast address and port.
+    MulticastAddress = "224.0.0.251"
+    MulticastPort = 5353
+
+    # How long a single query attempt will wait for answers, and how many attempts we make.
+    # We have seen that occasionally a first resolve won't work, but future resolves will.
+    QueryAttemptTimeoutSec = 1.0
+    QueryAttempts = 3
+    QueryAttemptDelaySec = 0.2
+
+    # How long a caller will wait if there's no cache entry at all and they must wait for the lookup.
+    # This is the worst case time of all of the query attempts, plus a bit of buffer.
+    BlockingLookupTimeoutSec = (QueryAttemptTimeoutSec + QueryAttemptDelaySec) * QueryAttempts + 0.5
+
+    # Finds a .local or .internal hostname in an absolute url. Group 1 is the hostname.
+    # We can't do a string contains, because there can be DNS names like "something.local.hostname.com"
+    # This is compiled once, so the common case of a url with no local hostname is a single regex match with no string allocations.
+    LocalHostnameRegex = re.compile(r"^[^:/?#]+://([^/:?#]+\.(?:local|internal))(?=[:/?#]|$)", re.IGNORECASE)
 
     _Instance = None
     _Debug = False
@@ -39,6 +61,7 @@ class MDns:
         self.Logger = logger
 
         # Init our DNS name cache.
+        # Note the lock is only needed for writes. Reads of the cache dict are atomic, and entries are always replaced, never edited.
         self.Lock = threading.Lock()
         self.CacheFilePath = os.path.join(pluginDataFolderPath, "mDnsCache.json")
 
@@ -48,51 +71,27 @@ class MDns:
         if self.Cache is None:
             self._ResetCacheFile()
 
-        # Now that we support only PY3, this should never fail.
-        try:
-            # Setup the client
-            self.dnsResolver = dns.resolver.Resolver()
-            # Use the mdns multicast address
-            self.dnsResolver.nameservers = ["224.0.0.251"]
-            # Use the mdns port.
-            self.dnsResolver.port = 5353
-        except Exception as e:
-            self.dnsResolver = None
-            self.Logger.warn("Failed to create DNS class, local dns resolve is disabled. "+str(e))
+        # Lookups that are currently in flight, keyed by the lower case domain. The event is set when the lookup is done.
+        # This ensures that any number of concurrent callers for the same domain only cause one lookup.
+        self.InFlightLookups = {}
+        # Domains that are waiting to be sent in the next query. All pending domains are sent in one query packet.
+        self.PendingLookups = set()
+        self.IsLookupWorkerRunning = False
 
 
     # Given a full url with protocol, hostname, and path, this will look for a local mdns hostname, try to resolve it, and return the full URL again with
     # the localhost name replaced. If no localhost name is found, if the resolve fails, or there's no entry in the cache, None is returned.
     def TryToResolveIfLocalHostnameFound(self, url):
-
-        # Parse the hostname out, be it an IP address, domain name, or other.
-        protocolEnd = url.find("://")
-        if protocolEnd == -1:
-            self.Logger.warn("No protocol found for url "+str(url))
-            return None
-        protocolEnd += len("://")
-
-        # Look for a port (:) first, since there can be a port and path.
-        hostnameEnd = url.find(":", protocolEnd)
-        if hostnameEnd == -1:
-            # If no port found, look for a path.
-            hostnameEnd = url.find("/", protocolEnd)
-            if hostnameEnd == -1:
-                # If there is no port or path, the full url ends with the domain.
-                hostnameEnd = len(url)
-
-        # Parse the hostname.
-        hostname = url[protocolEnd:hostnameEnd]
-        self.LogDebug("Found hostname "+hostname+" in url "+url)
-
-        # Check if the hostname ends with .local, which is a special domain that we can resolve.
-        # We can't do a string contains, because there can be DNS names like "something.local.hostname.com"
-        hostnameLower = hostname.lower()
-        if hostnameLower.endswith(".local") is False and hostnameLower.endswith(".internal") is False:
-            self.LogDebug("No local domain found in "+url)
+        # Parse the hostname out, but only if it's a .local or .internal domain, which is a special domain that we can resolve.
+        match = MDns.LocalHostnameRegex.match(url)
+        if match is None:
+            # This is the path for almost every request, so only build the log string if we are debugging.
+            if MDns._Debug:
+                self.LogDebug("No local domain found in "+url)
             return None
 
         # If we are here, we have a .local domain we should try to resolve.
+        hostname = match.group(1)
         resolveResult = self.TryToGetLocalIp(hostname)
 
         # If we don't get something back, we failed to resolve.
@@ -101,120 +100,212 @@ class MDns:
             return None
 
         # Inject the IP resolved into the url.
-        result = url[:protocolEnd] + str(resolveResult) + url[hostnameEnd:]
+        result = url[:match.start(1)] + str(resolveResult) + url[match.end(1):]
         self.LogDebug("Local domain resolved and replaced. "+str(url) + " -> " + result)
         return result
 
 
     # Returns a string with the local IP if the IP can be found, otherwise, it returns None.
+    #
+    # If there's any cache entry, no matter how old it is, it's returned right away. If it's older than the record TTL, a
+    # background refresh is started, so the next caller gets the new value. Only if there's no cache entry at all will this block.
     def TryToGetLocalIp(self, domain):
         domainLower = domain.lower()
-        nowSec = time.time()
 
         # See if we have an entry in our cache.
+        entry = self.Cache.get(domainLower, None)
+        if entry is not None:
+            # Check if we need to update async
+            if time.time() - self.GetUpdatedTimeSecFromEntryDict(entry) > self.GetTtlSecFromEntryDict(entry):
+                self.LogDebug("Found a cache entry for domain, but it's past the TTL, kicking off an async update. domain: "+domain)
+                self.TryToUpdateCacheAsync(domain)
+            self.LogDebug("Using cached entry for domain "+domain)
+            return self.GetIpAddressFromEntryDict(entry)
+
+        # If we get here, we don't have an entry, so we need to wait on the lookup.
+        # If there's already a lookup in flight for this domain, this will join it rather than start a new one.
+        self.LogDebug("No cache entry found for domain. Doing blocking resolve. "+domain)
+        lookupDoneEvent = self._StartLookup(domainLower)
+        lookupDoneEvent.wait(MDns.BlockingLookupTimeoutSec)
+
+        entry = self.Cache.get(domainLower, None)
+        if entry is None:
+            self.LogDebug("We didn't have a cached entry and the resolved failed.")
+            return None
+        return self.GetIpAddressFromEntryDict(entry)
+
+
+    # Starts a thread to update the domain in the cache async.
+    # If there's already a lookup in flight for the domain, this does nothing.
+    def TryToUpdateCacheAsync(self, domain):
+        self._StartLookup(domain.lower())
+
+
+    # Queues the domain for lookup, or joins the existing lookup if one is already in flight.
+    # Returns an event that will be set when the lookup is done, successful or not.
+    def _StartLookup(self, domainLower:str) -> threading.Event:
         with self.Lock:
-            if domainLower in self.Cache:
-                # We have an entry.
-                entry = self.Cache[domainLower]
-                deltaSec = nowSec - self.GetUpdatedTimeSecFromEntryDict(entry)
-
-                # Check if we need to update async
-                if deltaSec > MDns.CacheRefreshTimeSec:
-                    self.LogDebug("Found a cache entry for domain, but it's getting old, kicking off an async update. domain: "+domain)
-                    self.TryToUpdateCacheAsync(domain)
-
-                # Check if the entry is too old
-                if deltaSec < MDns.MaxCacheTimeSec:
-                    self.LogDebug("Using cached entry for domain "+domain)
-                    return self.GetIpAddressFromEntryDict(entry)
-
-        # If we get here, we don't have an entry or it's too old, so use the normal lookup.
-        self.LogDebug("No cache entry found for domain or it's too old. Doing blocking resolve. "+domain)
-        result = self._TryToResolve(domain)
-        if result is not None:
-            return result
-
-        # If we failed to get a resolved result, try one more time for the cache. If anything is in there, we will use it, since anything is better than nothing.
-        self.LogDebug("We didn't use a cached entry and the resolved failed, trying the cache one more time.")
-        with self.Lock:
-            if domainLower in self.Cache:
-                # We have an entry. No matter how old it is, try it.
-                self.LogDebug("We didn't use a cached entry and the resolved failed, and we found a cache entry, so we are using it.")
-                return self.GetIpAddressFromEntryDict(self.Cache[domainLower])
+            lookupDoneEvent = self.InFlightLookups.get(domainLower, None)
+            if lookupDoneEvent is not None:
+                return lookupDoneEvent
+            lookupDoneEvent = threading.Event()
+            self.InFlightLookups[domainLower] = lookupDoneEvent
+            self.PendingLookups.add(domainLower)
+
+            # If the worker is already running, it will pick up this domain in the next query.
+            if self.IsLookupWorkerRunning:
+                return lookupDoneEvent
+            self.IsLookupWorkerRunning = True
 
-        self.LogDebug("We didn't use a cached entry and the resolved failed, and no existing cache entry was found.")
-        return None
+        try:
+            ThreadBudget.StartThread("MDnsLookupWorker", self._LookupWorker, daemon=True)
+        except Exception as e:
+            # If we can't start the thread, make sure we don't leave callers waiting.
+            Sentry.Exception("MDns failed to start the lookup worker.", e)
+            with self.Lock:
+                self.IsLookupWorkerRunning = False
+                self.PendingLookups.discard(domainLower)
+                self.InFlightLookups.pop(domainLower, None)
+            lookupDoneEvent.set()
+        return lookupDoneEvent
+
+
+    # Runs until there are no more pending lookups. All of the domains pending at the time of each query are sent in one query.
+    def _LookupWorker(self):
+        while True:
+            with self.Lock:
+                domains = list(self.PendingLookups)
+                self.PendingLookups.clear()
+                if len(domains) == 0:
+                    self.IsLookupWorkerRunning = False
+                    return
+
+            results = {}
+            try:
+                self.LogDebug("Starting lookup for domains "+str(domains))
+                results = self._TryToResolve(domains)
+            except Exception as e:
+                Sentry.Exception("MDns lookup worker failed.", e)
+
+            # Find which IP is the primary for each domain.
+            # Sometimes, there's a multiples. For example, we have seen if docker is installed there are sometimes 172.x addresses.
+            newEntries = {}
+            for domainLower, (ipList, ttlSec) in results.items():
+                newEntries[domainLower] = self.CreateCacheEntryDict(self.GetSameLanIp(ipList), ttlSec)
+
+            # Update the cache with anything we found, and release any waiters.
+            with self.Lock:
+                self.Cache.update(newEntries)
+                for domainLower in domains:
+                    lookupDoneEvent = self.InFlightLookups.pop(domainLower, None)
+                    if lookupDoneEvent is not None:
+                        lookupDoneEvent.set()
+
+            for domainLower in domains:
+                if domainLower not in results:
+                    self.Logger.info("Failed to resolve mdns for domain "+str(domainLower))
+
+            # Save the cache file, only if something changed.
+            if len(results) > 0:
+                self._SaveCacheFile()
 
-    # Returns a string with the local IP if the IP can be found, otherwise, it returns None.
-    def _TryToResolve(self, domain):
 
-        # We have seen that occasionally a first resolve won't work, but future resolves will.
-        # For this reason, we do shorter lifetime resolves, but try a few times.
+    # Tries to resolve all of the domains passed, with a few attempts.
+    # Returns a dict of the lower case domain to a tuple of (ipList, ttlSec), only for domains that resolved.
+    def _TryToResolve(self, domains:list) -> dict:
+        results = {}
         attempt = 0
         while True:
+            # Only query for what hasn't been resolved yet.
+            remaining = [d for d in domains if d not in results]
+            if len(remaining) == 0:
+                return results
 
-            # Only allow 3 attempts to successfully resolve.
+            # Only allow a few attempts to successfully resolve.
             attempt += 1
-            if attempt > 3:
-                self.Logger.info("Failed to resolve mdns for domain "+str(domain))
-                # Return none to indicate a failure.
-                return None
+            if attempt > MDns.QueryAttempts:
+                return results
 
-            # If this isn't the first attempt, delay by 200ms
+            # If this isn't the first attempt, delay a bit.
             if attempt > 1:
-                time.sleep(0.2)
+                time.sleep(MDns.QueryAttemptDelaySec)
 
             try:
-                # If possible, get our local IP address, to make sure we broadcast on the right IP address.
-                localAdapterIp = LocalIpHelper.TryToGetLocalIp()
-                if localAdapterIp is None or len(localAdapterIp) == 0:
-                    localAdapterIp = None
-                    self.LogDebug("Failed to get local adapter IP.")
-                else:
-                    self.LogDebug("Local adapter IP found as "+localAdapterIp+" using this as the adapter to query on.")
-
-                # Since we do caching, we allow the lifetime of the lookup to be longer, so we have a better chance of getting it.
-                # Don't allow this to throw, so we don't get nosy exceptions on lookup failures.
-                answers = self.dnsResolver.resolve(domain, lifetime=1.0, raise_on_no_answer=False, source=localAdapterIp)
-
-                # Look get the list of IPs returned from the query. Sometimes, there's a multiples. For example, we have seen if docker is installed
-                # there are sometimes 172.x addresses.
-                ipList = []
-                if answers is not None:
-                    for data in answers:
+                results.update(self._QueryMulticast(remaining, MDns.QueryAttemptTimeoutSec))
+            except Exception as e:
+                self.Logger.error("Failed to resolve mdns for domains "+str(remaining)+" e:"+str(e))
+
+
+    # Sends one mDNS query packet with a question for each domain, and waits for answers until all domains are answered or the timeout expires.
+    # Returns a dict of the lower case domain to a tuple of (ipList, ttlSec), only for domains that were answered.
+    def _QueryMulticast(self, domains:list, timeoutSec:float) -> dict:
+        # Build one query with a question for each domain.
+        # Since we don't send from port 5353, this is a "legacy unicast" query and the responder will send the answer directly back to us.
+        # The dns lib is imported here, since it's slow to import and only needed when we have a .local hostname to resolve.
+        #pylint: disable=import-outside-toplevel
+        import dns.name
+        import dns.message
+        import dns.rdataclass
+        import dns.rdatatype
+        query = dns.message.Message()
+        for domain in domains:
+            query.find_rrset(query.question, dns.name.from_text(domain), dns.rdataclass.IN, dns.rdatatype.A, create=True, force_unique=True)
+        queryBytes = query.to_wire()
+
+        results = {}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            # If possible, get our local IP address, to make sure we broadcast on the right IP address.
+            localAdapterIp = LocalIpHelper.TryToGetLocalIp()
+            if localAdapterIp is None or len(localAdapterIp) == 0:
+                self.LogDebug("Failed to get local adapter IP.")
+                sock.bind(("", 0))
+            else:
+                self.LogDebug("Local adapter IP found as "+localAdapterIp+" using this as the adapter to query on.")
+                sock.bind((localAdapterIp, 0))
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(localAdapterIp))
+            sock.sendto(queryBytes, (MDns.MulticastAddress, MDns.MulticastPort))
+
+            deadlineSec = time.time() + timeoutSec
+            while len(results) < len(domains):
+                waitSec = deadlineSec - time.time()
+                if waitSec <= 0:
+                    break
+                readable, _, _ = select.select([sock], [], [], waitSec)
+                if len(readable) == 0:
+                    break
+                try:
+                    data, _ = sock.recvfrom(9000)
+                    response = dns.message.from_wire(data, ignore_trailing=True)
+                except BlockingIOError:
+                    continue
+                except Exception as e:
+                    # Ignore anything we can't parse, there might be other valid answers coming.
+                    self.LogDebug("Failed to parse mdns response. "+str(e))
+                    continue
+
+                # Responders can put the records in the answer or additional sections.
+                for rrset in response.answer + response.additional:
+                    if rrset.rdtype != dns.rdatatype.A:
+                        continue
+                    domainLower = rrset.name.to_text(omit_final_dot=True).lower()
+                    # Only take the first answer for a domain, later answers are usually duplicates from other interfaces.
+                    if domainLower not in domains or domainLower in results:
+                        continue
+                    ipList = []
+                    for rdata in rrset:
                         # Validate.
-                        if data is None or data.address is None or len(data.address) == 0:
+                        if rdata is None or rdata.address is None or len(rdata.address) == 0:
                             self.Logger.warn("Dns result had data, but there was no IP address")
                             continue
-
-                        self.LogDebug("Resolver found ip "+data.address+" for local hostname "+domain)
-                        ipList.append(data.address)
-
-                # If there are no ips, continue trying.
-                if len(ipList) == 0:
-                    continue
-
-                # Find which is the primary.
-                primaryIp = self.GetSameLanIp(ipList)
-
-                # Always update the cache
-                with self.Lock:
-                    self.Cache[domain.lower()] = self.CreateCacheEntryDict(primaryIp)
-
-                # Save the cache file.
-                # TODO - We could async this, but since this will usually be called in the background as a cache refresh anyways, there's no need.
-                self._SaveCacheFile()
-
-                # Return the result.
-                return primaryIp
-
-            except dns.resolver.LifetimeTimeout:
-                # This happens if no one responds, which is expected if the domain has no one listening.
-                pass
-            except Exception as e:
-                self.Logger.error("Failed to resolve mdns for domain "+str(domain)+" e:"+str(e))
-
-            # If we failed to find anything or it threw, don't return so we try again.
+                        self.LogDebug("Resolver found ip "+rdata.address+" for local hostname "+domainLower+" ttl "+str(rrset.ttl))
+                        ipList.append(rdata.address)
+                    if len(ipList) > 0:
+                        results[domainLower] = (ipList, rrset.ttl)
+        finally:
+            sock.close()
+        return results
 
 
     # Given a list of at least 1 IP, this will always return a string that's an IP. It should be the IP we think
@@ -296,20 +387,6 @@ class MDns:
         return ipList[0]
 
 
-    # Starts a thread to update the domain in the cache async.
-    def TryToUpdateCacheAsync(self, domain):
-        # Spin off a thread to try to resolve the dns and update the cache.
-        workerThread = threading.Thread(target=self.TryToUpdateCacheAsync_Thread, args=(domain,))
-        workerThread.start()
-
-
-    def TryToUpdateCacheAsync_Thread(self, domain):
-        # Just use _TryToResolve, which will try to resolve and will update the IP on success.
-        self.LogDebug("Starting async update for domain "+domain)
-        if self._TryToResolve(domain) is None:
-            self.Logger.error("Failed to update mdns cache for domain "+str(domain))
-
-
     # Logs if the debug flag is set.
     def LogDebug(self, msg):
         if MDns._Debug:
@@ -317,10 +394,11 @@ class MDns:
 
     # Note, we have to use a dict instead of a class here so that it serializes correctly with
     # the normal json serializer.
-    def CreateCacheEntryDict(self, address):
+    def CreateCacheEntryDict(self, address, ttlSec):
         d = {}
         d["UpdateTimeSec"] = time.time()
         d["IpAddress"] = address
+        d["TtlSec"] = min(max(float(ttlSec), MDns.MinRecordTtlSec), MDns.MaxRecordTtlSec)
         return d
 
     def GetUpdatedTimeSecFromEntryDict(self, d):
@@ -333,6 +411,11 @@ class MDns:
             return 0
 
 
+    def GetTtlSecFromEntryDict(self, d):
+        # Old cache files don't have a TTL, so use the default refresh time.
+        return d.get("TtlSec", MDns.CacheRefreshTimeSec)
+
+
     def GetIpAddressFromEntryDict(self, d):
         # Use a try catch incase there's anything that fails to due parsing of old files or such.
         try:
@@ -350,7 +433,9 @@ class MDns:
     def _SaveCacheFile(self):
         try:
             data = {}
-            data['Cache'] = self.Cache
+            # Copy the cache under the lock, so it can't change while it's being serialized.
+            with self.Lock:
+                data['Cache'] = dict(self.Cache)
             # pylint: disable=unspecified-encoding
             # encoding only supported in py3
             with open(self.CacheFilePath, 'w') as f:
@@ -8,25 +8,18 @@ import logging
 
 from .gadget import Gadget
 from .sentry import Sentry
+from .boundedexecutor import Executors
 from .compat import Compat
 from .finalsnap import FinalSnap
 from .repeattimer import RepeatTimer
 from .httpsessions import HttpSessions
 from .Webcam.webcamhelper import WebcamHelper
+from .pilimage import PilImage
 from .printinfo import PrintInfoManager, PrintInfo
 from .snapshotresizeparams import SnapshotResizeParams
 from .debugprofiler import DebugProfiler, DebugProfilerFeatures
 from .Notifications.bedcooldownwatcher import BedCooldownWatcher
 
-try:
-    # On some systems this package will install but the import will fail due to a missing system .so.
-    # Since most setups don't use this package, we will import it with a try catch and if it fails we
-    # won't use it.
-    from PIL import Image
-    from PIL import ImageFile
-except Exception as _:
-    pass
-
 class ProgressCompletionReportItem:
     def __init__(self, value, reported):
         self.value = value
@@ -771,14 +764,16 @@ class NotificationsHandler:
     # SnapshotResizeParams will also be ignored if the current image is smaller than the requested size.
     # If this fails for any reason, None is returned.
     def GetNotificationSnapshot(self, snapshotResizeParams = None):
+        snapshot = self.GetRawNotificationSnapshot()
+        if snapshot is None:
+            return None
+        return self.ProcessNotificationSnapshot(snapshot, snapshotResizeParams)
 
-        # If no snapshot resize param was specified, use the default for notifications.
-        if snapshotResizeParams is None:
-            # For notifications, if possible, we try to resize any image to be less than 720p.
-            # This scale will preserve the aspect ratio and won't happen if the image is already less than 720p.
-            # The scale might also fail if the image lib can't be loaded correctly.
-            snapshotResizeParams = SnapshotResizeParams(1080, True, False, False)
 
+    # Gets a snapshot as the webcam returned it, without the webcam transforms or resizing applied.
+    # This is used by things that capture a lot of snapshots but only send a few, so the image work is only done for the ones sent.
+    # If this fails for any reason, None is returned.
+    def GetRawNotificationSnapshot(self):
         try:
 
             # Use the snapshot helper to get the snapshot. This will handle advance logic like relative and absolute URLs
@@ -795,6 +790,31 @@ class NotificationsHandler:
                 self.Logger.error("WebcamHelper.Get().GetSnapshot() returned a web response but no FullBodyBuffer")
                 return None
 
+            return snapshot
+
+        except Exception as _:
+            # Don't log here, because for those users with no webcam setup this will fail often.
+            # TODO - Ideally we would log, but filter out the expected errors when snapshots are setup by the user.
+            #self.Logger.info("Snapshot http call failed. " + str(e))
+            pass
+
+        # On failure return nothing.
+        return None
+
+
+    # Applies the webcam transforms and any resizing to a snapshot, so it's ready to be sent with a notification.
+    # SnapshotResizeParams can be passed BUT MIGHT BE IGNORED if the PIL lib can't be loaded.
+    # If the snapshot is too large to send, None is returned.
+    def ProcessNotificationSnapshot(self, snapshot, snapshotResizeParams = None):
+
+        # If no snapshot resize param was specified, use the default for notifications.
+        if snapshotResizeParams is None:
+            # For notifications, if possible, we try to resize any image to be less than 720p.
+            # This scale will preserve the aspect ratio and won't happen if the image is already less than 720p.
+            # The scale might also fail if the image lib can't be loaded correctly.
+            snapshotResizeParams = SnapshotResizeParams(1080, True, False, False)
+
+        try:
             # Ensure the snapshot is a reasonable size. If it's not, try to resize it if there's not another resize planned.
             # If this fails, the size will be checked again later and the image will be thrown out.
             if len(snapshot) > NotificationsHandler.MaxSnapshotFileSizeBytes:
@@ -808,18 +828,9 @@ class NotificationsHandler:
             rotation = WebcamHelper.Get().GetWebcamRotation()
             if rotation != 0 or flipH or flipV or snapshotResizeParams is not None:
                 try:
+                    Image = PilImage.Get()
                     if Image is not None:
 
-                        # We noticed that on some under powered or otherwise bad systems the image returned
-                        # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
-                        # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
-                        # buffer, which is still an incomplete image.
-                        # Use a try catch incase the import of ImageFile failed
-                        try:
-                            ImageFile.LOAD_TRUNCATED_IMAGES = True
-                        except Exception as _:
-                            pass
-
                         # In pillow ~9.1.0 these constants moved.
                         # pylint: disable=no-member
                         OE_FLIP_LEFT_RIGHT = 0
@@ -837,6 +848,17 @@ class NotificationsHandler:
                         # If they are reordered, when multiple are applied the result will not be correct.
                         didWork = False
                         pilImage = Image.open(io.BytesIO(snapshot))
+
+                        # If the image will be scaled down, let the jpeg decoder do most of the scaling as it decodes, which is much faster than decoding the full image.
+                        # The decoder only scales by powers of 2 and never below the size we ask for, so the resize below still does the rest.
+                        if snapshotResizeParams is not None:
+                            draftSize = NotificationsHandler._GetDraftSize(pilImage.width, pilImage.height, snapshotResizeParams)
+                            if draftSize is not None:
+                                originalSize = pilImage.size
+                                pilImage.draft(pilImage.mode, draftSize)
+                                if pilImage.size != originalSize:
+                                    didWork = True
+
                         if flipH:
                             pilImage = pilImage.transpose(OE_FLIP_LEFT_RIGHT)
                             didWork = True
@@ -918,7 +940,8 @@ class NotificationsHandler:
                         #
                         if didWork:
                             buffer = io.BytesIO()
-                            pilImage.save(buffer, format="JPEG", quality=95)
+                            quality = 95 if snapshotResizeParams is None else snapshotResizeParams.JpegQuality
+                            pilImage.save(buffer, format="JPEG", quality=quality)
                             snapshot = buffer.getvalue()
                             buffer.close()
                     else:
@@ -934,19 +957,14 @@ class NotificationsHandler:
 
             # Ensure in the end, the snapshot is a reasonable size.
             if len(snapshot) > NotificationsHandler.MaxSnapshotFileSizeBytes:
-                self.Logger.error("Snapshot size if too large to send. Size: "+len(snapshot))
+                self.Logger.error("Snapshot size if too large to send. Size: "+str(len(snapshot)))
                 return None
 
             # Return the image
             return snapshot
 
-        except Exception as _:
-            # Don't log here, because for those users with no webcam setup this will fail often.
-            # TODO - Ideally we would log, but filter out the expected errors when snapshots are setup by the user.
-            #self.Logger.info("Snapshot http call failed. " + str(e))
-            pass
-
-        # On failure return nothing.
+        except Exception as e:
+            Sentry.Exception("Failed to process a notification snapshot.", e)
         return None
 
 
@@ -987,6 +1005,24 @@ class NotificationsHandler:
         pi.SetFileName(fileName)
 
 
+    # Returns the size the image will be scaled down to by the resize params, as a (width, height) tuple, or None if it won't be scaled down.
+    @staticmethod
+    def _GetDraftSize(width:int, height:int, snapshotResizeParams:SnapshotResizeParams):
+        scale = None
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            if height >= snapshotResizeParams.Size and width >= snapshotResizeParams.Size:
+                scale = float(snapshotResizeParams.Size) / float(min(width, height))
+        elif snapshotResizeParams.ResizeToHeight:
+            if height > snapshotResizeParams.Size:
+                scale = float(snapshotResizeParams.Size) / float(height)
+        elif snapshotResizeParams.ResizeToWidth:
+            if width > snapshotResizeParams.Size:
+                scale = float(snapshotResizeParams.Size) / float(width)
+        if scale is None or scale >= 1.0:
+            return None
+        return (int(math.ceil(width * scale)), int(math.ceil(height * scale)))
+
+
     # Stops the final snap object if it's running and returns
     # the final image if possible.
     def _getFinalSnapSnapshotAndStop(self):
@@ -1052,9 +1088,8 @@ class NotificationsHandler:
     # Returns True on success, otherwise False
     def _sendEvent(self, event:str, args = None, progressOverwriteFloat = None, useFinalSnapSnapshot = False):
         # Push the work off to a thread so we don't hang OctoPrint's plugin callbacks.
-        thread = threading.Thread(target=self._sendEventThreadWorker, args=(event, args, progressOverwriteFloat, useFinalSnapSnapshot, ), name="NotificationsHandler._sendEvent")
-        thread.start()
-        return True
+        # Notifications must never be dropped, so this uses the notification executor, which never rejects.
+        return Executors.Notification(self._sendEventThreadWorker, event, args, progressOverwriteFloat, useFinalSnapSnapshot)
 
 
     # Sends the event
@@ -1131,7 +1166,7 @@ class NotificationsHandler:
     # Returns an array of [args, files] which are ready to be used in the request.
     # The args and files will always contain any information that can be gathered at the time of the call.
     # Returns None if we don't have the printer id or octokey yet.
-    def BuildCommonEventArgs(self, event:str, args=None, progressOverwriteFloat=None, snapshotResizeParams = None, useFinalSnapSnapshot = False):
+    def BuildCommonEventArgs(self, event:str, args=None, progressOverwriteFloat=None, snapshotResizeParams = None, useFinalSnapSnapshot = False, snapshot = None):
 
         # Ensure we have the required var set already. If not, get out of here.
         if self.PrinterId is None or self.OctoKey is None:
@@ -1186,11 +1221,11 @@ class NotificationsHandler:
         args["DurationSec"] = str(self.GetCurrentDurationSecFloat())
 
         # Also always include a snapshot if we can get one.
-        snapshot = None
+        # If the caller already has the snapshot, it's used as is.
 
         # If we are requested to use a final snapshot, try to use the snapshot from it.
         # This should only be requested for the "done" notification.
-        if useFinalSnapSnapshot:
+        if snapshot is None and useFinalSnapSnapshot:
             snapshot = self._getFinalSnapSnapshotAndStop()
 
         # If we don't have a snapshot, try to get one now.
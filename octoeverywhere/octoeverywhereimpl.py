@@ -5,6 +5,7 @@ from .sentry import Sentry
 from .threaddebug import ThreadDebug
 from .octoservercon import OctoServerCon
 from .Proto import SummonMethods
+from .threadbudget import ThreadBudget
 
 #
 # This is the main running class that will connect and keep a connection to the service.
@@ -69,9 +70,7 @@ class OctoEverywhere:
                 return
 
             # We don't have a connection, so make a new connection now.
-            thread = threading.Thread(target=self.HandleSecondaryServerCon, args=(summonConnectUrl, summonMethod,))
-            thread.daemon = True
-            thread.start()
+            thread = ThreadBudget.StartThread("SecondaryServerCon", self.HandleSecondaryServerCon, args=(summonConnectUrl, summonMethod,), daemon=True)
             self.SecondaryServerCons[summonConnectUrl] = thread
 
     def HandleSecondaryServerCon(self, summonConnectUrl, summonMethod):
@@ -56,6 +56,14 @@ class OctoHttpRequest:
         return OctoHttpRequest.DisableHttpRelay
 
 
+    # Opens a few connections to the main local http server in the background, so they are ready for the first relay requests.
+    @staticmethod
+    def PreWarmLocalConnections():
+        if OctoHttpRequest.DisableHttpRelay:
+            return
+        HttpSessions.PreWarm("http://" + OctoHttpRequest.LocalHostAddress + ":" + str(OctoHttpRequest.LocalOctoPrintPort) + "/")
+
+
     # Based on the URL passed, this will return PathTypes.Relative or PathTypes.Absolute
     @staticmethod
     def GetPathType(url):
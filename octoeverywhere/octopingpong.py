@@ -1,11 +1,11 @@
 import os
 import json
-import threading
 import time
 import requests
 
 from .sentry import Sentry
 from .telemetry import Telemetry
+from .threadbudget import ThreadBudget
 
 #
 # The point of this class is to simply ping the available OctoEverywhere server regions occasionally to track which region is has the best
@@ -46,11 +46,7 @@ class OctoPingPong:
 
         # Start a new thread to do the occasional work.
         try:
-            th = threading.Thread(target=self._WorkerThread)
-            # pylint: disable=deprecated-method
-            # This is deprecated in PY3.10
-            th.setDaemon(True)
-            th.start()
+            ThreadBudget.StartThread("OctoPingPong", self._WorkerThread, daemon=True)
         except Exception as e:
             Sentry.Exception("Failed to start OctoPingPong Thread.", e)
 
@@ -9,6 +9,8 @@ from .repeattimer import RepeatTimer
 from .octopingpong import OctoPingPong
 from .threaddebug import ThreadDebug
 from .dnstest import DnsTest
+from .startupprofiler import StartupProfiler
+from .octohttprequest import OctoHttpRequest
 
 #
 # This class is responsible for connecting and maintaining a connection to a server.
@@ -185,6 +187,9 @@ class OctoServerCon:
 
         self.Logger.info("Handshake complete, server con "+self.GetConnectionString()+", successfully connected to OctoEverywhere!")
 
+        # If the startup profiler is running, this logs the report the first time we connect.
+        StartupProfiler.OnConnected(self.Logger)
+
         # Only primary connections have this handler.
         # For secondary connections, octoKey and connectedAccounts will be None.
         if self.StatusChangeHandler is not None:
@@ -193,6 +198,9 @@ class OctoServerCon:
         # Only set the back off when we are done with the handshake and it was successful.
         self.WsConnectBackOffSec = self.WsConnectBackOffSec_Default
 
+        # Now that we are connected, relay requests can start at any time, so get some local connections ready.
+        OctoHttpRequest.PreWarmLocalConnections()
+
 
     # Called by the session if we should kill this socket.
     def OnSessionError(self, sessionId, backoffModifierSec):
@@ -391,6 +399,22 @@ class OctoServerCon:
         self.Ws.Send(buffer, msgStartOffsetBytes, msgSize, True)
 
 
+    # Returns how long messages are waiting to be sent on the websocket, see websocketimpl.GetSendQueueDelaySec
+    def GetSendQueueDelaySec(self) -> float:
+        ws = self.Ws
+        if ws is None:
+            return 0.0
+        return ws.GetSendQueueDelaySec()
+
+
+    # Returns how many bytes are waiting to be sent on the websocket.
+    def GetSendQueueBytes(self) -> int:
+        ws = self.Ws
+        if ws is None:
+            return 0
+        return ws.GetSendQueueBytes()
+
+
     def GetWsId(self, ws):
         ws = self.Ws
         if ws is not None:
@@ -18,7 +18,9 @@ from .sentry import Sentry
 from .ostypeidentifier import OsTypeIdentifier
 from .threaddebug import ThreadDebug
 from .compression import Compression
+from .zstandarddictionary import ZStandardDictionary
 from .deviceid import DeviceId
+from .WebStream.flowcontrol import FlowControl
 
 from .Proto import OctoStreamMessage
 from .Proto import HandshakeAck
@@ -50,6 +52,9 @@ class OctoSession:
         # Create our server auth helper.
         self.ServerAuth = ServerAuthHelper(self.Logger)
 
+        # Limits how much data the web streams can have buffered.
+        self.FlowControl = FlowControl(self.Logger, self.GetSendQueueBytes)
+
 
     def OnSessionError(self, backoffModifierSec):
         # Just forward
@@ -61,6 +66,16 @@ class OctoSession:
         self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize)
 
 
+    def GetSendQueueDelaySec(self) -> float:
+        # Just forward
+        return self.OctoStream.GetSendQueueDelaySec()
+
+
+    def GetSendQueueBytes(self) -> int:
+        # Just forward
+        return self.OctoStream.GetSendQueueBytes()
+
+
     def HandleSummonRequest(self, msg):
         try:
             summonMsg = OctoSummon.OctoSummon()
@@ -130,6 +145,18 @@ class OctoSession:
                     connectedAccounts.append(OctoStreamMsgBuilder.BytesToString(handshakeAck.ConnectedAccounts(i)))
                     i += 1
 
+            # Parse out which of our zstandard dictionaries the service also has, so we know which we can use.
+            acceptedDictIds = []
+            acceptedDictIdsLen = handshakeAck.AcceptedZstandardDictionaryIdsLength()
+            i = 0
+            while i < acceptedDictIdsLen:
+                acceptedDictIds.append(handshakeAck.AcceptedZstandardDictionaryIds(i))
+                i += 1
+            ZStandardDictionary.Get().OnHandshakeAccepted(acceptedDictIds)
+
+            # If the server supports flow control, it will only send as much data for each stream as the window allows.
+            self.FlowControl.SetEnabled(handshakeAck.FlowControlEnabled())
+
             # Parse out the OctoKey
             octoKey = OctoStreamMsgBuilder.BytesToString(handshakeAck.Octokey())
             self.OctoStream.OnHandshakeComplete(self.SessionId, octoKey, connectedAccounts)
@@ -171,6 +198,7 @@ class OctoSession:
 
         # Grab the lock before messing with the map.
         localStream = None
+        startFailedStream = None
         with self.ActiveWebStreamsLock:
             # First, check if the stream exists.
             if streamId in self.ActiveWebStreams :
@@ -198,7 +226,15 @@ class OctoSession:
                 # Set it in the map
                 self.ActiveWebStreams[streamId] = localStream
                 # Start it's main worker thread
-                localStream.start()
+                # If there's no thread budget left, we close the stream, which tells the server it failed, rather than running out of threads.
+                if localStream.TryStart() is False:
+                    startFailedStream = localStream
+
+        # This must be done outside of the lock, since close will remove the stream from the map.
+        if startFailedStream is not None:
+            self.Logger.warn("Web stream "+str(streamId)+" was closed because its thread couldn't be started.")
+            startFailedStream.Close()
+            return
 
         # If we get here, we know we must have a localStream
         localStream.OnIncomingServerMessage(webStreamMsg)
@@ -252,9 +288,13 @@ class OctoSession:
 
             # Define which type of compression we can receive (beyond None)
             # Ideally this is zstandard lib, but all client must support zlib, so we can fallback to it.
+            # If we are using zstandard, we also send the ids of the dictionaries we have, and the service will tell us which ones it has.
             receiveCompressionType = DataCompression.Zlib
+            zstandardDictionaryIds = None
+            ZStandardDictionary.Get().OnHandshakeStarting()
             if Compression.Get().CanUseZStandardLib:
                 receiveCompressionType = DataCompression.ZStandard
+                zstandardDictionaryIds = ZStandardDictionary.Get().GetDictIds()
 
             # If possible, get a device ID for this plugin.
             # This will return None if no device id can be found.
@@ -263,7 +303,8 @@ class OctoSession:
             # Build the message
             buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.BuildHandshakeSyn(self.PrinterId, self.PrivateKey, self.isPrimarySession, self.PluginVersion,
                 OctoHttpRequest.GetLocalHttpProxyPort(), LocalIpHelper.TryToGetLocalIp(),
-                rasChallenge, rasChallengeKeyVerInt, summonMethod, self.ServerHostType, self.IsCompanion, OsTypeIdentifier.DetectOsType(), receiveCompressionType, deviceId)
+                rasChallenge, rasChallengeKeyVerInt, summonMethod, self.ServerHostType, self.IsCompanion, OsTypeIdentifier.DetectOsType(), receiveCompressionType, deviceId, zstandardDictionaryIds,
+                FlowControl.c_StreamWindowBytes)
 
             # Send!
             self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSizeBytes)
@@ -1,16 +1,53 @@
+import struct
+import threading
+
 import octoflatbuffers
 
 from .Proto import MessageContext
 from .Proto import HandshakeSyn
 from .Proto import OctoStreamMessage
+from .Proto import WebStreamMsg
+from .Proto import WebStreamWindowUpdate
 from .Proto import OsType
 from .Proto.DataCompression import DataCompression
 
 # A helper class that builds our OctoStream messages as flatbuffers.
+#
+# Most messages we send are small, like websocket messages, small http responses, and control messages. For those, building the
+# tables and allocating a buffer sized for the worst case is most of the cost. So there are a few ways to avoid that:
+#   - Small messages can be built in a pooled builder. The pool is shared by the process, since most messages are built on web stream threads,
+#     which only live for one request, so a pool per thread would almost never be reused. The send queue holds
+#     the buffer we give it until it's sent, so the pooled builder's buffer can't be handed off. Instead the finished message is copied out,
+#     which only allocates the size of the message.
+#   - Messages that always have the same fields, like the web stream close and window update, are built once as a template, and each
+#     message is a copy of the template with the values written in place.
+#   - Tables that repeat across messages, like common response headers, are interned. They are built once in their own builder, and after
+#     that the built bytes are copied into each message. Flatbuffer offsets are all relative, so the copy is valid anywhere it's placed.
 class OctoStreamMsgBuilder:
 
+    # The size of the pooled builders. Messages that are expected to be larger than this use their own builder.
+    c_PooledBuilderSizeBytes = 32 * 1024
+    # If a pooled builder grew larger than this, it's not kept, so the pool doesn't hold large buffers.
+    c_MaxPooledBuilderSizeBytes = 128 * 1024
+    # How many builders the pool keeps, which should cover the number of streams that are usually building messages at the same time.
+    c_MaxPooledBuilders = 16
+    # A table is interned once it has been seen this many times, so values that change every message aren't interned.
+    c_InternAfterUses = 2
+    # The most tables we will intern, and the most we track that might be, so values that change can't grow the cache forever.
+    c_MaxInternedTables = 512
+    c_MaxInternCandidates = 4096
+    # Tables larger than this aren't interned.
+    c_MaxInternedTableSizeBytes = 512
+
+    _PoolLock = threading.Lock()
+    _Pool = []
+    _InternedTables = {}
+    _InternCandidates = {}
+    _CloseMsgTemplate = None
+    _WindowUpdateTemplate = None
+
     @staticmethod
-    def BuildHandshakeSyn(printerId, privateKey, isPrimarySession, pluginVersion, localHttpProxyPort, localIp, rsaChallenge, rasKeyVersionInt, summonMethod, serverHostType, isCompanion, osType:OsType.OsType, receiveCompressionType:DataCompression, deviceId:str):
+    def BuildHandshakeSyn(printerId, privateKey, isPrimarySession, pluginVersion, localHttpProxyPort, localIp, rsaChallenge, rasKeyVersionInt, summonMethod, serverHostType, isCompanion, osType:OsType.OsType, receiveCompressionType:DataCompression, deviceId:str, zstandardDictionaryIds:list, receiveWindowBytes:int = 0):
         # Get a buffer
         builder = OctoStreamMsgBuilder.CreateBuffer(500)
 
@@ -27,6 +64,13 @@ class OctoStreamMsgBuilder:
 
         # Setup the data vectors
         rasChallengeOffset = builder.CreateByteVector(rsaChallenge)
+        zstandardDictionaryIdsOffset = None
+        if zstandardDictionaryIds is not None and len(zstandardDictionaryIds) > 0:
+            HandshakeSyn.StartZstandardDictionaryIdsVector(builder, len(zstandardDictionaryIds))
+            # Vectors are built backwards.
+            for dictId in reversed(zstandardDictionaryIds):
+                builder.PrependUint32(dictId)
+            zstandardDictionaryIdsOffset = builder.EndVector()
 
         # Build the handshake syn
         HandshakeSyn.Start(builder)
@@ -46,14 +90,125 @@ class OctoStreamMsgBuilder:
         HandshakeSyn.AddReceiveCompressionType(builder, receiveCompressionType)
         if deviceIdOffset is not None:
             HandshakeSyn.AddDeviceId(builder, deviceIdOffset)
+        if zstandardDictionaryIdsOffset is not None:
+            HandshakeSyn.AddZstandardDictionaryIds(builder, zstandardDictionaryIdsOffset)
+        # If set, this is the size of the window we give the server for each web stream, which tells the server we support flow control.
+        if receiveWindowBytes > 0:
+            HandshakeSyn.AddReceiveWindowBytes(builder, receiveWindowBytes)
         synOffset = HandshakeSyn.End(builder)
 
         return OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.HandshakeSyn, synOffset)
 
+    # Builds a message that tells the server it can send windowIncrementBytes more data for the web stream.
+    @staticmethod
+    def BuildWebStreamWindowUpdate(streamId:int, windowIncrementBytes:int):
+        template = OctoStreamMsgBuilder._WindowUpdateTemplate
+        if template is None:
+            builder = OctoStreamMsgBuilder.CreateBuffer(100)
+            WebStreamWindowUpdate.Start(builder)
+            # The values must not be the defaults, so they are written in the template.
+            WebStreamWindowUpdate.AddStreamId(builder, 1)
+            WebStreamWindowUpdate.AddWindowIncrementBytes(builder, 1)
+            updateOffset = WebStreamWindowUpdate.End(builder)
+            template = MsgTemplate(OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamWindowUpdate, updateOffset), [4, 6])
+            OctoStreamMsgBuilder._WindowUpdateTemplate = template
+        buffer = bytearray(template.Bytes)
+        struct.pack_into("<I", buffer, template.FieldPositions[0], streamId)
+        struct.pack_into("<I", buffer, template.FieldPositions[1], windowIncrementBytes)
+        return (buffer, 0, len(buffer))
+
+    # Builds a control message that closes the web stream.
+    @staticmethod
+    def BuildWebStreamCloseMsg(streamId:int, closeDueToRequestConnectionFailure:bool):
+        template = OctoStreamMsgBuilder._CloseMsgTemplate
+        if template is None:
+            builder = OctoStreamMsgBuilder.CreateBuffer(100)
+            WebStreamMsg.Start(builder)
+            # The values must not be the defaults, so they are written in the template.
+            WebStreamMsg.AddStreamId(builder, 1)
+            WebStreamMsg.AddIsControlFlagsOnly(builder, True)
+            WebStreamMsg.AddIsCloseMsg(builder, True)
+            WebStreamMsg.AddCloseDueToRequestConnectionFailure(builder, True)
+            webStreamMsgOffset = WebStreamMsg.End(builder)
+            template = MsgTemplate(OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset), [4, 32])
+            OctoStreamMsgBuilder._CloseMsgTemplate = template
+        buffer = bytearray(template.Bytes)
+        struct.pack_into("<I", buffer, template.FieldPositions[0], streamId)
+        buffer[template.FieldPositions[1]] = 1 if closeDueToRequestConnectionFailure else 0
+        return (buffer, 0, len(buffer))
+
     @staticmethod
     def CreateBuffer(size) -> octoflatbuffers.Builder:
         return octoflatbuffers.Builder(size)
 
+    # Returns a cleared builder from the pool, for messages smaller than c_PooledBuilderSizeBytes.
+    # The message must be finished with CreateOctoStreamMsgAndFinalizePooled, which gives the builder back to the pool.
+    @staticmethod
+    def GetPooledBuilder() -> octoflatbuffers.Builder:
+        builder = None
+        with OctoStreamMsgBuilder._PoolLock:
+            if len(OctoStreamMsgBuilder._Pool) > 0:
+                builder = OctoStreamMsgBuilder._Pool.pop()
+        if builder is None:
+            return octoflatbuffers.Builder(OctoStreamMsgBuilder.c_PooledBuilderSizeBytes)
+        builder.Clear()
+        return builder
+
+    # Like CreateOctoStreamMsgAndFinalize, but for a builder from GetPooledBuilder.
+    # The message is copied out of the builder, so the builder can be reused for the next message while this one waits to be sent.
+    @staticmethod
+    def CreateOctoStreamMsgAndFinalizePooled(builder, contextType, contextOffset):
+        buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, contextType, contextOffset)
+        msgBuffer = buffer[msgStartOffsetBytes:msgStartOffsetBytes+msgSizeBytes]
+        if len(builder.Bytes) <= OctoStreamMsgBuilder.c_MaxPooledBuilderSizeBytes:
+            with OctoStreamMsgBuilder._PoolLock:
+                if len(OctoStreamMsgBuilder._Pool) < OctoStreamMsgBuilder.c_MaxPooledBuilders:
+                    OctoStreamMsgBuilder._Pool.append(builder)
+        return (msgBuffer, 0, msgSizeBytes)
+
+    # Adds a table that's the same in many messages to the builder and returns its offset.
+    # buildFunc(builder, *args) must build the table, including anything it references, and return the table's offset.
+    # The key must identify everything in the table, and the table can't have fields that need more than 4 byte alignment.
+    @staticmethod
+    def CreateInternedTable(builder:octoflatbuffers.Builder, key, buildFunc, *args) -> int:
+        interned = OctoStreamMsgBuilder._InternedTables.get(key, None)
+        if interned is None:
+            if OctoStreamMsgBuilder._ShouldIntern(key) is False:
+                return buildFunc(builder, *args)
+            # Build it in a new builder, so everything it references is in the built bytes.
+            tableBuilder = octoflatbuffers.Builder(256)
+            tableOffset = buildFunc(tableBuilder, *args)
+            interned = (bytes(tableBuilder.Bytes[tableBuilder.Head():]), tableOffset)
+            if len(interned[0]) > OctoStreamMsgBuilder.c_MaxInternedTableSizeBytes:
+                return buildFunc(builder, *args)
+            if len(OctoStreamMsgBuilder._InternedTables) < OctoStreamMsgBuilder.c_MaxInternedTables:
+                OctoStreamMsgBuilder._InternedTables[key] = interned
+        tableBytes, tableOffset = interned
+        # The bytes were built starting at the end of the buffer, which is aligned, so we must start at an aligned offset.
+        builder.assertNotNested()
+        builder.Prep(4, 0)
+        # Make sure there's room, alignment of 1 never adds padding.
+        builder.Prep(1, len(tableBytes))
+        builder.head = builder.Head() - len(tableBytes)
+        builder.Bytes[builder.Head():builder.Head()+len(tableBytes)] = tableBytes
+        # The block ends where the builder's offset was before we added it.
+        return builder.Offset() - len(tableBytes) + tableOffset
+
+    # Returns True if the key has been seen enough times to intern it.
+    @staticmethod
+    def _ShouldIntern(key) -> bool:
+        candidates = OctoStreamMsgBuilder._InternCandidates
+        if len(OctoStreamMsgBuilder._InternedTables) >= OctoStreamMsgBuilder.c_MaxInternedTables:
+            return False
+        if len(candidates) >= OctoStreamMsgBuilder.c_MaxInternCandidates:
+            candidates.clear()
+        count = candidates.get(key, 0) + 1
+        if count < OctoStreamMsgBuilder.c_InternAfterUses:
+            candidates[key] = count
+            return False
+        candidates.pop(key, None)
+        return True
+
     @staticmethod
     def CreateOctoStreamMsgAndFinalize(builder, contextType, contextOffset):
         # Create the message
@@ -81,3 +236,22 @@ class OctoStreamMsgBuilder:
         if buf is None:
             return None
         return buf.decode("utf-8")
+
+
+# A fully built message that's copied for each send, for messages that always have the same fields.
+# The positions of the fields are found once, so they can be written in place in each copy.
+class MsgTemplate:
+
+    # msg is the (buffer, msgStartOffsetBytes, msgSizeBytes) tuple from CreateOctoStreamMsgAndFinalize.
+    # fieldVTableOffsets are the vtable offsets of the fields in the context table, like the generated code uses.
+    def __init__(self, msg, fieldVTableOffsets:list) -> None:
+        buffer, msgStartOffsetBytes, msgSizeBytes = msg
+        self.Bytes = bytes(buffer[msgStartOffsetBytes:msgStartOffsetBytes+msgSizeBytes])
+        # The message is size prefixed, so the root is after the uint32 size.
+        context = OctoStreamMessage.OctoStreamMessage.GetRootAs(self.Bytes, 4).Context()
+        self.FieldPositions = []
+        for vTableOffset in fieldVTableOffsets:
+            o = context.Offset(vTableOffset)
+            if o == 0:
+                raise Exception("MsgTemplate field at vtable offset "+str(vTableOffset)+" wasn't written in the template.")
+            self.FieldPositions.append(context.Pos + o)
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+
+
+# The kind of handler a route maps to.
+class RouteHandlerId:
+    Unknown = 0
+    MoonrakerApi = 1
+    StaticUi = 2
+    Webcam = 3
+    Websocket = 4
+
+
+# A single route in a route table.
+# If the route has a host and port, the absolute url prefix for each protocol is built once, so a match only needs one string concat.
+class PathRoute:
+
+    c_Protocols = ["http://", "https://", "ws://", "wss://"]
+
+    def __init__(self, prefix:str, handlerId:int, hostAndPortStr:str = None):
+        self.Prefix = prefix
+        self.HandlerId = handlerId
+        self.HostAndPortStr = hostAndPortStr
+        self.AbsoluteUrlPrefixes = {}
+        if hostAndPortStr is not None:
+            for protocol in PathRoute.c_Protocols:
+                self.AbsoluteUrlPrefixes[protocol] = protocol + hostAndPortStr
+
+
+    # Returns the absolute url for the relative url, or None if the route has no host.
+    def BuildAbsoluteUrl(self, protocol:str, relativeUrl:str) -> str:
+        urlPrefix = self.AbsoluteUrlPrefixes.get(protocol, None)
+        if urlPrefix is not None:
+            return urlPrefix + relativeUrl
+        if self.HostAndPortStr is None:
+            return None
+        return protocol + self.HostAndPortStr + relativeUrl
+
+
+# A case-insensitive prefix router, compiled once from a route table.
+#
+# The routes are built into a character trie, where each node has both the upper and lower case version of the character
+# pointing to the same child. That way matching is a dict lookup per character of the prefix, and the path never has to be lower cased.
+# The longest matching prefix wins, and since we stop at the first character that doesn't match, the cost is bound by the longest prefix, not the path length.
+#
+# We also keep a small LRU of recent path decisions, since web frontends request the same paths over and over.
+class PathRouter:
+
+    # The max number of path decisions we keep.
+    c_MaxCacheEntries = 512
+
+    # Used to cache paths that don't match any route, since None means not in the cache.
+    c_NoRoute = PathRoute("", RouteHandlerId.Unknown)
+
+    def __init__(self, routes:list):
+        # Each trie node is a list of [children dict, route or None], since indexing a list is cheaper than another dict lookup per character.
+        self.Root = [{}, None]
+        self.Cache = OrderedDict()
+        for route in routes:
+            self._AddRoute(route)
+
+
+    # Returns the PathRoute with the longest prefix that matches the path, or None if no routes match.
+    def Match(self, path:str) -> PathRoute:
+        # Note we don't lock the cache. Each OrderedDict call is atomic, so the worst case is two threads both walk
+        # the trie for the same path, or a path is evicted between the get and the move, which we ignore.
+        cache = self.Cache
+        route = cache.get(path, None)
+        if route is None:
+            route = self._Walk(path)
+            if route is None:
+                route = PathRouter.c_NoRoute
+            cache[path] = route
+            if len(cache) > PathRouter.c_MaxCacheEntries:
+                try:
+                    cache.popitem(last=False)
+                except KeyError:
+                    pass
+        else:
+            try:
+                cache.move_to_end(path)
+            except KeyError:
+                pass
+        if route is PathRouter.c_NoRoute:
+            return None
+        return route
+
+
+    def _Walk(self, path:str) -> PathRoute:
+        node = self.Root
+        best = node[1]
+        for c in path:
+            node = node[0].get(c, None)
+            if node is None:
+                break
+            if node[1] is not None:
+                best = node[1]
+        return best
+
+
+    def _AddRoute(self, route:PathRoute):
+        node = self.Root
+        for c in route.Prefix:
+            lower = c.lower()
+            upper = c.upper()
+            children = node[0]
+            child = children.get(lower, None)
+            if child is None:
+                child = children.get(upper, None)
+            if child is None:
+                child = [{}, None]
+            children[lower] = child
+            children[upper] = child
+            node = child
+        node[1] = route
@@ -0,0 +1,43 @@
+import threading
+
+
+# PIL is slow to import and most setups never need to change an image, so it's only imported the first time it's needed.
+# This is shared by everything that uses PIL, so it's only imported once.
+class PilImage:
+
+    _Image = None
+    _ImportAttempted = False
+    _Lock = threading.Lock()
+
+
+    # Returns the PIL Image module, or None if PIL can't be imported on this system.
+    @staticmethod
+    def Get():
+        if PilImage._ImportAttempted:
+            return PilImage._Image
+        # The import is slow, so other threads can call this while it's running. They wait for it, so they don't think PIL isn't installed.
+        with PilImage._Lock:
+            if PilImage._ImportAttempted:
+                return PilImage._Image
+            try:
+                # On some systems this package will install but the import will fail due to a missing system .so.
+                # Since most setups don't use this package, we will import it with a try catch and if it fails we
+                # won't use it.
+                #pylint: disable=import-outside-toplevel
+                from PIL import Image
+                PilImage._Image = Image
+                # We noticed that on some under powered or otherwise bad systems the image returned
+                # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
+                # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
+                # buffer, which is still an incomplete image.
+                # Use a try catch incase the import of ImageFile failed
+                try:
+                    from PIL import ImageFile
+                    ImageFile.LOAD_TRUNCATED_IMAGES = True
+                except Exception as _:
+                    pass
+            except Exception as _:
+                pass
+            # Only set this once the import is done, since the fast path above doesn't take the lock.
+            PilImage._ImportAttempted = True
+        return PilImage._Image
@@ -1,8 +1,11 @@
 import os
 import json
 import time
+import atexit
 import logging
+import threading
 from pathlib import Path
+from .threadbudget import ThreadBudget
 
 # The goal of this class is to keep track of info about the current print.
 # This is needed because sometimes we only get the info once, like at the start of a print, and then we want to keep it around for future notifications.
@@ -21,40 +24,46 @@ class PrintInfo:
     c_EstFilamentWeightMg = "EstFilamentWeightMg"
     c_FinalPrintDurationSec = "FinalPrintDurationSec"
 
-    # Given a file path, this loads a print info if possible.
+    # Given a file path of a legacy per print cookie file, this loads the print info data if possible.
     # Returns None on failure.
     @staticmethod
-    def LoadFromFile(logger:logging.Logger, filePath:str):
+    def LoadDataFromFile(logger:logging.Logger, filePath:str) -> dict:
         try:
             with open(filePath, "r", encoding="utf-8") as f:
                 data = json.load(f)
                 # Ensure it has the required vars.
-                if PrintInfo.c_PrintIdKey not in data  or PrintInfo.c_PrintCookieKey not in data or PrintInfo.c_PrintStartTimeSecKey not in data:
+                if PrintInfo.IsValidData(data) is False:
                     raise Exception("File loaded, but there was no Print ID")
-                return PrintInfo(logger, filePath, data)
+                return data
         except Exception as e:
             logger.error(f"Failed to load print info from file. {e}")
         return None
 
 
-    # Given a file path and required args, creates a new print context.
+    # Returns True if the dict has all of the required vars.
+    @staticmethod
+    def IsValidData(data:dict) -> bool:
+        return isinstance(data, dict) and PrintInfo.c_PrintIdKey in data and PrintInfo.c_PrintCookieKey in data and PrintInfo.c_PrintStartTimeSecKey in data
+
+
+    # Given the store and required args, creates a new print context.
     # This will always return a PrintInfo! Even if it fails to write to disk.
     @staticmethod
-    def CreateNew(logger:logging.Logger, filePath:str, printCookie:str, printId:str):
+    def CreateNew(logger:logging.Logger, store:"PrintInfoStore", printCookie:str, printId:str):
         data = {
             PrintInfo.c_PrintCookieKey : printCookie,
             PrintInfo.c_PrintIdKey : printId,
             PrintInfo.c_PrintStartTimeSecKey : time.time()
         }
-        pi = PrintInfo(logger, filePath, data)
+        pi = PrintInfo(logger, store, data)
         # Save, but always return a object even if this fails.
         pi.Save()
         return pi
 
 
-    def __init__(self, logger:logging.Logger, filePath:str, data:dict) -> None:
+    def __init__(self, logger:logging.Logger, store:"PrintInfoStore", data:dict) -> None:
         self.Logger = logger
-        self.FilePath = filePath
+        self.Store = store
         self.Data = data
 
 
@@ -109,7 +118,7 @@ class PrintInfo:
     def GetEstFilamentWeightUsageMg(self) -> int:
         return self.Data.get(PrintInfo.c_EstFilamentWeightMg, 0)
     def SetEstFilamentWeightUsageMg(self, estG:int) -> None:
-        if self.GetEstFilamentUsageMm() != estG:
+        if self.GetEstFilamentWeightUsageMg() != estG:
             self.Data[PrintInfo.c_EstFilamentWeightMg] = estG
             self.Save()
 
@@ -134,14 +143,246 @@ class PrintInfo:
         return int(time.time() - self.GetLocalPrintStartTimeSec())
 
 
+    # Queues the print info to be written to disk.
+    # The write is batched with any other changes, so this doesn't block on the disk.
     def Save(self) -> bool:
+        if self.Store is None:
+            return False
+        return self.Store.Write(self.GetPrintCookie(), self.Data)
+
+
+# Controls when the print info store calls fsync.
+class PrintInfoFsyncPolicy:
+    # Never fsync, the OS will write the data when it wants to.
+    Never = 0
+    # Fsync once for each batch of writes. (default)
+    OnFlush = 1
+    # Write and fsync every change right away, without batching.
+    Always = 2
+
+
+# Holds all of the print infos in a single append only log file.
+#
+# Each line of the log is a json record, which either sets the full data of a print info, deletes one, or clears all of them.
+# The log is replayed on load, so the last record for a print cookie wins. Since print infos are small and only change a
+# few times per print, writes are batched for a short time and then appended in one write, with at most one fsync.
+# When the log has too many dead records, it's compacted by writing only the live print infos to a new file and swapping it in.
+# Print infos older than the TTL are evicted when the log is loaded or compacted.
+class PrintInfoStore:
+
+    c_LogFileName = "PrintInfos.log"
+
+    # How long changes are batched before they are written.
+    c_WriteDebounceSec = 2.0
+
+    # Once the log has at least this many records and most of them are dead, it's compacted.
+    c_CompactMinRecords = 200
+    c_CompactDeadRecordRatio = 4
+
+    # Print infos older than this are evicted, no print takes this long.
+    c_MaxPrintInfoAgeSec = 60 * 60 * 24 * 30
+
+    # The record keys.
+    c_OpKey = "Op"
+    c_DataKey = "Data"
+    c_CookieKey = "Cookie"
+    c_OpSet = "s"
+    c_OpDelete = "d"
+    c_OpClear = "c"
+
+    def __init__(self, logger:logging.Logger, folderPath:str, fsyncPolicy:int = PrintInfoFsyncPolicy.OnFlush) -> None:
+        self.Logger = logger
+        self.LogFilePath = os.path.join(folderPath, PrintInfoStore.c_LogFileName)
+        self.FsyncPolicy = fsyncPolicy
+        # Protects the in memory state.
+        self.Lock = threading.Lock()
+        # Only one thread writes to the file at a time.
+        self.FileLock = threading.Lock()
+        # The current print infos, by cookie.
+        self.PrintInfos = {}
+        # The changes that haven't been written yet, by cookie. None means the print info was deleted.
+        self.PendingChanges = {}
+        self.PendingClear = False
+        # Set when there are pending changes, the flush thread is started when the first change is made.
+        self.FlushEvent = threading.Event()
+        self.FlushThread:threading.Thread = None
+        self.LogRecordCount = 0
+        # Stats, mostly for debugging.
+        self.WriteCount = 0
+        self.FsyncCount = 0
+        self._Load()
+        # Make sure any pending changes are written before we exit.
+        atexit.register(self.Flush)
+
+
+    # Returns a copy of the print info data for the cookie, or None if there isn't one.
+    def Get(self, printCookie:str) -> dict:
+        with self.Lock:
+            data = self.PrintInfos.get(printCookie, None)
+            if data is None:
+                return None
+            return dict(data)
+
+
+    # Returns the cookies of all print infos in the store.
+    def GetPrintCookies(self):
+        with self.Lock:
+            return list(self.PrintInfos.keys())
+
+
+    # Sets the print info data for the cookie, the write to disk is batched.
+    def Write(self, printCookie:str, data:dict) -> bool:
+        with self.Lock:
+            # Copy the dict, so the caller can keep changing it while we write it.
+            data = dict(data)
+            self.PrintInfos[printCookie] = data
+            self.PendingChanges[printCookie] = data
+        self._ScheduleFlush()
+        return True
+
+
+    # Deletes the print info for the cookie, if it exists.
+    def Delete(self, printCookie:str) -> None:
+        with self.Lock:
+            if self.PrintInfos.pop(printCookie, None) is None:
+                return
+            self.PendingChanges[printCookie] = None
+        self._ScheduleFlush()
+
+
+    # Deletes all of the print infos.
+    def Clear(self) -> None:
+        with self.Lock:
+            if len(self.PrintInfos) == 0 and len(self.PendingChanges) == 0:
+                return
+            self.PrintInfos.clear()
+            self.PendingChanges.clear()
+            self.PendingClear = True
+        self._ScheduleFlush()
+
+
+    # Writes any pending changes to disk now.
+    def Flush(self) -> None:
+        with self.FileLock:
+            with self.Lock:
+                if self.PendingClear is False and len(self.PendingChanges) == 0:
+                    return
+                records = []
+                if self.PendingClear:
+                    records.append({PrintInfoStore.c_OpKey: PrintInfoStore.c_OpClear})
+                for cookie, data in self.PendingChanges.items():
+                    if data is None:
+                        records.append({PrintInfoStore.c_OpKey: PrintInfoStore.c_OpDelete, PrintInfoStore.c_CookieKey: cookie})
+                    else:
+                        records.append({PrintInfoStore.c_OpKey: PrintInfoStore.c_OpSet, PrintInfoStore.c_DataKey: data})
+                self.PendingChanges = {}
+                self.PendingClear = False
+                liveCount = len(self.PrintInfos)
+            try:
+                # Append all of the records in one write.
+                buffer = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+                with open(self.LogFilePath, "a", encoding="utf-8") as f:
+                    f.write(buffer)
+                    self._FsyncIfNeeded(f)
+                self.WriteCount += 1
+                self.LogRecordCount += len(records)
+                # Compact if the log is mostly dead records.
+                if self.LogRecordCount >= PrintInfoStore.c_CompactMinRecords and self.LogRecordCount > liveCount * PrintInfoStore.c_CompactDeadRecordRatio:
+                    self._Compact()
+            except Exception as e:
+                self.Logger.error(f"Failed to write the print info log. {e}")
+
+
+    def _ScheduleFlush(self) -> None:
+        if self.FsyncPolicy == PrintInfoFsyncPolicy.Always:
+            self.Flush()
+            return
+        # Starting a thread per batch is slow enough to show up for the caller, so one thread does all of the flushes.
+        with self.Lock:
+            if self.FlushThread is None:
+                self.FlushThread = ThreadBudget.StartThread("PrintInfoFlush", self._FlushThread, daemon=True)
+        self.FlushEvent.set()
+
+
+    def _FlushThread(self) -> None:
+        while True:
+            try:
+                self.FlushEvent.wait()
+                # Wait a bit so any other changes are batched into the same write.
+                time.sleep(PrintInfoStore.c_WriteDebounceSec)
+                self.FlushEvent.clear()
+                self.Flush()
+            except Exception as e:
+                self.Logger.error(f"Exception in the print info flush thread. {e}")
+
+
+    def _FsyncIfNeeded(self, f) -> None:
+        if self.FsyncPolicy == PrintInfoFsyncPolicy.Never:
+            return
+        f.flush()
+        os.fsync(f.fileno())
+        self.FsyncCount += 1
+
+
+    # Rewrites the log with only the live print infos. Must be called with the file lock held.
+    def _Compact(self) -> None:
+        self._EvictExpired()
+        with self.Lock:
+            records = [{PrintInfoStore.c_OpKey: PrintInfoStore.c_OpSet, PrintInfoStore.c_DataKey: data} for data in self.PrintInfos.values()]
+        # Write to a temp file and then move it, so we never leave a partial log.
+        tempPath = self.LogFilePath + ".tmp"
+        with open(tempPath, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records))
+            self._FsyncIfNeeded(f)
+        os.replace(tempPath, self.LogFilePath)
+        self.WriteCount += 1
+        self.LogRecordCount = len(records)
+
+
+    # Removes any print infos that are older than the TTL, returns the number removed.
+    def _EvictExpired(self) -> int:
+        cutoffSec = time.time() - PrintInfoStore.c_MaxPrintInfoAgeSec
+        with self.Lock:
+            expired = [cookie for cookie, data in self.PrintInfos.items() if data.get(PrintInfo.c_PrintStartTimeSecKey, 0) < cutoffSec]
+            for cookie in expired:
+                del self.PrintInfos[cookie]
+            return len(expired)
+
+
+    # Replays the log into memory.
+    def _Load(self) -> None:
+        if os.path.exists(self.LogFilePath) is False:
+            return
         try:
-            with open(self.FilePath, "w", encoding="utf-8") as f:
-                json.dump(self.Data, f)
-            return True
+            recordCount = 0
+            badRecords = 0
+            with open(self.LogFilePath, "r", encoding="utf-8") as f:
+                for line in f:
+                    if len(line.strip()) == 0:
+                        continue
+                    recordCount += 1
+                    try:
+                        record = json.loads(line)
+                        op = record[PrintInfoStore.c_OpKey]
+                        if op == PrintInfoStore.c_OpSet:
+                            data = record[PrintInfoStore.c_DataKey]
+                            if PrintInfo.IsValidData(data):
+                                self.PrintInfos[data[PrintInfo.c_PrintCookieKey]] = data
+                        elif op == PrintInfoStore.c_OpDelete:
+                            self.PrintInfos.pop(record[PrintInfoStore.c_CookieKey], None)
+                        elif op == PrintInfoStore.c_OpClear:
+                            self.PrintInfos.clear()
+                    except Exception:
+                        # This can happen if we crashed while writing the last record, we just skip it.
+                        badRecords += 1
+            self.LogRecordCount = recordCount
+            evicted = self._EvictExpired()
+            # If anything was evicted or the log has bad records, rewrite it now.
+            if evicted > 0 or badRecords > 0:
+                with self.FileLock:
+                    self._Compact()
         except Exception as e:
-            self.Logger.error(f"Failed to write print context from file. {e}")
-        return False
+            self.Logger.error(f"Failed to load the print info log. {e}")
 
 
 # The goal of this class is to manage the current print info.
@@ -155,8 +396,8 @@ class PrintInfoManager:
     _Instance = None
 
     @staticmethod
-    def Init(logger:logging.Logger, localStorageFolderPath:str):
-        PrintInfoManager._Instance = PrintInfoManager(logger, localStorageFolderPath)
+    def Init(logger:logging.Logger, localStorageFolderPath:str, fsyncPolicy:int = PrintInfoFsyncPolicy.OnFlush):
+        PrintInfoManager._Instance = PrintInfoManager(logger, localStorageFolderPath, fsyncPolicy)
 
 
     @staticmethod
@@ -164,11 +405,13 @@ class PrintInfoManager:
         return PrintInfoManager._Instance
 
 
-    def __init__(self, logger:logging.Logger, localStorageFolderPath:str) -> None:
+    def __init__(self, logger:logging.Logger, localStorageFolderPath:str, fsyncPolicy:int = PrintInfoFsyncPolicy.OnFlush) -> None:
         self.Logger = logger
         self.ContextFolderPath = os.path.join(localStorageFolderPath, PrintInfoManager.c_ContextsFolder)
         Path(self.ContextFolderPath).mkdir(parents=True, exist_ok=True)
+        self.Store = PrintInfoStore(logger, self.ContextFolderPath, fsyncPolicy)
         self.CurrentContext:PrintInfo = None
+        self._MigrateLegacyFiles()
 
 
     # Given a print cookie, if a print info.
@@ -186,22 +429,15 @@ class PrintInfoManager:
             if c is not None and c.GetPrintCookie() == printCookie:
                 return c
 
-            # Else, go through the files looking for the correct context.
-            dirAndFiles = os.listdir(self.ContextFolderPath)
-            printCookieFileName = self._GetPrintCookieFileName(printCookie)
+            # Else, look for the context in the store, which is in memory.
             context = None
-            # Iterate all files. Any file that doesn't match or fails to parse we delete.
-            for name in dirAndFiles:
-                fullPath = os.path.join(self.ContextFolderPath, name)
-                if os.path.isfile(fullPath):
-                    if name == printCookieFileName:
-                        context = PrintInfo.LoadFromFile(self.Logger, fullPath)
-                        if context is None:
-                            self._DeleteFile(fullPath)
-                    else:
-                        self._DeleteFile(fullPath)
-                else:
-                    self._DeleteFile(fullPath)
+            data = self.Store.Get(printCookie)
+            if data is not None:
+                context = PrintInfo(self.Logger, self.Store, data)
+            # Remove any contexts that don't match.
+            for cookie in self.Store.GetPrintCookies():
+                if cookie != printCookie:
+                    self.Store.Delete(cookie)
             # Always replace the current context even if it's empty, so the old context is removed.
             self.CurrentContext = context
             return context
@@ -214,10 +450,9 @@ class PrintInfoManager:
     # like on a new print start or something.
     def ClearAllPrintInfos(self) -> None:
         try:
-            dirAndFiles = os.listdir(self.ContextFolderPath)
-            for name in dirAndFiles:
-                fullPath = os.path.join(self.ContextFolderPath, name)
-                self._DeleteFile(fullPath)
+            self.Store.Clear()
+            # This is only done on print starts, so write it now, rather than risk losing it to a restart.
+            self.Store.Flush()
         except Exception as e:
             self.Logger.error(f"Exception in PrintContextTracker.ClearAllPrintInfos: {e}")
 
@@ -226,16 +461,44 @@ class PrintInfoManager:
     # This will always return a new PrintInfo, even if it fails to write to disk.
     def CreateNewPrintInfo(self, printCookie:str, printId:str) -> PrintInfo:
         try:
-            fullPath = os.path.join(self.ContextFolderPath, self._GetPrintCookieFileName(printCookie))
-            self.CurrentContext = PrintInfo.CreateNew(self.Logger, fullPath, printCookie, printId)
+            self.CurrentContext = PrintInfo.CreateNew(self.Logger, self.Store, printCookie, printId)
+            # The print id must survive a restart, so write it now, rather than waiting for the batched flush.
+            self.Store.Flush()
             return self.CurrentContext
         except Exception as e:
             self.Logger.error(f"Exception in PrintContextTracker.CreateNew: {e}")
         return None
 
 
-    def _GetPrintCookieFileName(self, printCookie:str):
-        return f"{printCookie}.json"
+    # Writes any pending print info changes to disk now.
+    def Flush(self) -> None:
+        self.Store.Flush()
+
+
+    # Older versions wrote one json file per print cookie into the contexts folder.
+    # If there are any, move them into the store and delete them.
+    def _MigrateLegacyFiles(self) -> None:
+        try:
+            legacyFiles = []
+            for name in os.listdir(self.ContextFolderPath):
+                fullPath = os.path.join(self.ContextFolderPath, name)
+                if name.endswith(".json") and os.path.isfile(fullPath):
+                    legacyFiles.append(fullPath)
+            if len(legacyFiles) == 0:
+                return
+            migrated = 0
+            for fullPath in legacyFiles:
+                data = PrintInfo.LoadDataFromFile(self.Logger, fullPath)
+                if data is not None:
+                    self.Store.Write(data[PrintInfo.c_PrintCookieKey], data)
+                    migrated += 1
+            # Write the store before the old files are deleted.
+            self.Store.Flush()
+            for fullPath in legacyFiles:
+                self._DeleteFile(fullPath)
+            self.Logger.info(f"Migrated {migrated} print infos to the print info store.")
+        except Exception as e:
+            self.Logger.error(f"Exception in PrintContextTracker._MigrateLegacyFiles: {e}")
 
 
     def _DeleteFile(self, filePath:str):
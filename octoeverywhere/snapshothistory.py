@@ -0,0 +1,151 @@
+import time
+import logging
+import tempfile
+import threading
+from collections import deque
+
+from .sentry import Sentry
+
+# Keeps the most recent snapshots, so one can be picked by how long ago it was taken.
+#
+# Snapshots are kept in memory until they use more than the memory budget, then older ones are written to a temp file that's used as a ring buffer.
+# Most snapshots are small enough that the full history fits in the budget, so the temp file is never written, which matters for devices that run from an SD card.
+# Snapshots from 4k cameras can be a few MB each, so the spill keeps a long history of those from using a lot of memory on low end hardware.
+# The file is unlinked as soon as it's created, so it's cleaned up by the OS even if we are killed.
+# If the temp file can't be created, all of the snapshots are kept in memory.
+class SnapshotHistory:
+
+    # The newest memorySnapshots are always kept in memory, older ones are only spilled if the snapshots in memory use more than memoryBytes.
+    def __init__(self, logger:logging.Logger, maxSnapshots:int, memorySnapshots:int, memoryBytes:int, spillFileSizeBytes:int) -> None:
+        self.Logger = logger
+        self.MaxSnapshots = max(1, maxSnapshots)
+        self.MemorySnapshots = max(1, min(memorySnapshots, self.MaxSnapshots))
+        self.MemoryBytes = memoryBytes
+        self.SpillFileSizeBytes = spillFileSizeBytes
+        self.Lock = threading.Lock()
+        # The newest snapshots, oldest first, as (timeSec, buffer)
+        self.InMemory = deque()
+        self.InMemoryBytes = 0
+        # The older snapshots that were spilled to the file, oldest first, as (timeSec, offset, length)
+        self.Spilled = deque()
+        self.SpillFile = None
+        self.SpillWriteOffset = 0
+        self.SpillFailed = False
+        self.IsClosed = False
+
+
+    # Returns how many snapshots are in the history.
+    def Count(self) -> int:
+        with self.Lock:
+            return len(self.InMemory) + len(self.Spilled)
+
+
+    # Adds a snapshot, taken at the given time.
+    def Add(self, snapshot, timeSec:float = None) -> None:
+        if timeSec is None:
+            timeSec = time.time()
+        with self.Lock:
+            if self.IsClosed:
+                return
+            self.InMemory.append((timeSec, snapshot))
+            self.InMemoryBytes += len(snapshot)
+            while len(self.InMemory) + len(self.Spilled) > self.MaxSnapshots:
+                if len(self.Spilled) > 0:
+                    self.Spilled.popleft()
+                else:
+                    self._PopInMemory()
+            while len(self.InMemory) > self.MemorySnapshots and self.InMemoryBytes > self.MemoryBytes:
+                oldTimeSec, oldSnapshot = self.InMemory[0]
+                if self._Spill(oldTimeSec, oldSnapshot) is False:
+                    # If we can't spill, keep everything in memory.
+                    break
+                self._PopInMemory()
+
+
+    # Returns the newest snapshot that's at least targetAgeSec old, or the oldest snapshot if none are that old, as a tuple of (timeSec, snapshot).
+    # Returns (None, None) if there are no snapshots.
+    def Get(self, targetAgeSec:float):
+        targetTimeSec = time.time() - targetAgeSec
+        with self.Lock:
+            for timeSec, snapshot in reversed(self.InMemory):
+                if timeSec <= targetTimeSec:
+                    return (timeSec, snapshot)
+            for timeSec, offset, length in reversed(self.Spilled):
+                if timeSec <= targetTimeSec:
+                    return (timeSec, self._ReadSpilled(offset, length))
+            # Nothing is old enough, use the oldest.
+            if len(self.Spilled) > 0:
+                timeSec, offset, length = self.Spilled[0]
+                return (timeSec, self._ReadSpilled(offset, length))
+            if len(self.InMemory) > 0:
+                return self.InMemory[0]
+        return (None, None)
+
+
+    # Drops all of the snapshots and closes the spill file. Any snapshots added after this are ignored.
+    def Close(self) -> None:
+        with self.Lock:
+            self.IsClosed = True
+            self.InMemory.clear()
+            self.InMemoryBytes = 0
+            self.Spilled.clear()
+            spillFile = self.SpillFile
+            self.SpillFile = None
+            if spillFile is not None:
+                try:
+                    spillFile.close()
+                except Exception:
+                    pass
+
+
+    # Must be called under lock.
+    def _PopInMemory(self) -> None:
+        _, snapshot = self.InMemory.popleft()
+        self.InMemoryBytes -= len(snapshot)
+
+
+    # Must be called under lock. Returns False if the snapshot couldn't be spilled.
+    def _Spill(self, timeSec:float, snapshot) -> bool:
+        length = len(snapshot)
+        if self.SpillFailed or length > self.SpillFileSizeBytes:
+            return False
+        try:
+            if self.SpillFile is None:
+                self.SpillFile = tempfile.TemporaryFile(prefix="oe-snapshots-")
+                self.SpillWriteOffset = 0
+            # If it doesn't fit at the end of the file, wrap around to the start. Anything after the write offset is the oldest data, so it's overwritten.
+            offset = self.SpillWriteOffset
+            overwriteStart = offset
+            if offset + length > self.SpillFileSizeBytes:
+                offset = 0
+            end = offset + length
+            # Drop the oldest snapshots that will be overwritten. The snapshots are in the file in the order they are written, so they are always the oldest.
+            while len(self.Spilled) > 0:
+                _, oldOffset, oldLength = self.Spilled[0]
+                oldEnd = oldOffset + oldLength
+                if offset == 0 and overwriteStart != 0:
+                    # We wrapped, so [overwriteStart, end of file) is dropped too.
+                    overlaps = oldOffset < end or oldEnd > overwriteStart
+                else:
+                    overlaps = oldOffset < end and oldEnd > offset
+                if overlaps is False:
+                    break
+                self.Spilled.popleft()
+            self.SpillFile.seek(offset)
+            self.SpillFile.write(snapshot)
+            self.SpillWriteOffset = end
+            self.Spilled.append((timeSec, offset, length))
+            return True
+        except Exception as e:
+            self.SpillFailed = True
+            self.Spilled.clear()
+            Sentry.Exception("SnapshotHistory failed to spill a snapshot to disk, keeping them in memory.", e)
+        return False
+
+
+    # Must be called under lock.
+    def _ReadSpilled(self, offset:int, length:int) -> bytes:
+        # Any buffered writes must be written before we read them back.
+        self.SpillFile.flush()
+        self.SpillFile.seek(offset)
+        return self.SpillFile.read(length)
@@ -2,7 +2,7 @@
 #  A class argument that allows requesters to resize down and crop the image if desired.
 class SnapshotResizeParams:
 
-    def __init__(self, size, resizeToHeight = False, resizeToWidth = False, cropSquareCenterNoPadding = False):
+    def __init__(self, size, resizeToHeight = False, resizeToWidth = False, cropSquareCenterNoPadding = False, jpegQuality = 95):
         # The size that will be used for the resize.
         self.Size = size
         if self.Size < 2:
@@ -17,3 +17,6 @@ class SnapshotResizeParams:
         self.ResizeToWidth = resizeToWidth
         # If set to True, the size will be used for the height and width, and the image will remain uniform, but cropped to center.
         self.CropSquareCenterNoPadding = cropSquareCenterNoPadding
+
+        # The jpeg quality used if the image is re-encoded. If the image doesn't need any changes, the original image is used as is.
+        self.JpegQuality = jpegQuality
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import logging
+import builtins
+import threading
+
+
+# A startup profiler, used to find what makes the plugin slow to start and what uses memory at startup.
+#
+# It's only enabled when the OE_STARTUP_PROFILE env var is set to 1, otherwise all of the functions return right away.
+# When enabled, it records:
+#   - The time and RSS growth of each module that's imported, by wrapping the import function.
+#   - The time and RSS growth of each init phase of the host's RunBlocking, from the Phase() calls.
+#   - The time and RSS when the plugin first connects to the service.
+# The report is logged once the plugin is connected.
+#
+# Start() must be called as early as possible, before the host's imports, so the import times are recorded.
+class StartupProfiler:
+
+    c_EnvVarName = "OE_STARTUP_PROFILE"
+    c_ReportTopModuleCount = 30
+
+    _IsEnabled = False
+    _IsReported = False
+    _StartSec = 0.0
+    _ProcessAgeAtStartSec = 0.0
+    _Lock = threading.Lock()
+    _OriginalImport = builtins.__import__
+    # The stack of imports in progress, each item is [module name, start time, start rss, child time, child rss]
+    _ImportStack = []
+    # The completed imports, each item is (module name, self time, total time, self rss growth)
+    _Imports = []
+    # The completed phases, each item is (phase name, time, rss growth)
+    _Phases = []
+    _LastPhaseSec = 0.0
+    _LastPhaseRss = 0
+
+
+    # Starts the profiler if the env var is set.
+    @staticmethod
+    def Start() -> None:
+        if StartupProfiler._IsEnabled or os.environ.get(StartupProfiler.c_EnvVarName, "0") != "1":
+            return
+        StartupProfiler._IsEnabled = True
+        StartupProfiler._StartSec = time.perf_counter()
+        StartupProfiler._ProcessAgeAtStartSec = StartupProfiler._GetProcessAgeSec()
+        StartupProfiler._LastPhaseSec = StartupProfiler._StartSec
+        StartupProfiler._LastPhaseRss = StartupProfiler._GetRssBytes()
+        builtins.__import__ = StartupProfiler._ProfiledImport
+
+
+    @staticmethod
+    def IsEnabled() -> bool:
+        return StartupProfiler._IsEnabled
+
+
+    # Marks the end of an init phase, the time and memory since the last phase is recorded with this name.
+    @staticmethod
+    def Phase(name:str) -> None:
+        if StartupProfiler._IsEnabled is False or StartupProfiler._IsReported:
+            return
+        now = time.perf_counter()
+        rss = StartupProfiler._GetRssBytes()
+        with StartupProfiler._Lock:
+            StartupProfiler._Phases.append((name, now - StartupProfiler._LastPhaseSec, rss - StartupProfiler._LastPhaseRss))
+            StartupProfiler._LastPhaseSec = now
+            StartupProfiler._LastPhaseRss = rss
+
+
+    # Called when the plugin has connected to the service, this logs the report the first time it's called.
+    @staticmethod
+    def OnConnected(logger:logging.Logger) -> None:
+        if StartupProfiler._IsEnabled is False:
+            return
+        with StartupProfiler._Lock:
+            if StartupProfiler._IsReported:
+                return
+            StartupProfiler._IsReported = True
+        StartupProfiler.Phase("Connected")
+        # We don't need to watch imports anymore.
+        if builtins.__import__ is StartupProfiler._ProfiledImport:
+            builtins.__import__ = StartupProfiler._OriginalImport
+
+        sinceStartSec = time.perf_counter() - StartupProfiler._StartSec
+        logger.info("Startup Profile: connected %.3fs after the process started (%.3fs after the profiler started), RSS %.1fMB",
+                    StartupProfiler._ProcessAgeAtStartSec + sinceStartSec, sinceStartSec, StartupProfiler._GetRssBytes() / 1024.0 / 1024.0)
+        for name, durationSec, rssBytes in StartupProfiler._Phases:
+            logger.info("Startup Profile: phase %-30s %8.1fms %+8.1fMB", name, durationSec * 1000.0, rssBytes / 1024.0 / 1024.0)
+
+        # Report the top modules by self time, which is the time to import the module minus the modules it imported.
+        imports = sorted(StartupProfiler._Imports, key=lambda i: i[1], reverse=True)
+        totalImportSec = 0.0
+        for i in imports:
+            totalImportSec += i[1]
+        logger.info("Startup Profile: %d modules imported in %.1fms, top %d by self time:", len(imports), totalImportSec * 1000.0, StartupProfiler.c_ReportTopModuleCount)
+        for name, selfSec, totalSec, rssBytes in imports[:StartupProfiler.c_ReportTopModuleCount]:
+            logger.info("Startup Profile: import %-40s self %7.1fms total %7.1fms %+7.2fMB", name, selfSec * 1000.0, totalSec * 1000.0, rssBytes / 1024.0 / 1024.0)
+
+
+    # Replaces the builtin import while the profiler is running.
+    @staticmethod
+    def _ProfiledImport(name, globals=None, locals=None, fromlist=(), level=0): #pylint: disable=redefined-builtin
+        # Only record imports that load a module, and only from the thread doing the startup, so the stack stays correct.
+        fullName = name
+        if level > 0 and globals is not None:
+            package = globals.get("__package__", None)
+            if package:
+                parts = package.rsplit(".", level - 1)
+                fullName = parts[0] + "." + name if name else parts[0]
+        if fullName in sys.modules or threading.current_thread() is not threading.main_thread():
+            return StartupProfiler._OriginalImport(name, globals, locals, fromlist, level)
+
+        stack = StartupProfiler._ImportStack
+        item = [fullName, time.perf_counter(), StartupProfiler._GetRssBytes(), 0.0, 0]
+        stack.append(item)
+        try:
+            return StartupProfiler._OriginalImport(name, globals, locals, fromlist, level)
+        finally:
+            stack.pop()
+            totalSec = time.perf_counter() - item[1]
+            totalRss = StartupProfiler._GetRssBytes() - item[2]
+            StartupProfiler._Imports.append((fullName, totalSec - item[3], totalSec, totalRss - item[4]))
+            if len(stack) > 0:
+                stack[-1][3] += totalSec
+                stack[-1][4] += totalRss
+
+
+    # Returns the current RSS of the process, or 0 if it's not known.
+    @staticmethod
+    def _GetRssBytes() -> int:
+        try:
+            with open("/proc/self/statm", "rb") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except Exception:
+            return 0
+
+
+    # Returns how long the process has been running, so the report includes the interpreter startup, or 0 if it's not known.
+    @staticmethod
+    def _GetProcessAgeSec() -> float:
+        try:
+            with open("/proc/self/stat", "rb") as f:
+                # The process name can have spaces, so split after it. The start time is the 22nd field.
+                fields = f.read().rsplit(b")", 1)[1].split()
+            startTicks = int(fields[19])
+            with open("/proc/uptime", "rb") as f:
+                uptimeSec = float(f.read().split()[0])
+            return max(0.0, uptimeSec - startTicks / os.sysconf("SC_CLK_TCK"))
+        except Exception:
+            return 0.0
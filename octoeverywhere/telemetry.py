@@ -1,7 +1,7 @@
 import logging
-import threading
 
 from .httpsessions import HttpSessions
+from .boundedexecutor import Executors
 
 # A helper class for reporting telemetry.
 class Telemetry:
@@ -23,8 +23,7 @@ class Telemetry:
     # Example: Telemetry.Write("Test", 1, { "FieldKey":"FieldValue", "FieldKey2":1.5 }, { "TagKey":"TagValue" })
     @staticmethod
     def Write(measureStr:str, valueInt:int, fieldsOpt:dict=None, tagsOpt:dict=None):
-        thread = threading.Thread(target=Telemetry._WriteSync, args=(measureStr, valueInt, fieldsOpt, tagsOpt, ))
-        thread.start()
+        Executors.IoMustRun(Telemetry._WriteSync, measureStr, valueInt, fieldsOpt, tagsOpt)
 
     # Same as Write(), but it blocks on the request. True is returned on success, otherwise False.
     @staticmethod
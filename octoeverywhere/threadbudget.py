@@ -0,0 +1,219 @@
+import os
+import logging
+import threading
+
+
+# Tracks how many threads the plugin can safely create, and how many it has created, by where they came from.
+#
+# On small devices and in containers we have hit the "can't start new thread" error, which means the OS refused to give us another thread.
+# When that happens in the wrong place, the process can't recover, so instead we compute a budget when we start and refuse threads we can live without
+# before we get to the OS limit. The budget is the smallest of:
+#   - The cgroup pids.max, minus what's already used in the cgroup. This is the limit that docker and systemd (TasksMax) set.
+#   - A share of RLIMIT_NPROC, which is the limit for all of the processes and threads of the user.
+#   - What the available memory can hold, with a conservative estimate of what each thread costs.
+#
+# Threads are either required or optional.
+#   - Required threads are things like the main websocket, if we can't create them the plugin can't run anyway, so they are never refused by the budget.
+#   - Optional threads are things like web stream threads and thread pool workers, they are refused when the budget is used, and the caller must handle it.
+# Both are counted in the census, which ThreadDebug logs.
+class ThreadBudget:
+
+    # The budget we use if we can't read any of the limits.
+    c_DefaultMaxThreads = 1024
+    # We never go below this, since the plugin can't run with fewer.
+    c_MinThreads = 32
+    # The number of threads we leave for threads we don't create, like the ones created by libs.
+    c_ReservedThreads = 24
+    # The share of the user's NPROC limit we will use, since other processes of the same user share it.
+    c_NprocShare = 0.5
+    # The share of the available memory we will use for threads, and how much we assume each thread costs.
+    # The stack is 8MB of virtual memory, but only what's used is committed, which is small for our threads.
+    c_MemoryShare = 0.25
+    c_PerThreadMemoryBytes = 512 * 1024
+
+    _Logger:logging.Logger = None
+    _Lock = threading.Lock()
+    _MaxThreads = None
+    # Origin string -> live thread count
+    _Census = {}
+    _RefusedCount = 0
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        ThreadBudget._Logger = logger
+        ThreadBudget._MaxThreads = ThreadBudget._ComputeMaxThreads(logger)
+
+
+    # Returns the max number of threads we will create.
+    @staticmethod
+    def GetMaxThreads() -> int:
+        if ThreadBudget._MaxThreads is None:
+            ThreadBudget._MaxThreads = ThreadBudget._ComputeMaxThreads(None)
+        return ThreadBudget._MaxThreads
+
+
+    # Tries to take a slot for a thread. If required is False, this returns False if the budget is used.
+    # Every successful call must have a matching Release() call, when the thread exits or if it fails to start.
+    @staticmethod
+    def TryAcquire(origin:str, required:bool = False) -> bool:
+        maxThreads = ThreadBudget.GetMaxThreads()
+        with ThreadBudget._Lock:
+            # Required threads count against the budget as well, so optional threads can't starve them.
+            if required or ThreadBudget._GetTrackedCount() < maxThreads:
+                ThreadBudget._Census[origin] = ThreadBudget._Census.get(origin, 0) + 1
+                return True
+            ThreadBudget._RefusedCount += 1
+            refusedCount = ThreadBudget._RefusedCount
+        # Log outside of the lock, but don't spam the log if we are refusing a lot.
+        if ThreadBudget._Logger is not None and (refusedCount < 10 or refusedCount % 100 == 0):
+            ThreadBudget._Logger.warn(f"Thread budget of {maxThreads} is used, a thread was refused. Total refused: {refusedCount}")
+        return False
+
+
+    @staticmethod
+    def Release(origin:str) -> None:
+        with ThreadBudget._Lock:
+            count = ThreadBudget._Census.get(origin, 0) - 1
+            if count <= 0:
+                ThreadBudget._Census.pop(origin, None)
+            else:
+                ThreadBudget._Census[origin] = count
+
+
+    # Creates and starts a thread that's counted in the budget and census.
+    # If the thread is optional and the budget is used, or the OS refuses to create the thread, this returns None.
+    # Required threads raise the OS error just like threading.Thread.start() would.
+    @staticmethod
+    def StartThread(origin:str, target, args:tuple = (), name:str = None, daemon:bool = None, required:bool = True) -> threading.Thread:
+        if ThreadBudget.TryAcquire(origin, required) is False:
+            return None
+        def threadWrapper():
+            try:
+                target(*args)
+            finally:
+                ThreadBudget.Release(origin)
+        t = threading.Thread(target=threadWrapper, name=name if name is not None else origin, daemon=daemon)
+        try:
+            t.start()
+        except RuntimeError as e:
+            ThreadBudget.Release(origin)
+            if required:
+                raise
+            if ThreadBudget._Logger is not None:
+                ThreadBudget._Logger.warn(f"Failed to start optional thread {origin}. {e}")
+            return None
+        return t
+
+
+    # Returns a dict of origin -> live thread count, including threads we didn't create as "Untracked".
+    @staticmethod
+    def GetCensus() -> dict:
+        with ThreadBudget._Lock:
+            census = dict(ThreadBudget._Census)
+            tracked = ThreadBudget._GetTrackedCount()
+        census["Untracked"] = max(0, threading.active_count() - tracked)
+        return census
+
+
+    # Returns a single line string of the budget and census, for logging.
+    @staticmethod
+    def GetCensusStr() -> str:
+        census = ThreadBudget.GetCensus()
+        total = 0
+        for c in census.values():
+            total += c
+        items = sorted(census.items(), key=lambda i: i[1], reverse=True)
+        return f"Threads {total}/{ThreadBudget.GetMaxThreads()} (refused {ThreadBudget._RefusedCount}) - " + ", ".join(f"{k}:{v}" for k, v in items)
+
+
+    # Must be called under lock.
+    @staticmethod
+    def _GetTrackedCount() -> int:
+        total = 0
+        for c in ThreadBudget._Census.values():
+            total += c
+        return total
+
+
+    @staticmethod
+    def _ComputeMaxThreads(logger:logging.Logger) -> int:
+        limits = {}
+        try:
+            # The room that's left in the cgroup. This is computed when we start, so the threads that already exist are in pids.current.
+            pidsMax, pidsCurrent = ThreadBudget._GetCgroupPidsLimit()
+            if pidsMax is not None:
+                limits["cgroup"] = pidsMax - pidsCurrent
+        except Exception as e:
+            if logger is not None:
+                logger.debug(f"ThreadBudget failed to read the cgroup limit. {e}")
+        try:
+            import resource #pylint: disable=import-outside-toplevel
+            soft, _ = resource.getrlimit(resource.RLIMIT_NPROC)
+            if soft != resource.RLIM_INFINITY and soft > 0:
+                limits["nproc"] = int(soft * ThreadBudget.c_NprocShare)
+        except Exception as e:
+            if logger is not None:
+                logger.debug(f"ThreadBudget failed to read the nproc limit. {e}")
+        try:
+            with open("/proc/meminfo", "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        availableBytes = int(line.split()[1]) * 1024
+                        limits["memory"] = int(availableBytes * ThreadBudget.c_MemoryShare / ThreadBudget.c_PerThreadMemoryBytes)
+                        break
+        except Exception as e:
+            if logger is not None:
+                logger.debug(f"ThreadBudget failed to read the available memory. {e}")
+
+        maxThreads = ThreadBudget.c_DefaultMaxThreads
+        limitedBy = "default"
+        for name, value in limits.items():
+            if value - ThreadBudget.c_ReservedThreads < maxThreads:
+                maxThreads = value - ThreadBudget.c_ReservedThreads
+                limitedBy = name
+        maxThreads = max(ThreadBudget.c_MinThreads, maxThreads)
+        if logger is not None:
+            logger.info(f"Thread budget set to {maxThreads} threads, limited by {limitedBy}. Limits: {limits}")
+        return maxThreads
+
+
+    # Returns the (pids.max, pids.current) for our cgroup, or (None, None) if there's no limit.
+    # The limit applies to the whole tree, so we check each parent cgroup as well and use the one with the least room.
+    @staticmethod
+    def _GetCgroupPidsLimit():
+        with open("/proc/self/cgroup", "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        groupDir = None
+        for line in lines:
+            # Each line is hierarchy-id:controllers:path. For cgroup v1 the pids controller has its own hierarchy, v2 is the single 0:: line.
+            parts = line.split(":", 2)
+            if len(parts) != 3:
+                continue
+            if "pids" in parts[1].split(","):
+                groupDir = os.path.join("/sys/fs/cgroup/pids", parts[2].lstrip("/"))
+                break
+            if parts[0] == "0" and parts[1] == "" and groupDir is None:
+                groupDir = os.path.join("/sys/fs/cgroup", parts[2].lstrip("/"))
+        if groupDir is None:
+            return (None, None)
+
+        bestRoom = None
+        result = (None, None)
+        while groupDir.startswith("/sys/fs/cgroup"):
+            maxPath = os.path.join(groupDir, "pids.max")
+            if os.path.exists(maxPath):
+                with open(maxPath, "r", encoding="utf-8") as f:
+                    maxStr = f.read().strip()
+                if maxStr != "max":
+                    with open(os.path.join(groupDir, "pids.current"), "r", encoding="utf-8") as f:
+                        current = int(f.read().strip())
+                    room = int(maxStr) - current
+                    if bestRoom is None or room < bestRoom:
+                        bestRoom = room
+                        result = (int(maxStr), current)
+            parent = os.path.dirname(groupDir)
+            if parent == groupDir:
+                break
+            groupDir = parent
+        return result
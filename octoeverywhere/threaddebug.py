@@ -1,16 +1,16 @@
-import threading
 import logging
 import time
 import sys
 import traceback
 
+from .threadbudget import ThreadBudget
+
 
 class ThreadDebug:
 
     def Start(self, logger, delaySec):
         try:
-            th = threading.Thread(target=self.threadWorker, args=(logger, delaySec))
-            th.start()
+            ThreadBudget.StartThread("ThreadDebug", self.threadWorker, args=(logger, delaySec))
         except Exception as e:
             logger.error("Failed to start Thread Debug Thread: "+str(e))
 
@@ -29,6 +29,7 @@ class ThreadDebug:
     def DoThreadDumpLogout(logger:logging.Logger):
         try:
             logger.info("ThreadDump - Starting Thread Dump")
+            ThreadDebug.LogThreadCensus(logger)
             # pylint: disable=protected-access
             for threadId, stack in sys._current_frames().items():
                 trace = ""
@@ -43,3 +44,12 @@ class ThreadDebug:
                 logger.info("ThreadDump- Id: "+str(threadId) + " -> "+str(trace))
         except Exception as e:
             logger.error("Exception in ThreadDebug : "+str(e))
+
+
+    # Logs how many threads are running by where they were created, and how much of the thread budget is used.
+    @staticmethod
+    def LogThreadCensus(logger:logging.Logger):
+        try:
+            logger.info("ThreadCensus - "+ThreadBudget.GetCensusStr())
+        except Exception as e:
+            logger.error("Exception in ThreadDebug census : "+str(e))
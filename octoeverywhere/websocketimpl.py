@@ -1,14 +1,24 @@
 import queue
+import time
+import struct
 import threading
 import certifi
 import octowebsocket
 from octowebsocket import WebSocketApp
 
 from .sentry import Sentry
+from .threadbudget import ThreadBudget
+from .boundedexecutor import Executors
 
 # This class gives a bit of an abstraction over the normal ws
 class Client:
 
+    # Used to estimate how long the data in the socket buffer will take to send.
+    c_InitialSendRateBytesPerSec = 1024 * 1024
+    c_MinSendRateBytesPerSec = 32 * 1024
+    c_SendRateWindowSec = 0.25
+    c_BusySocketUnackedBytes = 64 * 1024
+
     def __init__(self, url, onWsOpen = None, onWsMsg = None, onWsData = None, onWsClose = None, onWsError = None, headers:dict = None, subProtocolList:list = None):
 
         # Set the default timeout for the socket. There's no other way to do this than this global var, and it will be shared by all websockets.
@@ -29,6 +39,17 @@ class Client:
         # We use a send queue thread because it allows us to process downloads about 2x faster.
         # This is because the downstream work of the WS can be made faster if it's done in parallel
         self.SendQueue = queue.Queue()
+        # How many bytes are in the send queue, so callers can limit how much is buffered.
+        self.SendQueueBytes = 0
+        self.SendQueueBytesLock = threading.Lock()
+        # How long the last message waited in the send queue before it was written to the socket.
+        self.LastSendQueueDelaySec = 0.0
+        # Used to estimate how fast the socket is sending, so we know how long the data in the socket buffer will take to send.
+        self.SentBytes = 0
+        self.SendRateBytesPerSec = Client.c_InitialSendRateBytesPerSec
+        self.SendRateWindowStartSec = 0.0
+        self.SendRateWindowStartBytes = 0
+        self.CanGetSocketUnackedBytes = True
         self.SendThread:threading.Thread = None
 
         # Used to log more details about what's going on with the websocket.
@@ -110,8 +131,7 @@ class Client:
             # Start the send queue thread if it hasn't been started.
             # Do this in the try block, so if we fail to start the thread the error is handled.
             if self.SendThread is None:
-                self.SendThread = threading.Thread(target=self._SendQueueThread, daemon=True)
-                self.SendThread.start()
+                self.SendThread = ThreadBudget.StartThread("WebsocketSend", self._SendQueueThread, daemon=True)
 
             # Do validation on the ping interval and timeout.
             # The API requires the timeout be less than the interval.
@@ -139,9 +159,7 @@ class Client:
 
     # Runs the websocket async.
     def RunAsync(self):
-        t = threading.Thread(target=self.RunUntilClosed, args=())
-        t.daemon = True
-        t.start()
+        ThreadBudget.StartThread("Websocket", self.RunUntilClosed, daemon=True)
 
 
     # Closes the websocket.
@@ -205,8 +223,7 @@ class Client:
         # To prevent locking issues or other issues, spin off a thread to fire the callback.
         # This prevents the case where send() fires the callback, we don't want to overlap the
         # send path callback.
-        callbackThread = threading.Thread(target=self.fireWsErrorCallbackThread, args=(exception, ))
-        callbackThread.start()
+        Executors.Callback(self.fireWsErrorCallbackThread, exception)
 
 
     def fireWsErrorCallbackThread(self, exception):
@@ -247,7 +264,10 @@ class Client:
             # Make sure we have a buffer, this is invalid and it will also shutdown our send thread.
             if buffer is None:
                 raise Exception("We tired to send a message to the websocket with a None buffer.")
-            self.SendQueue.put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode))
+            context = SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode)
+            with self.SendQueueBytesLock:
+                self.SendQueueBytes += context.SizeBytes
+            self.SendQueue.put(context)
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -267,6 +287,10 @@ class Client:
                 # The frame masking was only need back when websockets were used over the internet without SSL.
                 # Our server, OctoPrint, and Moonraker all accept unmasked frames, so its safe to do this for all WS.
                 self.Ws.send(context.Buffer, context.OptCode, False, context.MsgStartOffsetBytes, context.MsgSize)
+                self.LastSendQueueDelaySec = time.time() - context.QueuedTimeSec
+                self.SentBytes += context.SizeBytes
+                with self.SendQueueBytesLock:
+                    self.SendQueueBytes -= context.SizeBytes
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -278,6 +302,71 @@ class Client:
 
 
 
+    # Returns how many bytes are in the send queue waiting to be written to the socket.
+    def GetSendQueueBytes(self) -> int:
+        return self.SendQueueBytes
+
+
+    # Returns about how long a message sent now would take to get to the other side.
+    # This is used as a backpressure signal, so senders like webcam streams can slow down when the link can't keep up.
+    #
+    # There are two parts:
+    #   - How long messages wait in our send queue. This is the larger of how long the last sent message waited and how long the oldest
+    #     queued message has been waiting, so it goes up as soon as the queue starts backing up.
+    #   - How long the data the OS has buffered for the socket but the other side hasn't acked will take to send. The socket buffer can hold
+    #     seconds of data on a slow link, and writes don't block until it's full, so without this the queue delay shows up late.
+    def GetSendQueueDelaySec(self) -> float:
+        now = time.time()
+        delaySec = self.LastSendQueueDelaySec
+        isQueueBackedUp = False
+        try:
+            # Peeking at the queue without the lock is fine, worst case the item was just removed.
+            oldest = self.SendQueue.queue[0]
+            if oldest is not None:
+                isQueueBackedUp = True
+                delaySec = max(delaySec, now - oldest.QueuedTimeSec)
+        except IndexError:
+            pass
+
+        unackedBytes = self._GetSocketUnackedBytes()
+        # Only update the send rate when the link is busy, otherwise we would measure how much we are sending, not how much we can send.
+        if isQueueBackedUp or unackedBytes > Client.c_BusySocketUnackedBytes:
+            elapsedSec = now - self.SendRateWindowStartSec
+            if elapsedSec > 2.0:
+                # The window is stale, start a new one.
+                self.SendRateWindowStartSec = now
+                self.SendRateWindowStartBytes = self.SentBytes
+            elif elapsedSec >= Client.c_SendRateWindowSec:
+                rate = (self.SentBytes - self.SendRateWindowStartBytes) / elapsedSec
+                self.SendRateBytesPerSec = max(Client.c_MinSendRateBytesPerSec, self.SendRateBytesPerSec * 0.7 + rate * 0.3)
+                self.SendRateWindowStartSec = now
+                self.SendRateWindowStartBytes = self.SentBytes
+        if unackedBytes > 0:
+            delaySec += unackedBytes / self.SendRateBytesPerSec
+        return delaySec
+
+
+    # Returns the number of bytes in the socket's send buffer that the other side hasn't acked yet, or 0 if it's not known.
+    # This is only supported on linux.
+    def _GetSocketUnackedBytes(self) -> int:
+        if self.CanGetSocketUnackedBytes is False:
+            return 0
+        try:
+            #pylint: disable=import-outside-toplevel
+            import fcntl
+            import termios
+        except Exception:
+            self.CanGetSocketUnackedBytes = False
+            return 0
+        try:
+            wsSock = self.Ws.sock
+            if wsSock is None or wsSock.sock is None:
+                return 0
+            return struct.unpack("I", fcntl.ioctl(wsSock.sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+        except Exception:
+            return 0
+
+
     # Support using with:
     def __enter__(self):
         return self
@@ -338,3 +427,7 @@ class SendQueueContext():
         self.MsgStartOffsetBytes = msgStartOffsetBytes
         self.MsgSize = msgSize
         self.OptCode = optCode
+        self.QueuedTimeSec = time.time()
+        self.SizeBytes = 0
+        if buffer is not None:
+            self.SizeBytes = msgSize if msgSize is not None else len(buffer)
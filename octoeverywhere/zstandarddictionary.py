@@ -4,12 +4,68 @@ import random
 import base64
 import logging
 
-# A helper classed used for training the zstandard lib pre made dictionary.
-# This is only used for training the dictionary, so it's not used in the main code.
+
+# The kinds of payloads we can have a dedicated dictionary for.
+# Each of these has very different data in it, so a dictionary trained on one kind compresses it much better than the general dictionary.
+class ZStandardPayloadClass:
+    Default = 0
+    # Moonraker and Elegoo websocket JSON messages.
+    JsonRpcStream = 1
+    # OctoPrint SockJS websocket messages.
+    SockJsStream = 2
+    # HTML, JS and CSS files for the web frontends.
+    WebAsset = 3
+    # JSON http responses, like the printer status and file lists.
+    StatusJson = 4
+
+
+    # Returns the payload class for a websocket path.
+    @staticmethod
+    def FromWebsocketPath(path:str) -> int:
+        if path is None:
+            return ZStandardPayloadClass.Default
+        pathLower = path.lower()
+        if pathLower.find("sockjs") != -1:
+            return ZStandardPayloadClass.SockJsStream
+        if pathLower.find("websocket") != -1:
+            return ZStandardPayloadClass.JsonRpcStream
+        return ZStandardPayloadClass.Default
+
+
+    # Returns the payload class for a http response content type.
+    @staticmethod
+    def FromContentType(contentTypeLower:str) -> int:
+        if contentTypeLower is None:
+            return ZStandardPayloadClass.Default
+        if contentTypeLower.find("json") != -1:
+            return ZStandardPayloadClass.StatusJson
+        if contentTypeLower.find("html") != -1 or contentTypeLower.find("javascript") != -1 or contentTypeLower.find("css") != -1:
+            return ZStandardPayloadClass.WebAsset
+        return ZStandardPayloadClass.Default
+
+
+# Manages the zstandard dictionaries.
+#
+# There's always the pre-trained dictionary (id 1), which the service has and all payloads can use. There can also be one dictionary per payload class,
+# which must be built into the plugin and the service, like the pre-trained dictionary, see c_ClassDicts. The ids of all of the dictionaries we have are sent in the handshake syn, and the service
+# replies with the ids it also has in the handshake ack. Both sides must have the same dictionary, so a class dictionary is only used if the service accepted it,
+# otherwise that class uses the pre-trained dictionary.
+#
+# The dictionary id is written into each zstandard frame, so when we decompress we use the dictionary the frame was compressed with.
+#
+# This also has the dev only logic used to build the pre-trained dictionary.
 class ZStandardDictionary:
 
     _Instance = None
 
+    # The id of the pre-trained dictionary, this must match the service.
+    c_PreTrainedDictId = 1
+
+    # The built in dictionaries for the payload classes, as payload class -> (dict id, base64 encoded dict data).
+    # Each one must also be built into the service with the same id, or the service won't accept it in the handshake.
+    # There are none yet, so every payload class uses the pre-trained dictionary, and the handshake only offers the pre-trained dictionary.
+    c_ClassDicts = {}
+
     # These are only used for dev building.
     _TrainingPath = "/home/pi/zstandard-training-samples"
     _OutputDictFilePath = "/home/pi/zstandard-gen-dict-base64.data"
@@ -32,27 +88,84 @@ class ZStandardDictionary:
         # This will be None if we aren't using zstandard in this runtime.
         self.PreTrainedDict = None
 
+        # All of the dictionaries we have loaded, by dict id. Dictionaries are only ever added, so a stream that's using one can always find it.
+        self.Dicts = {}
+        # The dictionary id for each payload class that has its own dictionary.
+        self.ClassDictIds = {}
+        # The ids the service accepted in the handshake. This is replaced, not edited, so it can be read without a lock.
+        self.AcceptedDictIds = frozenset([ZStandardDictionary.c_PreTrainedDictId])
+
 
     # The check for zstandard lib must be made before we can call this, but if we are using zstandard, we must load this dict.
     def InitPreComputedDict(self):
         # To make things easier, we include the dict in the source code as a based64 encoded string.
         # This prevents us from doing any kind of file IO or network calls to load the dict.
-        dictData = base64.b64decode(ZStandardDictionary.c_Dict1)
+        localDict = ZStandardDictionary._LoadDict(ZStandardDictionary.c_Dict1)
 
+        # Success! We are using the pre-trained dict, so set it.
+        self.PreTrainedDict = localDict
+        self.Dicts[ZStandardDictionary.c_PreTrainedDictId] = localDict
+        self.Logger.info(f"ZStandard Dict Training loaded. Data Length:{len(self.PreTrainedDict.as_bytes())} DictID:{self.PreTrainedDict.dict_id()}")
+
+        # Load the payload class dictionaries. If one fails to load, that class just uses the pre-trained dictionary.
+        for payloadClass, (dictId, dictBase64) in ZStandardDictionary.c_ClassDicts.items():
+            try:
+                if dictId == ZStandardDictionary.c_PreTrainedDictId or dictId in self.Dicts:
+                    raise Exception(f"Dict id {dictId} is already used")
+                self.Dicts[dictId] = ZStandardDictionary._LoadDict(dictBase64)
+                self.ClassDictIds[payloadClass] = dictId
+            except Exception as e:
+                self.Logger.error(f"ZStandard Dict failed to load the dictionary for payload class {payloadClass}. Error: {e}")
+
+
+    # Loads and pre-computes a dictionary from the base64 encoded data.
+    @staticmethod
+    def _LoadDict(dictBase64:str):
         # We can input zlib, because this class is only inited when the compression class has already checked for zlib support.
         #pylint: disable=import-outside-toplevel,unused-import
         import zstandard as zstd
 
         # Load the dict from the data.
-        localDict = zstd.ZstdCompressionDict(dictData, dict_type=zstd.DICT_TYPE_FULLDICT)
+        localDict = zstd.ZstdCompressionDict(base64.b64decode(dictBase64), dict_type=zstd.DICT_TYPE_FULLDICT)
 
         # Doing pre-compute now makes it so we don't have to use compute the dict on first use.
         # We must specify a level, so we use the same level we use elsewhere, which is the default of 3.
         localDict.precompute_compress(level=3)
+        return localDict
 
-        # Success! We are using the pre-trained dict, so set it.
-        self.PreTrainedDict = localDict
-        self.Logger.info(f"ZStandard Dict Training loaded. Data Length:{len(self.PreTrainedDict.as_bytes())} DictID:{self.PreTrainedDict.dict_id()}")
+
+    # Returns the ids of all of the dictionaries we can use, to be sent in the handshake syn.
+    def GetDictIds(self) -> list:
+        return list(self.Dicts.keys())
+
+
+    # Called when a new connection to the service starts, before the handshake syn is sent.
+    def OnHandshakeStarting(self) -> None:
+        self.AcceptedDictIds = frozenset([ZStandardDictionary.c_PreTrainedDictId])
+
+
+    # Called with the dictionary ids the service accepted in the handshake ack.
+    def OnHandshakeAccepted(self, acceptedDictIds:list) -> None:
+        accepted = set([ZStandardDictionary.c_PreTrainedDictId])
+        for dictId in acceptedDictIds:
+            if dictId in self.Dicts:
+                accepted.add(dictId)
+        self.AcceptedDictIds = frozenset(accepted)
+        if len(accepted) > 1:
+            self.Logger.info(f"ZStandard Dict the service accepted the class dictionaries {sorted(accepted)}")
+
+
+    # Returns the dictionary id to compress this payload class with.
+    def GetDictIdForPayloadClass(self, payloadClass:int) -> int:
+        dictId = self.ClassDictIds.get(payloadClass, None)
+        if dictId is not None and dictId in self.AcceptedDictIds:
+            return dictId
+        return ZStandardDictionary.c_PreTrainedDictId
+
+
+    # Returns the dictionary for the id, or None if we don't have it.
+    def GetDict(self, dictId:int):
+        return self.Dicts.get(dictId, None)
 
 
     # DEV ONLY
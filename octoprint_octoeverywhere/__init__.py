@@ -26,6 +26,8 @@ from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.commandhandler import CommandHandler
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.compat import Compat
+from octoeverywhere.threadbudget import ThreadBudget
+from octoeverywhere.boundedexecutor import Executors
 
 
 from .printerstateobject import PrinterStateObject
@@ -34,6 +36,7 @@ from .octoprintwebcamhelper import OctoPrintWebcamHelper
 from .localauth import LocalAuth
 from .slipstream import Slipstream
 from .smartpause import SmartPause
+from .gcodehooks import GcodeHooks
 
 class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
                             octoprint.plugin.SettingsPlugin,
@@ -51,6 +54,8 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         # Default the handler to None since that will make the var name exist
         # but we can't actually create the class yet until the system is more initialized.
         self.NotificationHandler = None
+        # The gcode received and sent hooks, which are registered when the plugin loads, but do nothing until we start them.
+        self.GcodeHooks = GcodeHooks()
         # Init member vars
         self.octoKey = ""
         # Indicates if OnStartup has been called yet.
@@ -156,6 +161,9 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         # Report the current setup.
         self._logger.info("OctoPrint host:" +str(self.OctoPrintLocalHost) + " port:" + str(self.OctoPrintLocalPort))
 
+        # Setup the thread budget and the shared executors before anything starts threads.
+        Executors.Init(self._logger)
+
         # Setup the HttpSession cache early, so it can be used whenever
         HttpSessions.Init(self._logger)
 
@@ -211,6 +219,9 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         self.NotificationHandler.SetPrinterId(printerId)
         printerStateObject.SetNotificationHandler(self.NotificationHandler)
 
+        # Now that we have the notification handler, the gcode hooks can start.
+        self.GcodeHooks.Start(self._logger, self.NotificationHandler)
+
         # Create our command handler and our platform specific command handler.
         CommandHandler.Init(self._logger, self.NotificationHandler, OctoPrintCommandHandler(self._logger, self._printer, printerStateObject, self), self)
 
@@ -218,8 +229,7 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         SmartPause.Init(self._logger, self._printer, self._printer_profile_manager.get_current_or_default())
 
         # Spin off a thread to try to resolve hostnames for logging and debugging.
-        resolverThread = threading.Thread(target=self.TryToPrintHostNameIps)
-        resolverThread.start()
+        Executors.IoMustRun(self.TryToPrintHostNameIps)
 
         # Indicate this has been called and things have been inited.
         self.HasOnStartupBeenCalledYet = True
@@ -229,9 +239,7 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
     def on_after_startup(self):
         # Spin off a thread for us to operate on.
         self._logger.info("After startup called. Starting worker thread.")
-        main_thread = threading.Thread(target=self.main)
-        main_thread.daemon = True
-        main_thread.start()
+        ThreadBudget.StartThread("OctoPrintMain", self.main, daemon=True)
 
         # Init slipstream - This must be inited after LocalAuth since it requires the auth key.
         # Is also must be done when the OctoPrint server is ready, since it's going to kick off a thread to
@@ -292,68 +300,8 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
 
 
     #
-    # Functions are for the gcode receive plugin hook
+    # Functions are for the gcode plugin hooks, the received and sent hooks are in GcodeHooks.
     #
-    def received_gcode(self, comm, line, *args, **kwargs):
-        # Blocking will block the printer commands from being handled so we can't block here!
-
-        if line and self.NotificationHandler is not None:
-            # ToLower the line for better detection.
-            lineLower = line.lower()
-
-            # M600 is a filament change command.
-            # https://marlinfw.org/docs/gcode/M600.html
-            # On my Pursa, I see this "fsensor_update - M600" AND this "echo:Enqueuing to the front: "M600""
-            # We check for this both in sent and received, to make sure we cover all use cases. The OnFilamentChange will only allow one notification to fire every so often.
-            # This m600 usually comes from when the printer sensor has detected a filament run out.
-            if "m600" in lineLower or "fsensor_update" in lineLower:
-                self._logger.info("Firing On Filament Change Notification From GcodeReceived: "+str(line))
-                # No need to use a thread since all events are handled on a new thread.
-                self.NotificationHandler.OnFilamentChange()
-            else:
-                # Look for a line indicating user interaction is needed.
-                if "paused for user" in lineLower or "// action:paused" in lineLower:
-                    self._logger.info("Firing On User Interaction Required From GcodeReceived: "+str(line))
-                    # No need to use a thread since all events are handled on a new thread.
-                    self.NotificationHandler.OnUserInteractionNeeded()
-
-        # We must return line the line won't make it to OctoPrint!
-        return line
-
-    def sent_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-        # Blocking will block the printer commands from being handled so we can't block here!
-
-        # M600 is a filament change command.
-        # https://marlinfw.org/docs/gcode/M600.html
-        # We check for this both in sent and received, to make sure we cover all use cases. The OnFilamentChange will only allow one notification to fire every so often.
-        # This M600 usually comes from filament change required commands embedded in the gcode, for color changes and such.
-        if self.NotificationHandler is not None and gcode and gcode == "M600":
-            self._logger.info("Firing On Filament Change Notification From GcodeSent: "+str(gcode))
-            # No need to use a thread since all events are handled on a new thread.
-            self.NotificationHandler.OnFilamentChange()
-
-        # Look for positive extrude commands, so we can keep track of them for final snap and our first layer tracking logic.
-        # Example cmd value: `G1 X112.979 Y93.81 E.03895`
-        if self.NotificationHandler is not None and gcode and cmd and gcode == "G1":
-            try:
-                indexOfE = cmd.find('E')
-                if indexOfE != -1:
-                    endOfEValue = cmd.find(' ', indexOfE)
-                    if endOfEValue == -1:
-                        endOfEValue = len(cmd)
-                    eValue = cmd[indexOfE+1:endOfEValue]
-                    # The value will look like one of these: -.333,1.33,.33
-                    # We don't care about negative values, so ignore them.
-                    if eValue[0] != '-':
-                        # If the value doesn't start with a 0, the float parse wil fail.
-                        if eValue[0] != '0':
-                            eValue = "0" + eValue
-                        # Now the value should be something like 1.33 or 0.33
-                        if float(eValue) > 0:
-                            self.NotificationHandler.ReportPositiveExtrudeCommandSent()
-            except Exception as e:
-                self._logger.debug("Failed to parse gcode %s, error %s", cmd, str(e))
-
     def queuing_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
         # Make sure smart pause is setup, since this can be called really early on startup.
         smartPause = SmartPause.Get()
@@ -550,8 +498,7 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
                 else:
                     # We want to show the finish setup message, but we only want to show it if the account is still unlinked.
                     # So we will kick off a new thread to make a http request to check before we show it.
-                    t = threading.Thread(target=self.CheckIfPrinterIsSetupAndShowMessageIfNot)
-                    t.start()
+                    Executors.IoMustRun(self.CheckIfPrinterIsSetupAndShowMessageIfNot)
 
 
     # Should be called on a non-main thread!
@@ -861,8 +808,8 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.accesscontrol.keyvalidator": __plugin_implementation__.key_validator,
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-        "octoprint.comm.protocol.gcode.received": __plugin_implementation__.received_gcode,
-        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.sent_gcode,
+        "octoprint.comm.protocol.gcode.received": __plugin_implementation__.GcodeHooks.OnGcodeReceived,
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.GcodeHooks.OnGcodeSent,
         "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.queuing_gcode,
         # We supply a int here to set our order, so we can be one of the first plugins to execute, to prevent issues.
         # The default order value is 1000
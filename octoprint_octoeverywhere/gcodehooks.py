@@ -0,0 +1,101 @@
+import time
+import logging
+
+from octoeverywhere.notificationshandler import NotificationsHandler
+
+
+# Handles the OctoPrint gcode received and sent hooks.
+#
+# These hooks are called on OctoPrint's comm thread for every line sent to and received from the printer, which is thousands of lines a minute
+# while printing, and the printer waits on them. So the common lines, like "ok" and temp reports, must be rejected with as little work as possible.
+# That's also why the plugin registers these functions as the hooks directly, rather than calling them from a plugin function.
+#
+# This is created before the plugin is started, so the hooks do nothing until Start() is called.
+class GcodeHooks:
+
+    # We only need to know an extrude happened recently, so we report it at most once per interval instead of for every G1.
+    c_ExtrudeReportIntervalSec = 0.25
+
+    def __init__(self) -> None:
+        self.Logger:logging.Logger = None
+        self.NotificationHandler:NotificationsHandler = None
+        self.NextExtrudeReportSec = 0.0
+
+
+    def Start(self, logger:logging.Logger, notificationHandler:NotificationsHandler) -> None:
+        self.Logger = logger
+        self.NotificationHandler = notificationHandler
+
+
+    # The octoprint.comm.protocol.gcode.received hook.
+    # Blocking will block the printer commands from being handled so we can't block here!
+    def OnGcodeReceived(self, comm, line, *args, **kwargs):
+        # We must return line the line won't make it to OctoPrint!
+        if not line or self.NotificationHandler is None:
+            return line
+
+        # Every line we look for has "600", "_", or a "u" in it, in any case. Most lines don't, like "ok" and the temp reports,
+        # so we can reject them without lower casing the line. These checks are faster than a single regex search, which is ~10x slower in CPython.
+        if "u" not in line and "U" not in line and "600" not in line and "_" not in line:
+            return line
+
+        # ToLower the line for better detection.
+        lineLower = line.lower()
+
+        # M600 is a filament change command.
+        # https://marlinfw.org/docs/gcode/M600.html
+        # On my Pursa, I see this "fsensor_update - M600" AND this "echo:Enqueuing to the front: "M600""
+        # We check for this both in sent and received, to make sure we cover all use cases. The OnFilamentChange will only allow one notification to fire every so often.
+        # This m600 usually comes from when the printer sensor has detected a filament run out.
+        if "m600" in lineLower or "fsensor_update" in lineLower:
+            self.Logger.info("Firing On Filament Change Notification From GcodeReceived: "+str(line))
+            # No need to use a thread since all events are handled on a new thread.
+            self.NotificationHandler.OnFilamentChange()
+        # Look for a line indicating user interaction is needed.
+        elif "paused for user" in lineLower or "// action:paused" in lineLower:
+            self.Logger.info("Firing On User Interaction Required From GcodeReceived: "+str(line))
+            # No need to use a thread since all events are handled on a new thread.
+            self.NotificationHandler.OnUserInteractionNeeded()
+        return line
+
+
+    # The octoprint.comm.protocol.gcode.sent hook.
+    # Blocking will block the printer commands from being handled so we can't block here!
+    def OnGcodeSent(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        if not gcode or self.NotificationHandler is None:
+            return
+
+        # Look for positive extrude commands, so we can keep track of them for final snap and our first layer tracking logic.
+        # This is by far the most common command, so it's checked first, and if we reported one recently we don't need to look at the command at all.
+        # Example cmd value: `G1 X112.979 Y93.81 E.03895`
+        if gcode == "G1":
+            if cmd and time.monotonic() >= self.NextExtrudeReportSec and GcodeHooks._HasPositiveEValue(cmd):
+                self.NextExtrudeReportSec = time.monotonic() + GcodeHooks.c_ExtrudeReportIntervalSec
+                self.NotificationHandler.ReportPositiveExtrudeCommandSent()
+            return
+
+        # M600 is a filament change command.
+        # https://marlinfw.org/docs/gcode/M600.html
+        # We check for this both in sent and received, to make sure we cover all use cases. The OnFilamentChange will only allow one notification to fire every so often.
+        # This M600 usually comes from filament change required commands embedded in the gcode, for color changes and such.
+        if gcode == "M600":
+            self.Logger.info("Firing On Filament Change Notification From GcodeSent: "+str(gcode))
+            # No need to use a thread since all events are handled on a new thread.
+            self.NotificationHandler.OnFilamentChange()
+
+
+    # Returns True if the command has an E value that's greater than 0, without parsing it as a float.
+    # The value will look like one of these: -.333, 1.33, .33, 0.000
+    @staticmethod
+    def _HasPositiveEValue(cmd:str) -> bool:
+        indexOfE = cmd.find('E')
+        if indexOfE == -1:
+            return False
+        endOfEValue = cmd.find(' ', indexOfE)
+        if endOfEValue == -1:
+            endOfEValue = len(cmd)
+        # We don't care about negative values, so ignore them.
+        if indexOfE + 1 >= endOfEValue or cmd[indexOfE+1] == '-':
+            return False
+        # The value is positive if it has any digit other than 0. Something like "E" or "E." isn't a number, so it's not positive either.
+        return len(cmd[indexOfE+1:endOfEValue].strip("+0.")) > 0
@@ -9,6 +9,8 @@ from octoeverywhere.WebStream.octoheaderimpl import HeaderHelper
 from octoeverywhere.WebStream.octoheaderimpl import BaseProtocol
 from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder
 from octoeverywhere.compression import Compression, CompressionContext
+from octoeverywhere.threadbudget import ThreadBudget
+from octoeverywhere.boundedexecutor import Executors
 
 from .localauth import LocalAuth
 
@@ -154,8 +156,11 @@ class Slipstream:
     # Starts a async thread to update the index cache.
     def UpdateCache(self, delayMs):
         try:
-            th = threading.Thread(target=self._UpdateCacheThread, args=(delayMs,))
-            th.start()
+            # If there's a delay, it runs on its own thread, so the sleep doesn't hold an io worker.
+            if delayMs > 0:
+                ThreadBudget.StartThread("SlipstreamRefresh", self._UpdateCacheThread, args=(delayMs,), daemon=True)
+            else:
+                Executors.IoMustRun(self._UpdateCacheThread, delayMs)
         except Exception as e:
             Sentry.Exception("Slipstream failed to start index refresh thread. ", e)
 
@@ -9,6 +9,14 @@ from octoeverywhere.compat import Compat
 #
 class SmartPause:
 
+    # The positioning mode commands we track, lower case, mapped to which mode they set.
+    c_PositioningModeCommands = {
+        "g90": "g9",
+        "g91": "g9",
+        "m82": "m8",
+        "m83": "m8",
+    }
+
     # The static instance.
     _Instance = None
 
@@ -206,15 +214,17 @@ class SmartPause:
     def OnGcodeQueuing(self, cmd):
         # We need to keep track of the current positioning modes so we can resume them
         # after we do the pause command.
-        if cmd is None:
+        # This is called for every command queued, so reject everything that's not 3 chars long
+        # before doing any other work, since all of the commands we look for are.
+        if cmd is None or len(cmd) != 3:
             return
 
         # Try to match the command. If we find it, use the exact command casing that was
         # originally sent.
-        cmdLower = cmd.lower()
-        if cmdLower == "g90" or cmdLower == "g91":
+        mode = SmartPause.c_PositioningModeCommands.get(cmd.lower(), None)
+        if mode == "g9":
             self.LastG9Command = cmd
-        if cmdLower == "m82" or cmdLower == "m83":
+        elif mode == "m8":
             self.LastM8Command = cmd
 
 
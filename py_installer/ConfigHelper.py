@@ -44,6 +44,8 @@ class ConfigHelper:
             # Write the new values
             c.SetStr(Config.RelaySection, Config.RelayFrontEndPortKey, portStr)
             c.SetStr(Config.RelaySection, Config.RelayFrontEndTypeHintKey, frontendHint_CanBeNone)
+            # Write the changes now, since the plugin will read the file.
+            c.Flush()
         except Exception as e:
             Logger.Error("Failed to write frontend details to config. "+str(e))
             raise Exception("Failed to write frontend details to config") from e
@@ -83,6 +85,8 @@ class ConfigHelper:
             # Write the new values
             c.SetStr(Config.SectionCompanion, Config.CompanionKeyIpOrHostname, ipOrHostname)
             c.SetStr(Config.SectionCompanion, Config.CompanionKeyPort, portStr)
+            # Write the changes now, since the plugin will read the file.
+            c.Flush()
         except Exception as e:
             Logger.Error("Failed to write companion details to config. "+str(e))
             raise Exception("Failed to write companion details to config") from e
@@ -123,6 +127,8 @@ class ConfigHelper:
             c.SetStr(Config.SectionBambu, Config.BambuPrinterSn, printerSn)
             # The installer can only setup local connections right now, which is preferred since cloud doesn't work well.
             c.SetStr(Config.SectionBambu, Config.BambuConnectionMode, Config.BambuConnectionModeDefault)
+            # Write the changes now, since the plugin will read the file.
+            c.Flush()
         except Exception as e:
             Logger.Error("Failed to write bambu details to config. "+str(e))
             raise Exception("Failed to write bambu details to config") from e
@@ -156,6 +162,8 @@ class ConfigHelper:
             c = ConfigHelper._GetConfig(context, createIfNotExisting=True)
             # Write the new values
             c.SetStr(Config.SectionElegoo, Config.ElegooMainboardMac, mainboardMac)
+            # Write the changes now, since the plugin will read the file.
+            c.Flush()
         except Exception as e:
             Logger.Error("Failed to write elegoo details to config. "+str(e))
             raise Exception("Failed to write elegoo details to config") from e
@@ -191,6 +199,8 @@ class ConfigHelper:
             c = ConfigHelper._GetConfig(context, createIfNotExisting=True)
             # Write the new values
             c.SetStr(Config.MoonrakerSection, Config.MoonrakerApiKey, apiKey, True)
+            # Write the changes now, since the plugin will read the file.
+            c.Flush()
         except Exception as e:
             Logger.Error("Failed to write moonraker details to config. "+str(e))
             raise Exception("Failed to write moonraker details to config") from e